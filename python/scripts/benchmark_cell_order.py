@@ -0,0 +1,185 @@
+'''Compare the hole-growing time of the ijk and morton orderings of the empty cells'''
+
+################################################################################
+#
+#   IMPORT MODULES
+#
+################################################################################
+
+
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import shutil
+import subprocess
+import time
+
+import numpy as np
+
+from voidfinder._voidfinder import CellIDGenerator, \
+                                   MortonCellIDGenerator, \
+                                   run_single_process_cython
+from voidfinder.voidfinder_functions import mesh_galaxies_grid
+
+
+################################################################################
+#
+#   USER INPUTS
+#
+################################################################################
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument('--num_galaxies', type=int, default=50000,
+                    help='number of uniformly distributed galaxies to grow holes in')
+
+parser.add_argument('--radius', type=float, default=200.,
+                    help='radius of the spherical survey in Mpc/h')
+
+parser.add_argument('--dl', type=float, default=5.,
+                    help='length of each grid cell in Mpc/h')
+
+parser.add_argument('--batch_size', type=int, default=1000,
+                    help='number of empty cells passed to main_algorithm at once')
+
+parser.add_argument('--order', choices=['ijk', 'morton'], default=None,
+                    help='time only this ordering; used for the runs under perf stat')
+
+args = parser.parse_args()
+
+
+GENERATORS = {'ijk' : CellIDGenerator,
+              'morton' : MortonCellIDGenerator}
+
+
+
+def time_ordering(cell_order):
+    '''
+    Grow all the holes with the empty cells in the given order and return the
+    wall time, the number of holes and the mean volume (in cells) of the
+    bounding box of each batch.
+    '''
+
+    rng = np.random.RandomState(42)
+
+    w_coord = rng.uniform(-args.radius, args.radius, size=(2*args.num_galaxies, 3))
+
+    w_coord = w_coord[np.linalg.norm(w_coord, axis=1) < args.radius][:args.num_galaxies]
+
+    coord_min = w_coord.min(axis=0).reshape(1,3)
+
+    ngrid = np.ceil((w_coord.max(axis=0) - coord_min[0])/args.dl).astype(int)
+
+    mask = np.ones((360, 180), dtype=bool)
+
+    occupied = mesh_galaxies_grid(w_coord, coord_min, args.dl, ngrid)
+
+    ############################################################
+    # Locality of the batches
+    ############################################################
+    cell_ID_gen = GENERATORS[cell_order](ngrid[0], ngrid[1], ngrid[2], occupied)
+
+    cell_IDs = cell_ID_gen.next_batch(len(cell_ID_gen))
+
+    batch_volumes = []
+
+    for start in range(0, len(cell_IDs), args.batch_size):
+
+        batch = cell_IDs[start:start + args.batch_size]
+
+        batch_volumes.append(np.prod(batch.max(axis=0) - batch.min(axis=0) + 1))
+
+    ############################################################
+    # Hole growing time
+    ############################################################
+    cell_ID_gen.reset()
+
+    start_time = time.time()
+
+    n_holes = run_single_process_cython(cell_ID_gen,
+                                        ngrid,
+                                        args.dl,
+                                        1.,
+                                        coord_min,
+                                        mask,
+                                        1,
+                                        0.,
+                                        args.radius,
+                                        w_coord,
+                                        batch_size=args.batch_size)[4]
+
+    return time.time() - start_time, n_holes, np.mean(batch_volumes)
+
+
+
+def perf_cache_misses(cell_order):
+    '''
+    Rerun this script for one ordering under perf stat and return its
+    (cache-misses, cache-references) counts, or None if perf is not available
+    or cannot read the counters.
+    '''
+
+    if shutil.which('perf') is None:
+
+        return None
+
+    command = ['perf', 'stat', '-x,', '-e', 'cache-misses,cache-references',
+               sys.executable] + sys.argv + ['--order', cell_order]
+
+    result = subprocess.run(command, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE,
+                            universal_newlines=True)
+
+    counts = {}
+
+    for line in result.stderr.splitlines():
+
+        fields = line.split(',')
+
+        if len(fields) > 2 and fields[0].isdigit():
+
+            counts[fields[2]] = int(fields[0])
+
+    if 'cache-misses' not in counts or 'cache-references' not in counts:
+
+        return None
+
+    return counts['cache-misses'], counts['cache-references']
+
+
+
+################################################################################
+#
+#   RUN BENCHMARK
+#
+################################################################################
+
+
+if args.order is not None:
+
+    time_ordering(args.order)
+
+    exit()
+
+
+for cell_order in ['ijk', 'morton']:
+
+    wall_time, n_holes, batch_volume = time_ordering(cell_order)
+
+    print(cell_order)
+    print('    wall time [s]:', wall_time)
+    print('    holes found:', n_holes)
+    print('    mean batch bounding box [cells]:', batch_volume)
+
+    counts = perf_cache_misses(cell_order)
+
+    if counts is None:
+
+        print('    cache misses: not available (needs perf with access to the hardware counters)')
+
+    else:
+
+        print('    cache misses:', counts[0], 'of', counts[1], 'references',
+              '({:.1%})'.format(counts[0]/counts[1]))
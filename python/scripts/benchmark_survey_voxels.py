@@ -0,0 +1,152 @@
+'''Compare the survey footprint checks of the angular mask with and without the survey voxels'''
+
+################################################################################
+#
+#   IMPORT MODULES
+#
+################################################################################
+
+
+import os
+import sys
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import argparse
+import time
+
+import numpy as np
+
+from voidfinder._voidfinder_cython import main_algorithm, points_in_survey, GalaxyTree
+from voidfinder.voidfinder_functions import build_survey_voxels
+
+
+################################################################################
+#
+#   USER INPUTS
+#
+################################################################################
+
+
+parser = argparse.ArgumentParser(description=__doc__)
+
+parser.add_argument('--num_galaxies', type=int, default=100000,
+                    help='number of uniformly distributed galaxies to grow holes in')
+
+parser.add_argument('--num_points', type=int, default=2000000,
+                    help='number of random points to check against the footprint')
+
+parser.add_argument('--rmin', type=float, default=10.,
+                    help='minimum distance of the survey in Mpc/h')
+
+parser.add_argument('--rmax', type=float, default=200.,
+                    help='maximum distance of the survey in Mpc/h')
+
+parser.add_argument('--dl', type=float, default=5.,
+                    help='length of each grid cell in Mpc/h')
+
+parser.add_argument('--voxel_size', type=float, default=5.,
+                    help='length of the side of each survey voxel in Mpc/h')
+
+args = parser.parse_args()
+
+
+################################################################################
+#
+#   SURVEY
+#
+#   A wedge of 160 degrees of ra by 70 of dec, with galaxies uniformly
+#   distributed inside it
+#
+################################################################################
+
+
+rng = np.random.RandomState(5)
+
+mask = np.zeros((360, 180), dtype=np.uint8)
+
+mask[100:260, 90:160] = 1
+
+w_coord = rng.uniform(-args.rmax, args.rmax, size=(8*args.num_galaxies, 3))
+
+in_survey = np.empty(w_coord.shape[0], dtype=np.uint8)
+
+points_in_survey(w_coord, mask, 1, args.rmin, args.rmax, in_survey)
+
+w_coord = w_coord[in_survey.astype(bool)][:args.num_galaxies]
+
+start_time = time.time()
+
+survey_voxels = build_survey_voxels(mask, 1, args.rmin, args.rmax, args.voxel_size)
+
+print('voxel grid', survey_voxels.states.shape)
+print('    build time [s]:', time.time() - start_time)
+
+for state, name in [(survey_voxels.INSIDE, 'inside'),
+                    (survey_voxels.OUTSIDE, 'outside'),
+                    (survey_voxels.BOUNDARY, 'boundary')]:
+
+    print('    fraction ' + name + ':', np.mean(survey_voxels.states == state))
+
+
+################################################################################
+#
+#   RUN BENCHMARK
+#
+################################################################################
+
+
+points = rng.uniform(-args.rmax, args.rmax, size=(args.num_points, 3))
+
+exact = np.empty(args.num_points, dtype=np.uint8)
+
+with_voxels = np.empty(args.num_points, dtype=np.uint8)
+
+start_time = time.time()
+
+points_in_survey(points, mask, 1, args.rmin, args.rmax, exact)
+
+exact_time = time.time() - start_time
+
+start_time = time.time()
+
+points_in_survey(points, mask, 1, args.rmin, args.rmax, with_voxels, survey_voxels)
+
+voxel_time = time.time() - start_time
+
+print('points_in_survey')
+print('    mask time [s]:', exact_time)
+print('    voxel time [s]:', voxel_time)
+print('    same answers:', np.array_equal(exact, with_voxels))
+
+
+coord_min = w_coord.min(axis=0).reshape(1,3)
+
+ngrid = np.ceil((w_coord.max(axis=0) - coord_min[0])/args.dl).astype(int)
+
+cells = np.indices(ngrid).reshape(3,-1).T.astype(np.int64)
+
+galaxy_tree = GalaxyTree(w_coord)
+
+for exact_search in [False, True]:
+
+    holes = {}
+
+    times = {}
+
+    for voxels in [None, survey_voxels]:
+
+        results = np.empty((cells.shape[0], 4), dtype=np.float64)
+
+        start_time = time.time()
+
+        main_algorithm(cells, galaxy_tree, args.dl, 1., coord_min, mask, 1, args.rmin,
+                       args.rmax, results, 0, 1, exact_search, None, voxels)
+
+        times[voxels is None] = time.time() - start_time
+
+        holes[voxels is None] = results
+
+    print('main_algorithm, exact_search =', exact_search)
+    print('    mask time [s]:', times[True])
+    print('    voxel time [s]:', times[False])
+    print('    same holes:', np.array_equal(holes[True], holes[False], equal_nan=True))
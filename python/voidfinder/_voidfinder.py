@@ -7,23 +7,39 @@
 
 import numpy as np
 
+import os
+
 import time
 
 from sklearn import neighbors
 
-from .voidfinder_functions import not_in_mask
+from scipy import ndimage
+
+from scipy.spatial import Delaunay
+
+from .voidfinder_functions import not_in_mask, points_in_mask, build_survey_voxels, SurveyVoxelGrid
+
+from .volume_cut import volume_cut
 
-from ._voidfinder_cython import main_algorithm
+from ._voidfinder_cython import main_algorithm, cells_in_survey, GalaxyTree, HoleGrowthWorkspace
 
-from multiprocessing import Queue, Process, cpu_count
+from multiprocessing import Queue, Process, Pipe, cpu_count, shared_memory
 
-from queue import Empty
+from multiprocessing.connection import wait
+
+from queue import Empty, SimpleQueue
+
+import threading
 
 from copy import deepcopy
 
 import pickle
 
-from astropy.table import Table
+import json
+
+import csv
+
+from astropy.table import Table, vstack
 
 from .table_functions import to_array
 
@@ -45,7 +61,21 @@ def _main_hole_finder(cell_ID_dict,
                       w_coord,
                       batch_size=1000,
                       verbose=False,
-                      num_cpus=1):
+                      num_cpus=1,
+                      use_threads=False,
+                      exact_search=False,
+                      single_precision=False,
+                      cell_order='ijk',
+                      min_radius=None,
+                      coordinator_address=None,
+                      shared_data_path=None,
+                      checkpoint_path=None,
+                      resume=False,
+                      telemetry_path=None,
+                      domain_cells=None,
+                      halo=75.,
+                      hole_stream=None,
+                      survey_voxel_size=None):
     '''
     Description:
     ============
@@ -58,11 +88,11 @@ def _main_hole_finder(cell_ID_dict,
     Parameters:
     ===========
     
-    cell_ID_dict : python dictionary
-        keys are tuples of (i,j,k) locations which correspond to a grid cell.
-        if the key (i,j,k) is in the dictionary, then that means there is at 
-        least 1 galaxy at the corresponding grid cell so we should pass over 
-        that grid cell since it isn't empty.
+    cell_ID_dict : numpy.ndarray of shape ngrid of bool, or python dictionary
+        occupancy grid, True in the grid cells which contain at least 1 
+        galaxy (see mesh_galaxies_grid), so we should pass over them since 
+        they aren't empty.  A dictionary whose keys are the (i,j,k) of those
+        cells is also accepted.
     
     ngrid : numpy.ndarray of shape (3,)
         the number of grid cells in each of the 3 x,y,z dimensions
@@ -94,7 +124,9 @@ def _main_hole_finder(cell_ID_dict,
         x,y,z coordinates of the galaxies used in building the query tree
 
     batch_size : scalar float
-        Number of empty cells to pass into each process.  Initialized to 1000.
+        Number of empty cells to pass into each process.  With several 
+        processes this is the largest batch, and the batches shrink towards
+        the end of the run (see AdaptiveBatchSizer).  Initialized to 1000.
 
     verbose : boolean
         Flag to determine whether or not to display status messages while 
@@ -103,6 +135,86 @@ def _main_hole_finder(cell_ID_dict,
     num_cpus : scalar float
         Number of CPUs to use in parallel.  Default is 1.  Set to None to use 
         maximum number of CPUs available.
+        
+    use_threads : boolean
+        If True, use num_cpus OpenMP threads inside a single process instead 
+        of num_cpus worker processes.  The threads share the galaxy tree and 
+        mask instead of each process holding its own copy.  Default is False.
+        
+    exact_search : boolean
+        If True, find each bounding galaxy exactly from the closed-form 
+        x_ratio of the candidates instead of stepping the hole center by dr, 
+        so the results no longer depend on dr.  Default is False.
+        
+    single_precision : boolean
+        If True, the galaxy tree stores the coordinates as float32, halving 
+        the memory each worker holds for them.  The geometry is still 
+        computed in float64; see GalaxyTree for the resulting bound on the
+        hole radii.  Default is False.
+        
+    cell_order : string
+        Order in which the empty cells are enumerated and batched.  'ijk' 
+        walks the grid row by row, so each batch is a thin strip of cells 
+        through the survey.  'morton' walks the grid along a Morton 
+        (Z-order) curve, so each batch is a compact block of cells whose 
+        queries touch the same parts of the galaxy tree.  The holes found 
+        are the same, only their order changes.  Default is 'ijk'.
+        
+    min_radius : scalar float
+        If not None, skip the empty cells whose hole cannot reach a radius of 
+        min_radius Mpc/h (see find_unproductive_cells), since holes that small
+        do not seed or join voids.  Only holes smaller than min_radius are 
+        lost.  Default is None (grow a hole in every empty cell).
+        
+    coordinator_address : tuple of (string, integer)
+        If not None, listen on this (host, port) and grow the holes on the 
+        worker processes which connect to it, possibly from other hosts 
+        (see distributed.py), instead of on this host.  num_cpus and 
+        use_threads are then ignored.  Default is None.
+        
+    shared_data_path : string
+        Path of the .npz file the galaxy coordinates and mask are written to 
+        for the distributed workers.  It must be readable from every worker 
+        host.  Only used with coordinator_address.  Default is None.
+        
+    checkpoint_path : string
+        If not None, append each finished batch of cells and its holes to 
+        this file as the run goes (see CheckpointLog).  The file is left in 
+        place at the end.  Default is None.
+        
+    resume : boolean
+        If True and checkpoint_path exists, keep the holes already recorded 
+        there, grow holes only in the cells it does not list, and append to 
+        it.  The grid and growth parameters must match the run which wrote 
+        it.  Default is False.
+        
+    telemetry_path : string
+        If not None, write the performance counters of the run and of each 
+        worker (see HoleGrowthTelemetry) to this file, as CSV if it ends in 
+        .csv and as JSON otherwise.  Default is None.
+        
+    domain_cells : integer
+        If not None, split the grid into domains of domain_cells cells on a 
+        side and grow the holes of each on a tree of only the galaxies within
+        halo Mpc/h of it (see run_decomposed), growing the few holes which 
+        outgrow their halo again on the full tree.  cell_order is then 
+        ignored.  Default is None.
+        
+    halo : float
+        Width in Mpc/h of the margin of galaxies around each domain, used 
+        with domain_cells.  Default is 75.
+        
+    hole_stream : HoleStream
+        If not None, each finished batch of holes (and those restored from 
+        the checkpoint) is also added to it as soon as it is found, so that 
+        the volume cut is done while the rest are grown.  Default is None.
+        
+    survey_voxel_size : float
+        If not None, cover the survey with voxels of this side in Mpc/h 
+        marked as inside, outside or on the edge of the survey (see 
+        build_survey_voxels), so that the hole growth checks most points 
+        against the footprint with one lookup instead of the angular mask.  
+        Default is None.
     
     
     
@@ -132,7 +244,119 @@ def _main_hole_finder(cell_ID_dict,
     
     
     #empty_cell_counter = 0
+    
+    occupied = occupancy_grid(ngrid, cell_ID_dict)
+    
+    ################################################################################
+    #
+    # Skip the cells which cannot grow a useful hole by treating them like the
+    # cells containing galaxies
+    #
+    ################################################################################
+    
+    ################################################################################
+    # The galaxy tree the pruning queries is kept for growing the holes
+    ################################################################################
+    
+    galaxy_tree = None
+    
+    if min_radius is not None:
+        
+        num_empty_cells = occupied.size - np.count_nonzero(occupied)
+        
+        galaxy_tree = GalaxyTree(w_coord, single_precision=single_precision)
+        
+        pruned_cells = find_unproductive_cells(occupied, 
+                                               ngrid, 
+                                               dl, 
+                                               coord_min, 
+                                               w_coord, 
+                                               galaxy_tree,
+                                               mask,
+                                               mask_resolution,
+                                               min_dist,
+                                               max_dist,
+                                               min_radius)
+        
+        occupied = occupied.copy()
+        
+        occupied[tuple(pruned_cells.T)] = True
+        
+        if verbose:
+            
+            print("Pruned", len(pruned_cells), "of", num_empty_cells, "empty cells which cannot grow a hole of radius", min_radius)
+        
+    ################################################################################
+    #
+    # Skip the cells already finished in the checkpoint being resumed, again 
+    # by treating them like the cells containing galaxies
+    #
+    ################################################################################
+    
+    telemetry = None
+    
+    if telemetry_path is not None:
+        
+        telemetry = HoleGrowthTelemetry()
+    
+    checkpoint = None
+    
+    if checkpoint_path is not None:
+        
+        checkpoint = CheckpointLog(checkpoint_path, ngrid, dl, dr, coord_min, min_dist, max_dist, resume=resume)
+        
+        if checkpoint.cells.shape[0] > 0:
+            
+            occupied = occupied.copy()
+            
+            occupied[tuple(checkpoint.cells.T)] = True
+            
+            if verbose:
+                
+                print("Resuming with", checkpoint.cells.shape[0], "cells already finished in", checkpoint_path)
+                
+            if hole_stream is not None:
+                
+                hole_stream.add(checkpoint.results)
+        
+    ################################################################################
+    #
+    # Skip the empty cells whose center is outside the survey, which cannot 
+    # hold a hole, once more by treating them like the cells containing 
+    # galaxies
+    #
+    ################################################################################
+    
+    occupied, num_skipped_cells = mark_cells_outside_survey(occupied, 
+                                                            dl, 
+                                                            coord_min, 
+                                                            mask,
+                                                            mask_resolution,
+                                                            min_dist,
+                                                            max_dist)
+    
+    ################################################################################
+    #
+    # Cover the survey with voxels for the footprint checks of the hole growth
+    #
+    ################################################################################
+    
+    survey_voxels = None
+    
+    if survey_voxel_size is not None:
+        
+        voxel_start_time = time.time()
         
+        survey_voxels = build_survey_voxels(mask, 
+                                            mask_resolution, 
+                                            min_dist, 
+                                            max_dist, 
+                                            survey_voxel_size)
+        
+        if verbose:
+            
+            print("Built", survey_voxels.states.shape, "survey voxels in", time.time() - voxel_start_time)
+    
     ################################################################################
     #
     # Pop all the relevant grid cell IDs onto the job queue
@@ -157,18 +381,88 @@ def _main_hole_finder(cell_ID_dict,
                     
                     #empty_cell_counter += 1
     '''
-    cell_ID_list = CellIDGenerator(ngrid[0], ngrid[1], ngrid[2], cell_ID_dict)
+    if cell_order == 'ijk':
+        
+        cell_ID_list = CellIDGenerator(ngrid[0], ngrid[1], ngrid[2], occupied)
+        
+    elif cell_order == 'morton':
+        
+        cell_ID_list = MortonCellIDGenerator(ngrid[0], ngrid[1], ngrid[2], occupied)
+        
+    else:
+        
+        raise ValueError("cell_order must be 'ijk' or 'morton', not " + repr(cell_order))
     #num_empty_cells = ngrid[0]*ngrid[1]*ngrid[2] - len(cell_ID_dict)
     
     if verbose:
         print("cell_ID_list finish time: ", time.time() - start_time)
-        print("Len cell_ID_dict (eliminated cells): ", len(cell_ID_dict))
+        print("Eliminated cells: ", np.count_nonzero(occupied))
+        print("Dispatching", len(cell_ID_list), "empty cells, skipped", num_skipped_cells, "outside the survey")
     
     ################################################################################
     # Run single or multi-processed
     ################################################################################
     
-    if isinstance(num_cpus, int) and num_cpus == 1:
+    if coordinator_address is not None:
+        
+        if shared_data_path is None:
+            
+            raise ValueError("shared_data_path is needed to run with a coordinator_address")
+        
+        from .distributed import run_distributed
+        
+        myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes = run_distributed(cell_ID_list, 
+                                                                              dl, 
+                                                                              dr,
+                                                                              coord_min, 
+                                                                              mask,
+                                                                              mask_resolution,
+                                                                              min_dist,
+                                                                              max_dist,
+                                                                              w_coord,
+                                                                              coordinator_address,
+                                                                              shared_data_path,
+                                                                              batch_size=batch_size,
+                                                                              verbose=verbose,
+                                                                              exact_search=exact_search,
+                                                                              single_precision=single_precision,
+                                                                              checkpoint=checkpoint,
+                                                                              telemetry=telemetry,
+                                                                              hole_stream=hole_stream,
+                                                                              survey_voxels=survey_voxels
+                                                                              )
+        
+    elif domain_cells is not None:
+        
+        myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes = run_decomposed(occupied, 
+                                                                             ngrid, 
+                                                                             dl, 
+                                                                             dr,
+                                                                             coord_min, 
+                                                                             mask,
+                                                                             mask_resolution,
+                                                                             min_dist,
+                                                                             max_dist,
+                                                                             w_coord,
+                                                                             domain_cells=domain_cells,
+                                                                             halo=halo,
+                                                                             batch_size=batch_size,
+                                                                             verbose=verbose,
+                                                                             num_cpus=num_cpus,
+                                                                             use_threads=use_threads,
+                                                                             exact_search=exact_search,
+                                                                             single_precision=single_precision,
+                                                                             checkpoint=checkpoint,
+                                                                             telemetry=telemetry,
+                                                                             hole_stream=hole_stream,
+                                                                             survey_voxels=survey_voxels
+                                                                             )
+        
+    elif use_threads or (isinstance(num_cpus, int) and num_cpus == 1):
+        
+        if num_cpus is None:
+            
+            num_cpus = cpu_count()
         
         #myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes = run_single_process(cell_ID_list, 
         myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes = run_single_process_cython(cell_ID_list, 
@@ -183,7 +477,14 @@ def _main_hole_finder(cell_ID_dict,
                                                                                    w_coord,
                                                                                    batch_size=batch_size,
                                                                                    verbose=verbose,
-                                                                                   num_cpus=num_cpus
+                                                                                   num_cpus=num_cpus if use_threads else 1,
+                                                                                   exact_search=exact_search,
+                                                                                   single_precision=single_precision,
+                                                                                   checkpoint=checkpoint,
+                                                                                   telemetry=telemetry,
+                                                                                   hole_stream=hole_stream,
+                                                                                   survey_voxels=survey_voxels,
+                                                                                   galaxy_tree=galaxy_tree
                                                                                    )
     else:
         
@@ -199,1458 +500,3476 @@ def _main_hole_finder(cell_ID_dict,
                                                                                    w_coord,
                                                                                    batch_size=batch_size,
                                                                                    verbose=verbose,
-                                                                                   num_cpus=num_cpus
+                                                                                   num_cpus=num_cpus,
+                                                                                   exact_search=exact_search,
+                                                                                   single_precision=single_precision,
+                                                                                   checkpoint=checkpoint,
+                                                                                   telemetry=telemetry,
+                                                                                   hole_stream=hole_stream,
+                                                                                   survey_voxels=survey_voxels,
+                                                                                   galaxy_tree=galaxy_tree
                                                                                    )
     
-    
-        
-    return myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes
-    
-    
-
-class CellIDGenerator(object):
-    
-    def __init__(self, grid_dim_1, grid_dim_2, grid_dim_3, cell_ID_dict):
-        
-        self.num_grid_1 = grid_dim_1
-        self.num_grid_2 = grid_dim_2
-        self.num_grid_3 = grid_dim_3
-        
-        self.i = -1
-        self.j = -1
-        self.k = -1
-        
-        self.cell_ID_dict = cell_ID_dict
-        
-    def reset(self):
-        
-        self.i = -1
-        self.j = -1
-        self.k = -1
-        
-    def __iter__(self):
+    if telemetry is not None:
         
-        return self
-    
-    def __next__(self):
+        wall_time = time.time() - start_time
         
-        found_valid = False
+        telemetry.run.update({'num_cells' : len(cell_ID_list),
+                              'num_cells_skipped' : num_skipped_cells,
+                              'num_holes' : int(n_holes),
+                              'wall_time' : wall_time,
+                              'cells_per_sec' : len(cell_ID_list)/wall_time,
+                              'holes_per_sec' : n_holes/wall_time})
         
-        while not found_valid:
-            
-            next_cell_ID = self.gen_cell_ID()
+        telemetry.write(telemetry_path)
         
-            if next_cell_ID not in self.cell_ID_dict:
-                
-                break
-            
-        return next_cell_ID
+    ################################################################################
+    # Add back the holes restored from the checkpoint
+    ################################################################################
     
-    def __len__(self):
-        
-        return self.num_grid_1*self.num_grid_2*self.num_grid_3 - len(self.cell_ID_dict)
-        
-        
-    def gen_cell_ID(self):
-        
-        inc_j = False
-        
-        if self.k >= (self.num_grid_3 - 1) or self.k < 0:
-            
-            inc_j = True
-        
-        inc_i = False
-        
-        if (inc_j and self.j >= (self.num_grid_2 - 1)) or self.j < 0:
-            
-            inc_i = True
-            
-            
-        #print(inc_i, self.i, self.j, self.k)
-            
-        self.k = (self.k + 1) % self.num_grid_3
-        
-        if inc_j:
-            
-            self.j = (self.j + 1) % self.num_grid_2
-            
-        if inc_i:
-            
-            self.i += 1
-            
-            if self.i >= self.num_grid_1:
-                
-                raise StopIteration    
-        
-        out_cell_ID = (self.i, self.j, self.k)
-        
-        return out_cell_ID
-        
+    if checkpoint is not None:
         
+        restored = compact_holes(checkpoint.results)
         
+        checkpoint.close()
         
+        myvoids_x = np.concatenate((restored[0], myvoids_x))
+        myvoids_y = np.concatenate((restored[1], myvoids_y))
+        myvoids_z = np.concatenate((restored[2], myvoids_z))
+        myvoids_r = np.concatenate((restored[3], myvoids_r))
         
+        n_holes += restored[4]
         
-        
-
-
+    return myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes
+    
+    
 
+def delaunay_hole_finder(w_coord,
+                         mask,
+                         mask_resolution,
+                         min_dist,
+                         max_dist,
+                         verbose=False):
+    '''
+    Description:
+    ============
     
-def run_single_process(cell_ID_list, 
-                       ngrid, 
-                       dl, 
-                       dr,
-                       coord_min, 
-                       mask,
-                       mask_resolution,
-                       min_dist,
-                       max_dist,
-                       w_coord,
-                       batch_size=1000,
-                       verbose=False,
-                       num_cpus=None):
+    Find the holes as the circumspheres of the Delaunay tetrahedralization 
+    of the galaxies, instead of growing a sphere in each empty cell.
     
+    Every empty sphere with four galaxies on its surface is the circumsphere
+    of a Delaunay tetrahedron, so this finds each hole that _main_hole_finder
+    can find exactly once, with no dependence on the grid or on dr.  The 
+    circumspheres whose centers lie outside the survey are dropped, as 
+    _main_hole_finder drops holes whose centers leave the survey.
     
     
     
+    Parameters:
+    ===========
     
+    w_coord : numpy.ndarray of shape (N,3)
+        x,y,z coordinates of the galaxies
+        
+    mask : numpy.ndarray of shape (N,M) type bool
+        represents the survey footprint in scaled ra/dec space.  Value of True 
+        indicates that a location is within the survey
+
+    mask_resolution : integer
+        Scale factor of coordinates needed to index mask
     
-    ################################################################################
-    #
-    # Profiling parameters
-    #
-    ################################################################################
+    min_dist : scalar
+        minimum redshift in units of Mpc/h
+        
+    max_dist : scalar
+        maximum redshift in units of Mpc/h
+        
+    verbose : boolean
+        Flag to determine whether or not to display status messages while 
+        running.  Default is False.
     
-    #PROFILE_total_query_time = 0.0
     
-    PROFILE_total_start = time.time()
     
-    #PROFILE_mask_checking_time = 0.0
+    Returns:
+    ========
     
-    PROFILE_mask_times = []
+    myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes : 
+        as returned by _main_hole_finder
+    '''
     
-    PROFILE_loop_times = []
+    start_time = time.time()
     
-    PROFILE_query_times = []
+    tetrahedra = Delaunay(w_coord).simplices
     
-    PROFILE_section_1_times = []
-    PROFILE_section_2_times = []
-    PROFILE_section_3_times = []
-    PROFILE_section_4_times = []
-    PROFILE_void_times = []
+    if verbose:
+        
+        print("Delaunay tetrahedralization time: ", time.time() - start_time)
+        print("Number of tetrahedra: ", tetrahedra.shape[0])
     
+    ################################################################################
+    # Solve 2*(v_i - v_0).(center - v_0) = |v_i - v_0|^2 for the circumcenter of
+    # every tetrahedron at once
+    ################################################################################
     
+    vertex_0 = w_coord[tetrahedra[:,0]]
     
+    edges = w_coord[tetrahedra[:,1:]] - vertex_0[:,np.newaxis,:]
     
     ################################################################################
-    #
-    # Initialize some output containers and counter variables
-    #
+    # Drop the (nearly) flat tetrahedra qhull leaves on the hull, whose 
+    # circumspheres are unbounded
     ################################################################################
     
-    print("Running single-process mode")
+    volume_scale = np.abs(np.linalg.det(edges))
     
-    #hole_times = []
+    edge_scale = np.max(np.sum(edges**2, axis=2), axis=1)**1.5
     
-    # Initialize list of hole details
-    myvoids_x = []
+    keep = volume_scale > 1e-10*edge_scale
     
-    myvoids_y = []
+    edges = edges[keep]
     
-    myvoids_z = []
+    vertex_0 = vertex_0[keep]
     
-    myvoids_r = []
+    offsets = np.linalg.solve(2*edges, np.sum(edges**2, axis=2)[:,:,np.newaxis])[:,:,0]
     
-    # Number of holes found
-    n_holes = 0
-
-    # Counter for the number of empty cells
-    empty_cell_counter = 0
+    centers = vertex_0 + offsets
     
-    # Number of empty cells
-    #n_empty_cells = ngrid[0]*ngrid[1]*ngrid[2] - len(cell_ID_dict)
-    n_empty_cells = len(cell_ID_list)
+    radii = np.linalg.norm(offsets, axis=1)
     
     ################################################################################
-    #
-    #   BUILD NEAREST-NEIGHBOR TREE
-    #   galaxy_tree : sklearn.neighbors/scipy KDTree or similar implementing sklearn interface
-    #   nearest neighbor finder for the galaxies in x,y,z space
-    #
+    # Keep the holes centered in the survey
     ################################################################################
     
+    in_survey = points_in_mask(centers, mask, mask_resolution, min_dist, max_dist)
+    
+    centers = centers[in_survey]
+    
+    radii = radii[in_survey]
+    
     if verbose:
         
-        kdtree_start_time = time.time()
-
-    galaxy_tree = neighbors.KDTree(w_coord)
+        print("Delaunay hole finding time: ", time.time() - start_time)
     
-    if verbose:
+    return centers[:,0], centers[:,1], centers[:,2], radii, centers.shape[0]
+    
+    
+    
+    
+def find_unproductive_cells(cell_ID_dict, 
+                            ngrid, 
+                            dl, 
+                            coord_min, 
+                            w_coord, 
+                            galaxy_tree,
+                            mask,
+                            mask_resolution,
+                            min_dist,
+                            max_dist,
+                            min_radius,
+                            chunk_cells=2**20):
+    '''
+    Description:
+    ============
+    
+    Find the empty cells whose hole provably cannot reach a radius of 
+    min_radius, using a Euclidean distance transform of the galaxy occupancy
+    grid.
+    
+    The hole grown from a cell always has that cell's nearest galaxy A on 
+    its surface, and it contains no galaxies.  With h = sqrt(3)/2*dl the 
+    distance from any point of a cell to its center, a hole of radius R 
+    centered in cell q touching A (in cell a) therefore satisfies
+    
+        EDT(q) >= R - 2h    and    |q - a| <= R + 2h <= EDT(q) + 4h
         
-        print('KDTree creation time:', time.time() - kdtree_start_time)
+    where EDT(q) is the distance from the center of q to the center of the 
+    nearest occupied cell.  If no cell q in the survey with 
+    EDT(q) >= min_radius - 2h lies within EDT(q) + 4h of a, no cell whose 
+    nearest galaxy is in a can grow a hole of min_radius.  The cells q are 
+    grouped into bands of EDT one cell wide, and each band marks the 
+    occupied cells in a cube around it, which only errs on the side of 
+    keeping cells.
     
+    A cell counts as in the survey if its center or any of its corners is,
+    and the hole centers are assumed to lie within the grid, which holds as 
+    they must lie within the survey.  Only the cells deep enough to matter 
+    are tested against the survey, and those tests and the nearest galaxy 
+    queries go chunk_cells cells of the grid at a time, so that besides the
+    EDT no array much larger than the occupancy grid is made.
     
-    ################################################################################
-    # Main loop
-    ################################################################################
-    num_cells_processed = 0
     
-    for hole_center_coords in cell_ID_list:
-                    
-        num_cells_processed += 1
+    Parameters:
+    ===========
+    
+    cell_ID_dict : numpy.ndarray of shape ngrid of bool, or python dictionary
+        occupancy grid of the cells containing at least one galaxy, as for 
+        _main_hole_finder
         
-        #print(hole_center_coords)
+    ngrid : numpy.ndarray of shape (3,)
+        the number of grid cells in each of the 3 x,y,z dimensions
+    
+    dl : scalar float
+        length of each cell in Mpc/h
         
+    coord_min : numpy.ndarray of shape (1,3)
+        minimum coordinates of the survey in x,y,z in Mpc/h
         
-        PROFILE_loop_start_time = time.time()
+    w_coord : numpy.ndarray of shape (N,3)
+        x,y,z coordinates of the galaxies
         
+    galaxy_tree : GalaxyTree
+        tree of w_coord, to find the nearest galaxy of each empty cell
         
-        if verbose:
-            
-            if num_cells_processed % 10000 == 0:
-                
-               print('Processed', num_cells_processed, 'cells of', n_empty_cells)
+    mask : numpy.ndarray of shape (N,M) type bool
+        represents the survey footprint in scaled ra/dec space
         
+    mask_resolution : integer
+        Scale factor of coordinates needed to index mask
+    
+    min_dist : scalar
+        minimum redshift in units of Mpc/h
         
-        #if num_cells_processed % 10000 == 0:
-        #    print("Processed: ", num_cells_processed, "time: ", time.time() - worker_lifetime_start, "main: ", time_main, "empty: ", time_empty)
+    max_dist : scalar
+        maximum redshift in units of Mpc/h
         
-            
-        i, j, k = hole_center_coords
+    min_radius : scalar float
+        smallest hole radius of interest in Mpc/h
         
-
-        hole_center = (np.array([[i, j, k]]) + 0.5)*dl + coord_min  # Purposefully making hole_center have shape (1,3) for KDtree queries
-                        
-        #hole_center = to_vector(hole_center_table)
+    chunk_cells : integer
+        Number of cells of the grid handled at a time.  Default is 2**20.
+    
+    
+    Returns:
+    ========
+    
+    pruned_cells : numpy.ndarray of shape (M,3) of int64
+        (i,j,k) of the empty cells which cannot grow a hole of min_radius
+    '''
+    
+    half_diagonal = 0.5*np.sqrt(3)*dl
+    
+    occupied = occupancy_grid(ngrid, cell_ID_dict)
+    
+    min_edt = min_radius - 2*half_diagonal
+    
+    if min_edt <= 0 or not occupied.any():
         
+        return np.empty((0,3), dtype=np.int64)
+    
+    edt = ndimage.distance_transform_edt(~occupied, sampling=dl)
+    
+    ############################################################
+    # Only cells in the survey can hold a hole center.  The 
+    # cells too shallow for a band are left alone, and each 
+    # corner is only tested for the cells not yet found in the
+    # survey.
+    ############################################################
+    flat_edt = edt.reshape(-1)
+    
+    corners = [(0.5, 0.5, 0.5)] + [(x, y, z) for x in (0,1) for y in (0,1) for z in (0,1)]
+    
+    for start in range(0, flat_edt.shape[0], chunk_cells):
         
-        ############################################################
-        # Check to make sure in mask
-        ############################################################
+        deep = np.flatnonzero(flat_edt[start:start + chunk_cells] >= min_edt) + start
         
-        timer1 = time.time()
-        temp = not_in_mask(hole_center, mask, mask_resolution, min_dist, max_dist)
-        timer2 = time.time()
-        PROFILE_mask_times.append(timer2- timer1)
-        # Check to make sure that the hole center is still within the survey
-        if temp:
+        cells = np.stack(np.unravel_index(deep, edt.shape), axis=1)
+        
+        in_survey = np.zeros(deep.shape[0], dtype=bool)
+        
+        for corner in corners:
             
-            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+            untested = np.flatnonzero(~in_survey)
             
-            continue
+            in_survey[untested] = points_in_mask((cells[untested] + corner)*dl + coord_min, 
+                                                 mask, 
+                                                 mask_resolution, 
+                                                 min_dist, 
+                                                 max_dist)
+            
+        flat_edt[deep[~in_survey]] = 0
+    
+    ############################################################
+    # Mark the occupied cells within reach of a deep enough 
+    # cell, one band of EDT values at a time
+    ############################################################
+    useful = np.zeros(tuple(ngrid), dtype=bool)
+    
+    band_min = min_edt
+    
+    while band_min <= edt.max():
         
+        band_max = band_min + dl
         
-        ############################################################
-        #
-        # Find Galaxy 1 (closest to cell center)
-        #
-        # and calculate Unit vector pointing from cell 
-        # center to the closest galaxy
-        #
-        ############################################################
-        PROFILE_1_start = time.time()
+        in_band = (edt >= band_min) & (edt < band_max)
         
+        if in_band.any():
+            
+            reach = int((band_max + 4*half_diagonal)//dl)
+            
+            useful |= ndimage.maximum_filter(in_band, size=2*reach + 1, mode='constant')
+            
+        band_min = band_max
+    
+    ############################################################
+    # Prune the empty cells whose nearest galaxy is not in a
+    # marked cell
+    ############################################################
+    flat_occupied = occupied.reshape(-1)
+    
+    pruned_cells = [np.empty((0,3), dtype=np.int64)]
+    
+    for start in range(0, flat_occupied.shape[0], chunk_cells):
         
-        timer1 = time.time()
-        modv1, k1g = galaxy_tree.query(hole_center, k=1)
-        timer2 = time.time()
-        PROFILE_query_times.append(timer2-timer1)
+        empty = np.flatnonzero(~flat_occupied[start:start + chunk_cells]) + start
         
-        modv1 = modv1[0][0]
+        empty_cells = np.stack(np.unravel_index(empty, occupied.shape), axis=1).astype(np.int64)
         
-        k1g = k1g[0][0]
-    
-        v1_unit = (w_coord[k1g] - hole_center)/modv1
+        cell_centers = (empty_cells + 0.5)*dl + coord_min
         
+        nearest_galaxy = galaxy_tree.query(cell_centers)[1][:,0]
         
-        PROFILE_1_time = time.time() - PROFILE_1_start
-    
-        ############################################################
-        #
-        # Find Galaxy 2 
-        #
-        # We are going to shift the center of the hole by dr along 
-        # the direction of the vector pointing from the nearest 
-        # galaxy to the center of the empty cell.  From there, we 
-        # will search within a radius of length the distance between 
-        # the center of the hole and the first galaxy from the 
-        # center of the hole to find the next nearest neighbors.  
-        # From there, we will minimize top/bottom to find which one 
-        # is the next nearest galaxy that bounds the hole.
-        ############################################################
+        nearest_cells = ((w_coord[nearest_galaxy] - coord_min)/dl).astype(np.int64)
         
-        PROFILE_2_start = time.time()
+        nearest_cells = np.clip(nearest_cells, 0, np.array(occupied.shape) - 1)
+        
+        pruned_cells.append(empty_cells[~useful[tuple(nearest_cells.T)]])
+        
+    return np.concatenate(pruned_cells)
     
-        galaxy_search = True
     
-        hole_center_2 = hole_center
     
-        in_mask_2 = True
     
-        while galaxy_search:
+def mark_cells_outside_survey(occupied, 
+                              dl, 
+                              coord_min, 
+                              mask,
+                              mask_resolution,
+                              min_dist,
+                              max_dist,
+                              chunk_cells=2**20):
+    '''
+    Description:
+    ============
     
-            # Shift hole center away from first galaxy
-            hole_center_2 = hole_center_2 - dr*v1_unit
-            
-            # Distance between hole center and nearest galaxy
-            modv1 += dr
-            
-            # Search for nearest neighbors within modv1 of the hole center
-            timer1 = time.time()
-            i_nearest = galaxy_tree.query_radius(hole_center_2, r=modv1)
-            timer2 = time.time()
-            PROFILE_query_times.append(timer2-timer1)
+    Mark the empty cells whose center is outside the survey like the cells 
+    containing galaxies, so that they are never enumerated and dispatched.  
+    main_algorithm returns NaN for those cells without growing a hole, so 
+    the holes found are unchanged.
     
-            i_nearest = i_nearest[0]
-            #dist_nearest = dist_nearest[0]
+    The grid is bounded by the galaxies' bounding box, so for a narrow 
+    survey most of its cells lie outside the footprint.  They are tested in 
+    bulk with cells_in_survey, chunk_cells cells of the grid at a time.
     
-            # Remove nearest galaxy from list
-            boolean_nearest = i_nearest != k1g
-            
-            i_nearest = i_nearest[boolean_nearest]
-            
-            if len(i_nearest) <= 0:
-                timer1 = time.time()
-                PROFILE_TEMP = not_in_mask(hole_center_2, mask, mask_resolution, min_dist, max_dist)
-                timer2 = time.time()
-                PROFILE_mask_times.append(timer2- timer1)
-                
     
-            if len(i_nearest) > 0:
-                # Found at least one other nearest neighbor!
+    Parameters:
+    ===========
     
-                # Calculate vector pointing from next nearest galaxies to the nearest galaxy
-                BA = w_coord[k1g] - w_coord[i_nearest]  # shape (N,3)
-                
-                bot = 2*np.dot(BA, v1_unit.T)  # shape (N,1)
-                
-                top = np.sum(BA**2, axis=1)  # shape (N,)
-                
-                x2 = top/bot.T[0]  # shape (N,)
+    occupied : numpy.ndarray of shape ngrid of bool
+        True in the cells containing at least one galaxy
+        
+    dl, coord_min, mask, mask_resolution, min_dist, max_dist :
+        as for _main_hole_finder
+        
+    chunk_cells : integer
+        Number of cells of the grid tested at a time.  Default is 2**20.
     
-                # Locate positive values of x2
-                valid_idx = np.where(x2 > 0)[0]  # shape (n,)
-                
-                if len(valid_idx) > 0:
-                    # Find index of 2nd nearest galaxy
-                    k2g_x2 = valid_idx[x2[valid_idx].argmin()]
-                    
-                    k2g = i_nearest[k2g_x2]
     
-                    minx2 = x2[k2g_x2]  # Eliminated transpose on x2
+    Returns:
+    ========
     
-                    galaxy_search = False
-                
-            elif PROFILE_TEMP:
-                # Hole is no longer within survey limits
-                galaxy_search = False
-                
-                in_mask_2 = False
+    occupied : numpy.ndarray of shape ngrid of bool
+        copy of occupied, also True in the empty cells outside the survey
+        
+    num_skipped : integer
+        number of empty cells newly marked
+    '''
     
-        # Check to make sure that the hole center is still within the survey
-        if not in_mask_2:
-            #print('hole not in survey')
-            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
-            
-            continue
+    occupied = occupied.copy()
     
-        #print('Found 2nd galaxy')
+    flat_occupied = occupied.reshape(-1)
     
+    mask = mask.astype(np.uint8)
     
-        PROFILE_2_time = time.time() - PROFILE_2_start
+    num_skipped = 0
     
-        ############################################################
-        # Update hole center
-        ############################################################
+    for start in range(0, flat_occupied.shape[0], chunk_cells):
         
-        # Calculate new hole center
-        hole_radius = 0.5*np.sum(BA[k2g_x2]**2)/np.dot(BA[k2g_x2], v1_unit.T)  # shape (1,)
+        empty = np.flatnonzero(~flat_occupied[start:start + chunk_cells]) + start
         
-        hole_center = w_coord[k1g] - hole_radius*v1_unit  # shape (1,3)
-       
-        # Check to make sure that the hole center is still within the survey
+        cells = np.stack(np.unravel_index(empty, occupied.shape), axis=1).astype(np.int64)
         
-        timer1 = time.time()
-        temp = not_in_mask(hole_center, mask, mask_resolution, min_dist, max_dist)
-        timer2 = time.time()
-        PROFILE_mask_times.append(timer2- timer1)
+        in_survey = np.empty(cells.shape[0], dtype=np.uint8)
         
-        if temp:
-            #print('hole not in survey')
-            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
-            
-            continue
-    
-        ########################################################################
-        # Find Galaxy 3 (closest to cell center)
-        #
-        # (Same methodology as for finding the second galaxy)
-        ########################################################################
+        cells_in_survey(cells, dl, coord_min, mask, mask_resolution, min_dist, max_dist, in_survey)
         
-        PROFILE_3_start = time.time()
+        outside = empty[in_survey == 0]
         
+        flat_occupied[outside] = True
+        
+        num_skipped += outside.shape[0]
+        
+    return occupied, num_skipped
     
-        # Find the midpoint between the two nearest galaxies
-        midpoint = 0.5*(w_coord[k1g] + w_coord[k2g])  # shape (3,)
-        #print('midpoint shape:', midpoint.shape)           
-    
-        # Define the unit vector along which to move the hole center
-        modv2 = np.linalg.norm(hole_center - midpoint)
-        v2_unit = (hole_center - midpoint)/modv2  # shape (1,3)
-        #print('v2_unit shape', v2_unit.shape)
-    
-        # Calculate vector pointing from the hole center to the nearest galaxy
-        Acenter = w_coord[k1g] - hole_center  # shape (1,3)
-        # Calculate vector pointing from the hole center to the second-nearest galaxy
-        Bcenter = w_coord[k2g] - hole_center  # shape (1,3)
     
-        # Initialize moving hole center
-        hole_center_3 = hole_center  # shape (1,3)
     
-        galaxy_search = True
     
-        in_mask_3 = True
+class CellIDGenerator(object):
+    '''
+    Description:
+    ============
     
-        while galaxy_search:
+    The empty cells of the grid in row (i,j,k) order, handed out as (N,3) 
+    int64 arrays ready to be passed to main_algorithm as its i_j_k_array.
     
-            # Shift hole center along unit vector
-            hole_center_3 = hole_center_3 + dr*v2_unit
+    The occupancy grid is scanned chunk_cells cells of its flattened index at
+    a time, so no Python object is made per cell and at most one chunk of 
+    cell IDs is held at once.  Iterating gives the cells one (i,j,k) tuple at
+    a time instead, which is only meant for tests and small grids.
     
-            # New hole "radius"
-            search_radius = np.linalg.norm(w_coord[k1g] - hole_center_3)
-            
-            # Search for nearest neighbors within modv1 of the hole center
-            #i_nearest, dist_nearest = galaxy_tree.query_radius(hole_center, r=np.linalg.norm(Acenter), return_distance=True, sort_results=True)
-            timer1 = time.time()
-            i_nearest = galaxy_tree.query_radius(hole_center_3, r=search_radius)
-            timer2 = time.time()
-            PROFILE_query_times.append(timer2 - timer1)
     
-            i_nearest = i_nearest[0]
-            #dist_nearest = dist_nearest[0]
+    Parameters:
+    ===========
     
-            # Remove two nearest galaxies from list
-            boolean_nearest = np.logical_and(i_nearest != k1g, i_nearest != k2g)
-            i_nearest = i_nearest[boolean_nearest]
-            #dist_nearest = dist_nearest[boolean_nearest]
+    grid_dim_1, grid_dim_2, grid_dim_3 : integers
+        number of cells of the grid along each dimension
+        
+    occupied : numpy.ndarray of shape (grid_dim_1, grid_dim_2, grid_dim_3) of bool
+        True in the cells containing at least one galaxy (see 
+        mesh_galaxies_grid).  A dictionary keyed by those cells' (i,j,k) is 
+        also accepted.
+        
+    chunk_cells : integer
+        Number of cells of the grid scanned at a time.  Default is 2**20.
+    '''
     
+    def __init__(self, grid_dim_1, grid_dim_2, grid_dim_3, occupied, chunk_cells=2**20):
+        
+        self.grid_shape = (grid_dim_1, grid_dim_2, grid_dim_3)
+        
+        self.occupied = occupancy_grid(self.grid_shape, occupied)
+        
+        self.num_empty_cells = self.occupied.size - int(np.count_nonzero(self.occupied))
+        
+        self.chunk_cells = chunk_cells
+        
+        self.reset()
+        
+    def reset(self):
+        
+        self.next_cell = 0
+        
+        self.pending = np.empty((0,3), dtype=np.int64)
+        
+        self.pending_idx = 0
+        
+    def __iter__(self):
+        
+        return self
     
-            if len(i_nearest) <= 0:
-                timer1 = time.time()
-                PROFILE_TEMP = not_in_mask(hole_center_3, mask, mask_resolution, min_dist, max_dist)
-                timer2 = time.time()
-                PROFILE_mask_times.append(timer2- timer1)
+    def __next__(self):
+        
+        next_cell_ID = self.next_batch(1)
+        
+        if next_cell_ID.shape[0] == 0:
+            
+            raise StopIteration
+        
+        return tuple(next_cell_ID[0].tolist())
     
+    def __len__(self):
+        
+        return self.num_empty_cells
     
-            if len(i_nearest) > 0:
-                # Found at least one other nearest neighbor!
     
-                # Calculate vector pointing from hole center to next nearest galaxies
-                Ccenter = w_coord[i_nearest] - hole_center  # shape (N,3)
+    def next_batch(self, batch_size):
+        '''
+        Take the next batch_size empty cells (fewer at the end, none once 
+        every cell has been handed out) as an (N,3) int64 array.
+        '''
+        
+        batch = []
+        
+        num_cells = 0
+        
+        while num_cells < batch_size:
+            
+            if self.pending_idx >= self.pending.shape[0]:
                 
-                bot = 2*np.dot((Ccenter - Acenter), v2_unit.T)  # shape (N,1)
-                
-                top = np.sum(Ccenter**2, axis=1) - np.sum(Bcenter**2)  # shape (N,)
+                try:
+                    
+                    self.fill_next_chunk()
+                    
+                except StopIteration:
+                    
+                    break
                 
-                x3 = top/bot.T[0]  # shape (N,)
-    
-                # Locate positive values of x3
-                valid_idx = np.where(x3 > 0)[0]  # shape (N,)
-    
-                if len(valid_idx) > 0:
-                    # Find index of 3rd nearest galaxy
-                    k3g_x3 = valid_idx[x3[valid_idx].argmin()]
-                    k3g = i_nearest[k3g_x3]
-    
-                    minx3 = x3[k3g_x3]
-    
-                    galaxy_search = False
+                continue
+            
+            cells = self.pending[self.pending_idx:self.pending_idx + batch_size - num_cells]
+            
+            self.pending_idx += cells.shape[0]
+            
+            num_cells += cells.shape[0]
+            
+            batch.append(cells)
+            
+        if len(batch) == 1:
+            
+            return batch[0]
+        
+        if not batch:
+            
+            return np.empty((0,3), dtype=np.int64)
+        
+        return np.concatenate(batch)
     
-            #elif not in_mask(hole_center_3, mask, [min_dist, max_dist]):
-            elif PROFILE_TEMP:
-                # Hole is no longer within survey limits
-                galaxy_search = False
-                in_mask_3 = False
     
-        # Check to make sure that the hole center is still within the survey
-        #if not in_mask(hole_center_3, mask, [min_dist, max_dist]):
-        #if not_in_mask(hole_center_3, mask, min_dist, max_dist):
-        if not in_mask_3:
-            #print('hole not in survey')
-            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+    def fill_next_chunk(self):
+        '''
+        Replace the pending cells with the empty cells of the next chunk of 
+        the flattened grid.
+        '''
+        
+        if self.next_cell >= self.occupied.size:
             
-            continue
-    
-        #print('Found 3rd galaxy')
+            raise StopIteration
         
-        PROFILE_3_time = time.time() - PROFILE_3_start
+        chunk = self.occupied.reshape(-1)[self.next_cell:self.next_cell + self.chunk_cells]
+        
+        empty = np.flatnonzero(~chunk) + self.next_cell
+        
+        self.next_cell += chunk.shape[0]
+        
+        self.pending = np.stack(np.unravel_index(empty, self.grid_shape), axis=1).astype(np.int64)
         
+        self.pending_idx = 0
+        
+        
+        
+        
+class MortonCellIDGenerator(CellIDGenerator):
+    '''
+    Drop-in replacement for CellIDGenerator which walks the grid along a 
+    Morton (Z-order) curve instead of row by row, so that consecutive cells 
+    - and therefore each batch - form compact 3D blocks.
+    
+    The curve is covered in aligned cubic blocks of 2**block_bits cells on a 
+    side.  Blocks which lie entirely outside the grid are skipped without 
+    being expanded, and the cells of the remaining blocks are produced from 
+    a precomputed table of offsets in Morton order, about chunk_cells at a 
+    time.
+    '''
+    
+    def __init__(self, grid_dim_1, grid_dim_2, grid_dim_3, occupied, block_bits=4, chunk_cells=2**20):
         
         ############################################################
-        # Update hole center
+        # Number of bits needed per dimension to cover the grid
         ############################################################
-        hole_center = hole_center + minx3*v2_unit  # shape (1,3)
+        num_bits = int(np.ceil(np.log2(max(grid_dim_1, grid_dim_2, grid_dim_3, 1))))
         
-        hole_radius = np.linalg.norm(hole_center - w_coord[k1g])  # shape ()
-    
-        # Check to make sure that the hole center is still within the survey
-        timer1 = time.time()
-        temp = not_in_mask(hole_center, mask, mask_resolution, min_dist, max_dist)
-        timer2 = time.time()
-        PROFILE_mask_times.append(timer2- timer1)
-        if temp:
-            #print('hole not in survey')
-            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+        self.block_bits = min(block_bits, num_bits)
+        
+        self.num_blocks = 8**(num_bits - self.block_bits)
+        
+        self.block_offsets = morton_decode(np.arange(8**self.block_bits, dtype=np.int64))
+        
+        super(MortonCellIDGenerator, self).__init__(grid_dim_1, grid_dim_2, grid_dim_3, occupied, chunk_cells=chunk_cells)
+        
+    def reset(self):
+        
+        super(MortonCellIDGenerator, self).reset()
+        
+        self.next_block = 0
+        
+        
+    def fill_next_chunk(self):
+        '''
+        Replace the pending cells with the empty cells of the next blocks on 
+        the curve.
+        '''
+        
+        if self.next_block >= self.num_blocks:
             
-            continue
-    
-    
-        ########################################################################
-        #
-        # Find Galaxy 4 
-        #
-        # Process is very similar as before, except we do not know if we have to 
-        # move above or below the plane.  Therefore, we will find the next closest 
-        # if we move above the plane, and the next closest if we move below the 
-        # plane.
-        ########################################################################
+            raise StopIteration
         
-        PROFILE_4_start = time.time()
+        num_blocks = max(1, self.chunk_cells//self.block_offsets.shape[0])
         
-    
-        # The vector along which to move the hole center is defined by the cross 
-        # product of the vectors pointing between the three nearest galaxies.
-        AB = w_coord[k1g] - w_coord[k2g]  # shape (3,)
-        BC = w_coord[k3g] - w_coord[k2g]  # shape (3,)
-        v3 = np.cross(AB,BC)  # shape (3,)
+        codes = np.arange(self.next_block, min(self.next_block + num_blocks, self.num_blocks), dtype=np.int64)
         
+        self.next_block += codes.shape[0]
         
-        modv3 = np.linalg.norm(v3)
-        v3_unit = v3/modv3  # shape (3,)
+        grid_dims = np.array(self.grid_shape)
+        
+        block_origins = morton_decode(codes) << self.block_bits
+        
+        block_origins = block_origins[np.all(block_origins < grid_dims, axis=1)]
+        
+        cells = (block_origins[:,None,:] + self.block_offsets[None,:,:]).reshape(-1,3)
+        
+        cells = cells[np.all(cells < grid_dims, axis=1)]
+        
+        self.pending = cells[~self.occupied[tuple(cells.T)]]
+        
+        self.pending_idx = 0
+        
+        
+        
+        
+def morton_decode(codes):
+    '''
+    Description:
+    ============
     
-        # Calculate vector pointing from the hole center to the nearest galaxy
-        Acenter = w_coord[k1g] - hole_center  # shape (1,3)
-        # Calculate vector pointing from the hole center to the second-nearest galaxy
-        Bcenter = w_coord[k2g] - hole_center  # shape (1,3)
+    Split Morton (Z-order) codes into their (i,j,k) grid indices.  Bit 3n+2 
+    of a code is bit n of i, bit 3n+1 is bit n of j and bit 3n is bit n of k,
+    so walking the codes in order fills each octant of the grid before 
+    moving on to the next.
     
     
-        # First move in the direction of the unit vector defined above
+    Parameters:
+    ===========
     
-        galaxy_search = True
-        
-        hole_center_41 = hole_center 
+    codes : numpy.ndarray of shape (N,) of non-negative int64
+        Morton codes of up to 63 bits
     
-        in_mask_41 = True
     
-        while galaxy_search:
+    Returns:
+    ========
     
-            # Shift hole center along unit vector
-            hole_center_41 = hole_center_41 + dr*v3_unit
-            #print('Shifted center to', hole_center_41)
+    cell_IDs : numpy.ndarray of shape (N,3) of int64
+        (i,j,k) grid indices of the codes
+    '''
     
-            # New hole "radius"
-            search_radius = np.linalg.norm(w_coord[k1g] - hole_center_41)
+    cell_IDs = np.zeros((codes.shape[0], 3), dtype=np.int64)
     
-            # Search for nearest neighbors within R of the hole center
-            #i_nearest, dist_nearest = galaxy_tree.query_radius(hole_center_41, r=np.linalg.norm(Acenter), return_distance=True, sort_results=True)
-            timer1 = time.time()
-            i_nearest = galaxy_tree.query_radius(hole_center_41, r=search_radius)
-            timer2 = time.time()
-            PROFILE_query_times.append(timer2 - timer1)
+    for bit in range(21):
+        
+        for dim in range(3):
+            
+            cell_IDs[:,dim] |= ((codes >> (3*bit + 2 - dim)) & 1) << bit
+            
+    return cell_IDs
+        
+        
+        
+        
+        
+        
+        
+
+
+
     
-            i_nearest = i_nearest[0]
-            #dist_nearest = dist_nearest[0]
+def run_single_process(cell_ID_list, 
+                       ngrid, 
+                       dl, 
+                       dr,
+                       coord_min, 
+                       mask,
+                       mask_resolution,
+                       min_dist,
+                       max_dist,
+                       w_coord,
+                       batch_size=1000,
+                       verbose=False,
+                       num_cpus=None):
     
-            # Remove two nearest galaxies from list
-            boolean_nearest = np.logical_and.reduce((i_nearest != k1g, i_nearest != k2g, i_nearest != k3g))
-            i_nearest = i_nearest[boolean_nearest]
-            #dist_nearest = dist_nearest[boolean_nearest]
-            #print('Number of nearby galaxies', len(i_nearest))
     
     
-            if len(i_nearest) <= 0:
-                timer1 = time.time()
-                PROFILE_TEMP = not_in_mask(hole_center_41, mask, mask_resolution, min_dist, max_dist)
-                timer2 = time.time()
-                PROFILE_mask_times.append(timer2- timer1)
     
     
     
-            #if i_nearest.shape[0] > 0:
-            if len(i_nearest) > 0:
-                # Found at least one other nearest neighbor!
+    ################################################################################
+    #
+    # Profiling parameters
+    #
+    ################################################################################
     
-                # Calculate vector pointing from hole center to next nearest galaxies
-                Dcenter = w_coord[i_nearest] - hole_center  # shape (N,3)
-                #print('Dcenter shape:', Dcenter.shape)
-                
-                bot = 2*np.dot((Dcenter - Acenter), v3_unit.T)  # shape (N,)
-                #print('bot shape:', bot.shape)
-                
-                top = np.sum(Dcenter**2, axis=1) - np.sum(Bcenter**2)  # shape (N,)
-                #print('top shape:', top.shape)
-                
-                x41 = top/bot  # shape (N,)
-                #print('x41 shape:', x41.shape)
+    #PROFILE_total_query_time = 0.0
     
-                # Locate positive values of x41
-                valid_idx = np.where(x41 > 0)[0]  # shape (n,)
-                #print('valid_idx shape:', valid_idx.shape)
+    PROFILE_total_start = time.time()
     
-                #if valid_idx.shape[0] == 1:
-                #    k4g1 = i_nearest[valid_idx[0]]
-                #    minx41 = x41[valid_idx[0]]
-                #    galaxy_search = False
-                #    
-                #elif valid_idx.shape[0] > 1:
-                if len(valid_idx) > 0:
-                    # Find index of 4th nearest galaxy
-                    k4g1_x41 = valid_idx[x41[valid_idx].argmin()]
-                    k4g1 = i_nearest[k4g1_x41]
+    #PROFILE_mask_checking_time = 0.0
     
-                    minx41 = x41[k4g1_x41]
+    PROFILE_mask_times = []
     
-                    galaxy_search = False
+    PROFILE_loop_times = []
     
+    PROFILE_query_times = []
     
-            #elif not in_mask(hole_center_41, mask, mask_resolution, [min_dist, max_dist]):
-            elif PROFILE_TEMP:
-                # Hole is no longer within survey limits
-                galaxy_search = False
-                in_mask_41 = False
+    PROFILE_section_1_times = []
+    PROFILE_section_2_times = []
+    PROFILE_section_3_times = []
+    PROFILE_section_4_times = []
+    PROFILE_void_times = []
     
-        #print('Found first potential 4th galaxy')
-        
     
-        # Calculate potential new hole center
-        #if not not_in_mask(hole_center_41, mask, mask_resolution, min_dist, max_dist):
-        if in_mask_41:
-            hole_center_41 = hole_center + minx41*v3_unit  # shape (1,3)
-            #print('______________________')
-            #print(hole_center_41, 'hc41')
-            #print('hole_radius_41', np.linalg.norm(hole_center_41 - w_coord[k1g]))
-       
-        ########################################################################
-        # Repeat same search, but shift the hole center in the other direction 
-        # this time
-        ########################################################################
-        v3_unit = -v3_unit
     
-        # First move in the direction of the unit vector defined above
-        galaxy_search = True
     
-        # Initialize minx42 (in case it does not get created later)
-        minx42 = np.infty
+    ################################################################################
+    #
+    # Initialize some output containers and counter variables
+    #
+    ################################################################################
     
-        hole_center_42 = hole_center
+    if num_cpus is None:
         
-        minx42 = np.infty
+        num_cpus = 1
     
-        in_mask_42 = True
+    print("Running single-process mode with", num_cpus, "thread(s)")
     
-        while galaxy_search:
+    #hole_times = []
     
-            # Shift hole center along unit vector
-            hole_center_42 = hole_center_42 + dr*v3_unit
+    # Initialize list of hole details
+    myvoids_x = []
     
-            # New hole "radius"
-            search_radius = np.linalg.norm(w_coord[k1g] - hole_center_42)
+    myvoids_y = []
     
-            # Search for nearest neighbors within R of the hole center
-            #i_nearest, dist_nearest = galaxy_tree.query_radius(hole_center_42, r=np.linalg.norm(Acenter), return_distance=True, sort_results=True)
+    myvoids_z = []
+    
+    myvoids_r = []
+    
+    # Number of holes found
+    n_holes = 0
+
+    # Counter for the number of empty cells
+    empty_cell_counter = 0
+    
+    # Number of empty cells
+    #n_empty_cells = ngrid[0]*ngrid[1]*ngrid[2] - len(cell_ID_dict)
+    n_empty_cells = len(cell_ID_list)
+    
+    ################################################################################
+    #
+    #   BUILD NEAREST-NEIGHBOR TREE
+    #   galaxy_tree : sklearn.neighbors/scipy KDTree or similar implementing sklearn interface
+    #   nearest neighbor finder for the galaxies in x,y,z space
+    #
+    ################################################################################
+    
+    if verbose:
+        
+        kdtree_start_time = time.time()
+
+    galaxy_tree = neighbors.KDTree(w_coord)
+    
+    if verbose:
+        
+        print('KDTree creation time:', time.time() - kdtree_start_time)
+    
+    
+    ################################################################################
+    # Main loop
+    ################################################################################
+    num_cells_processed = 0
+    
+    for hole_center_coords in cell_ID_list:
+                    
+        num_cells_processed += 1
+        
+        #print(hole_center_coords)
+        
+        
+        PROFILE_loop_start_time = time.time()
+        
+        
+        if verbose:
+            
+            if num_cells_processed % 10000 == 0:
+                
+               print('Processed', num_cells_processed, 'cells of', n_empty_cells)
+        
+        
+        #if num_cells_processed % 10000 == 0:
+        #    print("Processed: ", num_cells_processed, "time: ", time.time() - worker_lifetime_start, "main: ", time_main, "empty: ", time_empty)
+        
+            
+        i, j, k = hole_center_coords
+        
+
+        hole_center = (np.array([[i, j, k]]) + 0.5)*dl + coord_min  # Purposefully making hole_center have shape (1,3) for KDtree queries
+                        
+        #hole_center = to_vector(hole_center_table)
+        
+        
+        ############################################################
+        # Check to make sure in mask
+        ############################################################
+        
+        timer1 = time.time()
+        temp = not_in_mask(hole_center, mask, mask_resolution, min_dist, max_dist)
+        timer2 = time.time()
+        PROFILE_mask_times.append(timer2- timer1)
+        # Check to make sure that the hole center is still within the survey
+        if temp:
+            
+            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+            
+            continue
+        
+        
+        ############################################################
+        #
+        # Find Galaxy 1 (closest to cell center)
+        #
+        # and calculate Unit vector pointing from cell 
+        # center to the closest galaxy
+        #
+        ############################################################
+        PROFILE_1_start = time.time()
+        
+        
+        timer1 = time.time()
+        modv1, k1g = galaxy_tree.query(hole_center, k=1)
+        timer2 = time.time()
+        PROFILE_query_times.append(timer2-timer1)
+        
+        modv1 = modv1[0][0]
+        
+        k1g = k1g[0][0]
+    
+        v1_unit = (w_coord[k1g] - hole_center)/modv1
+        
+        
+        PROFILE_1_time = time.time() - PROFILE_1_start
+    
+        ############################################################
+        #
+        # Find Galaxy 2 
+        #
+        # We are going to shift the center of the hole by dr along 
+        # the direction of the vector pointing from the nearest 
+        # galaxy to the center of the empty cell.  From there, we 
+        # will search within a radius of length the distance between 
+        # the center of the hole and the first galaxy from the 
+        # center of the hole to find the next nearest neighbors.  
+        # From there, we will minimize top/bottom to find which one 
+        # is the next nearest galaxy that bounds the hole.
+        ############################################################
+        
+        PROFILE_2_start = time.time()
+    
+        galaxy_search = True
+    
+        hole_center_2 = hole_center
+    
+        in_mask_2 = True
+    
+        while galaxy_search:
+    
+            # Shift hole center away from first galaxy
+            hole_center_2 = hole_center_2 - dr*v1_unit
+            
+            # Distance between hole center and nearest galaxy
+            modv1 += dr
+            
+            # Search for nearest neighbors within modv1 of the hole center
             timer1 = time.time()
-            i_nearest = galaxy_tree.query_radius(hole_center_42, r=search_radius)
+            i_nearest = galaxy_tree.query_radius(hole_center_2, r=modv1)
             timer2 = time.time()
-            PROFILE_query_times.append(timer2 - timer1)
+            PROFILE_query_times.append(timer2-timer1)
     
             i_nearest = i_nearest[0]
             #dist_nearest = dist_nearest[0]
     
-            # Remove three nearest galaxies from list
-            boolean_nearest = np.logical_and.reduce((i_nearest != k1g, i_nearest != k2g, i_nearest != k3g))
+            # Remove nearest galaxy from list
+            boolean_nearest = i_nearest != k1g
+            
             i_nearest = i_nearest[boolean_nearest]
-            #dist_nearest = dist_nearest[boolean_nearest]
+            
+            if len(i_nearest) <= 0:
+                timer1 = time.time()
+                PROFILE_TEMP = not_in_mask(hole_center_2, mask, mask_resolution, min_dist, max_dist)
+                timer2 = time.time()
+                PROFILE_mask_times.append(timer2- timer1)
+                
+    
+            if len(i_nearest) > 0:
+                # Found at least one other nearest neighbor!
+    
+                # Calculate vector pointing from next nearest galaxies to the nearest galaxy
+                BA = w_coord[k1g] - w_coord[i_nearest]  # shape (N,3)
+                
+                bot = 2*np.dot(BA, v1_unit.T)  # shape (N,1)
+                
+                top = np.sum(BA**2, axis=1)  # shape (N,)
+                
+                x2 = top/bot.T[0]  # shape (N,)
+    
+                # Locate positive values of x2
+                valid_idx = np.where(x2 > 0)[0]  # shape (n,)
+                
+                if len(valid_idx) > 0:
+                    # Find index of 2nd nearest galaxy
+                    k2g_x2 = valid_idx[x2[valid_idx].argmin()]
+                    
+                    k2g = i_nearest[k2g_x2]
+    
+                    minx2 = x2[k2g_x2]  # Eliminated transpose on x2
+    
+                    galaxy_search = False
+                
+            elif PROFILE_TEMP:
+                # Hole is no longer within survey limits
+                galaxy_search = False
+                
+                in_mask_2 = False
+    
+        # Check to make sure that the hole center is still within the survey
+        if not in_mask_2:
+            #print('hole not in survey')
+            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+            
+            continue
+    
+        #print('Found 2nd galaxy')
+    
+    
+        PROFILE_2_time = time.time() - PROFILE_2_start
+    
+        ############################################################
+        # Update hole center
+        ############################################################
+        
+        # Calculate new hole center
+        hole_radius = 0.5*np.sum(BA[k2g_x2]**2)/np.dot(BA[k2g_x2], v1_unit.T)  # shape (1,)
+        
+        hole_center = w_coord[k1g] - hole_radius*v1_unit  # shape (1,3)
+       
+        # Check to make sure that the hole center is still within the survey
+        
+        timer1 = time.time()
+        temp = not_in_mask(hole_center, mask, mask_resolution, min_dist, max_dist)
+        timer2 = time.time()
+        PROFILE_mask_times.append(timer2- timer1)
+        
+        if temp:
+            #print('hole not in survey')
+            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+            
+            continue
+    
+        ########################################################################
+        # Find Galaxy 3 (closest to cell center)
+        #
+        # (Same methodology as for finding the second galaxy)
+        ########################################################################
+        
+        PROFILE_3_start = time.time()
+        
+    
+        # Find the midpoint between the two nearest galaxies
+        midpoint = 0.5*(w_coord[k1g] + w_coord[k2g])  # shape (3,)
+        #print('midpoint shape:', midpoint.shape)           
+    
+        # Define the unit vector along which to move the hole center
+        modv2 = np.linalg.norm(hole_center - midpoint)
+        v2_unit = (hole_center - midpoint)/modv2  # shape (1,3)
+        #print('v2_unit shape', v2_unit.shape)
+    
+        # Calculate vector pointing from the hole center to the nearest galaxy
+        Acenter = w_coord[k1g] - hole_center  # shape (1,3)
+        # Calculate vector pointing from the hole center to the second-nearest galaxy
+        Bcenter = w_coord[k2g] - hole_center  # shape (1,3)
+    
+        # Initialize moving hole center
+        hole_center_3 = hole_center  # shape (1,3)
+    
+        galaxy_search = True
+    
+        in_mask_3 = True
+    
+        while galaxy_search:
+    
+            # Shift hole center along unit vector
+            hole_center_3 = hole_center_3 + dr*v2_unit
+    
+            # New hole "radius"
+            search_radius = np.linalg.norm(w_coord[k1g] - hole_center_3)
+            
+            # Search for nearest neighbors within modv1 of the hole center
+            #i_nearest, dist_nearest = galaxy_tree.query_radius(hole_center, r=np.linalg.norm(Acenter), return_distance=True, sort_results=True)
+            timer1 = time.time()
+            i_nearest = galaxy_tree.query_radius(hole_center_3, r=search_radius)
+            timer2 = time.time()
+            PROFILE_query_times.append(timer2 - timer1)
+    
+            i_nearest = i_nearest[0]
+            #dist_nearest = dist_nearest[0]
+    
+            # Remove two nearest galaxies from list
+            boolean_nearest = np.logical_and(i_nearest != k1g, i_nearest != k2g)
+            i_nearest = i_nearest[boolean_nearest]
+            #dist_nearest = dist_nearest[boolean_nearest]
+    
+    
+            if len(i_nearest) <= 0:
+                timer1 = time.time()
+                PROFILE_TEMP = not_in_mask(hole_center_3, mask, mask_resolution, min_dist, max_dist)
+                timer2 = time.time()
+                PROFILE_mask_times.append(timer2- timer1)
+    
+    
+            if len(i_nearest) > 0:
+                # Found at least one other nearest neighbor!
+    
+                # Calculate vector pointing from hole center to next nearest galaxies
+                Ccenter = w_coord[i_nearest] - hole_center  # shape (N,3)
+                
+                bot = 2*np.dot((Ccenter - Acenter), v2_unit.T)  # shape (N,1)
+                
+                top = np.sum(Ccenter**2, axis=1) - np.sum(Bcenter**2)  # shape (N,)
+                
+                x3 = top/bot.T[0]  # shape (N,)
+    
+                # Locate positive values of x3
+                valid_idx = np.where(x3 > 0)[0]  # shape (N,)
+    
+                if len(valid_idx) > 0:
+                    # Find index of 3rd nearest galaxy
+                    k3g_x3 = valid_idx[x3[valid_idx].argmin()]
+                    k3g = i_nearest[k3g_x3]
+    
+                    minx3 = x3[k3g_x3]
+    
+                    galaxy_search = False
+    
+            #elif not in_mask(hole_center_3, mask, [min_dist, max_dist]):
+            elif PROFILE_TEMP:
+                # Hole is no longer within survey limits
+                galaxy_search = False
+                in_mask_3 = False
+    
+        # Check to make sure that the hole center is still within the survey
+        #if not in_mask(hole_center_3, mask, [min_dist, max_dist]):
+        #if not_in_mask(hole_center_3, mask, min_dist, max_dist):
+        if not in_mask_3:
+            #print('hole not in survey')
+            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+            
+            continue
+    
+        #print('Found 3rd galaxy')
+        
+        PROFILE_3_time = time.time() - PROFILE_3_start
+        
+        
+        ############################################################
+        # Update hole center
+        ############################################################
+        hole_center = hole_center + minx3*v2_unit  # shape (1,3)
+        
+        hole_radius = np.linalg.norm(hole_center - w_coord[k1g])  # shape ()
+    
+        # Check to make sure that the hole center is still within the survey
+        timer1 = time.time()
+        temp = not_in_mask(hole_center, mask, mask_resolution, min_dist, max_dist)
+        timer2 = time.time()
+        PROFILE_mask_times.append(timer2- timer1)
+        if temp:
+            #print('hole not in survey')
+            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+            
+            continue
+    
+    
+        ########################################################################
+        #
+        # Find Galaxy 4 
+        #
+        # Process is very similar as before, except we do not know if we have to 
+        # move above or below the plane.  Therefore, we will find the next closest 
+        # if we move above the plane, and the next closest if we move below the 
+        # plane.
+        ########################################################################
+        
+        PROFILE_4_start = time.time()
+        
+    
+        # The vector along which to move the hole center is defined by the cross 
+        # product of the vectors pointing between the three nearest galaxies.
+        AB = w_coord[k1g] - w_coord[k2g]  # shape (3,)
+        BC = w_coord[k3g] - w_coord[k2g]  # shape (3,)
+        v3 = np.cross(AB,BC)  # shape (3,)
+        
+        
+        modv3 = np.linalg.norm(v3)
+        v3_unit = v3/modv3  # shape (3,)
+    
+        # Calculate vector pointing from the hole center to the nearest galaxy
+        Acenter = w_coord[k1g] - hole_center  # shape (1,3)
+        # Calculate vector pointing from the hole center to the second-nearest galaxy
+        Bcenter = w_coord[k2g] - hole_center  # shape (1,3)
+    
+    
+        # First move in the direction of the unit vector defined above
+    
+        galaxy_search = True
+        
+        hole_center_41 = hole_center 
+    
+        in_mask_41 = True
+    
+        while galaxy_search:
+    
+            # Shift hole center along unit vector
+            hole_center_41 = hole_center_41 + dr*v3_unit
+            #print('Shifted center to', hole_center_41)
+    
+            # New hole "radius"
+            search_radius = np.linalg.norm(w_coord[k1g] - hole_center_41)
+    
+            # Search for nearest neighbors within R of the hole center
+            #i_nearest, dist_nearest = galaxy_tree.query_radius(hole_center_41, r=np.linalg.norm(Acenter), return_distance=True, sort_results=True)
+            timer1 = time.time()
+            i_nearest = galaxy_tree.query_radius(hole_center_41, r=search_radius)
+            timer2 = time.time()
+            PROFILE_query_times.append(timer2 - timer1)
+    
+            i_nearest = i_nearest[0]
+            #dist_nearest = dist_nearest[0]
+    
+            # Remove two nearest galaxies from list
+            boolean_nearest = np.logical_and.reduce((i_nearest != k1g, i_nearest != k2g, i_nearest != k3g))
+            i_nearest = i_nearest[boolean_nearest]
+            #dist_nearest = dist_nearest[boolean_nearest]
+            #print('Number of nearby galaxies', len(i_nearest))
+    
+    
+            if len(i_nearest) <= 0:
+                timer1 = time.time()
+                PROFILE_TEMP = not_in_mask(hole_center_41, mask, mask_resolution, min_dist, max_dist)
+                timer2 = time.time()
+                PROFILE_mask_times.append(timer2- timer1)
+    
+    
+    
+            #if i_nearest.shape[0] > 0:
+            if len(i_nearest) > 0:
+                # Found at least one other nearest neighbor!
+    
+                # Calculate vector pointing from hole center to next nearest galaxies
+                Dcenter = w_coord[i_nearest] - hole_center  # shape (N,3)
+                #print('Dcenter shape:', Dcenter.shape)
+                
+                bot = 2*np.dot((Dcenter - Acenter), v3_unit.T)  # shape (N,)
+                #print('bot shape:', bot.shape)
+                
+                top = np.sum(Dcenter**2, axis=1) - np.sum(Bcenter**2)  # shape (N,)
+                #print('top shape:', top.shape)
+                
+                x41 = top/bot  # shape (N,)
+                #print('x41 shape:', x41.shape)
+    
+                # Locate positive values of x41
+                valid_idx = np.where(x41 > 0)[0]  # shape (n,)
+                #print('valid_idx shape:', valid_idx.shape)
+    
+                #if valid_idx.shape[0] == 1:
+                #    k4g1 = i_nearest[valid_idx[0]]
+                #    minx41 = x41[valid_idx[0]]
+                #    galaxy_search = False
+                #    
+                #elif valid_idx.shape[0] > 1:
+                if len(valid_idx) > 0:
+                    # Find index of 4th nearest galaxy
+                    k4g1_x41 = valid_idx[x41[valid_idx].argmin()]
+                    k4g1 = i_nearest[k4g1_x41]
+    
+                    minx41 = x41[k4g1_x41]
+    
+                    galaxy_search = False
+    
+    
+            #elif not in_mask(hole_center_41, mask, mask_resolution, [min_dist, max_dist]):
+            elif PROFILE_TEMP:
+                # Hole is no longer within survey limits
+                galaxy_search = False
+                in_mask_41 = False
+    
+        #print('Found first potential 4th galaxy')
+        
+    
+        # Calculate potential new hole center
+        #if not not_in_mask(hole_center_41, mask, mask_resolution, min_dist, max_dist):
+        if in_mask_41:
+            hole_center_41 = hole_center + minx41*v3_unit  # shape (1,3)
+            #print('______________________')
+            #print(hole_center_41, 'hc41')
+            #print('hole_radius_41', np.linalg.norm(hole_center_41 - w_coord[k1g]))
+       
+        ########################################################################
+        # Repeat same search, but shift the hole center in the other direction 
+        # this time
+        ########################################################################
+        v3_unit = -v3_unit
+    
+        # First move in the direction of the unit vector defined above
+        galaxy_search = True
+    
+        # Initialize minx42 (in case it does not get created later)
+        minx42 = np.infty
+    
+        hole_center_42 = hole_center
+        
+        minx42 = np.infty
+    
+        in_mask_42 = True
+    
+        while galaxy_search:
+    
+            # Shift hole center along unit vector
+            hole_center_42 = hole_center_42 + dr*v3_unit
+    
+            # New hole "radius"
+            search_radius = np.linalg.norm(w_coord[k1g] - hole_center_42)
+    
+            # Search for nearest neighbors within R of the hole center
+            #i_nearest, dist_nearest = galaxy_tree.query_radius(hole_center_42, r=np.linalg.norm(Acenter), return_distance=True, sort_results=True)
+            timer1 = time.time()
+            i_nearest = galaxy_tree.query_radius(hole_center_42, r=search_radius)
+            timer2 = time.time()
+            PROFILE_query_times.append(timer2 - timer1)
+    
+            i_nearest = i_nearest[0]
+            #dist_nearest = dist_nearest[0]
+    
+            # Remove three nearest galaxies from list
+            boolean_nearest = np.logical_and.reduce((i_nearest != k1g, i_nearest != k2g, i_nearest != k3g))
+            i_nearest = i_nearest[boolean_nearest]
+            #dist_nearest = dist_nearest[boolean_nearest]
+    
+            if len(i_nearest) <= 0:
+                timer1 = time.time()
+                PROFILE_TEMP = not_in_mask(hole_center_42, mask, mask_resolution, min_dist, max_dist)
+                timer2 = time.time()
+                PROFILE_mask_times.append(timer2- timer1)
+    
+            if len(i_nearest) > 0:
+                # Found at least one other nearest neighbor!
+    
+                # Calculate vector pointing from hole center to next nearest galaxies
+                Dcenter = w_coord[i_nearest] - hole_center  # shape (N,3)
+    
+                bot = 2*np.dot((Dcenter - Acenter), v3_unit.T)  # shape (N,)
+    
+                top = np.sum(Dcenter**2, axis=1) - np.sum(Bcenter**2)  # shape (N,)
+    
+                x42 = top/bot  # shape (N,)
+    
+                # Locate positive values of x42
+                valid_idx = np.where(x42 > 0)[0]  # shape (n,)
+    
+                if len(valid_idx) > 0:
+                    # Find index of 3rd nearest galaxy
+                    k4g2_x42 = valid_idx[x42[valid_idx].argmin()]
+                    k4g2 = i_nearest[k4g2_x42]
+    
+                    minx42 = x42[k4g2_x42]
+    
+                    galaxy_search = False
+    
+            #elif not in_mask(hole_center_42, mask, mask_resolution, [min_dist, max_dist]):
+            elif PROFILE_TEMP:
+                # Hole is no longer within survey limits
+                galaxy_search = False
+                in_mask_42 = False
+    
+        #print('Found second potential 4th galaxy')
+        
+    
+        # Calculate potential new hole center
+        #if not not_in_mask(hole_center_42, mask, mask_resolution, min_dist, max_dist):
+        if in_mask_42:
+            hole_center_42 = hole_center + minx42*v3_unit  # shape (1,3)
+            #print(hole_center_42, 'hc42')
+            #print('hole_radius_42', np.linalg.norm(hole_center_42 - w_coord[k1g]))
+            #print('minx41:', minx41, '   minx42:', minx42)
+        
+        
+        ########################################################################
+        # Figure out which is the real galaxy 4
+        ########################################################################
+        
+        
+        # Determine which is the 4th nearest galaxy
+        #if in_mask(hole_center_41, mask, mask_resolution, [min_dist, max_dist]) and minx41 <= minx42:
+        timer1 = time.time()
+        not_in_mask_41 = not_in_mask(hole_center_41, mask, mask_resolution, min_dist, max_dist)
+        timer2 = time.time()
+        PROFILE_mask_times.append(timer2- timer1)
+        
+        
+        if not not_in_mask_41 and minx41 <= minx42:
+            # The first 4th galaxy found is the next closest
+            hole_center = hole_center_41
+            k4g = k4g1
+        elif not not_in_mask(hole_center_42, mask, mask_resolution, min_dist, max_dist):
+            # The second 4th galaxy found is the next closest
+            
+            timer1 = time.time()
+            not_in_mask(hole_center_42, mask, mask_resolution, min_dist, max_dist)
+            timer2 = time.time()
+            PROFILE_mask_times.append(timer2- timer1)
+            
+            
+            
+            
+            hole_center = hole_center_42
+            k4g = k4g2
+        elif not not_in_mask_41:
+            # The first 4th galaxy found is the next closest
+            hole_center = hole_center_41
+            k4g = k4g1
+        else:
+            # Neither hole center is within the mask - not a valid hole
+            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+            
+            continue
+    
+    
+        PROFILE_4_time = time.time() - PROFILE_4_start
+    
+        ########################################################################
+        # Calculate Radius of the hole
+        ########################################################################
+        hole_radius = np.linalg.norm(hole_center - w_coord[k1g])
+    
+        
+        ########################################################################
+        # Save hole
+        ########################################################################
+        
+        
+        PROFILE_section_1_times.append(PROFILE_1_time)
+        PROFILE_section_2_times.append(PROFILE_2_time)
+        PROFILE_section_3_times.append(PROFILE_3_time)
+        PROFILE_section_4_times.append(PROFILE_4_time)
+        
+        
+        
+        myvoids_x.append(hole_center[0,0])
+        #x_val = hole_center[0,0]
+        
+        myvoids_y.append(hole_center[0,1])
+        #y_val = hole_center[0,1]
+        
+        myvoids_z.append(hole_center[0,2])
+        #z_val = hole_center[0,2]
+        
+        myvoids_r.append(hole_radius)
+        #r_val = hole_radius
+        
+        #hole_times.append(time.time() - hole_start)
+        
+        #print(hole_times[n_holes], i,j,k)
+        
+        n_holes += 1
+        
+        PROFILE_loop_end_time = time.time()
+        
+        PROFILE_void_times.append(PROFILE_loop_end_time - PROFILE_loop_start_time)
+        
+        PROFILE_loop_times.append(PROFILE_loop_end_time - PROFILE_loop_start_time)
+    
+    
+    ########################################################################
+    # Profiling statistics
+    ########################################################################
+    
+    
+    total_time = time.time() - PROFILE_total_start
+    
+    print("Total time: ", total_time)
+    print("Loop time: ", np.sum(PROFILE_loop_times))
+    print("Query time: ", np.sum(PROFILE_query_times))
+    print("Mask time: ", np.sum(PROFILE_mask_times))
+    print("Total loops: ", len(PROFILE_loop_times))
+    print("Total queries: ", len(PROFILE_query_times))
+    print("Total masks: ", len(PROFILE_mask_times))
+    print("Total (void-cell) time: ", np.sum(PROFILE_void_times))
+    print("Section 1 (void) time: ", np.sum(PROFILE_section_1_times))
+    print("Section 2 (void) time: ", np.sum(PROFILE_section_2_times))
+    print("Section 3 (void) time: ", np.sum(PROFILE_section_3_times))
+    print("Section 4 (void) time: ", np.sum(PROFILE_section_4_times))
+    
+    
+    
+    fig = plt.figure(figsize=(14,10))
+    plt.hist(PROFILE_loop_times, bins=50)
+    plt.title("All Single Cell processing times (sec)")
+    #plt.show()
+    plt.savefig("Cell_time_dist.png")
+    plt.close()
+    
+    fig = plt.figure(figsize=(14,10))
+    plt.hist(PROFILE_query_times, bins=50)
+    plt.title("All Query KDTree times (sec)")
+    #plt.show()
+    plt.savefig("Query_time_dist.png")
+    plt.close()
+    
+    fig = plt.figure(figsize=(14,10))
+    plt.hist(PROFILE_mask_times, bins=50)
+    plt.title("All calls to not_in_mask times (sec)")
+    #plt.show()
+    plt.savefig("not_in_mask_time_dist.png")
+    plt.close()
+    
+    fig = plt.figure(figsize=(19.2,12))
+    top_left = plt.subplot(221)
+    top_right = plt.subplot(222)
+    bot_left = plt.subplot(223)
+    bot_right = plt.subplot(224)
+    top_left.hist(PROFILE_section_1_times, bins=50)
+    top_right.hist(PROFILE_section_2_times, bins=50)
+    bot_left.hist(PROFILE_section_3_times, bins=50)
+    bot_right.hist(PROFILE_section_4_times, bins=50)
+    top_left.set_title("(Void cells only) Section 1 times (sec)")
+    top_right.set_title("(Void cells only) Section 2 times (sec)")
+    bot_left.set_title("(Void cells only) Section 3 times (sec)")
+    bot_right.set_title("(Void cells only) Section 4 times (sec)")
+    #plt.show()
+    plt.savefig("void_cell_section_breakdown_dist.png")
+    plt.close()
+    
+    
+    
+    
+    
+        
+    return myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes
+
+
+
+    
+
+    
+def run_single_process_cython(cell_ID_gen, 
+                       ngrid, 
+                       dl, 
+                       dr,
+                       coord_min, 
+                       mask,
+                       mask_resolution,
+                       min_dist,
+                       max_dist,
+                       w_coord,
+                       batch_size=1000,
+                       verbose=False,
+                       num_cpus=None,
+                       exact_search=False,
+                       single_precision=False,
+                       checkpoint=None,
+                       telemetry=None,
+                       hole_stream=None,
+                       survey_voxels=None,
+                       galaxy_tree=None):
+    
+    
+    ################################################################################
+    #
+    # Profiling
+    #
+    ################################################################################
+    
+    PROFILE_loop_times = []
+    
+    
+    ################################################################################
+    #
+    # Initialize some output containers and counter variables
+    #
+    ################################################################################
+    
+    if num_cpus is None:
+        
+        num_cpus = 1
+    
+    print("Running single-process mode with", num_cpus, "thread(s)")
+    
+    n_empty_cells = len(cell_ID_gen)
+    
+    #return_array = np.empty(4, dtype=np.float64)
+    
+    ################################################################################
+    # Convert the mask to an array of uint8 values for running in the cython code
+    ################################################################################
+    
+    
+    mask = mask.astype(np.uint8)
+    
+    
+    ################################################################################
+    #
+    #   BUILD NEAREST-NEIGHBOR TREE
+    #   galaxy_tree : GalaxyTree, the cython KDTree whose queries main_algorithm
+    #   calls directly without going through python
+    #   nearest neighbor finder for the galaxies in x,y,z space
+    #   (unless the caller already built one)
+    #
+    ################################################################################
+    
+    if galaxy_tree is None:
+        
+        if verbose:
+            
+            kdtree_start_time = time.time()
+    
+        galaxy_tree = GalaxyTree(w_coord, single_precision=single_precision)
+        
+        if verbose:
+            
+            print('KDTree creation time:', time.time() - kdtree_start_time)
+    
+    
+    ################################################################################
+    # Main loop
+    ################################################################################
+    '''
+    num_cells_processed = 0
+    
+    for hole_center_coords in cell_ID_list:
+                    
+        num_cells_processed += 1
+        
+        PROFILE_loop_start_time = time.time()
+        
+        if verbose:
+            
+            if num_cells_processed % 10000 == 0:
+                
+               print('Processed', num_cells_processed, 'cells of', n_empty_cells)
+        
+        i, j, k = hole_center_coords
+        
+        
+        main_algorithm(i,
+                       j,
+                       k,
+                       galaxy_tree,
+                       w_coord,
+                       dl, 
+                       dr,
+                       coord_min,
+                       mask,
+                       mask_resolution,
+                       min_dist,
+                       max_dist,
+                       return_array
+                       )
+        
+        x_val = return_array[0]
+        y_val = return_array[1]
+        z_val = return_array[2]
+        r_val = return_array[3]
+        
+        
+        
+        if not np.isnan(x_val):
+                
+            myvoids_x.append(x_val)
+            #x_val = hole_center[0,0]
+            
+            myvoids_y.append(y_val)
+            #y_val = hole_center[0,1]
+            
+            myvoids_z.append(z_val)
+            #z_val = hole_center[0,2]
+            
+            myvoids_r.append(r_val)
+            #r_val = hole_radius
+            
+            n_holes += 1
+        
+        
+        PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+    '''
+    
+    
+    
+    
+    ################################################################################
+    # Every batch writes its results straight into its own rows of results
+    ################################################################################
+    
+    results = np.empty((n_empty_cells, 4), dtype=np.float64)
+    
+    num_processed = 0
+    
+    workspace = HoleGrowthWorkspace(num_cpus)
+    
+    time_main = 0.0
+    
+    num_batches = 0
+    
+    loop_start_time = time.time()
+    
+    while True:
+        
+        cell_ID_list = cell_ID_gen.next_batch(batch_size)
+        
+        if cell_ID_list.shape[0] == 0:
+            
+            break
+        
+        if verbose > 0:
+        
+            print("Processing cell "+str(num_processed)+" of "+str(n_empty_cells))
+            
+        i_j_k_array = cell_ID_list
+        
+        main_start_time = time.time()
+            
+        main_algorithm(i_j_k_array,
+                       galaxy_tree,
+                       dl, 
+                       dr,
+                       coord_min,
+                       mask,
+                       mask_resolution,
+                       min_dist,
+                       max_dist,
+                       results[num_processed:num_processed + len(cell_ID_list)],
+                       0,  #verbose level
+                       num_cpus,  #number of OpenMP threads
+                       exact_search,
+                       workspace,
+                       survey_voxels
+                       )
+        
+        time_main += time.time() - main_start_time
+        
+        num_batches += 1
+        
+        if checkpoint is not None:
+            
+            checkpoint.append(cell_ID_list, results[num_processed:num_processed + len(cell_ID_list)])
+            
+        if hole_stream is not None:
+            
+            hole_stream.add(results[num_processed:num_processed + len(cell_ID_list)])
+        
+        num_processed += len(cell_ID_list)
+        
+    
+    '''
+    print('Plotting single cell processing times distribution')
+    plt.figure(figsize=(14,10))
+    plt.hist(PROFILE_loop_times, bins=50)
+    plt.title("All Single Cell processing times Cython (sec)")
+    plt.xlabel('Time [s]')
+    plt.ylabel('Count')
+    #plt.show()
+    plt.savefig("Cell_time_dist_Cython.png")
+    plt.close()
+    '''
+    
+    ################################################################################
+    # The single process is both coordinator and only worker
+    ################################################################################
+    
+    if telemetry is not None:
+        
+        telemetry.add_worker({'worker' : 0,
+                              'pid' : os.getpid(),
+                              'num_threads' : num_cpus,
+                              'num_batches' : num_batches,
+                              'num_cells' : num_processed,
+                              'num_holes' : int(np.count_nonzero(~np.isnan(results[:,0]))),
+                              'time_main' : time_main,
+                              'time_total' : time.time() - loop_start_time})
+        
+        telemetry.run.update({'num_workers' : 1,
+                              'time_dispatching' : time.time() - loop_start_time - time_main})
+        
+    return compact_holes(results)
+
+
+
+    
+    
+    
+    
+    
+
+
+def run_multi_process(cell_ID_gen, 
+                       ngrid, 
+                       dl, 
+                       dr,
+                       coord_min, 
+                       mask,
+                       mask_resolution,
+                       min_dist,
+                       max_dist,
+                       w_coord,
+                       batch_size=1000,
+                       verbose=False,
+                       num_cpus=1,
+                       exact_search=False,
+                       single_precision=False,
+                       checkpoint=None,
+                       max_respawns=None,
+                       max_batch_failures=2,
+                       telemetry=None,
+                       hole_stream=None,
+                       survey_voxels=None,
+                       galaxy_tree=None):
+    
+    
+    start_time = time.time()
+    
+    ################################################################################
+    #
+    # Initialize some output containers and counter variables
+    #
+    ################################################################################
+    #hole_times = []
+    
+    # Number of empty cells
+    #n_empty_cells = ngrid[0]*ngrid[1]*ngrid[2] - len(cell_ID_dict)
+    n_empty_cells = len(cell_ID_gen)
+    
+    
+    
+    ################################################################################
+    # mask needs to be 1 byte per bool to match the cython dtype
+    ################################################################################
+    
+    mask = mask.astype(np.uint8)
+    
+    
+    ################################################################################
+    #
+    #   BUILD NEAREST-NEIGHBOR TREE
+    #   galaxy_tree : GalaxyTree, the cython KDTree whose queries main_algorithm
+    #   calls directly without going through python
+    #   nearest neighbor finder for the galaxies in x,y,z space
+    #   (unless the caller already built one)
+    #
+    ################################################################################
+    
+    if galaxy_tree is None:
+        
+        if verbose:
+            
+            kdtree_start_time = time.time()
+    
+        galaxy_tree = GalaxyTree(w_coord, single_precision=single_precision)
+        
+        if verbose:
+            
+            print('KDTree creation time:', time.time() - kdtree_start_time)
+    
+    
+    ################################################################################
+    #
+    # Place the tree's flat arrays (which include the galaxy coordinates) and
+    # the mask (and the survey voxels) in shared memory once, so that every 
+    # worker attaches to the same pages instead of holding its own copy
+    #
+    ################################################################################
+    
+    tree_arrays = galaxy_tree.get_arrays()
+    
+    shared_arrays = SharedArrays(list(tree_arrays[:-1]) + [mask] + survey_voxel_arrays(survey_voxels))
+    
+    voxel_grid = survey_voxel_grid(survey_voxels)
+    
+    max_cpus = cpu_count()
+    
+    if (num_cpus is None) or (num_cpus > max_cpus):
+          
+        num_cpus = max_cpus
+    
+    ################################################################################
+    # The workers write the results of each batch straight into its rows of 
+    # the first array, so only (offset, length) notices come back on their 
+    # pipes.  In the second, each worker keeps the offset of the batch it is 
+    # growing holes in (-1 otherwise), so that a worker which dies is only 
+    # charged to the batch it was working on.
+    ################################################################################
+    
+    shared_results = SharedArrays([((n_empty_cells, 4), np.float64), ((num_cpus,), np.int64)])
+    
+    shared_results.arrays[1][:] = -1
+    
+    leaf_size = tree_arrays[-1]
+    
+    del galaxy_tree, tree_arrays
+    
+    
+    ################################################################################
+    #
+    # Set up worker processes
+    #
+    # Each worker gets its batches on its own pipe, and sends the notice for 
+    # each one back on the same pipe.  The coordinator keeps prefetch batches
+    # handed to every worker, so that a worker which finishes a batch always
+    # finds the next one waiting while there is work left, and sends a worker
+    # a new batch each time one of its results comes back.  Both sides block
+    # on their pipes, so nobody polls.  The size of each new batch comes from
+    # batch_sizer, so that the batches shrink towards the end of the run.
+    #
+    ################################################################################
+    
+    prefetch = 2
+    
+    batch_sizer = AdaptiveBatchSizer(batch_size, num_cpus)
+    
+    ################################################################################
+    # The batches handed out and not yet returned, by offset, and the offsets
+    # handed to each worker, in the order it works through them
+    ################################################################################
+    
+    outstanding = {}
+    
+    assigned = [[] for proc_idx in range(num_cpus)]
+    
+    processes = [None]*num_cpus
+    
+    connections = [None]*num_cpus
+    
+    def start_worker(proc_idx):
+        '''
+        Start worker proc_idx on a new pipe, and send it the batches assigned
+        to it.
+        '''
+        
+        connection, worker_connection = Pipe()
+        
+        shared_results.arrays[1][proc_idx] = -1
+        
+        worker_args = (proc_idx,
+                       shared_arrays, 
+                       shared_results,
+                       leaf_size,
+                       ngrid, 
+                       dl, 
+                       dr,
+                       coord_min, 
+                       mask_resolution,
+                       min_dist,
+                       max_dist,
+                       worker_connection,
+                       exact_search,
+                       voxel_grid)
+        
+        p = Process(target=_main_hole_finder_worker, args=worker_args)
+        
+        p.start()
+        
+        ############################################################
+        # Only the worker may hold its end, so that the pipe reads as
+        # closed once the worker is gone
+        ############################################################
+        worker_connection.close()
+        
+        processes[proc_idx] = p
+        
+        connections[proc_idx] = connection
+        
+        for offset in assigned[proc_idx]:
+            
+            connection.send((offset, outstanding[offset]))
+            
+    num_cells_dispatched = 0
+    
+    def dispatch(proc_idx):
+        '''
+        Hand the next batch of cells, if there are any left, to worker 
+        proc_idx.
+        '''
+        
+        nonlocal num_cells_dispatched
+        
+        cell_ID_list = cell_ID_gen.next_batch(batch_sizer.next_size(n_empty_cells - num_cells_dispatched))
+        
+        if cell_ID_list.shape[0] == 0:
+            
+            return
+        
+        offset = num_cells_dispatched
+        
+        outstanding[offset] = cell_ID_list
+        
+        assigned[proc_idx].append(offset)
+        
+        num_cells_dispatched += len(cell_ID_list)
+        
+        ############################################################
+        # If the worker has died, its replacement gets the batch
+        ############################################################
+        try:
+            
+            connections[proc_idx].send((offset, cell_ID_list))
+            
+        except OSError:
+            
+            pass
+    
+    for proc_idx in range(num_cpus):
+        
+        start_worker(proc_idx)
+
+    time_setup = time.time() - start_time
+    
+    if verbose:
+        print("Worker processes started time: ", time_setup)
+        
+    ################################################################################
+    #
+    # Fill the pipes, then hand out a new batch for every batch returned.
+    #
+    # A worker which dies (a crash in the cython code, or the OOM killer) 
+    # never returns its batches, so the coordinator also waits on the 
+    # sentinels of the workers.  Once the notices the dead worker sent have 
+    # been read, a new worker on a new pipe takes over the batches still 
+    # assigned to it, while the other workers carry on.  Up to max_respawns 
+    # workers (default num_cpus) may die in all.  Only the batch the dead 
+    # worker was growing holes in, if any, counts against it, and a batch 
+    # which has killed max_batch_failures workers is taken to crash the 
+    # kernel itself, so the run stops with an error naming its cells.
+    #
+    ################################################################################
+    
+    if max_respawns is None:
+        
+        max_respawns = num_cpus
+    
+    num_respawns = 0
+    
+    batch_failures = {}
+    
+    def replace_dead_worker(proc_idx):
+        
+        nonlocal num_respawns
+        
+        p = processes[proc_idx]
+        
+        p.join()
+        
+        ############################################################
+        # The worker keeps the offset of its batch set only while it
+        # is growing holes in it
+        ############################################################
+        offset = int(shared_results.arrays[1][proc_idx])
+        
+        if offset in assigned[proc_idx]:
+            
+            cell_ID_list = outstanding[offset]
+            
+            batch_failures[offset] = batch_failures.get(offset, 0) + 1
+            
+            batch_description = "the batch of " + str(len(cell_ID_list)) + " cells from " \
+                                + str(tuple(map(int, cell_ID_list[0]))) + " to " \
+                                + str(tuple(map(int, cell_ID_list[-1])))
+            
+            if batch_failures[offset] >= max_batch_failures:
+                
+                raise RuntimeError("Worker processes died " + str(batch_failures[offset]) \
+                                   + " times growing holes in " + batch_description \
+                                   + " (last exit code " + str(p.exitcode) + ")")
+            
+        else:
+            
+            batch_description = "no batch"
+        
+        num_respawns += 1
+        
+        if num_respawns > max_respawns:
+            
+            raise RuntimeError("Worker process " + str(proc_idx) + " died (exit code " \
+                               + str(p.exitcode) + ") in " + batch_description \
+                               + " after " + str(num_respawns - 1) + " workers had already died")
+        
+        print("Worker process", proc_idx, "died (exit code", str(p.exitcode) + ") in", 
+              batch_description + "; restarting it with", len(assigned[proc_idx]), "batches", 
+              flush=True)
+        
+        connections[proc_idx].close()
+        
+        start_worker(proc_idx)
+    
+    num_cells_processed = 0
+    
+    time_waiting = 0.0
+    
+    time_dispatching = 0.0
+    
+    dispatch_start = time.time()
+    
+    for _ in range(prefetch):
+        
+        for proc_idx in range(num_cpus):
+            
+            dispatch(proc_idx)
+    
+    try:
+        
+        while outstanding:
+            
+            time_dispatching += time.time() - dispatch_start
+            
+            wait_start = time.time()
+            
+            ready = wait(connections + [p.sentinel for p in processes])
+            
+            time_waiting += time.time() - wait_start
+            
+            dispatch_start = time.time()
+            
+            for proc_idx in range(num_cpus):
+                
+                connection = connections[proc_idx]
+                
+                p = processes[proc_idx]
+                
+                if connection not in ready and p.sentinel not in ready:
+                    
+                    continue
+                
+                ############################################################
+                # Read everything the worker sent before checking whether 
+                # it died, so that no finished batch is handed out again
+                ############################################################
+                messages = []
+                
+                died = False
+                
+                try:
+                    
+                    while connection.poll():
+                        
+                        messages.append(connection.recv())
+                        
+                except (EOFError, OSError):
+                    
+                    died = True
+                
+                for message in messages:
+                    
+                    offset = message[1]
+                    
+                    assigned[proc_idx].remove(offset)
+                    
+                    finished_cells = outstanding.pop(offset)
+                    
+                    batch_sizer.update(message[2], message[3])
+                    
+                    dispatch(proc_idx)
+                    
+                    num_batch_cells = message[2]
+                    
+                    if checkpoint is not None:
+                        
+                        checkpoint.append(finished_cells, shared_results.arrays[0][offset:offset + num_batch_cells])
+                        
+                    if hole_stream is not None:
+                        
+                        hole_stream.add(shared_results.arrays[0][offset:offset + num_batch_cells])
+                    
+                    if verbose and (num_cells_processed + num_batch_cells)//10000 > num_cells_processed//10000:
+                        
+                        print('Processed', num_cells_processed + num_batch_cells, 'cells of', n_empty_cells)
+                        
+                    num_cells_processed += num_batch_cells
+                
+                if died or p.exitcode is not None:
+                    
+                    replace_dead_worker(proc_idx)
+            
+    except:
+        
+        for p in processes:
+            
+            p.terminate()
+            
+            p.join()
+            
+        shared_arrays.close()
+        
+        shared_results.close()
+        
+        raise
+                
+    if verbose:
+        print("Main task finish time: ", time.time() - start_time)
+                
+    ################################################################################
+    #
+    # Clean up worker processes, without waiting on the 'Done' of one which
+    # died after the last batch
+    #
+    ################################################################################
+    
+    for connection in connections:
+        
+        try:
+            
+            connection.send(u"exit")
+            
+        except OSError:
+            
+            pass
+        
+    for connection in connections:
+        
+        try:
+            
+            message = connection.recv()
+            
+        except (EOFError, OSError):
+            
+            continue
+        
+        if message[0] == "Done" and telemetry is not None:
+            
+            telemetry.add_worker(message[1])
+            
+        connection.close()
+        
+    for p in processes:
+        
+        p.join(None)
+        
+    shared_arrays.close()
+    
+    hole_values = compact_holes(shared_results.arrays[0][:num_cells_processed])
+    
+    shared_results.close()
+        
+    if verbose:
+        
+        print("Num empty cells: ", n_empty_cells)
+        
+    if telemetry is not None:
+        
+        telemetry.run.update({'num_workers' : num_cpus,
+                              'num_respawns' : num_respawns,
+                              'time_setup' : time_setup,
+                              'time_dispatching' : time_dispatching,
+                              'time_waiting' : time_waiting})
+        
+    return hole_values
+                    
+    
+    
+    
+    
+    
+    
+    
+    
+
+
+
+def run_decomposed(cell_ID_dict, 
+                   ngrid, 
+                   dl, 
+                   dr,
+                   coord_min, 
+                   mask,
+                   mask_resolution,
+                   min_dist,
+                   max_dist,
+                   w_coord,
+                   domain_cells=32,
+                   halo=75.,
+                   batch_size=1000,
+                   verbose=False,
+                   num_cpus=1,
+                   use_threads=False,
+                   exact_search=False,
+                   single_precision=False,
+                   checkpoint=None,
+                   max_respawns=None,
+                   telemetry=None,
+                   hole_stream=None,
+                   survey_voxels=None):
+    '''
+    Description:
+    ============
+    
+    Grow the holes domain by domain.  The grid is split into cubic domains 
+    of domain_cells cells on a side, and the holes of each domain are grown 
+    on a small tree of only the galaxies within halo Mpc/h of it, so that 
+    each worker works on a compact part of the survey through a shallow tree
+    and holds only O(N/P) galaxies of its own.
+    
+    A hole grown on a domain's tree is the same as on the full tree if no 
+    galaxy missing from the domain's tree could have stopped its growth.  
+    Every sphere the hole passes through while growing has the hole's first
+    galaxy A on its surface and a radius of at most r + dr (r the final 
+    radius), so all of them lie within 3r + 2dr of the final center.  Holes
+    for which that ball is not inside the halo, and the cells which did not 
+    produce a hole (their growth may have left the halo), are grown again on
+    the full tree.  The holes found are the same as _main_hole_finder's, in 
+    a different order.
+    
+    
+    Parameters:
+    ===========
+    
+    cell_ID_dict, ngrid, dl, dr, coord_min, mask, mask_resolution, min_dist,
+    max_dist, w_coord, batch_size, verbose, num_cpus, use_threads, 
+    exact_search, single_precision :
+        as for _main_hole_finder; batch_size is the size of the batches of 
+        cells grown again on the full tree
+        
+    domain_cells : integer
+        Number of cells on each side of a domain.  Default is 32.
+        
+    halo : float
+        Distance in Mpc/h around each domain from which galaxies are added 
+        to its tree.  Holes of radius up to about (halo - 2dr)/3 are 
+        finished within their domain.  Default is 75.
+        
+    checkpoint : CheckpointLog
+        If not None, log to append each finished domain and batch to.  
+        Default is None.
+        
+    max_respawns : integer
+        Number of worker processes which may die (their jobs being handed 
+        to a new set of workers) before the run stops with a RuntimeError.
+        Default is num_cpus.
+        
+    telemetry : HoleGrowthTelemetry
+        If not None, counters to add the number of domains and of cells grown
+        again on the full tree to.  Default is None.
+        
+    hole_stream : HoleStream
+        If not None, stream to add each finished domain and batch to.  
+        Default is None.
+        
+    survey_voxels : SurveyVoxelGrid
+        If not None, voxel grid to check the survey footprint with before 
+        falling back to the mask.  Default is None.
+    
+    
+    Returns:
+    ========
+    
+    myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes :
+        as returned by _main_hole_finder
+    '''
+    
+    start_time = time.time()
+    
+    if num_cpus is None:
+        
+        num_cpus = cpu_count()
+    
+    mask = mask.astype(np.uint8)
+    
+    occupied = occupancy_grid(ngrid, cell_ID_dict)
+    
+    domains = split_domains(ngrid, domain_cells)
+    
+    ################################################################################
+    # Sort the galaxies by domain once, so that each domain takes its halo 
+    # galaxies from a few ranges of the sorted array instead of the whole 
+    # catalog
+    ################################################################################
+    
+    order, galaxy_ranges = bin_galaxies(w_coord, coord_min, dl, ngrid, domain_cells, halo)
+    
+    w_coord = w_coord[order]
+    
+    galaxy_bounds = np.stack((w_coord.min(axis=0), w_coord.max(axis=0)))
+    
+    galaxy_tree = GalaxyTree(w_coord, single_precision=single_precision)
+    
+    tree_arrays = galaxy_tree.get_arrays()
+    
+    growth_args = (dl, dr, coord_min, mask_resolution, min_dist, max_dist, halo, exact_search, single_precision)
+    
+    finished = []
+    
+    retry_cells = []
+    
+    def finish(cells, results):
+        
+        finished.append(results)
+        
+        if checkpoint is not None:
+            
+            checkpoint.append(cells, results)
+            
+        if hole_stream is not None:
+            
+            hole_stream.add(results)
+    
+    ################################################################################
+    #
+    # With one process (or threads), grow the domains and then the escaped 
+    # holes in this process
+    #
+    ################################################################################
+    
+    if use_threads or num_cpus == 1:
+        
+        num_threads = num_cpus if use_threads else 1
+        
+        workspace = HoleGrowthWorkspace(num_threads)
+        
+        for (lower, upper), ranges in zip(domains, galaxy_ranges):
+            
+            cells, results, escaped = grow_domain(lower, upper, occupied, w_coord, ranges, 
+                                                  galaxy_bounds, mask, growth_args, num_threads, 
+                                                  workspace, survey_voxels)
+            
+            finish(cells, results)
+            
+            retry_cells.append(escaped)
+            
+        retry_cells = np.concatenate(retry_cells)
+        
+        for start in range(0, retry_cells.shape[0], batch_size):
+            
+            cells = retry_cells[start:start + batch_size]
+            
+            results = np.empty((cells.shape[0], 4), dtype=np.float64)
+            
+            main_algorithm(cells, galaxy_tree, dl, dr, coord_min, mask, mask_resolution, 
+                           min_dist, max_dist, results, 0, num_threads, exact_search, workspace,
+                           survey_voxels)
+            
+            finish(cells, results)
+            
+    ################################################################################
+    #
+    # Otherwise the workers take the domains off a shared job_queue, then the
+    # batches of escaped cells, attaching to the full tree in shared memory 
+    # only for those
+    #
+    ################################################################################
+    
+    else:
+        
+        num_cpus = min(num_cpus, cpu_count())
+        
+        shared_arrays = SharedArrays([w_coord, mask, occupied] + list(tree_arrays[:-1]) 
+                                     + survey_voxel_arrays(survey_voxels))
+        
+        voxel_grid = survey_voxel_grid(survey_voxels)
+        
+        ############################################################
+        # The jobs queued or in progress, by job ID
+        ############################################################
+        outstanding = {}
+        
+        processes = []
+        
+        def start_workers():
+            '''
+            Start num_cpus workers on new queues, and queue the outstanding 
+            jobs for them.
+            '''
+            
+            nonlocal job_queue, return_queue
+            
+            job_queue = Queue()
+            
+            return_queue = Queue()
+            
+            processes.clear()
+            
+            for proc_idx in range(num_cpus):
+                
+                p = Process(target=_decomposed_worker, 
+                            args=(shared_arrays, tree_arrays[-1], growth_args, galaxy_bounds, 
+                                  job_queue, return_queue, voxel_grid))
+                
+                p.start()
+                
+                processes.append(p)
+                
+            for job in outstanding.values():
+                
+                job_queue.put(job)
+                
+        job_queue = None
+        
+        return_queue = None
+        
+        start_workers()
+        
+        ############################################################
+        # As in run_multi_process, a worker which dies never returns
+        # its job and may leave a queue lock held, so between 
+        # messages the exit codes of the workers are checked, and a 
+        # new set of workers on new queues picks up every job 
+        # without results, up to max_respawns dead workers in all
+        ############################################################
+        if max_respawns is None:
+            
+            max_respawns = num_cpus
+        
+        num_respawns = 0
+        
+        def restart_if_workers_died():
+            
+            nonlocal num_respawns
+            
+            dead = [(proc_idx, p) for proc_idx, p in enumerate(processes) if p.exitcode is not None]
+            
+            if not dead:
+                
+                return
+            
+            for proc_idx, p in dead:
+                
+                num_respawns += 1
+                
+                if num_respawns > max_respawns:
+                    
+                    raise RuntimeError("Worker process " + str(proc_idx) + " died (exit code " \
+                                       + str(p.exitcode) + ") after " + str(num_respawns - 1) \
+                                       + " workers had already died")
+                
+                print("Worker process", proc_idx, "died (exit code", str(p.exitcode) + ");", 
+                      "restarting the workers with", len(outstanding), "jobs outstanding", flush=True)
+                
+            for p in processes:
+                
+                p.terminate()
+                
+                p.join()
+                
+            for queue in (job_queue, return_queue):
+                
+                queue.cancel_join_thread()
+                
+                queue.close()
+                
+            start_workers()
+            
+        def run_jobs(jobs):
+            '''
+            Queue jobs, and yield the result of each as it comes back.
+            '''
+            
+            for job in jobs:
+                
+                outstanding[job[1]] = job
+                
+                job_queue.put(job)
+                
+            while outstanding:
+                
+                restart_if_workers_died()
+                
+                try:
+                    
+                    job_id, result = return_queue.get(timeout=1.)
+                    
+                except Empty:
+                    
+                    continue
+                
+                ############################################################
+                # A job queued again after its worker died may come back 
+                # twice
+                ############################################################
+                if outstanding.pop(job_id, None) is not None:
+                    
+                    yield result
+                
+        try:
+            
+            domain_jobs = [('domain', job_id, lower, upper, ranges) 
+                           for job_id, ((lower, upper), ranges) in enumerate(zip(domains, galaxy_ranges))]
+            
+            for cells, results, escaped in run_jobs(domain_jobs):
+                
+                finish(cells, results)
+                
+                retry_cells.append(escaped)
+                
+            retry_cells = np.concatenate(retry_cells)
+            
+            batches = [('cells', len(domains) + job_id, retry_cells[start:start + batch_size]) 
+                       for job_id, start in enumerate(range(0, retry_cells.shape[0], batch_size))]
+            
+            for cells, results in run_jobs(batches):
+                
+                finish(cells, results)
+                
+        except:
+            
+            for p in processes:
+                
+                p.terminate()
+                
+                p.join()
+                
+            shared_arrays.close()
+            
+            raise
+        
+        ############################################################
+        # Stop the workers, without waiting on those which cannot 
+        # get their 'exit' because another died holding the 
+        # job_queue lock
+        ############################################################
+        for p in processes:
+            
+            job_queue.put('exit')
+            
+        for p in processes:
+            
+            while p.exitcode is None and all(other.exitcode in (None, 0) for other in processes):
+                
+                p.join(1.)
+                
+            p.terminate()
+            
+            p.join()
+            
+        shared_arrays.close()
+            
+    if verbose:
+        
+        print("Grew holes in", len(domains), "domains, and", retry_cells.shape[0], 
+              "cells again on the full tree, in", time.time() - start_time)
+        
+    if telemetry is not None:
+        
+        telemetry.run.update({'num_workers' : num_cpus,
+                              'num_domains' : len(domains),
+                              'num_retried_cells' : retry_cells.shape[0]})
+    
+    return compact_holes(np.concatenate(finished) if finished else np.empty((0,4)))
+
+
+
+
+def occupancy_grid(ngrid, cell_ID_dict):
+    '''
+    Boolean array of shape ngrid, True in the cells which are keys of 
+    cell_ID_dict.  Keys outside the grid are left out, as CellIDGenerator 
+    never reaches them.  An occupancy array is returned as it is.
+    '''
+    
+    if isinstance(cell_ID_dict, np.ndarray):
+        
+        if cell_ID_dict.shape != tuple(ngrid):
+            
+            raise ValueError("Occupancy grid of shape " + str(cell_ID_dict.shape) + " does not match ngrid " + str(tuple(ngrid)))
+        
+        return cell_ID_dict.astype(bool, copy=False)
+    
+    occupied = np.zeros(tuple(ngrid), dtype=bool)
+    
+    if len(cell_ID_dict) > 0:
+        
+        cells = np.array(list(cell_ID_dict.keys()), dtype=np.int64)
+        
+        cells = cells[np.all((cells >= 0) & (cells < np.array(ngrid)), axis=1)]
+        
+        occupied[tuple(cells.T)] = True
+        
+    return occupied
+
+
+
+
+def split_domains(ngrid, domain_cells):
+    '''
+    Split the grid into cubic domains of domain_cells cells on a side 
+    (smaller along the upper edges), returned as a list of (lower, upper) 
+    cell index arrays, upper exclusive.
+    '''
+    
+    ranges = [[(start, min(start + domain_cells, n)) for start in range(0, n, domain_cells)] for n in ngrid]
+    
+    domains = []
+    
+    for i_lower, i_upper in ranges[0]:
+        
+        for j_lower, j_upper in ranges[1]:
+            
+            for k_lower, k_upper in ranges[2]:
+                
+                domains.append((np.array([i_lower, j_lower, k_lower]), np.array([i_upper, j_upper, k_upper])))
+                
+    return domains
+
+
+
+
+def bin_galaxies(w_coord, coord_min, dl, ngrid, domain_cells, halo):
+    '''
+    Description:
+    ============
     
-            if len(i_nearest) <= 0:
-                timer1 = time.time()
-                PROFILE_TEMP = not_in_mask(hole_center_42, mask, mask_resolution, min_dist, max_dist)
-                timer2 = time.time()
-                PROFILE_mask_times.append(timer2- timer1)
+    Sort the galaxies by the domain of split_domains they fall in, and list
+    for each domain the ranges of the sorted galaxies in the domains near 
+    enough to hold galaxies within halo of it.  Galaxies outside the grid 
+    are put in the nearest domain.
     
-            if len(i_nearest) > 0:
-                # Found at least one other nearest neighbor!
     
-                # Calculate vector pointing from hole center to next nearest galaxies
-                Dcenter = w_coord[i_nearest] - hole_center  # shape (N,3)
+    Parameters:
+    ===========
     
-                bot = 2*np.dot((Dcenter - Acenter), v3_unit.T)  # shape (N,)
+    w_coord, coord_min, dl, ngrid :
+        as for _main_hole_finder
+        
+    domain_cells, halo :
+        as for run_decomposed
     
-                top = np.sum(Dcenter**2, axis=1) - np.sum(Bcenter**2)  # shape (N,)
     
-                x42 = top/bot  # shape (N,)
+    Returns:
+    ========
     
-                # Locate positive values of x42
-                valid_idx = np.where(x42 > 0)[0]  # shape (n,)
+    order : numpy.ndarray of shape (N,)
+        indices which sort w_coord by domain
+        
+    galaxy_ranges : list of numpy.ndarray of shape (K,2)
+        for each domain, in the order of split_domains, the (start, stop) 
+        ranges of the rows of w_coord[order] in it and its neighbours
+    '''
     
-                if len(valid_idx) > 0:
-                    # Find index of 3rd nearest galaxy
-                    k4g2_x42 = valid_idx[x42[valid_idx].argmin()]
-                    k4g2 = i_nearest[k4g2_x42]
+    num_domains = -(-np.asarray(ngrid, dtype=np.int64)//domain_cells)
     
-                    minx42 = x42[k4g2_x42]
+    domain_index = np.floor((w_coord - coord_min[0])/(dl*domain_cells)).astype(np.int64)
     
-                    galaxy_search = False
+    np.clip(domain_index, 0, num_domains - 1, out=domain_index)
     
-            #elif not in_mask(hole_center_42, mask, mask_resolution, [min_dist, max_dist]):
-            elif PROFILE_TEMP:
-                # Hole is no longer within survey limits
-                galaxy_search = False
-                in_mask_42 = False
+    flat_index = np.ravel_multi_index(tuple(domain_index.T), num_domains)
     
-        #print('Found second potential 4th galaxy')
-        
+    order = np.argsort(flat_index, kind='stable')
     
-        # Calculate potential new hole center
-        #if not not_in_mask(hole_center_42, mask, mask_resolution, min_dist, max_dist):
-        if in_mask_42:
-            hole_center_42 = hole_center + minx42*v3_unit  # shape (1,3)
-            #print(hole_center_42, 'hc42')
-            #print('hole_radius_42', np.linalg.norm(hole_center_42 - w_coord[k1g]))
-            #print('minx41:', minx41, '   minx42:', minx42)
-        
-        
-        ########################################################################
-        # Figure out which is the real galaxy 4
-        ########################################################################
+    bin_starts = np.searchsorted(flat_index[order], np.arange(np.prod(num_domains) + 1))
+    
+    ############################################################
+    # A galaxy within halo of a domain is at most this many 
+    # domains away from it along each axis.  Along the last axis 
+    # the neighbouring bins are contiguous in the sorted array, 
+    # so each (i,j) column of them is one range.
+    ############################################################
+    reach = int(halo//(dl*domain_cells)) + 1
+    
+    galaxy_ranges = []
+    
+    for i, j, k in np.ndindex(*num_domains):
         
+        k_lower = max(k - reach, 0)
         
-        # Determine which is the 4th nearest galaxy
-        #if in_mask(hole_center_41, mask, mask_resolution, [min_dist, max_dist]) and minx41 <= minx42:
-        timer1 = time.time()
-        not_in_mask_41 = not_in_mask(hole_center_41, mask, mask_resolution, min_dist, max_dist)
-        timer2 = time.time()
-        PROFILE_mask_times.append(timer2- timer1)
+        k_upper = min(k + reach, num_domains[2] - 1)
         
+        ranges = []
         
-        if not not_in_mask_41 and minx41 <= minx42:
-            # The first 4th galaxy found is the next closest
-            hole_center = hole_center_41
-            k4g = k4g1
-        elif not not_in_mask(hole_center_42, mask, mask_resolution, min_dist, max_dist):
-            # The second 4th galaxy found is the next closest
-            
-            timer1 = time.time()
-            not_in_mask(hole_center_42, mask, mask_resolution, min_dist, max_dist)
-            timer2 = time.time()
-            PROFILE_mask_times.append(timer2- timer1)
-            
-            
-            
-            
-            hole_center = hole_center_42
-            k4g = k4g2
-        elif not not_in_mask_41:
-            # The first 4th galaxy found is the next closest
-            hole_center = hole_center_41
-            k4g = k4g1
-        else:
-            # Neither hole center is within the mask - not a valid hole
-            PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
+        for i_near in range(max(i - reach, 0), min(i + reach, num_domains[0] - 1) + 1):
             
-            continue
+            for j_near in range(max(j - reach, 0), min(j + reach, num_domains[1] - 1) + 1):
+                
+                start = bin_starts[np.ravel_multi_index((i_near, j_near, k_lower), num_domains)]
+                
+                stop = bin_starts[np.ravel_multi_index((i_near, j_near, k_upper), num_domains) + 1]
+                
+                ranges.append((start, stop))
+                
+        galaxy_ranges.append(np.array(ranges, dtype=np.int64))
+        
+    return order, galaxy_ranges
+
+
+
+
+def grow_domain(lower, upper, occupied, w_coord, galaxy_ranges, galaxy_bounds, mask, growth_args, 
+                num_threads=1, workspace=None, survey_voxels=None):
+    '''
+    Description:
+    ============
     
+    Grow the holes of the empty cells from lower to upper (exclusive) on a 
+    tree of the galaxies within halo of them, and sort out the holes which
+    may have been changed by the missing galaxies (see run_decomposed).
     
-        PROFILE_4_time = time.time() - PROFILE_4_start
     
-        ########################################################################
-        # Calculate Radius of the hole
-        ########################################################################
-        hole_radius = np.linalg.norm(hole_center - w_coord[k1g])
+    Parameters:
+    ===========
     
+    lower, upper : numpy.ndarray of shape (3,)
+        cell indices of the corners of the domain
         
-        ########################################################################
-        # Save hole
-        ########################################################################
-        
-        
-        PROFILE_section_1_times.append(PROFILE_1_time)
-        PROFILE_section_2_times.append(PROFILE_2_time)
-        PROFILE_section_3_times.append(PROFILE_3_time)
-        PROFILE_section_4_times.append(PROFILE_4_time)
-        
-        
-        
-        myvoids_x.append(hole_center[0,0])
-        #x_val = hole_center[0,0]
-        
-        myvoids_y.append(hole_center[0,1])
-        #y_val = hole_center[0,1]
+    occupied : numpy.ndarray of shape ngrid of bool
+        cells containing galaxies
         
-        myvoids_z.append(hole_center[0,2])
-        #z_val = hole_center[0,2]
+    w_coord : numpy.ndarray of shape (N,3)
+        coordinates of all the galaxies, sorted by bin_galaxies
         
-        myvoids_r.append(hole_radius)
-        #r_val = hole_radius
+    galaxy_ranges : numpy.ndarray of shape (K,2)
+        (start, stop) ranges of the rows of w_coord in the domain and its 
+        neighbours out to halo, from bin_galaxies
         
-        #hole_times.append(time.time() - hole_start)
+    galaxy_bounds : numpy.ndarray of shape (2,3)
+        minimum and maximum coordinates of all the galaxies
         
-        #print(hole_times[n_holes], i,j,k)
+    mask : numpy.ndarray of shape (N,M) of uint8
+        survey footprint
         
-        n_holes += 1
+    growth_args : tuple
+        (dl, dr, coord_min, mask_resolution, min_dist, max_dist, halo, 
+        exact_search, single_precision)
         
-        PROFILE_loop_end_time = time.time()
+    num_threads : integer
+        number of OpenMP threads for main_algorithm
         
-        PROFILE_void_times.append(PROFILE_loop_end_time - PROFILE_loop_start_time)
+    workspace : HoleGrowthWorkspace
+        scratch space for main_algorithm
         
-        PROFILE_loop_times.append(PROFILE_loop_end_time - PROFILE_loop_start_time)
-    
-    
-    ########################################################################
-    # Profiling statistics
-    ########################################################################
-    
+    survey_voxels : SurveyVoxelGrid
+        voxel grid for the footprint checks of main_algorithm, or None
     
-    total_time = time.time() - PROFILE_total_start
     
-    print("Total time: ", total_time)
-    print("Loop time: ", np.sum(PROFILE_loop_times))
-    print("Query time: ", np.sum(PROFILE_query_times))
-    print("Mask time: ", np.sum(PROFILE_mask_times))
-    print("Total loops: ", len(PROFILE_loop_times))
-    print("Total queries: ", len(PROFILE_query_times))
-    print("Total masks: ", len(PROFILE_mask_times))
-    print("Total (void-cell) time: ", np.sum(PROFILE_void_times))
-    print("Section 1 (void) time: ", np.sum(PROFILE_section_1_times))
-    print("Section 2 (void) time: ", np.sum(PROFILE_section_2_times))
-    print("Section 3 (void) time: ", np.sum(PROFILE_section_3_times))
-    print("Section 4 (void) time: ", np.sum(PROFILE_section_4_times))
+    Returns:
+    ========
     
+    cells : numpy.ndarray of shape (N,3)
+        cells whose holes are final
+        
+    results : numpy.ndarray of shape (N,4)
+        their main_algorithm results
+        
+    escaped : numpy.ndarray of shape (M,3)
+        cells to grow again on the full tree
+    '''
     
+    dl, dr, coord_min, mask_resolution, min_dist, max_dist, halo, exact_search, single_precision = growth_args
     
-    fig = plt.figure(figsize=(14,10))
-    plt.hist(PROFILE_loop_times, bins=50)
-    plt.title("All Single Cell processing times (sec)")
-    #plt.show()
-    plt.savefig("Cell_time_dist.png")
-    plt.close()
+    domain = tuple(slice(lower[dim], upper[dim]) for dim in range(3))
     
-    fig = plt.figure(figsize=(14,10))
-    plt.hist(PROFILE_query_times, bins=50)
-    plt.title("All Query KDTree times (sec)")
-    #plt.show()
-    plt.savefig("Query_time_dist.png")
-    plt.close()
+    cells = (np.argwhere(~occupied[domain]) + lower).astype(np.int64)
     
-    fig = plt.figure(figsize=(14,10))
-    plt.hist(PROFILE_mask_times, bins=50)
-    plt.title("All calls to not_in_mask times (sec)")
-    #plt.show()
-    plt.savefig("not_in_mask_time_dist.png")
-    plt.close()
+    ############################################################
+    # The region whose galaxies are all in the domain's tree,
+    # unbounded on the sides where it takes in every galaxy
+    ############################################################
+    covered_lower = coord_min[0] + lower*dl - halo
     
-    fig = plt.figure(figsize=(19.2,12))
-    top_left = plt.subplot(221)
-    top_right = plt.subplot(222)
-    bot_left = plt.subplot(223)
-    bot_right = plt.subplot(224)
-    top_left.hist(PROFILE_section_1_times, bins=50)
-    top_right.hist(PROFILE_section_2_times, bins=50)
-    bot_left.hist(PROFILE_section_3_times, bins=50)
-    bot_right.hist(PROFILE_section_4_times, bins=50)
-    top_left.set_title("(Void cells only) Section 1 times (sec)")
-    top_right.set_title("(Void cells only) Section 2 times (sec)")
-    bot_left.set_title("(Void cells only) Section 3 times (sec)")
-    bot_right.set_title("(Void cells only) Section 4 times (sec)")
-    #plt.show()
-    plt.savefig("void_cell_section_breakdown_dist.png")
-    plt.close()
+    covered_upper = coord_min[0] + upper*dl + halo
     
+    halo_coord = np.concatenate([w_coord[start:stop] for start, stop in galaxy_ranges])
     
+    in_halo = np.all((halo_coord >= covered_lower) & (halo_coord <= covered_upper), axis=1)
     
+    covered_lower[covered_lower <= galaxy_bounds[0]] = -np.inf
     
+    covered_upper[covered_upper >= galaxy_bounds[1]] = np.inf
     
+    if cells.shape[0] == 0 or np.count_nonzero(in_halo) == 0:
         
-    return myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes
-
-
-
-    
-
-    
-def run_single_process_cython(cell_ID_gen, 
-                       ngrid, 
-                       dl, 
-                       dr,
-                       coord_min, 
-                       mask,
-                       mask_resolution,
-                       min_dist,
-                       max_dist,
-                       w_coord,
-                       batch_size=1000,
-                       verbose=False,
-                       num_cpus=None):
+        return cells[:0], np.empty((0,4), dtype=np.float64), cells
     
+    local_tree = GalaxyTree(halo_coord[in_halo], single_precision=single_precision)
     
-    ################################################################################
-    #
-    # Profiling
-    #
-    ################################################################################
-    
-    PROFILE_loop_times = []
+    results = np.empty((cells.shape[0], 4), dtype=np.float64)
     
+    main_algorithm(cells, local_tree, dl, dr, coord_min, mask, mask_resolution, 
+                   min_dist, max_dist, results, 0, num_threads, exact_search, workspace, 
+                   survey_voxels)
     
-    ################################################################################
-    #
-    # Initialize some output containers and counter variables
-    #
-    ################################################################################
+    ############################################################
+    # Keep the holes whose growth stayed in the covered region.  
+    # Of the cells without holes, those centered outside the 
+    # survey never started growing, but the others may have left 
+    # it, unless nothing was left out of the tree.
+    ############################################################
+    if np.all(np.isinf(covered_lower)) and np.all(np.isinf(covered_upper)):
+        
+        return cells, results, cells[:0]
     
-    print("Running single-process mode")
+    reach = 3*results[:,3:4] + 2*dr
     
-    myvoids_x = []
+    final = np.all(results[:,:3] - reach >= covered_lower, axis=1) \
+            & np.all(results[:,:3] + reach <= covered_upper, axis=1)
     
-    myvoids_y = []
+    no_hole = np.isnan(results[:,3])
     
-    myvoids_z = []
+    cell_centers = (cells[no_hole] + 0.5)*dl + coord_min
     
-    myvoids_r = []
+    final[no_hole] = ~points_in_mask(cell_centers, mask, mask_resolution, min_dist, max_dist)
     
-    n_holes = 0
+    return cells[final], results[final], cells[~final]
 
-    empty_cell_counter = 0
+
+
+
+def compact_holes(results):
+    '''
+    Drop the rows of NAN (cells which did not produce a hole) from the 
+    (N,4) array of main_algorithm results and split the rest into the 
+    values returned by _main_hole_finder.
+    '''
     
-    n_empty_cells = len(cell_ID_gen)
+    holes = results[~np.isnan(results[:,0])]
     
-    #return_array = np.empty(4, dtype=np.float64)
+    return holes[:,0].copy(), holes[:,1].copy(), holes[:,2].copy(), holes[:,3].copy(), holes.shape[0]
     
-    ################################################################################
-    # Convert the mask to an array of uint8 values for running in the cython code
-    ################################################################################
     
     
-    mask = mask.astype(np.uint8)
     
+class AdaptiveBatchSizer(object):
+    '''
+    Description:
+    ============
     
-    ################################################################################
-    #
-    #   BUILD NEAREST-NEIGHBOR TREE
-    #   galaxy_tree : sklearn.neighbors/scipy KDTree or similar implementing sklearn interface
-    #   nearest neighbor finder for the galaxies in x,y,z space
-    #
-    ################################################################################
+    Chooses the size of each batch of cells run_multi_process hands out.
     
-    if verbose:
-        
-        kdtree_start_time = time.time()
-
-    galaxy_tree = neighbors.KDTree(w_coord)
+    The time per cell varies by orders of magnitude between the cells near 
+    walls and the cells deep in voids, so a fixed batch size leaves the 
+    workers which drew the last few slow batches running long after the 
+    others are idle.  Each batch is instead the smallest of
+    
+        - max_batch_size
+        - the number of cells a worker processes in target_batch_time, from 
+          a running average of the measured time per cell
+        - the remaining cells divided by 2*num_workers (guided scheduling), 
+          so the batches shrink geometrically towards the end of the run
+          
+    and no smaller than min_batch_size.
     
-    if verbose:
-        
-        print('KDTree creation time:', time.time() - kdtree_start_time)
     
+    Parameters:
+    ===========
     
-    ################################################################################
-    # Main loop
-    ################################################################################
+    max_batch_size : integer
+        Largest batch to hand out
+        
+    num_workers : integer
+        Number of worker processes
+        
+    target_batch_time : float
+        Time in seconds a batch should take a worker.  Default is 0.5.
+        
+    min_batch_size : integer
+        Smallest batch to hand out, to bound the queue overhead per cell.  
+        Default is 16.
     '''
-    num_cells_processed = 0
     
-    for hole_center_coords in cell_ID_list:
-                    
-        num_cells_processed += 1
+    def __init__(self, max_batch_size, num_workers, target_batch_time=0.5, min_batch_size=16):
         
-        PROFILE_loop_start_time = time.time()
+        self.max_batch_size = max_batch_size
         
-        if verbose:
-            
-            if num_cells_processed % 10000 == 0:
-                
-               print('Processed', num_cells_processed, 'cells of', n_empty_cells)
+        self.num_workers = num_workers
         
-        i, j, k = hole_center_coords
+        self.target_batch_time = target_batch_time
         
+        self.min_batch_size = min(min_batch_size, max_batch_size)
         
-        main_algorithm(i,
-                       j,
-                       k,
-                       galaxy_tree,
-                       w_coord,
-                       dl, 
-                       dr,
-                       coord_min,
-                       mask,
-                       mask_resolution,
-                       min_dist,
-                       max_dist,
-                       return_array
-                       )
+        self.time_per_cell = None
         
-        x_val = return_array[0]
-        y_val = return_array[1]
-        z_val = return_array[2]
-        r_val = return_array[3]
         
+    def update(self, num_cells, elapsed):
+        '''
+        Fold the measured time of a finished batch into the running average 
+        of the time per cell.
+        '''
         
+        if num_cells == 0:
+            
+            return
         
-        if not np.isnan(x_val):
-                
-            myvoids_x.append(x_val)
-            #x_val = hole_center[0,0]
+        batch_time_per_cell = elapsed/num_cells
+        
+        if self.time_per_cell is None:
             
-            myvoids_y.append(y_val)
-            #y_val = hole_center[0,1]
+            self.time_per_cell = batch_time_per_cell
             
-            myvoids_z.append(z_val)
-            #z_val = hole_center[0,2]
+        else:
             
-            myvoids_r.append(r_val)
-            #r_val = hole_radius
+            self.time_per_cell = 0.7*self.time_per_cell + 0.3*batch_time_per_cell
             
-            n_holes += 1
+            
+    def next_size(self, num_remaining):
+        '''
+        Size of the next batch, given the number of cells not yet handed out.
+        '''
         
+        size = min(self.max_batch_size, int(np.ceil(num_remaining/(2*self.num_workers))))
         
-        PROFILE_loop_times.append(time.time() - PROFILE_loop_start_time)
-    '''
-    
-    
+        if self.time_per_cell is not None and self.time_per_cell > 0:
+            
+            size = min(size, int(self.target_batch_time/self.time_per_cell))
+            
+        return max(size, self.min_batch_size)
     
     
-    num_processed = 0
     
-    num_in_batch = 0
     
-    cell_ID_list = []
+class HoleGrowthTelemetry(object):
+    '''
+    Description:
+    ============
     
+    Performance counters of one hole growing run, for telling a starved 
+    coordinator from an expensive kernel from IPC overhead.
     
-    return_array = np.empty((batch_size, 4), dtype=np.float64)
+    self.run holds the counters of the run as a whole (wall time, time the 
+    coordinator spent setting up, dispatching batches and waiting on 
+    results, ...) and self.workers one dict per worker process (time in 
+    main_algorithm, time waiting for batches, time returning results, cells 
+    and holes per second of main_algorithm, ...).
+    '''
     
-    for curr_ID in cell_ID_gen:
+    def __init__(self):
         
+        self.run = {}
         
+        self.workers = []
         
-        if (verbose > 0 and num_processed % 10000 == 0):
         
-            print("Processing cell "+str(num_processed)+" of "+str(n_empty_cells))
-            
-        num_processed += 1
+    def add_worker(self, stats):
+        '''
+        Add the counters of one worker, and its rates of cells and holes per 
+        second of time_main.
+        '''
         
+        stats = dict(stats)
         
-        if num_in_batch < batch_size:
+        if stats['time_main'] > 0:
             
-            cell_ID_list.append(curr_ID)
+            stats['cells_per_sec'] = stats['num_cells']/stats['time_main']
             
-            num_in_batch += 1
+            stats['holes_per_sec'] = stats['num_holes']/stats['time_main']
             
+        self.workers.append(stats)
+        
+        
+    def write(self, path):
+        '''
+        Write the counters to path, as CSV rows of (scope, name, value) if 
+        path ends in .csv and as JSON {"run" : {...}, "workers" : [...]} 
+        otherwise.
+        '''
+        
+        if path.endswith('.csv'):
             
-        if num_in_batch == batch_size or num_processed == n_empty_cells:
-    
-            
-            i_j_k_array = np.array(cell_ID_list, dtype=np.int64)
-            
-            #return_array = np.empty((n_empty_cells, 4), dtype=np.float64)
-            if len(cell_ID_list) != return_array.shape[0]:
-                
-                return_array = np.empty((len(cell_ID_list), 4), dtype=np.float64)
-                
-            main_algorithm(i_j_k_array,
-                           galaxy_tree,
-                           w_coord,
-                           dl, 
-                           dr,
-                           coord_min,
-                           mask,
-                           mask_resolution,
-                           min_dist,
-                           max_dist,
-                           return_array,
-                           0  #verbose level
-                           )
-                
-            
-            #print("Exited main algorithm returned to python")
-            
+            with open(path, 'w', newline='') as report_file:
                 
-            for row in return_array:
+                writer = csv.writer(report_file)
                 
-                x_val = row[0]
-                y_val = row[1]
-                z_val = row[2]
-                r_val = row[3]
+                writer.writerow(['scope', 'name', 'value'])
                 
-                if not np.isnan(x_val):
-                        
-                    myvoids_x.append(x_val)
-                    #x_val = hole_center[0,0]
+                for name, value in self.run.items():
                     
-                    myvoids_y.append(y_val)
-                    #y_val = hole_center[0,1]
+                    writer.writerow(['run', name, value])
                     
-                    myvoids_z.append(z_val)
-                    #z_val = hole_center[0,2]
+                for stats in self.workers:
                     
-                    myvoids_r.append(r_val)
-                    #r_val = hole_radius
-                    
-                    n_holes += 1
+                    for name, value in stats.items():
+                        
+                        writer.writerow(['worker ' + str(stats['worker']), name, value])
                     
-            num_in_batch = 0
-            cell_ID_list = []
-                
+        else:
+            
+            with open(path, 'w') as report_file:
                 
-        
-    '''
-    print('Plotting single cell processing times distribution')
-    plt.figure(figsize=(14,10))
-    plt.hist(PROFILE_loop_times, bins=50)
-    plt.title("All Single Cell processing times Cython (sec)")
-    plt.xlabel('Time [s]')
-    plt.ylabel('Count')
-    #plt.show()
-    plt.savefig("Cell_time_dist_Cython.png")
-    plt.close()
-    '''
-        
-    return myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes
-
-
-
+                json.dump({'run' : self.run, 'workers' : self.workers}, report_file, indent=2)
     
     
     
     
+class HoleStream(object):
+    '''
+    Description:
+    ============
     
-
-
-def run_multi_process(cell_ID_gen, 
-                       ngrid, 
-                       dl, 
-                       dr,
-                       coord_min, 
-                       mask,
-                       mask_resolution,
-                       min_dist,
-                       max_dist,
-                       w_coord,
-                       batch_size=1000,
-                       verbose=False,
-                       num_cpus=1):
+    Volume cut of the holes as they are found, on a background thread of 
+    the coordinator, so that it is done by the time the last hole is grown
+    instead of starting then.
     
+    Each batch of main_algorithm results passed to add() has its rows 
+    without a hole dropped and goes through volume_cut, which judges every 
+    hole on its own, so cutting batch by batch keeps exactly the holes 
+    cutting them all at once would.  finish() returns the kept holes sorted 
+    by decreasing radius, as find_voids passes them to combine_holes.
     
-    start_time = time.time()
+    Removing duplicates and picking the maximal spheres run down the holes 
+    in order of radius, so they cannot start before the largest hole is 
+    known, and stay with combine_holes.
     
-    ################################################################################
-    #
-    # Initialize some output containers and counter variables
-    #
-    ################################################################################
-    #hole_times = []
     
-    # Initialize list of hole details
-    myvoids_x = []
+    Parameters:
+    ===========
     
-    myvoids_y = []
+    mask : numpy.ndarray of shape (N,M) type bool
+        survey footprint, as for _main_hole_finder
+        
+    mask_resolution : integer
+        Scale factor of coordinates needed to index mask
+        
+    r_limits : list of 2 floats
+        minimum and maximum distance of the survey in Mpc/h
+        
+    distance_field : SurveyDistanceField
+        If not None, passed to volume_cut to keep the holes well inside the
+        survey without checking them.  Default is None.
+    '''
     
-    myvoids_z = []
+    def __init__(self, mask, mask_resolution, r_limits, distance_field=None):
+        
+        self.mask = mask
+        
+        self.mask_resolution = mask_resolution
+        
+        self.r_limits = r_limits
+        
+        self.distance_field = distance_field
+        
+        self.kept = []
+        
+        self.error = None
+        
+        self.time_cutting = 0.0
+        
+        self.batches = SimpleQueue()
+        
+        self.thread = threading.Thread(target=self.cut_batches, daemon=True)
+        
+        self.thread.start()
+        
+        
+    def add(self, results):
+        '''
+        Queue a (N,4) array of main_algorithm results to be cut.  The rows are
+        copied, so results may be reused as soon as this returns.
+        '''
+        
+        holes = results[~np.isnan(results[:,0])]
+        
+        if holes.shape[0] > 0:
+            
+            self.batches.put(holes.copy())
+            
+            
+    def cut_batches(self):
+        
+        while True:
+            
+            holes = self.batches.get()
+            
+            if holes is None:
+                
+                return
+            
+            if self.error is not None:
+                
+                continue
+            
+            cut_start = time.time()
+            
+            try:
+                
+                hole_table = Table([holes[:,0], holes[:,1], holes[:,2], holes[:,3]], names=('x','y','z','radius'))
+                
+                self.kept.append(volume_cut(hole_table, self.mask, self.mask_resolution, self.r_limits, 
+                                            self.distance_field))
+                
+            except Exception as error:
+                
+                self.error = error
+                
+            self.time_cutting += time.time() - cut_start
+            
+            
+    def finish(self):
+        '''
+        Wait for the queued batches to be cut, and return an astropy Table 
+        (x, y, z, radius) of the holes kept, largest first.
+        '''
+        
+        self.batches.put(None)
+        
+        self.thread.join()
+        
+        if self.error is not None:
+            
+            raise self.error
+        
+        if not self.kept:
+            
+            return Table(names=('x','y','z','radius'), dtype=(np.float64,)*4)
+        
+        hole_table = vstack(self.kept)
+        
+        hole_table.sort('radius')
+        
+        hole_table.reverse()
+        
+        return hole_table
     
-    myvoids_r = []
     
-    # Number of holes found
-    n_holes = 0
-
-    # Counter for the number of empty cells
-    #empty_cell_counter = 0
     
-    # Number of empty cells
-    #n_empty_cells = ngrid[0]*ngrid[1]*ngrid[2] - len(cell_ID_dict)
-    n_empty_cells = len(cell_ID_gen)
     
+class SharedArrays(object):
+    '''
+    Description:
+    ============
     
+    A list of numpy arrays copied once into a single block of shared memory.
     
-    ################################################################################
-    # mask needs to be 1 byte per bool to match the cython dtype
-    ################################################################################
+    Pickling a SharedArrays sends only the name of the block and the layout 
+    of the arrays in it, and unpickling attaches to the block, so a worker 
+    process started with one as an argument sees the same physical pages as 
+    the parent whatever the start method.  Only the process which created 
+    the block unlinks it in close().
     
-    mask = mask.astype(np.uint8)
     
+    Parameters:
+    ===========
     
-    ################################################################################
-    #
-    #   BUILD NEAREST-NEIGHBOR TREE
-    #   galaxy_tree : sklearn.neighbors/scipy KDTree or similar implementing sklearn interface
-    #   nearest neighbor finder for the galaxies in x,y,z space
-    #
-    ################################################################################
+    arrays : list of numpy.ndarray or (shape, dtype) tuples
+        arrays to place in shared memory, available afterwards as the list 
+        self.arrays of views into the block.  A (shape, dtype) tuple makes an
+        uninitialized array of that shape and dtype.
+    '''
     
-    if verbose:
+    def __init__(self, arrays):
         
-        kdtree_start_time = time.time()
-
-    galaxy_tree = neighbors.KDTree(w_coord)
-    
-    if verbose:
+        self.layout = []
         
-        print('KDTree creation time:', time.time() - kdtree_start_time)
+        offset = 0
+        
+        for array in arrays:
+            
+            if isinstance(array, tuple):
+                
+                shape, dtype = array
+                
+            else:
+                
+                shape, dtype = array.shape, array.dtype
+                
+            dtype = np.dtype(dtype)
+            
+            ############################################################
+            # Keep every array 64-byte (cache line) aligned
+            ############################################################
+            offset = 64*((offset + 63)//64)
+            
+            self.layout.append((dtype.str, tuple(shape), offset))
+            
+            offset += int(np.prod(shape))*dtype.itemsize
+            
+        self.shm = shared_memory.SharedMemory(create=True, size=max(offset, 1))
+        
+        self.is_owner = True
+        
+        self.attach_views()
+        
+        for view, array in zip(self.arrays, arrays):
+            
+            if not isinstance(array, tuple):
+                
+                view[...] = array
+            
+            
+    def attach_views(self):
+        
+        self.arrays = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=self.shm.buf, offset=offset) \
+                       for dtype, shape, offset in self.layout]
+        
+        
+    def __getstate__(self):
+        
+        return (self.shm.name, self.layout)
     
     
-    ################################################################################
-    #
-    # Set up worker processes
-    #
-    ################################################################################
+    def __setstate__(self, state):
+        
+        name, self.layout = state
+        
+        self.shm = shared_memory.SharedMemory(name=name)
+        
+        self.is_owner = False
+        
+        self.attach_views()
+        
+        
+    def close(self):
+        '''
+        Detach from the block, and free it if this process created it.  All
+        other references to self.arrays must have been dropped first.
+        '''
+        
+        self.arrays = []
+        
+        self.shm.close()
+        
+        if self.is_owner:
+            
+            self.shm.unlink()
     
     
-    #job_queue = Queue()
     
-    return_queue = Queue()
-
-    max_cpus = cpu_count()
     
-    if (num_cpus is None) or (num_cpus > max_cpus):
-          
-        num_cpus = max_cpus
+class CheckpointLog(object):
+    '''
+    Description:
+    ============
+    
+    Append-only binary log of the finished batches of cells and their hole 
+    results, so that an interrupted run can pick up where it stopped.
     
-    processes = []
+    The file starts with a header recording the grid and growth parameters, 
+    followed by one record per batch:
     
-    job_queues = []
+        int64 n, int64 cell IDs of shape (n,3), float64 results of shape (n,4)
     
-    workers_waiting = []
+    Records are flushed as they are appended and synced to disk at most 
+    every sync_interval seconds.  A record cut short by the interruption is 
+    dropped (and cut off the file) when the log is reopened with resume.
     
-    num_active_processes = 0
     
-    #num_cell_per_process = int(np.ceil(len(cell_ID_list)/num_cpus))
+    Parameters:
+    ===========
     
-    for proc_idx in range(num_cpus):
-        
-        #start_idx = proc_idx*num_cell_per_process
+    path : string
+        file to write the log to
         
-        #end_idx = (proc_idx+1)*num_cell_per_process
+    ngrid, dl, dr, coord_min, min_dist, max_dist :
+        as for _main_hole_finder; resuming from a log written with different
+        values raises a ValueError
         
-        #worker_cell_IDs = cell_ID_list[start_idx:end_idx]
+    resume : boolean
+        If True and path exists, load its records into self.cells and 
+        self.results and append to it.  Otherwise start a new log at path.
+        Default is False.
         
-        curr_job_queue = Queue()
-        
-        job_queues.append(curr_job_queue)
-        
-        workers_waiting.append(True)
+    sync_interval : float
+        Seconds between fsyncs of the log.  Default is 60.
+    '''
+    
+    MAGIC = b'VFCKPT01'
+    
+    def __init__(self, path, ngrid, dl, dr, coord_min, min_dist, max_dist, resume=False, sync_interval=60.):
         
-        worker_args = (proc_idx,
-                       galaxy_tree, 
-                       ngrid, 
-                       dl, 
-                       dr,
-                       coord_min, 
-                       mask,
-                       mask_resolution,
-                       min_dist,
-                       max_dist,
-                       w_coord,
-                       curr_job_queue,
-                       return_queue)
+        self.header = self.MAGIC + np.asarray(ngrid, dtype=np.int64).tobytes() \
+                      + np.array([dl, dr] + list(np.ravel(coord_min)) + [min_dist, max_dist], dtype=np.float64).tobytes()
         
-        p = Process(target=_main_hole_finder_worker, args=worker_args)
+        self.cells = np.empty((0,3), dtype=np.int64)
         
-        p.start()
+        self.results = np.empty((0,4), dtype=np.float64)
         
-        processes.append(p)
+        self.sync_interval = sync_interval
         
-        num_active_processes += 1
-
-    if verbose:
-        print("Worker processes started time: ", time.time() - start_time)
-    ################################################################################
-    #
-    # Listen on the return_queue for results
-    # and feed workers when they become inactive
-    #
-    ################################################################################
-    num_cells_processed = 0
-    
-    curr_cell_idx = 0
-    
-    while num_cells_processed < n_empty_cells:
+        self.last_sync = time.time()
         
-        try:
+        if resume and os.path.exists(path):
             
-            message = return_queue.get(False)
+            end = self.load(path)
             
-        except Empty:
+            self.log_file = open(path, 'r+b')
             
-            pass
-            #time.sleep(.01)
+            self.log_file.truncate(end)
             
-        else:
+            self.log_file.seek(end)
             
-            if message[0] == 'Done':
-                
-                num_active_processes -= 1
-                
-            elif message[0] == "empty_job":
-                
-                workers_waiting[message[1]] = True
-                
-            elif message[0] == "data":
-                
-                #append to the correct lists and stuff
-                
-                
-                return_array = message[1]
-                
-                for row in return_array:
-                
-                    x_val = row[0]
-                    y_val = row[1] 
-                    z_val = row[2] 
-                    r_val = row[3]
-                    
-                    if not np.isnan(x_val):
-                    
-                        myvoids_x.append(x_val)
+        else:
             
-                        myvoids_y.append(y_val)
-                        
-                        myvoids_z.append(z_val)
-                        
-                        myvoids_r.append(r_val)
-                        
-                        n_holes += 1
-                    
-                    num_cells_processed += 1
-                
-                
-                    if verbose:
-                
-                        if num_cells_processed % 10000 == 0:
-                            
-                           print('Processed', num_cells_processed, 'cells of', n_empty_cells)
-                
-                
-        for proc_idx, worker_waiting in enumerate(workers_waiting):
+            self.log_file = open(path, 'wb')
             
+            self.log_file.write(self.header)
             
-            if curr_cell_idx > n_empty_cells:
-                break
+            self.log_file.flush()
             
             
-            curr_qsize = job_queues[proc_idx].qsize()
+    def load(self, path):
+        '''
+        Read the complete records of the log at path into self.cells and 
+        self.results, and return the position just after the last of them.
+        '''
+        
+        with open(path, 'rb') as log_file:
             
-            if job_queues[proc_idx].qsize() < 3:
-                
-                num_put = 3 - curr_qsize
-                
-                for _ in range(num_put):
-                    
-                    if curr_cell_idx > n_empty_cells:
-                        break
-                
-                
-                    chunk_list = []
-                    chunk_add = 0
-                    
-                    for _ in range(batch_size):
-                        try:
-                            chunk_list.append(next(cell_ID_gen))
-                        except StopIteration:
-                            break
-                        else:
-                            chunk_add += 1
-                
-                    job_queues[proc_idx].put(chunk_list)
-                    
-                    curr_cell_idx += chunk_add
-                
+            data = log_file.read()
             
+        if data[:len(self.header)] != self.header:
             
-            if worker_waiting:
-                
-                #put an extra item on the queue for a worker who said they are waiting
-                
-                if curr_cell_idx > n_empty_cells:
-                    break
-                
-                chunk_list = []
-                chunk_add = 0
-                
-                for _ in range(batch_size):
-                    try:
-                        chunk_list.append(next(cell_ID_gen))
-                    except StopIteration:
-                        break
-                    else:
-                        chunk_add += 1
-                
-                job_queues[proc_idx].put(chunk_list)
-                
-                curr_cell_idx += chunk_add
-                
-                workers_waiting[proc_idx] = False        
+            raise ValueError("Checkpoint " + path + " was written for a different grid or parameters")
         
-                
-    if verbose:
-        print("Main task finish time: ", time.time() - start_time)
-                
-    ################################################################################
-    #
-    # Clean up worker processes
-    #
-    ################################################################################
-    
-    for proc_idx in range(num_cpus):
+        position = len(self.header)
         
-        job_queues[proc_idx].put(u"exit")
+        cells = []
         
-    while num_active_processes > 0:
+        results = []
         
-        try:
+        while position + 8 <= len(data):
             
-            message = return_queue.get(False)
+            n = int(np.frombuffer(data, dtype=np.int64, count=1, offset=position)[0])
             
-        except Empty:
+            if position + 8 + 56*n > len(data):
+                
+                break
             
-            time.sleep(.1)
+            cells.append(np.frombuffer(data, dtype=np.int64, count=3*n, offset=position + 8).reshape(n,3))
             
-        else:
+            results.append(np.frombuffer(data, dtype=np.float64, count=4*n, offset=position + 8 + 24*n).reshape(n,4))
             
-            if message[0] == 'Done':
-                
-                num_active_processes -= 1
-                
-    for p in processes:
+            position += 8 + 56*n
+            
+        if cells:
+            
+            self.cells = np.concatenate(cells)
+            
+            self.results = np.concatenate(results)
+            
+        return position
+    
+    
+    def append(self, cell_IDs, results):
+        '''
+        Record that the cells cell_IDs (sequence of (i,j,k)) finished with the
+        (n,4) array results.
+        '''
         
-        p.join(None)
+        cell_IDs = np.asarray(cell_IDs, dtype=np.int64).reshape(-1,3)
         
-    if verbose:
+        self.log_file.write(np.int64(cell_IDs.shape[0]).tobytes() 
+                            + cell_IDs.tobytes() 
+                            + np.ascontiguousarray(results, dtype=np.float64).tobytes())
         
-        print("Num empty cells: ", n_empty_cells)
+        self.log_file.flush()
         
-    return myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes
-                    
+        if time.time() - self.last_sync > self.sync_interval:
+            
+            os.fsync(self.log_file.fileno())
+            
+            self.last_sync = time.time()
+            
+            
+    def close(self):
+        
+        self.log_file.flush()
+        
+        os.fsync(self.log_file.fileno())
+        
+        self.log_file.close()
+    
     
     
     
+def survey_voxel_arrays(survey_voxels):
+    '''
+    The arrays of survey_voxels to place in shared memory after the others,
+    an empty list if it is None.
+    '''
+    
+    if survey_voxels is None:
+        
+        return []
     
+    return [survey_voxels.states]
+
+
+
+
+def survey_voxel_grid(survey_voxels):
+    '''
+    The (origin, voxel_size) of survey_voxels to pass to the workers along 
+    with the shared arrays, or None.
+    '''
     
+    if survey_voxels is None:
+        
+        return None
     
+    return (survey_voxels.origin, survey_voxels.voxel_size)
+
+
+
+
+def attach_survey_voxels(arrays, voxel_grid):
+    '''
+    Split the survey voxel states placed last by survey_voxel_arrays off the
+    shared arrays, returning the other arrays and the SurveyVoxelGrid (or 
+    None if voxel_grid is None).
+    '''
     
+    if voxel_grid is None:
+        
+        return arrays, None
     
+    return arrays[:-1], SurveyVoxelGrid(arrays[-1], *voxel_grid)
 
 
 
+
+def _decomposed_worker(shared_arrays, leaf_size, growth_args, galaxy_bounds, job_queue, return_queue, 
+                       voxel_grid=None):
+    '''
+    Worker process of run_decomposed.  Grows the holes of the domains and 
+    batches of cells taken off job_queue, returning each result with its job
+    ID, until it gets 'exit'.
+    '''
+    
+    arrays, survey_voxels = attach_survey_voxels(shared_arrays.arrays, voxel_grid)
+    
+    w_coord, mask, occupied = arrays[:3]
+    
+    dl, dr, coord_min, mask_resolution, min_dist, max_dist, halo, exact_search, single_precision = growth_args
+    
+    galaxy_tree = None
+    
+    workspace = HoleGrowthWorkspace()
+    
+    while True:
+        
+        message = job_queue.get()
+        
+        if isinstance(message, str) and message == 'exit':
+            
+            break
+        
+        if message[0] == 'domain':
+            
+            return_queue.put((message[1], grow_domain(message[2], message[3], occupied, w_coord, message[4], 
+                                                      galaxy_bounds, mask, growth_args, 1, workspace, 
+                                                      survey_voxels)))
+            
+        else:
+            
+            if galaxy_tree is None:
+                
+                galaxy_tree = GalaxyTree.from_arrays(*arrays[3:], leaf_size)
+            
+            cells = message[2]
+            
+            results = np.empty((cells.shape[0], 4), dtype=np.float64)
+            
+            main_algorithm(cells, galaxy_tree, dl, dr, coord_min, mask, mask_resolution, 
+                           min_dist, max_dist, results, 0, 1, exact_search, workspace,
+                           survey_voxels)
+            
+            return_queue.put((message[1], (cells, results)))
+            
+    ############################################################
+    # Drop the views before the shared block is closed
+    ############################################################
+    del arrays, w_coord, mask, occupied, galaxy_tree, survey_voxels
+    
+    
+    
+    
 def _main_hole_finder_worker(process_id,
-                             galaxy_tree, 
+                             shared_arrays, 
+                             shared_results,
+                             leaf_size,
                              ngrid, 
                              dl, 
                              dr,
                              coord_min, 
-                             mask,
                              mask_resolution,
                              min_dist,
                              max_dist,
-                             w_coord,
-                             job_queue,
-                             return_queue
+                             connection,
+                             exact_search=False,
+                             voxel_grid=None
                              ):
     
     #galaxy_tree = neighbors.KDTree(w_coord)
@@ -1678,198 +3997,142 @@ def _main_hole_finder_worker(process_id,
     #print("Process id: ", process_id, id(mask), id(w_coord), id(galaxy_tree), w_coord.__array_interface__['data'][0])
     
     
+    worker_lifetime_start = time.time()
+    
     ################################################################################
     #
-    # Profiling parameters
+    # Attach the tree, the mask and the survey voxels to the arrays shared by 
+    # run_multi_process
     #
     ################################################################################
     
-    worker_lifetime_start = time.time()
-    time_main = 0.0
-    time_message = 0.0
-    time_sleeping = 0.0
-    time_empty = 0.0
+    arrays, survey_voxels = attach_survey_voxels(shared_arrays.arrays, voxel_grid)
     
-    num_message_checks = 0
-    
-    num_cells_processed = 0
+    galaxy_tree = GalaxyTree.from_arrays(*arrays[:-1], leaf_size)
     
-    num_empty_job_put = 0
+    mask = arrays[-1]
     
-    total_loops = 0
+    results = shared_results.arrays[0]
     
-    time_returning = 0
+    worker_offsets = shared_results.arrays[1]
     
     
     ################################################################################
     #
-    # exit_process - flag for reading an exit command off the queue
-    # is_waiting - flag for state of whether this worker is working or waiting for data
-    # return_array - some memory for cython code to pass return values back to
+    # Profiling parameters, sent back to the coordinator with 'Done'
+    #
+    #   time_main - time spent in main_algorithm
+    #   time_waiting - time blocked on connection, waiting for the coordinator
+    #   time_returning - time sending notices on connection
     #
     ################################################################################
     
-    exit_process = False
+    time_main = 0.0
+    
+    time_waiting = 0.0
+    
+    time_returning = 0.0
+    
+    num_batches = 0
+    
+    num_cells_processed = 0
+    
+    num_holes = 0
     
-    is_waiting = False
+    time_startup = time.time() - worker_lifetime_start
     
-    return_array = np.empty(4, dtype=np.float64)
     
-    while not exit_process:
+    ################################################################################
+    #
+    # Block on the pipe until a batch or the exit command arrives.  Each batch
+    # comes with the offset of its rows in results, and only the offset and 
+    # length go back on the pipe once they are written.
+    #
+    ################################################################################
+    
+    workspace = HoleGrowthWorkspace()
+    
+    while True:
         
-        total_loops += 1
+        wait_start_time = time.time()
         
-        try:
-            
-            num_message_checks += 1
-            
-            message_time_start = time.time()
-            
-            message = job_queue.get(False)
-            
-        except Empty:
-            
-            if is_waiting:
-                
-                time.sleep(.01)
-                
-                time_sleeping += time.time() - message_time_start
-                
-            else:
-                
-                put_start = time.time()
-                
-                return_queue.put(("empty_job", process_id))
-                
-                time_returning += time.time() - put_start
-            
-                is_waiting = True
-                
-                num_empty_job_put += 1
-                
-            time_empty += time.time() - message_time_start
-                
-            
-        else:
-            
-            curr_msg_check_time = time.time() - message_time_start
-            
-            time_message += curr_msg_check_time
+        message = connection.recv()
+        
+        time_waiting += time.time() - wait_start_time
+        
+        if isinstance(message, str) and message == 'exit':
             
-            is_waiting = False
+            break
+        
+        main_proc_start_time = time.time()
+        
+        offset, cell_ID_list = message
+        
+        ############################################################
+        # Set while growing holes in the batch, so that if this 
+        # process dies the coordinator knows which batch killed it
+        ############################################################
+        worker_offsets[process_id] = offset
+        
+        i_j_k_array = np.ascontiguousarray(cell_ID_list, dtype=np.int64)
+
+        return_array = results[offset:offset + len(cell_ID_list)]
             
-            if isinstance(message, str) and message == 'exit':
-                
-                exit_process = True
-                
-            else:
-                
-                main_proc_start_time = time.time()
-                
-                cell_ID_list = message
-                '''
-                for hole_center_coords in cell_ID_list:
-                    
-                    num_cells_processed += 1
-                    
-                    #if num_cells_processed % 10000 == 0:
-                    #    print("Processed: ", num_cells_processed, "time: ", time.time() - worker_lifetime_start, "main: ", time_main, "empty: ", time_empty)
-                    
-                    i, j, k = hole_center_coords
-                    
-                    
-                    main_algorithm(i,
-                                   j,
-                                   k,
-                                   galaxy_tree,
-                                   w_coord,
-                                   dl, 
-                                   dr,
-                                   coord_min,
-                                   mask,
-                                   mask_resolution,
-                                   min_dist,
-                                   max_dist,
-                                   return_array
-                                   )
-                    
-                    x_val = return_array[0]
-                    y_val = return_array[1]
-                    z_val = return_array[2]
-                    r_val = return_array[3]
-                    
-                    
-                    put_start = time.time()
-                    return_queue.put(("data", (x_val, y_val, z_val, r_val)))
-                    time_returning += time.time() - put_start
-                    
-                '''
-                    
-                    
+        main_algorithm(i_j_k_array,
+                       galaxy_tree,
+                       dl, 
+                       dr,
+                       coord_min,
+                       mask,
+                       mask_resolution,
+                       min_dist,
+                       max_dist,
+                       return_array,
+                       0,  #verbose level
+                       1,  #number of OpenMP threads
+                       exact_search,
+                       workspace,
+                       survey_voxels
+                       )
+        
+        main_time = time.time() - main_proc_start_time
+        
+        time_main += main_time
+        
+        num_batches += 1
+        
+        num_cells_processed += return_array.shape[0]
+        
+        num_holes += np.count_nonzero(~np.isnan(return_array[:,0]))
+        
+        ############################################################
+        # Cleared before the notice goes out, so that dying between 
+        # batches charges no batch
+        ############################################################
+        worker_offsets[process_id] = -1
+        
+        put_start = time.time()
+        
+        connection.send(("data", offset, return_array.shape[0], main_time))
+        
+        time_returning += time.time() - put_start
+        
+    worker_stats = {'worker' : process_id,
+                    'pid' : os.getpid(),
+                    'num_batches' : num_batches,
+                    'num_cells' : num_cells_processed,
+                    'num_holes' : int(num_holes),
+                    'time_startup' : time_startup,
+                    'time_main' : time_main,
+                    'time_waiting' : time_waiting,
+                    'time_returning' : time_returning,
+                    'time_total' : time.time() - worker_lifetime_start}
                     
-                i_j_k_array = np.array(cell_ID_list, dtype=np.int64)
+    connection.send(("Done", worker_stats))
     
-                return_array = np.empty((len(cell_ID_list), 4), dtype=np.float64)
-                    
-                main_algorithm(i_j_k_array,
-                               galaxy_tree,
-                               w_coord,
-                               dl, 
-                               dr,
-                               coord_min,
-                               mask,
-                               mask_resolution,
-                               min_dist,
-                               max_dist,
-                               return_array,
-                               0  #verbose level
-                               )
-                '''
-                for row in return_array:
-                    
-                    x_val = row[0]
-                    y_val = row[1]
-                    z_val = row[2]
-                    r_val = row[3]
-                    
-                    if not np.isnan(x_val):
-                            
-                        myvoids_x.append(x_val)
-                        #x_val = hole_center[0,0]
-                        
-                        myvoids_y.append(y_val)
-                        #y_val = hole_center[0,1]
-                        
-                        myvoids_z.append(z_val)
-                        #z_val = hole_center[0,2]
-                        
-                        myvoids_r.append(r_val)
-                        #r_val = hole_radius
-                        
-                        n_holes += 1
-                '''
-                
-                
-                num_cells_processed += return_array.shape[0]
-                
-                put_start = time.time()
-                return_queue.put(("data", return_array))
-                time_returning += time.time() - put_start
-                    
-                    
-                    
-                time_main += time.time() - main_proc_start_time
-                
-                #print("Processed2: ", num_cells_processed, "time: ", time.time() - worker_lifetime_start, "main: ", time_main, time_empty)
-                    
-    return_queue.put(("Done", None))
+    connection.close()
     
-    #print("Worker lifetime: ", time.time() - worker_lifetime_start)
     print("Time process: ", time_main, "num: ", num_cells_processed)
-    #print("Time sleeping: ", time_sleeping)
-    #print("Time returning: ", time_returning)
-    #print("Time message: ", time_message)
-    #print("Msg chks: ", num_message_checks, "Cells procd: ", num_cells_processed, "Empty puts: ", num_empty_job_put, "total loop: ", total_loops)
     
     return None
     
@@ -14,850 +14,1153 @@ from numpy.math cimport NAN, INFINITY
 
 from libc.math cimport fabs, sqrt, asin, atan#, exp, pow, cos, sin, asin
 
-from _voidfinder_cython_find_next cimport find_next_galaxy, not_in_mask
+from cython.parallel cimport prange, parallel, threadid
+
+from _voidfinder_cython_find_next cimport GalaxyTree, \
+                                          HoleGrowthWorkspace, \
+                                          FindNextScratch, \
+                                          find_next_galaxy, \
+                                          find_next_galaxy_exact, \
+                                          galaxy_coord, \
+                                          SurveyVoxels, \
+                                          not_in_mask, \
+                                          not_in_survey
 
 
 
 #import time
 
 
+############################################################
+# Make the tree and workspace classes available from this
+# module, so that callers build them from the same extension
+# types main_algorithm checks its arguments against
+############################################################
+globals()['GalaxyTree'] = GalaxyTree
+
+globals()['HoleGrowthWorkspace'] = HoleGrowthWorkspace
+
+
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
 cpdef void main_algorithm(DTYPE_INT64_t[:,:] i_j_k_array,
-                          galaxy_tree,
-                          DTYPE_F64_t[:,:] w_coord,
-                          DTYPE_F64_t dl, 
+                          GalaxyTree galaxy_tree,
+                          DTYPE_F64_t dl,
                           DTYPE_F64_t dr,
-                          DTYPE_F64_t[:,:] coord_min, 
+                          DTYPE_F64_t[:,:] coord_min,
                           DTYPE_B_t[:,:] mask,
                           DTYPE_INT32_t mask_resolution,
                           DTYPE_F64_t min_dist,
                           DTYPE_F64_t max_dist,
                           DTYPE_F64_t[:,:] return_array,
-                          int verbose
+                          int verbose,
+                          int num_threads=1,
+                          DTYPE_B_t exact_search=0,
+                          HoleGrowthWorkspace workspace=None,
+                          survey_voxels=None
                           ) except *:
     '''
-    
+
     Description:
     ============
     Given a potential void cell center denoted by i,j,k, find the 4 bounding galaxies
     that maximize the interior dimensions of the void sphere at this location.
-    
+
     There are some really weird particulars to this algorithm that need to be laid out
     in better detail.
 
     The code below will utilize the naming scheme galaxy A, B, C, and D to denote the
     1st, 2nd, 3rd, and 4th "neighbor" bounding galaxies found during the running of this algorithm.
     I tried to use 1/A, 2/B, 3/C and 4/D to be clear on the numbers and letters are together.
-    
+
     The distance metrics are somewhat special.  Galaxy A is found by normal minimzation of euclidean
-    distance between the cell center and itself and the other neighbors.  Galaxies B, C, and D are 
+    distance between the cell center and itself and the other neighbors.  Galaxies B, C, and D are
     found by propogating a hole center in specific directions and minimizing a ratio of two other
     distance-metric-like values.  This needs more detail on how and why.
-    
+
+    The cells are processed in two passes.  locate_first_galaxies() first 
+    computes the centers of all the cells in i_j_k_array, rejects those 
+    outside the survey, and finds galaxy 1/A of the rest, each query 
+    starting from the answer for the previous cell.  grow_hole() then grows
+    the holes of the remaining cells from those results.  Both run without 
+    the GIL.  With num_threads > 1 the rows of i_j_k_array are split across 
+    OpenMP threads, each with its own scratch memory for find_next_galaxy().
+    Every thread only writes the rows belonging to its own cells, and the 
+    galaxy_tree and mask are shared read-only.
+
     Parameters:
     ===========
-    
+
     Fill in later
-    
+
+    num_threads : int
+        Number of OpenMP threads to grow holes with.  Default is 1, which
+        runs serially in the calling thread.
+        
+    exact_search : bool
+        If true, find each bounding galaxy with find_next_galaxy_exact() 
+        instead of stepping the hole center by dr.  Default is False.
+        
+    workspace : HoleGrowthWorkspace
+        Scratch memory to grow the holes with, reused across calls.  If None
+        or made for fewer than num_threads threads, a temporary one is 
+        created for this call.
+        
+    survey_voxels : SurveyVoxelGrid
+        If not None, precomputed voxels of the survey volume which answer 
+        the survey checks of the points away from the survey boundary with 
+        one lookup instead of the angular test (see not_in_survey()).  The 
+        holes found are the same.  Default is None.
+
     Returns:
     ========
-    
+
     NAN or (x,y,z,r) values filled into the return_array parameter.
-    
+
+    '''
+
+
+    cdef ITYPE_t working_idx
+
+    cdef ITYPE_t num_cells = i_j_k_array.shape[0]
+
+    cdef int num_failed = 0
+
+    cdef FindNextScratch* scratch
+
+    ############################################################
+    # Results of the first pass: the center of each cell, and
+    # the tree position of and distance to its nearest galaxy
+    # (position -1 if the cell is outside the survey)
+    ############################################################
+    cdef DTYPE_F64_t[:,::1] cell_centers = np.empty((num_cells, 3), dtype=np.float64)
+
+    cdef ITYPE_t[::1] nearest_idx = np.empty(num_cells, dtype=np.intp)
+
+    cdef DTYPE_F64_t[::1] nearest_dist = np.empty(num_cells, dtype=np.float64)
+
+    cdef ITYPE_t block_size
+
+    cdef ITYPE_t block_idx
+
+    ############################################################
+    # Survey voxel lookup, with NULL states if there is none.
+    # voxel_states keeps the states alive during the call.
+    ############################################################
+    cdef SurveyVoxels voxel_lookup
+
+    cdef SurveyVoxels* voxels = &voxel_lookup
+
+    voxel_states = set_survey_voxels(voxels, survey_voxels)
+
+
+    if num_threads < 1:
+
+        num_threads = 1
+
+    ############################################################
+    # One block of find_next_galaxy() scratch memory per
+    # thread, the blocks grow as needed.
+    ############################################################
+    if workspace is None or workspace.num_threads < num_threads:
+
+        workspace = HoleGrowthWorkspace(num_threads)
+
+    scratch = workspace.scratch
+
+
+    if num_threads == 1:
+
+        ############################################################
+        # Without the GIL, so that python threads of the caller 
+        # (such as the post-processing of finished holes) keep 
+        # running while the holes grow
+        ############################################################
+        with nogil:
+
+            locate_first_galaxies(0,
+                                  num_cells,
+                                  i_j_k_array,
+                                  galaxy_tree,
+                                  dl,
+                                  coord_min,
+                                  mask,
+                                  mask_resolution,
+                                  min_dist,
+                                  max_dist,
+                                  voxels,
+                                  cell_centers,
+                                  nearest_idx,
+                                  nearest_dist)
+
+            for working_idx in range(num_cells):
+
+                if (verbose > 0 and working_idx % 10000 == 0):
+
+                    with gil:
+
+                        print("Processing cell "+str(working_idx)+" of "+str(num_cells))
+
+                if grow_hole(working_idx,
+                             cell_centers,
+                             nearest_idx,
+                             nearest_dist,
+                             galaxy_tree,
+                             dr,
+                             exact_search,
+                             mask,
+                             mask_resolution,
+                             min_dist,
+                             max_dist,
+                             voxels,
+                             return_array,
+                             &scratch[0]) < 0:
+
+                    with gil:
+
+                        raise MemoryError()
+
+    else:
+
+        ############################################################
+        # Contiguous blocks of cells for the first pass, so that
+        # the nearest galaxy of the previous cell is a good guess
+        ############################################################
+        block_size = (num_cells + num_threads - 1)//num_threads
+
+        with nogil, parallel(num_threads=num_threads):
+
+            for block_idx in prange(num_threads, schedule='static'):
+
+                locate_first_galaxies(block_idx*block_size,
+                                      min((block_idx + 1)*block_size, num_cells),
+                                      i_j_k_array,
+                                      galaxy_tree,
+                                      dl,
+                                      coord_min,
+                                      mask,
+                                      mask_resolution,
+                                      min_dist,
+                                      max_dist,
+                                      voxels,
+                                      cell_centers,
+                                      nearest_idx,
+                                      nearest_dist)
+
+        with nogil, parallel(num_threads=num_threads):
+
+            for working_idx in prange(num_cells, schedule='dynamic'):
+
+                if grow_hole(working_idx,
+                             cell_centers,
+                             nearest_idx,
+                             nearest_dist,
+                             galaxy_tree,
+                             dr,
+                             exact_search,
+                             mask,
+                             mask_resolution,
+                             min_dist,
+                             max_dist,
+                             voxels,
+                             return_array,
+                             &scratch[threadid()]) < 0:
+
+                    num_failed += 1
+
+        if num_failed > 0:
+
+            raise MemoryError()
+
+    #print("Finished main loop")
+
+    #return (x_val, y_val, z_val, r_val)
+    return
+
+
+
+
+cdef object set_survey_voxels(SurveyVoxels* voxels, object survey_voxels):
+    '''
+    Point voxels at the states, origin and voxel size of the SurveyVoxelGrid 
+    survey_voxels, or set its states to NULL if survey_voxels is None.  
+    Returns the memoryview of the states, which the caller must hold on to 
+    while voxels is in use.
+    '''
+
+    cdef DTYPE_B_t[:,:,::1] voxel_states
+
+    cdef ITYPE_t idx
+
+    voxels.states = NULL
+
+    if survey_voxels is None:
+
+        return None
+
+    voxel_states = survey_voxels.states
+
+    voxels.states = &voxel_states[0,0,0]
+
+    for idx in range(3):
+
+        voxels.shape[idx] = voxel_states.shape[idx]
+
+        voxels.origin[idx] = survey_voxels.origin[idx]
+
+    voxels.inv_voxel_size = 1.0/survey_voxels.voxel_size
+
+    return voxel_states
+
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef void points_in_survey(DTYPE_F64_t[:,:] points,
+                            DTYPE_B_t[:,:] mask,
+                            DTYPE_INT32_t mask_resolution,
+                            DTYPE_F64_t min_dist,
+                            DTYPE_F64_t max_dist,
+                            DTYPE_B_t[:] in_survey,
+                            survey_voxels=None):
+    '''
+    Set in_survey[i] to 1 if points[i] is in the survey and 0 otherwise, with
+    the test hole growth uses: not_in_survey() if survey_voxels is given, 
+    not_in_mask() otherwise.
+    '''
+
+    cdef ITYPE_t working_idx
+
+    cdef ITYPE_t idx
+
+    cdef DTYPE_F64_t point[3]
+
+    cdef SurveyVoxels voxel_lookup
+
+    voxel_states = set_survey_voxels(&voxel_lookup, survey_voxels)
+
+    with nogil:
+
+        for working_idx in range(points.shape[0]):
+
+            for idx in range(3):
+
+                point[idx] = points[working_idx, idx]
+
+            in_survey[working_idx] = not not_in_survey(point, mask, mask_resolution, min_dist, max_dist, &voxel_lookup)
+
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cpdef void cells_in_survey(DTYPE_INT64_t[:,:] i_j_k_array,
+                           DTYPE_F64_t dl,
+                           DTYPE_F64_t[:,:] coord_min,
+                           DTYPE_B_t[:,:] mask,
+                           DTYPE_INT32_t mask_resolution,
+                           DTYPE_F64_t min_dist,
+                           DTYPE_F64_t max_dist,
+                           DTYPE_B_t[:] in_survey):
+    '''
+    Set in_survey[i] to 1 if the center of cell i_j_k_array[i] is in the
+    survey and 0 otherwise, with the same center and the same not_in_mask
+    test main_algorithm starts each cell with, so that the cells for which
+    it is 0 are exactly those main_algorithm would return NaN for without
+    growing a hole.
+    '''
+
+    cdef ITYPE_t working_idx
+
+    cdef ITYPE_t idx
+
+    cdef DTYPE_F64_t cell_center[3]
+
+    with nogil:
+
+        for working_idx in range(i_j_k_array.shape[0]):
+
+            for idx in range(3):
+
+                cell_center[idx] = (i_j_k_array[working_idx, idx] + 0.5)*dl + coord_min[0,idx]
+
+            in_survey[working_idx] = not not_in_mask(cell_center, mask, mask_resolution, min_dist, max_dist)
+
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef void locate_first_galaxies(ITYPE_t start,
+                                ITYPE_t end,
+                                DTYPE_INT64_t[:,:] i_j_k_array,
+                                GalaxyTree galaxy_tree,
+                                DTYPE_F64_t dl,
+                                DTYPE_F64_t[:,:] coord_min,
+                                DTYPE_B_t[:,:] mask,
+                                DTYPE_INT32_t mask_resolution,
+                                DTYPE_F64_t min_dist,
+                                DTYPE_F64_t max_dist,
+                                SurveyVoxels* voxels,
+                                DTYPE_F64_t[:,::1] cell_centers,
+                                ITYPE_t[::1] nearest_idx,
+                                DTYPE_F64_t[::1] nearest_dist
+                                ) nogil:
+    '''
+    First pass of main_algorithm() over the cells start to end-1 of 
+    i_j_k_array: compute the center of each cell from its i,j,k and the 
+    grid spacing, check that it is in the survey, and find its nearest 
+    galaxy (galaxy 1/A).  Each nearest-galaxy query starts from the answer 
+    for the previous cell, which is usually the answer again or close to it.
+    
+    Writes the centers into cell_centers, and the tree position of and 
+    distance to the nearest galaxy into nearest_idx and nearest_dist, with
+    nearest_idx set to -1 for cells outside the survey.
     '''
     
+    cdef ITYPE_t working_idx
     
+    cdef ITYPE_t idx
     
+    cdef ITYPE_t guess = -1
     
+    for working_idx in range(start, end):
+        
+        for idx in range(3):
+            
+            cell_centers[working_idx, idx] = (i_j_k_array[working_idx, idx] + 0.5)*dl + coord_min[0,idx]
+            
+        if not_in_survey(&cell_centers[working_idx, 0], mask, mask_resolution, min_dist, max_dist, voxels):
+            
+            nearest_idx[working_idx] = -1
+            
+            continue
+        
+        guess = galaxy_tree.find_nearest_from(&cell_centers[working_idx, 0], 
+                                              guess, 
+                                              &nearest_dist[working_idx])
+        
+        nearest_idx[working_idx] = guess
+        
+        
+        
+        
+cdef inline int search_next_galaxy(DTYPE_F64_t* hole_center,
+                                   DTYPE_F64_t* temp_hole_center,
+                                   DTYPE_F64_t search_radius,
+                                   DTYPE_F64_t dr,
+                                   DTYPE_B_t exact_search,
+                                   DTYPE_F64_t direction_mod,
+                                   DTYPE_F64_t* unit_vector,
+                                   GalaxyTree galaxy_tree,
+                                   DTYPE_INT64_t* nearest_gal_index_list,
+                                   ITYPE_t num_neighbors,
+                                   DTYPE_B_t[:,:] mask,
+                                   DTYPE_INT32_t mask_resolution,
+                                   DTYPE_F64_t min_dist,
+                                   DTYPE_F64_t max_dist,
+                                   SurveyVoxels* voxels,
+                                   FindNextScratch* scratch,
+                                   ITYPE_t* nearest_neighbor_index,
+                                   DTYPE_F64_t* min_x_ratio,
+                                   DTYPE_B_t* in_mask
+                                   ) nogil:
+    '''
+    Call find_next_galaxy_exact() or the dr-stepping find_next_galaxy()
+    '''
     
+    if exact_search:
+        
+        return find_next_galaxy_exact(hole_center,
+                                      temp_hole_center,
+                                      search_radius,
+                                      direction_mod,
+                                      unit_vector,
+                                      galaxy_tree,
+                                      nearest_gal_index_list,
+                                      num_neighbors,
+                                      mask,
+                                      mask_resolution,
+                                      min_dist,
+                                      max_dist,
+                                      voxels,
+                                      scratch,
+                                      nearest_neighbor_index,
+                                      min_x_ratio,
+                                      in_mask)
+    
+    return find_next_galaxy(hole_center,
+                            temp_hole_center,
+                            search_radius,
+                            dr,
+                            direction_mod,
+                            unit_vector,
+                            galaxy_tree,
+                            nearest_gal_index_list,
+                            num_neighbors,
+                            mask,
+                            mask_resolution,
+                            min_dist,
+                            max_dist,
+                            voxels,
+                            scratch,
+                            nearest_neighbor_index,
+                            min_x_ratio,
+                            in_mask)
+
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int grow_hole(ITYPE_t working_idx,
+                   DTYPE_F64_t[:,::1] cell_centers,
+                   ITYPE_t[::1] nearest_idx,
+                   DTYPE_F64_t[::1] nearest_dist,
+                   GalaxyTree galaxy_tree,
+                   DTYPE_F64_t dr,
+                   DTYPE_B_t exact_search,
+                   DTYPE_B_t[:,:] mask,
+                   DTYPE_INT32_t mask_resolution,
+                   DTYPE_F64_t min_dist,
+                   DTYPE_F64_t max_dist,
+                   SurveyVoxels* voxels,
+                   DTYPE_F64_t[:,:] return_array,
+                   FindNextScratch* scratch
+                   ) nogil:
+    '''
+    Grow the hole for cell working_idx, from the center and galaxy 1/A 
+    found by locate_first_galaxies(), and write NAN or its (x,y,z,r) values 
+    into the same row of return_array.
+
+    All the per-cell vectors live on the stack, so concurrent calls only
+    share the read-only inputs.  Returns 0, or -1 if the scratch memory could
+    not be grown.
+    '''
+
+
     ############################################################
     # Declarations - Definitely needed
     ############################################################
-    
+
     ############################################################
     # re-used helper index variables
     # re-used helper computation variables
     ############################################################
-    
-    
-    cdef ITYPE_t working_idx
-    
+
     cdef ITYPE_t idx
-    
-    cdef ITYPE_t jdx
-    
-    cdef ITYPE_t temp_idx
-    
-    
+
     cdef DTYPE_F64_t temp_f64_accum
-    
+
     cdef DTYPE_F64_t temp_f64_accum2
-    
+
     cdef DTYPE_F64_t temp_f64_val
-    
-    
+
+
     ############################################################
     #hole center vector and propogate hole center memory.  We can re-use the same
     #memory for finding galaxies 2/B and 3/C but not for galaxy 4/D
     ############################################################
-    cdef DTYPE_F64_t[:,:] hole_center_memview = np.empty((1,3), dtype=np.float64, order='C')
-    
-    cdef DTYPE_F64_t[:,:] hole_center_2_3_memview = np.empty((1,3), dtype=np.float64, order='C')
-    
-    cdef DTYPE_F64_t[:,:] hole_center_41_memview = np.empty((1,3), dtype=np.float64, order='C')
-    
-    cdef DTYPE_F64_t[:,:] hole_center_42_memview = np.empty((1,3), dtype=np.float64, order='C')
-    
+    cdef DTYPE_F64_t hole_center[3]
+
+    cdef DTYPE_F64_t hole_center_2_3[3]
+
+    cdef DTYPE_F64_t hole_center_41[3]
+
+    cdef DTYPE_F64_t hole_center_42[3]
+
     ############################################################
     # the nearest_gal_index_list variable stores 2 things -
-    # the sentinel value -1 meaning 'no value here' or the 
-    # index of the found galaxies A,B,C (but not D since its 
+    # the sentinel value -1 meaning 'no value here' or the
+    # index of the found galaxies A,B,C (but not D since its
     # the last one)
     ############################################################
-    cdef DTYPE_INT64_t[:] nearest_gal_index_list = np.empty(3, dtype=np.int64, order='C')
-    
-    
-    
+    cdef DTYPE_INT64_t nearest_gal_index_list[3]
+
+
     ############################################################
     #memory for the return variables when calling find_next_galaxy
     ############################################################
-    cdef ITYPE_t[:] x_ratio_index_return_mem = np.zeros(1, dtype=np.int64, order='C')
-    
-    cdef ITYPE_t[:] gal_idx_return_mem = np.zeros(1, dtype=np.int64, order='C')
-    
-    cdef DTYPE_F64_t[:] min_x_return_mem = np.zeros(1, dtype=np.float64, order='C')
-    
-    cdef DTYPE_B_t[:] in_mask_return_mem = np.ones(1, dtype=np.uint8)
+    cdef ITYPE_t gal_idx_return
+
+    cdef DTYPE_F64_t min_x_return
+
+    cdef DTYPE_B_t in_mask_return
 
     ############################################################
     # vector_modulus is re-used each time the new unit vector is calculated
-    # unit_vector_memview is re-used each time the new unit vector is calculated
-    # v3_memview is used in calculating the cross product for galaxy 4/D
+    # unit_vector is re-used each time the new unit vector is calculated
+    # v3 is used in calculating the cross product for galaxy 4/D
     # hole_radius is used in some hole update calculations
     ############################################################
     cdef DTYPE_F64_t vector_modulus
-    
-    cdef DTYPE_F64_t[:] unit_vector_memview = np.empty(3, dtype=np.float64, order='C')
-    
-    cdef DTYPE_F64_t[:] v3_memview = np.empty(3, dtype=np.float64, order='C')
-    
+
+    cdef DTYPE_F64_t unit_vector[3]
+
+    cdef DTYPE_F64_t v3[3]
+
     cdef DTYPE_F64_t hole_radius
-    
-    
-    
-    ############################################################
-    #variables for the 4 galaxy seaarches whether the hole center is in the mask
-    ############################################################
-    cdef DTYPE_B_t in_mask_2
-    
-    cdef DTYPE_B_t in_mask_3
-    
-    cdef DTYPE_B_t in_mask_41
-    
-    cdef DTYPE_B_t in_mask_42
-    
-    
+
+
     ############################################################
     #variables for the 4 bounding galaxies (gal 4/D gets 3 variables because it uses 2 searches
     #and then picks one of the two based on some criteria)
     ############################################################
     cdef ITYPE_t k1g
-    
+
     cdef ITYPE_t k2g
-    
+
     cdef ITYPE_t k3g
-    
+
     cdef ITYPE_t k4g1
-    
+
     cdef ITYPE_t k4g2
-    
+
     cdef ITYPE_t k4g
-    
+
     ############################################################
     #minx3 is used in updating a hole center and minx41-42 are used in comparing to find
     #galaxy 4/D
     ############################################################
     cdef DTYPE_F64_t minx3
-    
+
     cdef DTYPE_F64_t minx41
-    
+
     cdef DTYPE_F64_t minx42
-    
+
+    cdef DTYPE_B_t in_mask_41
+
+    cdef DTYPE_B_t in_mask_42
+
+    cdef DTYPE_B_t not_in_mask_41
+
     ############################################################
     #these are used in calcuating the unit vector for galaxy 4/D
     ############################################################
-    cdef DTYPE_F64_t[:] midpoint_memview = np.empty(3, dtype=np.float64, order='C')
-    
-    #cdef DTYPE_F64_t[:] Acenter_memview = np.empty(3, dtype=np.float64, order='C')
-    
-    cdef DTYPE_F64_t[:] AB_memview = np.empty(3, dtype=np.float64, order='C')
-    
-    cdef DTYPE_F64_t[:] BC_memview = np.empty(3, dtype=np.float64, order='C')
-    
-    
-    
-    
-    
-    
+    cdef DTYPE_F64_t midpoint[3]
+
+    cdef DTYPE_F64_t AB[3]
+
+    cdef DTYPE_F64_t BC[3]
+
+
+
+    #re-init nearest gal index list on new cell
+    for idx in range(3):
+
+        nearest_gal_index_list[idx] = -1
+
+
     ############################################################
-    # Computation memory to pass into find_next_galaxy()
-    #
-    # NOTE: This memory is currently unused because of 
-    # I need to figure out how to reallocate it if it isnt
-    # big enough without leaking memory and causing a segfault
-    #
-    #
+    # Cells outside the survey were already rejected by 
+    # locate_first_galaxies()
     ############################################################
-    
-    cdef DTYPE_F64_t[:] Bcenter_memview = np.empty(3, dtype=np.float64, order='C')
-    
-    cdef ITYPE_t[:] MAX_NEAREST = np.empty(1, dtype=np.int64)
-    
-    MAX_NEAREST[0] = 16 #guess at the max number of results returned by kdtree
-    
-    cdef ITYPE_t[:] i_nearest_reduced_memview = np.empty(MAX_NEAREST[0], dtype=np.int64)
-                
-    cdef DTYPE_F64_t[:,:] candidate_minus_A_memview = np.empty((MAX_NEAREST[0], 3), dtype=np.float64, order='C')
+    if nearest_idx[working_idx] < 0:
+
+        return_array[working_idx, 0] = NAN
+
+        return_array[working_idx, 1] = NAN
+
+        return_array[working_idx, 2] = NAN
+
+        return_array[working_idx, 3] = NAN
+
+        return 0
+
+
+    for idx in range(3):
+
+        hole_center[idx] = cell_centers[working_idx, idx]
 
-    cdef DTYPE_F64_t[:,:] candidate_minus_center_memview = np.empty((MAX_NEAREST[0], 3), dtype=np.float64, order='C')
-    
-    cdef DTYPE_F64_t[:] bot_memview = np.empty(MAX_NEAREST[0], dtype=np.float64, order='C')
-    
-    cdef DTYPE_F64_t[:] top_memview = np.empty(MAX_NEAREST[0], dtype=np.float64, order='C')
-    
-    cdef DTYPE_F64_t[:] x_ratio_memview = np.empty(MAX_NEAREST[0], dtype=np.float64, order='C')
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
     ############################################################
-    # Declarations - possibly remove
+    #
+    # Galaxy 1/A - found for the whole batch in the first pass
+    #
     ############################################################
-    
-    #these are never actually used
-    #cdef ITYPE_t k2g_x2
-    #cdef ITYPE_t k3g_x3
-    #cdef ITYPE_t k4g1_x41
-    #cdef ITYPE_t k4g2_x42
+    k1g = nearest_idx[working_idx]
+
+    vector_modulus = nearest_dist[working_idx]
+
+    ############################################################################
+    #
+    # Start Galaxy 2/B
+    #
+    # unit_vector - unit vector hole propagation direction
+    #
+    # vector_modulus - l2 norm modulus of v1_unit
+    #
+    ############################################################################
+    for idx in range(3):
+
+        unit_vector[idx] = (galaxy_coord(galaxy_tree, k1g, idx) - hole_center[idx])/vector_modulus
+
+    hole_radius = vector_modulus
+
+    ############################################################################
+    # Make a copy of the hole center for propogation during the galaxy finding
+    # set the nearest_gal_index_list first neighbor index since we have a neighbor
+    # now
+    #
+    # Also fill in neighbor 1/A into the existing neighbor idx list
+    ############################################################################
+    for idx in range(3):
+
+        hole_center_2_3[idx] = hole_center[idx]
+
+    ############################################################################
+    #
+    # Find galaxy 2/B
+    #
+    # set the nearest neighbor 1 index in the list and init the in_mask to 1
+    ############################################################################
+    nearest_gal_index_list[0] = k1g
+
+    in_mask_return = 1
+
+    if search_next_galaxy(hole_center,
+                        hole_center_2_3,
+                        hole_radius,
+                        dr,
+                        exact_search,
+                        -1.0,
+                        unit_vector,
+                        galaxy_tree,
+                        nearest_gal_index_list,
+                        1,
+                        mask,
+                        mask_resolution,
+                        min_dist,
+                        max_dist,
+                        voxels,
+                        scratch,
+                        &gal_idx_return,        #return variable
+                        &min_x_return,          #return variable
+                        &in_mask_return) < 0:   #return variable
+
+        return -1
+
+
+    k2g = gal_idx_return
+
+    if not in_mask_return:
+
+        return_array[working_idx, 0] = NAN
+
+        return_array[working_idx, 1] = NAN
+
+        return_array[working_idx, 2] = NAN
+
+        return_array[working_idx, 3] = NAN
+
+        return 0
+
+
+    ###################################################################################
+    #
+    # Start Galaxy 3/C
+    #
+    # Calculate the new starting hole radius, and move the hole center where it
+    # already was?
+    # then make sure that location is still in the mask
+    ##################################################################################
+
+    temp_f64_accum = 0.0
+
+    temp_f64_accum2 = 0.0
+
+    for idx in range(3):
+
+        temp_f64_val = galaxy_coord(galaxy_tree, k1g, idx) - galaxy_coord(galaxy_tree, k2g, idx)
+
+        temp_f64_accum += temp_f64_val*temp_f64_val
+
+        temp_f64_accum2 += temp_f64_val*unit_vector[idx]
+
+    hole_radius = 0.5*temp_f64_accum/temp_f64_accum2
+
+
+    for idx in range(3):
+
+        hole_center[idx] = galaxy_coord(galaxy_tree, k1g, idx) - hole_radius*unit_vector[idx]
+
+
+    if not_in_survey(hole_center, mask, mask_resolution, min_dist, max_dist, voxels):
+
+        return_array[working_idx, 0] = NAN
+
+        return_array[working_idx, 1] = NAN
+
+        return_array[working_idx, 2] = NAN
+
+        return_array[working_idx, 3] = NAN
+
+        return 0
+
+    ############################################################################
+    # Find the midpoint between the two nearest galaxies
+    # calculate the new modulus between the hole center and midpoint spot
+    # Define the new unit vector along which to move the hole center
+    ############################################################################
+
+    for idx in range(3):
+
+        midpoint[idx] = 0.5*(galaxy_coord(galaxy_tree, k1g, idx) + galaxy_coord(galaxy_tree, k2g, idx))
+
+
+    temp_f64_accum = 0.0
+
+    for idx in range(3):
+
+        temp_f64_val = hole_center[idx] - midpoint[idx]
+
+        temp_f64_accum += temp_f64_val*temp_f64_val
+
+    vector_modulus = sqrt(temp_f64_accum)
+
+
+    for idx in range(3):
+
+        unit_vector[idx] = (hole_center[idx] - midpoint[idx])/vector_modulus
+
+
+    ############################################################################
+    # Initialize moving hole center
+    ############################################################################
+    for idx in range(3):
+
+        hole_center_2_3[idx] = hole_center[idx]
+
+
+    ############################################################################
+    #
+    # Find galaxy 3/C
+    #
+    # set neighbors 1 and 2 in the list, and re-init the in_mask variable to 1
+    ############################################################################
+    nearest_gal_index_list[0] = k1g
+
+    nearest_gal_index_list[1] = k2g
+
+    in_mask_return = 1
+
+    if search_next_galaxy(hole_center,
+                        hole_center_2_3,
+                        hole_radius,
+                        dr,
+                        exact_search,
+                        1.0,
+                        unit_vector,
+                        galaxy_tree,
+                        nearest_gal_index_list,
+                        2,
+                        mask,
+                        mask_resolution,
+                        min_dist,
+                        max_dist,
+                        voxels,
+                        scratch,
+                        &gal_idx_return,        #return variable
+                        &min_x_return,          #return variable
+                        &in_mask_return) < 0:   #return variable
+
+        return -1
+
+    k3g = gal_idx_return
+
+    minx3 = min_x_return
+
+    if not in_mask_return:
+
+        return_array[working_idx, 0] = NAN
+
+        return_array[working_idx, 1] = NAN
+
+        return_array[working_idx, 2] = NAN
+
+        return_array[working_idx, 3] = NAN
+
+        return 0
+
+    ###########################################################################
+    #
+    # Start Galaxy 4/D-1 (galaxy 4/D takes 2 attempts)
+    #
+    # Process is very similar as before, except we do not know if we have to
+    # move above or below the plane.  Therefore, we will find the next closest
+    # if we move above the plane, and the next closest if we move below the
+    # plane.
+    #
+    # Update hole center
+    # update hole radius
+    #
+    ###########################################################################
+    for idx in range(3):
+
+        hole_center[idx] += minx3*unit_vector[idx]
+
+
+    temp_f64_accum = 0.0
+
+    for idx in range(3):
+
+        temp_f64_val = hole_center[idx] - galaxy_coord(galaxy_tree, k1g, idx)
+
+        temp_f64_accum += temp_f64_val*temp_f64_val
+
+    hole_radius = sqrt(temp_f64_accum)
+
+
+    if not_in_survey(hole_center, mask, mask_resolution, min_dist, max_dist, voxels):
+
+        return_array[working_idx, 0] = NAN
+
+        return_array[working_idx, 1] = NAN
+
+        return_array[working_idx, 2] = NAN
+
+        return_array[working_idx, 3] = NAN
+
+        return 0
+
+    ############################################################################
+    #
+    # The vector along which to move the hole center is defined by the cross
+    # product of the vectors pointing between the three nearest galaxies.
+    #
+    # Calculate the cross product of the difference vectors, calculate
+    # the modulus of that vector and normalize to a unit vector
+    #
+    ############################################################################
+
+    for idx in range(3):
+
+        AB[idx] = galaxy_coord(galaxy_tree, k1g, idx) - galaxy_coord(galaxy_tree, k2g, idx)
+
+        BC[idx] = galaxy_coord(galaxy_tree, k3g, idx) - galaxy_coord(galaxy_tree, k2g, idx)
+
+
+    v3[0] = AB[1]*BC[2] - AB[2]*BC[1]
+
+    v3[1] = AB[2]*BC[0] - AB[0]*BC[2]
+
+    v3[2] = AB[0]*BC[1] - AB[1]*BC[0]
+
+
+    temp_f64_accum = 0.0
+
+    for idx in range(3):
+
+        temp_f64_accum += v3[idx]*v3[idx]
+
+    vector_modulus = sqrt(temp_f64_accum)
+
+
+    for idx in range(3):
+
+        unit_vector[idx] = v3[idx]/vector_modulus
+
+    ############################################################################
+    # Update new hole center for propagation
+    ############################################################################
+    for idx in range(3):
+
+        hole_center_41[idx] = hole_center[idx]
+
+    ############################################################################
+    #
+    # Find galaxy 4/D-1
+    #
+    # update the exiting neighbors 1/A, 2/B and 3/C in the
+    # nearest_gal_index_list and re-init in_mask to 1
+    ############################################################################
+    nearest_gal_index_list[0] = k1g
+
+    nearest_gal_index_list[1] = k2g
+
+    nearest_gal_index_list[2] = k3g
+
+    in_mask_return = 1
+
+    if search_next_galaxy(hole_center,
+                        hole_center_41,
+                        hole_radius,
+                        dr,
+                        exact_search,
+                        1.0,
+                        unit_vector,
+                        galaxy_tree,
+                        nearest_gal_index_list,
+                        3,
+                        mask,
+                        mask_resolution,
+                        min_dist,
+                        max_dist,
+                        voxels,
+                        scratch,
+                        &gal_idx_return,        #return variable
+                        &min_x_return,          #return variable
+                        &in_mask_return) < 0:   #return variable
+
+        return -1
+
+    k4g1 = gal_idx_return
+
+    minx41 = min_x_return
+
+    in_mask_41 = in_mask_return
+
+
+    # Calculate potential new hole center
+    if in_mask_41:
 
-    
-    cdef ITYPE_t num_cells = i_j_k_array.shape[0]
-    
-    
-    
-    for working_idx in range(num_cells):
-        
-        
-        
-        if (verbose > 0 and working_idx % 10000 == 0):
-        
-            print("Processing cell "+str(working_idx)+" of "+str(num_cells))
-        
-        
-        #re-init nearest gal index list on new cell
-        for idx in range(3):
-        
-            nearest_gal_index_list[idx] = -1
-    
-        
-        ############################################################
-        # initialize the starting hole center based on the given
-        # i,j,k and grid spacing parameters, and then check to
-        # make sure it's in the survey
-        ############################################################
-        hole_center_memview[0,0] = i_j_k_array[working_idx, 0]
-        
-        hole_center_memview[0,1] = i_j_k_array[working_idx, 1]
-        
-        hole_center_memview[0,2] = i_j_k_array[working_idx, 2]
-    
-        
-        for idx in range(3):
-            
-            hole_center_memview[0,idx] = (hole_center_memview[0,idx] + 0.5)*dl + coord_min[0,idx]
-            
-            
-        if not_in_mask(hole_center_memview, mask, mask_resolution, min_dist, max_dist):
-            
-            return_array[working_idx, 0] = NAN
-            
-            return_array[working_idx, 1] = NAN
-            
-            return_array[working_idx, 2] = NAN
-            
-            return_array[working_idx, 3] = NAN
-            
-            #return 
-            continue
-        
-        
-        ############################################################
-        #
-        # Find Galaxy 1/A - super easy using KDTree
-        #
-        ############################################################
-        neighbor_1_dists, neighbor_1_idxs = galaxy_tree.query(hole_center_memview, k=1)
-        
-        k1g = neighbor_1_idxs[0][0]
-        
-        ############################################################################
-        #
-        # Start Galaxy 2/B
-        #
-        # v1_unit_memview - unit vector hole propagation direction
-        #
-        # modv1 - l2 norm modulus of v1_unit
-        #
-        ############################################################################
-        vector_modulus = neighbor_1_dists[0][0] #float64
-        
-        for idx in range(3):
-            
-            unit_vector_memview[idx] = (w_coord[k1g,idx] - hole_center_memview[0,idx])/vector_modulus
-            
-        hole_radius = vector_modulus
-        
-        ############################################################################
-        # Make a copy of the hole center for propogation during the galaxy finding
-        # set the nearest_gal_index_list first neighbor index since we have a neighbor
-        # now
-        #
-        # Also fill in neighbor 1/A into the existing neighbor idx list
-        ############################################################################
-        for idx in range(3):
-            
-            hole_center_2_3_memview[0,idx] = hole_center_memview[0,idx]
-    
-        ############################################################################
-        #
-        # Find galaxy 2/B
-        #
-        # set the nearest neighbor 1 index in the list and init the in_mask to 1
-        ############################################################################
-        nearest_gal_index_list[0] = k1g
-        
-        in_mask_return_mem[0] = 1
-        
-        find_next_galaxy(hole_center_memview,
-                         hole_center_2_3_memview, 
-                         hole_radius, 
-                         dr, 
-                         -1.0,
-                         unit_vector_memview, 
-                         galaxy_tree, 
-                         nearest_gal_index_list, 
-                         1,
-                         w_coord, 
-                         mask, 
-                         mask_resolution,
-                         min_dist, 
-                         max_dist,
-                         Bcenter_memview,
-                         MAX_NEAREST,
-                         i_nearest_reduced_memview,
-                         candidate_minus_A_memview,
-                         candidate_minus_center_memview,
-                         bot_memview,
-                         top_memview,
-                         x_ratio_memview,
-                         #x_ratio_index_return_mem,  #return variable
-                         gal_idx_return_mem,        #return variable
-                         min_x_return_mem,          #return variable
-                         in_mask_return_mem)        #return variable
-    
-    
-        #k2g_x2 = x_ratio_index_return_mem[0]
-        
-        k2g = gal_idx_return_mem[0]
-        
-        in_mask_2 = in_mask_return_mem[0]
-        
-        #minx2 = min_x_return_mem[0]
-        
-        if not in_mask_2:
-        
-            return_array[working_idx, 0] = NAN
-            
-            return_array[working_idx, 1] = NAN
-            
-            return_array[working_idx, 2] = NAN
-            
-            return_array[working_idx, 3] = NAN
-            
-            #return 
-            continue
-        
-        
-        ###################################################################################
-        #
-        # Start Galaxy 3/C
-        #
-        # Calculate the new starting hole radius, and move the hole center where it 
-        # already was?
-        # then make sure that location is still in the mask
-        ##################################################################################
-        
-        temp_f64_accum = 0.0
-        
-        temp_f64_accum2 = 0.0
-        
-        for idx in range(3):
-        
-            temp_f64_val = w_coord[k1g,idx] - w_coord[k2g, idx]
-            
-            temp_f64_accum += temp_f64_val*temp_f64_val
-            
-            temp_f64_accum2 += temp_f64_val*unit_vector_memview[idx]
-        
-        hole_radius = 0.5*temp_f64_accum/temp_f64_accum2
-    
-        
-        for idx in range(3):
-            
-            hole_center_memview[0,idx] = w_coord[k1g,idx] - hole_radius*unit_vector_memview[idx]
-        
-        
-        if not_in_mask(hole_center_memview, mask, mask_resolution, min_dist, max_dist):
-            
-            return_array[working_idx, 0] = NAN
-            
-            return_array[working_idx, 1] = NAN
-            
-            return_array[working_idx, 2] = NAN
-            
-            return_array[working_idx, 3] = NAN
-            
-            #return 
-            continue
-    
-        ############################################################################
-        # Find the midpoint between the two nearest galaxies
-        # calculate the new modulus between the hole center and midpoint spot
-        # Define the new unit vector along which to move the hole center
-        ############################################################################
-        
-        for idx in range(3):
-            
-            midpoint_memview[idx] = 0.5*(w_coord[k1g,idx] + w_coord[k2g,idx])
-        
-        
-        temp_f64_accum = 0.0
-        
-        for idx in range(3):
-            
-            temp_f64_val = hole_center_memview[0,idx] - midpoint_memview[idx]
-            
-            temp_f64_accum += temp_f64_val*temp_f64_val
-        
-        vector_modulus = sqrt(temp_f64_accum)
-        
-        
-        for idx in range(3):
-        
-            unit_vector_memview[idx] = (hole_center_memview[0,idx] - midpoint_memview[idx])/vector_modulus
-        
-        
-        ############################################################################
-        # Calculate vector pointing from the hole center to the nearest galaxy
-        # Calculate vector pointing from the hole center to the second-nearest galaxy
-        # Initialize moving hole center
-        ############################################################################
-        '''
-        for idx in range(3):
-            
-            Acenter_memview[idx] = w_coord[k1g, idx] - hole_center_memview[0,idx]
-        
-        for idx in range(3):
-            
-            Bcenter_memview[idx] = w_coord[k2g, idx] - hole_center_memview[0,idx]
-        '''
-        for idx in range(3):
-            
-            hole_center_2_3_memview[0,idx] = hole_center_memview[0,idx]
-        
-    
-        ############################################################################
-        #
-        # Find galaxy 3/C
-        #
-        # set neighbors 1 and 2 in the list, and re-init the in_mask variable to 1
-        ############################################################################
-        nearest_gal_index_list[0] = k1g
-        
-        nearest_gal_index_list[1] = k2g
-    
-        in_mask_return_mem[0] = 1
-    
-        find_next_galaxy(hole_center_memview,
-                         hole_center_2_3_memview, 
-                         hole_radius, 
-                         dr, 
-                         1.0,
-                         unit_vector_memview, 
-                         galaxy_tree, 
-                         nearest_gal_index_list, 
-                         2,
-                         w_coord, 
-                         mask, 
-                         mask_resolution, 
-                         min_dist, 
-                         max_dist,
-                         Bcenter_memview,
-                         MAX_NEAREST,
-                         i_nearest_reduced_memview,
-                         candidate_minus_A_memview,
-                         candidate_minus_center_memview,
-                         bot_memview,
-                         top_memview,
-                         x_ratio_memview,
-                         #x_ratio_index_return_mem,  #return variable
-                         gal_idx_return_mem,        #return variable
-                         min_x_return_mem,          #return variable
-                         in_mask_return_mem)        #return variable
-    
-        #k3g_x3 = x_ratio_index_return_mem[0]
-        
-        k3g = gal_idx_return_mem[0]
-        
-        minx3 = min_x_return_mem[0]
-        
-        in_mask_3 = in_mask_return_mem[0]
-        
-        if not in_mask_3:
-        
-            return_array[working_idx, 0] = NAN
-            
-            return_array[working_idx, 1] = NAN
-            
-            return_array[working_idx, 2] = NAN
-            
-            return_array[working_idx, 3] = NAN
-            
-            #return 
-            continue
-    
-        ###########################################################################
-        #
-        # Start Galaxy 4/D-1 (galaxy 4/D takes 2 attempts)
-        #
-        # Process is very similar as before, except we do not know if we have to 
-        # move above or below the plane.  Therefore, we will find the next closest 
-        # if we move above the plane, and the next closest if we move below the 
-        # plane.
-        #
-        # Update hole center
-        # update hole radius
-        #
-        ###########################################################################
-        for idx in range(3):
-        
-            hole_center_memview[0,idx] += minx3*unit_vector_memview[idx]
-    
-    
-        temp_f64_accum = 0.0
-    
-        for idx in range(3):
-    
-            temp_f64_val = hole_center_memview[0,idx] - w_coord[k1g,idx]
-    
-            temp_f64_accum += temp_f64_val*temp_f64_val
-    
-        hole_radius = sqrt(temp_f64_accum)
-        
-    
-        if not_in_mask(hole_center_memview, mask, mask_resolution, min_dist, max_dist):
-        
-            return_array[working_idx, 0] = NAN
-            
-            return_array[working_idx, 1] = NAN
-            
-            return_array[working_idx, 2] = NAN
-            
-            return_array[working_idx, 3] = NAN
-            
-            #return 
-            continue
-    
-        ############################################################################
-        #
-        # The vector along which to move the hole center is defined by the cross 
-        # product of the vectors pointing between the three nearest galaxies.
-        #
-        # Calculate the cross product of the difference vectors, calculate
-        # the modulus of that vector and normalize to a unit vector
-        # 
-        ############################################################################
-    
-        for idx in range(3):
-    
-            AB_memview[idx] = w_coord[k1g, idx] - w_coord[k2g, idx]
-    
-            BC_memview[idx] = w_coord[k3g, idx] - w_coord[k2g, idx]
-    
-    
-        v3_memview[0] = AB_memview[1]*BC_memview[2] - AB_memview[2]*BC_memview[1]
-    
-        v3_memview[1] = AB_memview[2]*BC_memview[0] - AB_memview[0]*BC_memview[2]
-    
-        v3_memview[2] = AB_memview[0]*BC_memview[1] - AB_memview[1]*BC_memview[0]
-    
-    
-        temp_f64_accum = 0.0
-    
-        for idx in range(3):
-    
-            temp_f64_accum += v3_memview[idx]*v3_memview[idx]
-    
-        vector_modulus = sqrt(temp_f64_accum)
-    
-    
-        for idx in range(3):
-    
-            unit_vector_memview[idx] = v3_memview[idx]/vector_modulus
-    
-        ############################################################################
-        # Calculate vector pointing from the hole center to the neighbor 1/A
-        # Calculate vector pointing from the hole center to the neighbor 2/B
-        # Update new hole center for propagation
-        ############################################################################
-        '''
-        for idx in range(3):
-    
-            Acenter_memview[idx] = w_coord[k1g, idx] - hole_center_memview[0, idx]
-    
-    
         for idx in range(3):
-    
-            Bcenter_memview[idx] = w_coord[k2g, idx] - hole_center_memview[0, idx]
-        '''
-    
+
+            hole_center_41[idx] = hole_center[idx] + minx41*unit_vector[idx]
+
+
+    ############################################################################
+    #
+    # Start galaxy 4/D-2
+    #
+    # Repeat same search, but shift the hole center in the other direction
+    # this time, so flip the unit_vector in other direction
+    ############################################################################
+    for idx in range(3):
+
+        unit_vector[idx] *= -1.0
+
+
+    minx42 = INFINITY
+
+
+    for idx in range(3):
+
+        hole_center_42[idx] = hole_center[idx]
+
+
+    ############################################################################
+    #
+    # Find galaxy 4/D-2
+    #
+    # nearest_neighbor_gal_list already updated from galaxy 4/D-1
+    # re-init in_mask to 1
+    ############################################################################
+    in_mask_return = 1
+
+    if search_next_galaxy(hole_center,
+                        hole_center_42,
+                        hole_radius,
+                        dr,
+                        exact_search,
+                        1.0,
+                        unit_vector,
+                        galaxy_tree,
+                        nearest_gal_index_list,
+                        3,
+                        mask,
+                        mask_resolution,
+                        min_dist,
+                        max_dist,
+                        voxels,
+                        scratch,
+                        &gal_idx_return,        #return variable
+                        &min_x_return,          #return variable
+                        &in_mask_return) < 0:   #return variable
+
+        return -1
+
+    k4g2 = gal_idx_return
+
+    minx42 = min_x_return
+
+    in_mask_42 = in_mask_return
+
+    # Calculate potential new hole center
+    if in_mask_42:
+
         for idx in range(3):
-    
-            hole_center_41_memview[0, idx] = hole_center_memview[0, idx]
-    
-        ############################################################################
-        #
-        # Find galaxy 4/D-1
-        #
-        # update the exiting neighbors 1/A, 2/B and 3/C in the 
-        # nearest_gal_index_list and re-init in_mask to 1
-        ############################################################################
-        nearest_gal_index_list[0] = k1g
-        
-        nearest_gal_index_list[1] = k2g
-        
-        nearest_gal_index_list[2] = k3g
-    
-        in_mask_return_mem[0] = 1
-    
-        find_next_galaxy(hole_center_memview,
-                         hole_center_41_memview, 
-                         hole_radius, 
-                         dr, 
-                         1.0,
-                         unit_vector_memview, 
-                         galaxy_tree, 
-                         nearest_gal_index_list, 
-                         3,
-                         w_coord, 
-                         mask, 
-                         mask_resolution,
-                         min_dist, 
-                         max_dist,
-                         Bcenter_memview,
-                         MAX_NEAREST,
-                         i_nearest_reduced_memview,
-                         candidate_minus_A_memview,
-                         candidate_minus_center_memview,
-                         bot_memview,
-                         top_memview,
-                         x_ratio_memview,
-                         #x_ratio_index_return_mem,  #return variable
-                         gal_idx_return_mem,        #return variable
-                         min_x_return_mem,          #return variable
-                         in_mask_return_mem)        #return variable
-    
-        #k4g1_x41 = x_ratio_index_return_mem[0]
-                        
-        k4g1 = gal_idx_return_mem[0]
-        
-        minx41 = min_x_return_mem[0]
-    
-        in_mask_41 = in_mask_return_mem[0]
-    
-    
-        # Calculate potential new hole center
-        if in_mask_41:
-    
-            for idx in range(3):
-    
-                hole_center_41_memview[0, idx] = hole_center_memview[0, idx] + minx41*unit_vector_memview[idx]
-    
-    
-    
-            
-       
-        ############################################################################
-        #
-        # Start galaxy 4/D-2
-        #
-        # Repeat same search, but shift the hole center in the other direction 
-        # this time, so flip the v3_unit_memview in other direction
-        ############################################################################
+
+            hole_center_42[idx] = hole_center[idx] + minx42*unit_vector[idx]
+
+
+
+    ############################################################################
+    # Figure out whether galaxy 4/D is 4/D-1 or 4/D-2
+    # use the minx41 and minx42 variables to figure out which one is
+    # closer? then set the 4th galaxy index based on that and update the
+    # output hole center based on that.  Or, if the conditions aren't filled
+    # because we left the survey, return NAN output
+    ############################################################################
+
+    not_in_mask_41 = not_in_survey(hole_center_41, mask, mask_resolution, min_dist, max_dist, voxels)
+
+    if not not_in_mask_41 and minx41 <= minx42:
+
         for idx in range(3):
-    
-            unit_vector_memview[idx] *= -1.0
-    
-    
-        minx42 = INFINITY
-    
-    
+
+            hole_center[idx] = hole_center_41[idx]
+
+        k4g = k4g1
+
+    elif not not_in_survey(hole_center_42, mask, mask_resolution, min_dist, max_dist, voxels):
+
         for idx in range(3):
-    
-            hole_center_42_memview[0, idx] = hole_center_memview[0, idx]
-    
-        
-        ############################################################################
-        #
-        # Find galaxy 4/D-2
-        #
-        # nearest_neighbor_gal_list already updated from galaxy 4/D-1
-        # re-init in_mask to 1
-        ############################################################################
-        in_mask_return_mem[0] = 1
-    
-        find_next_galaxy(hole_center_memview,
-                         hole_center_42_memview, 
-                         hole_radius, 
-                         dr, 
-                         1.0,
-                         unit_vector_memview, 
-                         galaxy_tree, 
-                         nearest_gal_index_list, 
-                         3,
-                         w_coord, 
-                         mask, 
-                         mask_resolution,
-                         min_dist, 
-                         max_dist,
-                         Bcenter_memview,
-                         MAX_NEAREST,
-                         i_nearest_reduced_memview,
-                         candidate_minus_A_memview,
-                         candidate_minus_center_memview,
-                         bot_memview,
-                         top_memview,
-                         x_ratio_memview,
-                         #x_ratio_index_return_mem,  #return variable
-                         gal_idx_return_mem,        #return variable
-                         min_x_return_mem,          #return variable
-                         in_mask_return_mem)        #return variable
-    
-        #k4g2_x42 = x_ratio_index_return_mem[0]
-                        
-        k4g2 = gal_idx_return_mem[0]
-        
-        minx42 = min_x_return_mem[0]
-    
-        in_mask_42 = in_mask_return_mem[0]
-        
-        # Calculate potential new hole center
-        if in_mask_42:
-    
-            for idx in range(3):
-    
-                hole_center_42_memview[0, idx] = hole_center_memview[0, idx] + minx42*unit_vector_memview[idx]
-    
-        
-        
-        ############################################################################
-        # Figure out whether galaxy 4/D is 4/D-1 or 4/D-2
-        # use the minx41 and minx42 variables to figure out which one is 
-        # closer? then set the 4th galaxy index based on that and update the
-        # output hole center based on that.  Or, if the conditions aren't filled
-        # because we left the survey, return NAN output
-        ############################################################################
-        
-        not_in_mask_41 = not_in_mask(hole_center_41_memview, mask, mask_resolution, min_dist, max_dist)
-    
-        if not not_in_mask_41 and minx41 <= minx42:
-    
-            for idx in range(3):
-    
-                hole_center_memview[0, idx] = hole_center_41_memview[0, idx]
-    
-            k4g = k4g1
-    
-        elif not not_in_mask(hole_center_42_memview, mask, mask_resolution, min_dist, max_dist):
-            
-            for idx in range(3):
-    
-                hole_center_memview[0, idx] = hole_center_42_memview[0, idx]
-    
-            k4g = k4g2
-    
-        elif not not_in_mask_41:
-    
-            for idx in range(3):
-    
-                hole_center_memview[0, idx] = hole_center_41_memview[0, idx]
-    
-            k4g = k4g1
-            
-        else:
-            
-            return_array[working_idx, 0] = NAN
-            
-            return_array[working_idx, 1] = NAN
-            
-            return_array[working_idx, 2] = NAN
-            
-            return_array[working_idx, 3] = NAN
-            
-            #return 
-            continue
-    
-    
-        ############################################################################
-        # Now that we have all 4 bounding galaxies, calculate the hole radius
-        # and write the valid (x,y,z,r) values!
-        ############################################################################
-    
-        temp_f64_accum = 0.0
-    
+
+            hole_center[idx] = hole_center_42[idx]
+
+        k4g = k4g2
+
+    elif not not_in_mask_41:
+
         for idx in range(3):
-    
-            temp_f64_val = hole_center_memview[0, idx] - w_coord[k1g, idx]
-    
-            temp_f64_accum += temp_f64_val*temp_f64_val
-    
-        hole_radius = sqrt(temp_f64_accum)
-    
-    
-        return_array[working_idx, 0] = hole_center_memview[0, 0]
-        
-        return_array[working_idx, 1] = hole_center_memview[0, 1]
-        
-        return_array[working_idx, 2] = hole_center_memview[0, 2]
-        
-        return_array[working_idx, 3] = hole_radius
-    
-    
-    #print("Finished main loop")
-    
-    #return (x_val, y_val, z_val, r_val)
-    return
+
+            hole_center[idx] = hole_center_41[idx]
+
+        k4g = k4g1
+
+    else:
+
+        return_array[working_idx, 0] = NAN
+
+        return_array[working_idx, 1] = NAN
+
+        return_array[working_idx, 2] = NAN
+
+        return_array[working_idx, 3] = NAN
+
+        return 0
+
+
+    ############################################################################
+    # Now that we have all 4 bounding galaxies, calculate the hole radius
+    # and write the valid (x,y,z,r) values!
+    ############################################################################
+
+    temp_f64_accum = 0.0
+
+    for idx in range(3):
+
+        temp_f64_val = hole_center[idx] - galaxy_coord(galaxy_tree, k1g, idx)
+
+        temp_f64_accum += temp_f64_val*temp_f64_val
+
+    hole_radius = sqrt(temp_f64_accum)
+
+
+    return_array[working_idx, 0] = hole_center[0]
+
+    return_array[working_idx, 1] = hole_center[1]
+
+    return_array[working_idx, 2] = hole_center[2]
+
+    return_array[working_idx, 3] = hole_radius
+
+    return 0
 
 
-    
 
 
 
@@ -9,40 +9,213 @@ from typedefs cimport DTYPE_CP128_t, DTYPE_CP64_t, DTYPE_F64_t, DTYPE_F32_t, DTY
 
 
 
-cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview, \
-                           DTYPE_F64_t[:,:] moving_hole_center_memview, \
-                            DTYPE_F64_t hole_radius, \
-                            DTYPE_F64_t dr, \
-                            DTYPE_F64_t direction_mod,\
-                            DTYPE_F64_t[:] unit_vector_memview, \
-                            galaxy_tree, \
-                            DTYPE_INT64_t[:] nearest_gal_index_list, \
-                            ITYPE_t num_neighbors, \
-                            DTYPE_F64_t[:,:] w_coord, \
-                            DTYPE_B_t[:,:] mask, \
-                            DTYPE_INT32_t mask_resolution, \
-                            DTYPE_F64_t min_dist, \
-                            DTYPE_F64_t max_dist, \
-                            
-                            DTYPE_F64_t[:] Bcenter_memview, \
-                            
-                            ITYPE_t[:] MAX_NEAREST, \
-                            ITYPE_t[:] i_nearest_reduced_memview, \
-                            DTYPE_F64_t[:,:] candidate_minus_A_memview, \
-                            DTYPE_F64_t[:,:] candidate_minus_center_memview, \
-                            DTYPE_F64_t[:] bot_memview, \
-                            DTYPE_F64_t[:] top_memview, \
-                            DTYPE_F64_t[:] x_ratio_memview, \
-                            #ITYPE_t[:] nearest_neighbor_x_ratio_index, \
-                            ITYPE_t[:] nearest_neighbor_index, \
-                            DTYPE_F64_t[:] min_x_ratio, \
-                            DTYPE_B_t[:] in_mask) #except *
-
-
-
-
-cdef DTYPE_B_t not_in_mask(DTYPE_F64_t[:,:] coordinates, \
-                  DTYPE_B_t[:,:] survey_mask_ra_dec, \
-                  DTYPE_INT32_t n, \
-                  DTYPE_F64_t rmin, \
-                  DTYPE_F64_t rmax)
\ No newline at end of file
+cdef class GalaxyTree:
+
+    cdef DTYPE_F64_t[:,::1] data
+    
+    cdef DTYPE_F32_t[:,::1] data32
+    
+    cdef ITYPE_t[::1] idx_array
+    
+    cdef ITYPE_t[::1] node_idx_start
+    
+    cdef ITYPE_t[::1] node_idx_end
+    
+    cdef DTYPE_B_t[::1] node_is_leaf
+    
+    cdef DTYPE_F64_t[:,::1] node_lower
+    
+    cdef DTYPE_F64_t[:,::1] node_upper
+    
+    cdef readonly ITYPE_t num_points
+    
+    cdef readonly ITYPE_t num_nodes
+    
+    cdef readonly ITYPE_t leaf_size
+    
+    cdef readonly DTYPE_B_t single_precision
+    
+    cdef ITYPE_t find_within_radius(self, \
+                                    DTYPE_F64_t* center, \
+                                    DTYPE_F64_t radius, \
+                                    ITYPE_t* index_buffer, \
+                                    ITYPE_t buffer_size) nogil
+    
+    cdef ITYPE_t find_in_shell(self, \
+                               DTYPE_F64_t* center, \
+                               DTYPE_F64_t radius, \
+                               DTYPE_F64_t* inner_center, \
+                               DTYPE_F64_t inner_radius, \
+                               ITYPE_t* index_buffer, \
+                               ITYPE_t buffer_size) nogil
+    
+    cdef ITYPE_t find_nearest(self, \
+                              DTYPE_F64_t* center, \
+                              DTYPE_F64_t* distance) nogil
+    
+    cdef ITYPE_t find_nearest_from(self, \
+                                   DTYPE_F64_t* center, \
+                                   ITYPE_t guess, \
+                                   DTYPE_F64_t* distance) nogil
+    
+    cdef ITYPE_t _radius_node(self, \
+                              ITYPE_t i_node, \
+                              DTYPE_F64_t* center, \
+                              DTYPE_F64_t radius_sq, \
+                              ITYPE_t* index_buffer, \
+                              ITYPE_t buffer_size, \
+                              ITYPE_t count) nogil
+    
+    cdef ITYPE_t _shell_node(self, \
+                             ITYPE_t i_node, \
+                             DTYPE_F64_t* center, \
+                             DTYPE_F64_t radius_sq, \
+                             DTYPE_F64_t* inner_center, \
+                             DTYPE_F64_t inner_radius_sq, \
+                             ITYPE_t* index_buffer, \
+                             ITYPE_t buffer_size, \
+                             ITYPE_t count) nogil
+    
+    cdef void _nearest_node(self, \
+                            ITYPE_t i_node, \
+                            DTYPE_F64_t* center, \
+                            DTYPE_F64_t* best_dist_sq, \
+                            ITYPE_t* best_idx) nogil
+    
+    cdef DTYPE_F64_t _min_dist_sq(self, ITYPE_t i_node, DTYPE_F64_t* center) nogil
+    
+    cdef DTYPE_F64_t _max_dist_sq(self, ITYPE_t i_node, DTYPE_F64_t* center) nogil
+
+
+
+cdef inline DTYPE_F64_t galaxy_coord(GalaxyTree galaxy_tree, ITYPE_t idx, ITYPE_t dim) nogil:
+    '''
+    Coordinate dim of the galaxy at tree position idx, as a double whichever
+    precision the tree stores
+    '''
+    
+    with cython.boundscheck(False), cython.wraparound(False):
+        
+        if galaxy_tree.single_precision:
+            
+            return galaxy_tree.data32[idx, dim]
+        
+        return galaxy_tree.data[idx, dim]
+
+
+
+cdef struct FindNextScratch:
+
+    ITYPE_t capacity
+
+    ITYPE_t* i_nearest
+
+    ITYPE_t* i_nearest_reduced
+
+    DTYPE_F64_t* candidate_minus_A
+
+    DTYPE_F64_t* candidate_minus_center
+
+    DTYPE_F64_t* bot
+
+    DTYPE_F64_t* top
+
+    DTYPE_F64_t* x_ratio
+
+
+
+cdef struct SurveyVoxels:
+
+    DTYPE_B_t* states
+
+    ITYPE_t shape[3]
+
+    DTYPE_F64_t origin[3]
+
+    DTYPE_F64_t inv_voxel_size
+
+
+
+cdef enum:
+
+    SURVEY_VOXEL_OUTSIDE = 0
+
+    SURVEY_VOXEL_INSIDE = 1
+
+    SURVEY_VOXEL_BOUNDARY = 2
+
+
+
+cdef class HoleGrowthWorkspace:
+    
+    cdef FindNextScratch* scratch
+    
+    cdef readonly int num_threads
+
+
+
+cdef int init_find_next_scratch(FindNextScratch* scratch, ITYPE_t capacity) nogil
+
+cdef int grow_find_next_scratch(FindNextScratch* scratch, ITYPE_t capacity) nogil
+
+cdef void free_find_next_scratch(FindNextScratch* scratch) nogil
+
+
+
+cdef int find_next_galaxy(DTYPE_F64_t* hole_center, \
+                          DTYPE_F64_t* temp_hole_center, \
+                          DTYPE_F64_t search_radius, \
+                          DTYPE_F64_t dr, \
+                          DTYPE_F64_t direction_mod, \
+                          DTYPE_F64_t* unit_vector, \
+                          GalaxyTree galaxy_tree, \
+                          DTYPE_INT64_t* nearest_gal_index_list, \
+                          ITYPE_t num_neighbors, \
+                          DTYPE_B_t[:,:] mask, \
+                          DTYPE_INT32_t mask_resolution, \
+                          DTYPE_F64_t min_dist, \
+                          DTYPE_F64_t max_dist, \
+                          SurveyVoxels* voxels, \
+                          FindNextScratch* scratch, \
+                          ITYPE_t* nearest_neighbor_index, \
+                          DTYPE_F64_t* min_x_ratio, \
+                          DTYPE_B_t* in_mask) nogil
+
+
+
+
+cdef int find_next_galaxy_exact(DTYPE_F64_t* hole_center, \
+                                DTYPE_F64_t* temp_hole_center, \
+                                DTYPE_F64_t search_radius, \
+                                DTYPE_F64_t direction_mod, \
+                                DTYPE_F64_t* unit_vector, \
+                                GalaxyTree galaxy_tree, \
+                                DTYPE_INT64_t* nearest_gal_index_list, \
+                                ITYPE_t num_neighbors, \
+                                DTYPE_B_t[:,:] mask, \
+                                DTYPE_INT32_t mask_resolution, \
+                                DTYPE_F64_t min_dist, \
+                                DTYPE_F64_t max_dist, \
+                                SurveyVoxels* voxels, \
+                                FindNextScratch* scratch, \
+                                ITYPE_t* nearest_neighbor_index, \
+                                DTYPE_F64_t* min_x_ratio, \
+                                DTYPE_B_t* in_mask) nogil
+
+
+
+
+cdef DTYPE_B_t not_in_mask(DTYPE_F64_t* coordinates, \
+                           DTYPE_B_t[:,:] survey_mask_ra_dec, \
+                           DTYPE_INT32_t n, \
+                           DTYPE_F64_t rmin, \
+                           DTYPE_F64_t rmax) nogil
+
+
+
+cdef DTYPE_B_t not_in_survey(DTYPE_F64_t* coordinates, \
+                             DTYPE_B_t[:,:] survey_mask_ra_dec, \
+                             DTYPE_INT32_t n, \
+                             DTYPE_F64_t rmin, \
+                             DTYPE_F64_t rmax, \
+                             SurveyVoxels* voxels) nogil
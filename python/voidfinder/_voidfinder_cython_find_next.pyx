@@ -27,7 +27,7 @@ from numpy.math cimport NAN, INFINITY
 
 from libc.math cimport fabs, sqrt, asin, atan#, exp, pow, cos, sin, asin
 
-#from libc.stdlib cimport malloc, free
+from libc.stdlib cimport malloc, calloc, free
 
 
 
@@ -38,48 +38,1193 @@ from libc.math cimport fabs, sqrt, asin, atan#, exp, pow, cos, sin, asin
 
 
 
+cdef class GalaxyTree:
+    '''
+    Description:
+    ============
+    KD-tree over the galaxy coordinates whose queries can be called directly
+    from the cython hole-growing kernels without the GIL.
+    
+    The layout follows the sklearn KDTree: a complete binary tree stored in 
+    flat arrays, where node i has children 2i+1 and 2i+2, and each node owns 
+    the contiguous range [node_idx_start, node_idx_end) of idx_array.  Unlike 
+    sklearn, the galaxy coordinates are stored in tree order so that the 
+    points of a leaf are adjacent in memory.
+    
+    The cdef queries write the tree positions of the matching galaxies into 
+    a caller-owned buffer instead of allocating a python array, so a query 
+    costs no python object creation at all.  A tree position idx is the 
+    galaxy in row idx_array[idx] of w_coord, and its coordinates are read 
+    with galaxy_coord(), so the kernels need no copy of w_coord besides the 
+    tree's own.  The python query methods return w_coord row indices.
+    
+    With single_precision the coordinates are stored as float32, halving 
+    the memory the tree takes and the bandwidth the queries use.  All the 
+    distances are still computed in float64 from the rounded coordinates, 
+    so the only error is the rounding of each coordinate x to float32, at 
+    most |x|*2**-24 (e.g. 3e-5 Mpc/h at 500 Mpc/h).  The bounding galaxies 
+    of a hole are then the same as in float64 unless two candidates are 
+    within that distance of bounding it, and the hole radius, being the 
+    circumradius of the 4 bounding galaxies, moves by at most about 
+    sqrt(3)*|x|*2**-24 times R/h, where R is the hole radius and h the 
+    smallest height of the tetrahedron of the 4 galaxies.
+    
+    Parameters:
+    ===========
+    
+    w_coord : numpy.ndarray of shape (N,3)
+        x,y,z coordinates of the galaxies in units of Mpc/h
+        
+    leaf_size : integer
+        Maximum number of galaxies in a leaf node.  Default is 32.
+        
+    single_precision : boolean
+        Store the coordinates as float32 instead of float64.  Default is 
+        False.
+    '''
+    
+    def __init__(self, w_coord, ITYPE_t leaf_size=32, single_precision=False):
+        
+        cdef ITYPE_t num_levels
+        
+        cdef ITYPE_t i_node
+        
+        cdef ITYPE_t start
+        
+        cdef ITYPE_t end
+        
+        cdef ITYPE_t mid
+        
+        
+        coords = np.asarray(w_coord, dtype=np.float64)
+        
+        ############################################################
+        # Build from the rounded coordinates, so that the node 
+        # bounds are exact for the coordinates actually stored
+        ############################################################
+        if single_precision:
+            
+            coords = coords.astype(np.float32).astype(np.float64)
+        
+        if coords.ndim != 2 or coords.shape[1] != 3 or coords.shape[0] == 0:
+            
+            raise ValueError("w_coord must be a non-empty array of shape (N,3)")
+        
+        if leaf_size < 1:
+            
+            raise ValueError("leaf_size must be at least 1")
+        
+        
+        num_points = coords.shape[0]
+        
+        ############################################################
+        # num_levels = 1 + floor(log2(max(1, (N - 1)/leaf_size))), 
+        # computed as a bit length so it stays in integer arithmetic
+        ############################################################
+        num_leaf_chunks = max(1, (num_points - 1)//leaf_size)
+        
+        num_levels = 1
+        
+        while num_leaf_chunks > 1:
+            
+            num_leaf_chunks >>= 1
+            
+            num_levels += 1
+        
+        num_nodes = 2**num_levels - 1
+        
+        
+        idx_array = np.arange(num_points, dtype=np.intp)
+        
+        node_idx_start = np.empty(num_nodes, dtype=np.intp)
+        
+        node_idx_end = np.empty(num_nodes, dtype=np.intp)
+        
+        node_is_leaf = np.empty(num_nodes, dtype=np.uint8)
+        
+        node_lower = np.empty((num_nodes, 3), dtype=np.float64)
+        
+        node_upper = np.empty((num_nodes, 3), dtype=np.float64)
+        
+        node_idx_start[0] = 0
+        
+        node_idx_end[0] = num_points
+        
+        ############################################################
+        # Parents always come before their children in the flat
+        # layout, so a single pass over the nodes builds the tree.
+        # Each internal node is split at the median of its widest
+        # dimension.
+        ############################################################
+        for i_node in range(num_nodes):
+            
+            start = node_idx_start[i_node]
+            
+            end = node_idx_end[i_node]
+            
+            node_coords = coords[idx_array[start:end]]
+            
+            node_lower[i_node] = node_coords.min(axis=0)
+            
+            node_upper[i_node] = node_coords.max(axis=0)
+            
+            if 2*i_node + 1 >= num_nodes:
+                
+                node_is_leaf[i_node] = 1
+                
+                continue
+            
+            node_is_leaf[i_node] = 0
+            
+            split_dim = np.argmax(node_upper[i_node] - node_lower[i_node])
+            
+            mid = start + (end - start)//2
+            
+            order = np.argpartition(node_coords[:,split_dim], mid - start)
+            
+            idx_array[start:end] = idx_array[start:end][order]
+            
+            node_idx_start[2*i_node + 1] = start
+            
+            node_idx_end[2*i_node + 1] = mid
+            
+            node_idx_start[2*i_node + 2] = mid
+            
+            node_idx_end[2*i_node + 2] = end
+            
+            
+        data = np.ascontiguousarray(coords[idx_array])
+        
+        if single_precision:
+            
+            data = data.astype(np.float32)
+            
+        self._set_arrays(data,
+                         idx_array,
+                         node_idx_start,
+                         node_idx_end,
+                         node_is_leaf,
+                         node_lower,
+                         node_upper,
+                         leaf_size)
+        
+        
+    def _set_arrays(self, 
+                    data, 
+                    idx_array, 
+                    node_idx_start, 
+                    node_idx_end, 
+                    node_is_leaf, 
+                    node_lower, 
+                    node_upper, 
+                    leaf_size):
+        
+        ############################################################
+        # The dtype of data decides the precision, so trees rebuilt
+        # by from_arrays() keep theirs
+        ############################################################
+        if data.dtype == np.float32:
+            
+            self.data32 = data
+            
+            self.single_precision = 1
+            
+        else:
+            
+            self.data = data
+            
+            self.single_precision = 0
+        
+        self.idx_array = idx_array
+        
+        self.node_idx_start = node_idx_start
+        
+        self.node_idx_end = node_idx_end
+        
+        self.node_is_leaf = node_is_leaf
+        
+        self.node_lower = node_lower
+        
+        self.node_upper = node_upper
+        
+        self.num_points = data.shape[0]
+        
+        self.num_nodes = self.node_idx_start.shape[0]
+        
+        self.leaf_size = leaf_size
+        
+        
+    def get_arrays(self):
+        '''
+        Return the flat arrays backing the tree, in the order accepted by
+        GalaxyTree.from_arrays()
+        '''
+        
+        return (np.asarray(self.data32) if self.single_precision else np.asarray(self.data),
+                np.asarray(self.idx_array),
+                np.asarray(self.node_idx_start),
+                np.asarray(self.node_idx_end),
+                np.asarray(self.node_is_leaf),
+                np.asarray(self.node_lower),
+                np.asarray(self.node_upper),
+                self.leaf_size)
+        
+        
+    @staticmethod
+    def from_arrays(data, 
+                    idx_array, 
+                    node_idx_start, 
+                    node_idx_end, 
+                    node_is_leaf, 
+                    node_lower, 
+                    node_upper, 
+                    leaf_size):
+        '''
+        Rebuild a tree from the output of get_arrays() without copying or
+        re-sorting the galaxies.
+        '''
+        
+        tree = GalaxyTree.__new__(GalaxyTree)
+        
+        tree._set_arrays(data, 
+                         idx_array, 
+                         node_idx_start, 
+                         node_idx_end, 
+                         node_is_leaf, 
+                         node_lower, 
+                         node_upper, 
+                         leaf_size)
+        
+        return tree
+    
+    
+    def __reduce__(self):
+        
+        return (_galaxy_tree_from_arrays, self.get_arrays())
+        
+        
+    def query(self, points, k=1):
+        '''
+        Python interface matching sklearn's KDTree.query for k=1.
+        
+        Returns:
+        ========
+        
+        distances : numpy.ndarray of shape (n,1)
+        
+        indices : numpy.ndarray of shape (n,1)
+        '''
+        
+        cdef DTYPE_F64_t[:,::1] points_memview
+        
+        cdef DTYPE_F64_t[::1] dist_memview
+        
+        cdef ITYPE_t[::1] idx_memview
+        
+        cdef ITYPE_t idx
+        
+        if k != 1:
+            
+            raise ValueError("GalaxyTree only supports k=1 queries")
+        
+        points_memview = np.ascontiguousarray(np.atleast_2d(points), dtype=np.float64)
+        
+        dist_memview = np.empty(points_memview.shape[0], dtype=np.float64)
+        
+        idx_memview = np.empty(points_memview.shape[0], dtype=np.intp)
+        
+        for idx in range(points_memview.shape[0]):
+            
+            idx_memview[idx] = self.idx_array[self.find_nearest(&points_memview[idx,0], &dist_memview[idx])]
+            
+        return np.asarray(dist_memview).reshape(-1,1), np.asarray(idx_memview).reshape(-1,1)
+    
+    
+    def query_radius(self, points, r):
+        '''
+        Python interface matching sklearn's KDTree.query_radius.
+        
+        Returns:
+        ========
+        
+        indices : numpy.ndarray of shape (n,) and dtype object
+            Each element is an array of the w_coord row indices within r of 
+            the corresponding point.
+        '''
+        
+        cdef DTYPE_F64_t[:,::1] points_memview
+        
+        cdef ITYPE_t[::1] buffer_memview = np.empty(64, dtype=np.intp)
+        
+        cdef ITYPE_t num_results
+        
+        cdef ITYPE_t idx
+        
+        points_memview = np.ascontiguousarray(np.atleast_2d(points), dtype=np.float64)
+        
+        out = np.empty(points_memview.shape[0], dtype=object)
+        
+        for idx in range(points_memview.shape[0]):
+            
+            num_results = self.find_within_radius(&points_memview[idx,0], 
+                                                  r, 
+                                                  &buffer_memview[0], 
+                                                  buffer_memview.shape[0])
+            
+            if num_results > buffer_memview.shape[0]:
+                
+                buffer_memview = np.empty(2*num_results, dtype=np.intp)
+                
+                num_results = self.find_within_radius(&points_memview[idx,0], 
+                                                      r, 
+                                                      &buffer_memview[0], 
+                                                      buffer_memview.shape[0])
+            
+            out[idx] = np.asarray(self.idx_array)[buffer_memview[0:num_results]]
+            
+        return out
+        
+    
+    
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef ITYPE_t find_within_radius(self, 
+                                    DTYPE_F64_t* center, 
+                                    DTYPE_F64_t radius, 
+                                    ITYPE_t* index_buffer, 
+                                    ITYPE_t buffer_size) nogil:
+        '''
+        Find all the galaxies within radius of center (inclusive).
+        
+        Writes the tree positions of at most buffer_size galaxies into 
+        index_buffer and returns the total number of galaxies found.  If the 
+        return value is larger than buffer_size, the buffer was too small and 
+        the caller should re-run the query with a larger buffer.
+        '''
+        
+        return self._radius_node(0, center, radius*radius, index_buffer, buffer_size, 0)
+    
+    
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef ITYPE_t find_in_shell(self, 
+                               DTYPE_F64_t* center, 
+                               DTYPE_F64_t radius, 
+                               DTYPE_F64_t* inner_center, 
+                               DTYPE_F64_t inner_radius, 
+                               ITYPE_t* index_buffer, 
+                               ITYPE_t buffer_size) nogil:
+        '''
+        Find the galaxies within radius of center (inclusive) that are not 
+        within inner_radius of inner_center (inclusive), i.e. the galaxies a
+        find_within_radius() query of the new sphere returns on top of those 
+        of the inner one.  Nodes entirely inside the inner sphere are never 
+        visited.
+        
+        Same buffer handling and return value as find_within_radius().
+        '''
+        
+        return self._shell_node(0, 
+                                center, 
+                                radius*radius, 
+                                inner_center, 
+                                inner_radius*inner_radius, 
+                                index_buffer, 
+                                buffer_size, 
+                                0)
+    
+    
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef ITYPE_t find_nearest(self, 
+                              DTYPE_F64_t* center, 
+                              DTYPE_F64_t* distance) nogil:
+        '''
+        Find the galaxy closest to center.  Returns its tree position and 
+        writes its distance from center into distance[0].
+        '''
+        
+        return self.find_nearest_from(center, -1, distance)
+    
+    
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef ITYPE_t find_nearest_from(self, 
+                                   DTYPE_F64_t* center, 
+                                   ITYPE_t guess,
+                                   DTYPE_F64_t* distance) nogil:
+        '''
+        Same as find_nearest(), but starting from the tree position guess as 
+        the closest galaxy so far (no guess if negative).  When consecutive 
+        queries are close together, like the centers of neighboring grid 
+        cells, the previous answer is a good guess and prunes most of the 
+        tree right away.
+        '''
+        
+        cdef ITYPE_t jdx
+        
+        cdef DTYPE_F64_t temp_f64_val
+        
+        cdef DTYPE_F64_t best_dist_sq = INFINITY
+        
+        cdef ITYPE_t best_idx = -1
+        
+        if guess >= 0:
+            
+            best_dist_sq = 0.0
+            
+            for jdx in range(3):
+                
+                temp_f64_val = galaxy_coord(self, guess, jdx) - center[jdx]
+                
+                best_dist_sq += temp_f64_val*temp_f64_val
+                
+            best_idx = guess
+        
+        self._nearest_node(0, center, &best_dist_sq, &best_idx)
+        
+        distance[0] = sqrt(best_dist_sq)
+        
+        return best_idx
+    
+    
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef ITYPE_t _radius_node(self, 
+                              ITYPE_t i_node, 
+                              DTYPE_F64_t* center, 
+                              DTYPE_F64_t radius_sq, 
+                              ITYPE_t* index_buffer, 
+                              ITYPE_t buffer_size, 
+                              ITYPE_t count) nogil:
+        
+        cdef ITYPE_t idx
+        
+        cdef ITYPE_t jdx
+        
+        cdef DTYPE_F64_t temp_f64_accum
+        
+        cdef DTYPE_F64_t temp_f64_val
+        
+        
+        if self._min_dist_sq(i_node, center) > radius_sq:
+            
+            return count
+        
+        ############################################################
+        # Node entirely inside the sphere - take all its galaxies
+        # without computing any distances
+        ############################################################
+        if self._max_dist_sq(i_node, center) <= radius_sq:
+            
+            for idx in range(self.node_idx_start[i_node], self.node_idx_end[i_node]):
+                
+                if count < buffer_size:
+                    
+                    index_buffer[count] = idx
+                    
+                count += 1
+                
+            return count
+        
+        
+        if self.node_is_leaf[i_node]:
+            
+            for idx in range(self.node_idx_start[i_node], self.node_idx_end[i_node]):
+                
+                temp_f64_accum = 0.0
+                
+                for jdx in range(3):
+                    
+                    temp_f64_val = galaxy_coord(self, idx, jdx) - center[jdx]
+                    
+                    temp_f64_accum += temp_f64_val*temp_f64_val
+                    
+                if temp_f64_accum <= radius_sq:
+                    
+                    if count < buffer_size:
+                        
+                        index_buffer[count] = idx
+                        
+                    count += 1
+                    
+            return count
+        
+        
+        count = self._radius_node(2*i_node + 1, center, radius_sq, index_buffer, buffer_size, count)
+        
+        count = self._radius_node(2*i_node + 2, center, radius_sq, index_buffer, buffer_size, count)
+        
+        return count
+    
+    
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef ITYPE_t _shell_node(self, 
+                             ITYPE_t i_node, 
+                             DTYPE_F64_t* center, 
+                             DTYPE_F64_t radius_sq, 
+                             DTYPE_F64_t* inner_center, 
+                             DTYPE_F64_t inner_radius_sq, 
+                             ITYPE_t* index_buffer, 
+                             ITYPE_t buffer_size, 
+                             ITYPE_t count) nogil:
+        
+        cdef ITYPE_t idx
+        
+        cdef ITYPE_t jdx
+        
+        cdef DTYPE_F64_t temp_f64_accum
+        
+        cdef DTYPE_F64_t temp_f64_val
+        
+        cdef DTYPE_B_t node_inside
+        
+        
+        if self._min_dist_sq(i_node, center) > radius_sq:
+            
+            return count
+        
+        ############################################################
+        # Every galaxy in the node was already in the inner sphere
+        ############################################################
+        if self._max_dist_sq(i_node, inner_center) <= inner_radius_sq:
+            
+            return count
+        
+        node_inside = self._max_dist_sq(i_node, center) <= radius_sq
+        
+        
+        if node_inside or self.node_is_leaf[i_node]:
+            
+            for idx in range(self.node_idx_start[i_node], self.node_idx_end[i_node]):
+                
+                if not node_inside:
+                
+                    temp_f64_accum = 0.0
+                    
+                    for jdx in range(3):
+                        
+                        temp_f64_val = galaxy_coord(self, idx, jdx) - center[jdx]
+                        
+                        temp_f64_accum += temp_f64_val*temp_f64_val
+                        
+                    if temp_f64_accum > radius_sq:
+                        
+                        continue
+                    
+                temp_f64_accum = 0.0
+                
+                for jdx in range(3):
+                    
+                    temp_f64_val = galaxy_coord(self, idx, jdx) - inner_center[jdx]
+                    
+                    temp_f64_accum += temp_f64_val*temp_f64_val
+                    
+                if temp_f64_accum > inner_radius_sq:
+                    
+                    if count < buffer_size:
+                        
+                        index_buffer[count] = idx
+                        
+                    count += 1
+                    
+            return count
+        
+        
+        count = self._shell_node(2*i_node + 1, center, radius_sq, inner_center, inner_radius_sq, index_buffer, buffer_size, count)
+        
+        count = self._shell_node(2*i_node + 2, center, radius_sq, inner_center, inner_radius_sq, index_buffer, buffer_size, count)
+        
+        return count
+    
+    
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef void _nearest_node(self, 
+                            ITYPE_t i_node, 
+                            DTYPE_F64_t* center, 
+                            DTYPE_F64_t* best_dist_sq, 
+                            ITYPE_t* best_idx) nogil:
+        
+        cdef ITYPE_t idx
+        
+        cdef ITYPE_t jdx
+        
+        cdef DTYPE_F64_t temp_f64_accum
+        
+        cdef DTYPE_F64_t temp_f64_val
+        
+        cdef DTYPE_F64_t dist_sq_1
+        
+        cdef DTYPE_F64_t dist_sq_2
+        
+        
+        if self._min_dist_sq(i_node, center) >= best_dist_sq[0]:
+            
+            return
+        
+        if self.node_is_leaf[i_node]:
+            
+            for idx in range(self.node_idx_start[i_node], self.node_idx_end[i_node]):
+                
+                temp_f64_accum = 0.0
+                
+                for jdx in range(3):
+                    
+                    temp_f64_val = galaxy_coord(self, idx, jdx) - center[jdx]
+                    
+                    temp_f64_accum += temp_f64_val*temp_f64_val
+                    
+                if temp_f64_accum < best_dist_sq[0]:
+                    
+                    best_dist_sq[0] = temp_f64_accum
+                    
+                    best_idx[0] = idx
+                    
+            return
+        
+        ############################################################
+        # Descend into the closer child first so the farther one is
+        # usually pruned
+        ############################################################
+        dist_sq_1 = self._min_dist_sq(2*i_node + 1, center)
+        
+        dist_sq_2 = self._min_dist_sq(2*i_node + 2, center)
+        
+        if dist_sq_1 <= dist_sq_2:
+            
+            self._nearest_node(2*i_node + 1, center, best_dist_sq, best_idx)
+            
+            self._nearest_node(2*i_node + 2, center, best_dist_sq, best_idx)
+            
+        else:
+            
+            self._nearest_node(2*i_node + 2, center, best_dist_sq, best_idx)
+            
+            self._nearest_node(2*i_node + 1, center, best_dist_sq, best_idx)
+            
+            
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef DTYPE_F64_t _min_dist_sq(self, ITYPE_t i_node, DTYPE_F64_t* center) nogil:
+        '''
+        Squared distance from center to the closest point of the node's 
+        bounding box
+        '''
+        
+        cdef ITYPE_t jdx
+        
+        cdef DTYPE_F64_t temp_f64_accum = 0.0
+        
+        cdef DTYPE_F64_t temp_f64_val
+        
+        for jdx in range(3):
+            
+            temp_f64_val = self.node_lower[i_node, jdx] - center[jdx]
+            
+            if temp_f64_val > 0.0:
+                
+                temp_f64_accum += temp_f64_val*temp_f64_val
+                
+                continue
+            
+            temp_f64_val = center[jdx] - self.node_upper[i_node, jdx]
+            
+            if temp_f64_val > 0.0:
+                
+                temp_f64_accum += temp_f64_val*temp_f64_val
+                
+        return temp_f64_accum
+    
+    
+    @cython.boundscheck(False)
+    @cython.wraparound(False)
+    cdef DTYPE_F64_t _max_dist_sq(self, ITYPE_t i_node, DTYPE_F64_t* center) nogil:
+        '''
+        Squared distance from center to the farthest corner of the node's 
+        bounding box
+        '''
+        
+        cdef ITYPE_t jdx
+        
+        cdef DTYPE_F64_t temp_f64_accum = 0.0
+        
+        cdef DTYPE_F64_t temp_f64_val
+        
+        cdef DTYPE_F64_t temp_f64_val2
+        
+        for jdx in range(3):
+            
+            temp_f64_val = fabs(center[jdx] - self.node_lower[i_node, jdx])
+            
+            temp_f64_val2 = fabs(self.node_upper[i_node, jdx] - center[jdx])
+            
+            if temp_f64_val2 > temp_f64_val:
+                
+                temp_f64_val = temp_f64_val2
+                
+            temp_f64_accum += temp_f64_val*temp_f64_val
+            
+        return temp_f64_accum
+    
+    
+    
+    
+    
+    
+    
+
+
+
+def _galaxy_tree_from_arrays(*arrays):
+    '''
+    Module-level unpickling helper for GalaxyTree
+    '''
+    
+    return GalaxyTree.from_arrays(*arrays)
+
+
+
+
+cdef class HoleGrowthWorkspace:
+    '''
+    Description:
+    ============
+    Scratch memory for main_algorithm(), one FindNextScratch block per 
+    thread.  A worker creates one workspace and passes it to every 
+    main_algorithm() call, so after the first few cells have grown the 
+    blocks to the size of the largest sphere query, growing holes does not 
+    allocate any memory at all.
+    
+    Parameters:
+    ===========
+    
+    num_threads : integer
+        Number of threads main_algorithm() may be run with.  Default is 1.
+        
+    initial_capacity : integer
+        Number of candidate galaxies each block holds to start with.  16 is a
+        guess at the max number of results returned by the kdtree.
+    '''
+    
+    def __cinit__(self, int num_threads=1, ITYPE_t initial_capacity=16):
+        
+        cdef int idx
+        
+        if num_threads < 1:
+            
+            raise ValueError("num_threads must be at least 1")
+        
+        self.scratch = <FindNextScratch*>calloc(num_threads, sizeof(FindNextScratch))
+        
+        if self.scratch == NULL:
+            
+            raise MemoryError()
+        
+        self.num_threads = num_threads
+        
+        for idx in range(num_threads):
+            
+            if init_find_next_scratch(&self.scratch[idx], initial_capacity) < 0:
+                
+                raise MemoryError()
+            
+            
+    def __dealloc__(self):
+        
+        cdef int idx
+        
+        if self.scratch != NULL:
+            
+            for idx in range(self.num_threads):
+                
+                free_find_next_scratch(&self.scratch[idx])
+                
+            free(self.scratch)
+            
+            
+    def capacities(self):
+        '''
+        Number of candidate galaxies each thread's block currently holds
+        '''
+        
+        return [self.scratch[idx].capacity for idx in range(self.num_threads)]
+
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int init_find_next_scratch(FindNextScratch* scratch, ITYPE_t capacity) nogil:
+    '''
+    Allocate the working memory of find_next_galaxy() for up to capacity
+    candidate galaxies.  Returns 0, or -1 if the memory could not be
+    allocated, in which case free_find_next_scratch() is still safe to call.
+    '''
+    
+    scratch.capacity = 0
+    
+    scratch.i_nearest = NULL
+    
+    scratch.i_nearest_reduced = NULL
+    
+    scratch.candidate_minus_A = NULL
+    
+    scratch.candidate_minus_center = NULL
+    
+    scratch.bot = NULL
+    
+    scratch.top = NULL
+    
+    scratch.x_ratio = NULL
+    
+    return grow_find_next_scratch(scratch, capacity)
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef int grow_find_next_scratch(FindNextScratch* scratch, ITYPE_t capacity) nogil:
+    '''
+    Make sure the scratch memory holds at least capacity candidate galaxies.
+    The memory doubles until it is big enough, so a workspace only 
+    reallocates a handful of times before it fits the largest query of a 
+    run.  The old contents are not preserved.  Returns 0, or -1 if the 
+    memory could not be allocated.
+    '''
+    
+    if capacity <= scratch.capacity:
+        
+        return 0
+    
+    cdef ITYPE_t new_capacity = scratch.capacity
+    
+    if new_capacity < 1:
+        
+        new_capacity = capacity
+    
+    while new_capacity < capacity:
+        
+        new_capacity *= 2
+        
+    capacity = new_capacity
+    
+    free_find_next_scratch(scratch)
+    
+    scratch.i_nearest = <ITYPE_t*>malloc(capacity*sizeof(ITYPE_t))
+    
+    scratch.i_nearest_reduced = <ITYPE_t*>malloc(capacity*sizeof(ITYPE_t))
+    
+    scratch.candidate_minus_A = <DTYPE_F64_t*>malloc(3*capacity*sizeof(DTYPE_F64_t))
+    
+    scratch.candidate_minus_center = <DTYPE_F64_t*>malloc(3*capacity*sizeof(DTYPE_F64_t))
+    
+    scratch.bot = <DTYPE_F64_t*>malloc(capacity*sizeof(DTYPE_F64_t))
+    
+    scratch.top = <DTYPE_F64_t*>malloc(capacity*sizeof(DTYPE_F64_t))
+    
+    scratch.x_ratio = <DTYPE_F64_t*>malloc(capacity*sizeof(DTYPE_F64_t))
+    
+    if scratch.i_nearest == NULL or \
+       scratch.i_nearest_reduced == NULL or \
+       scratch.candidate_minus_A == NULL or \
+       scratch.candidate_minus_center == NULL or \
+       scratch.bot == NULL or \
+       scratch.top == NULL or \
+       scratch.x_ratio == NULL:
+        
+        free_find_next_scratch(scratch)
+        
+        return -1
+    
+    scratch.capacity = capacity
+    
+    return 0
+
+
+
+cdef void free_find_next_scratch(FindNextScratch* scratch) nogil:
+    
+    free(scratch.i_nearest)
+    
+    free(scratch.i_nearest_reduced)
+    
+    free(scratch.candidate_minus_A)
+    
+    free(scratch.candidate_minus_center)
+    
+    free(scratch.bot)
+    
+    free(scratch.top)
+    
+    free(scratch.x_ratio)
+    
+    scratch.i_nearest = NULL
+    
+    scratch.i_nearest_reduced = NULL
+    
+    scratch.candidate_minus_A = NULL
+    
+    scratch.candidate_minus_center = NULL
+    
+    scratch.bot = NULL
+    
+    scratch.top = NULL
+    
+    scratch.x_ratio = NULL
+    
+    scratch.capacity = 0
+    
+    
+    
+
+cdef inline ITYPE_t query_sphere(GalaxyTree galaxy_tree,
+                                 DTYPE_F64_t* center,
+                                 DTYPE_F64_t radius,
+                                 DTYPE_F64_t* inner_center,
+                                 DTYPE_F64_t inner_radius,
+                                 FindNextScratch* scratch) nogil:
+    
+    if inner_radius < 0.0:
+        
+        return galaxy_tree.find_within_radius(center, 
+                                              radius, 
+                                              scratch.i_nearest, 
+                                              scratch.capacity)
+    
+    return galaxy_tree.find_in_shell(center, 
+                                     radius, 
+                                     inner_center, 
+                                     inner_radius, 
+                                     scratch.i_nearest, 
+                                     scratch.capacity)
+    
+    
+    
+    
+@cython.boundscheck(False)
+@cython.wraparound(False)
+cdef ITYPE_t query_candidates(GalaxyTree galaxy_tree,
+                              DTYPE_F64_t* center,
+                              DTYPE_F64_t radius,
+                              DTYPE_F64_t* inner_center,
+                              DTYPE_F64_t inner_radius,
+                              DTYPE_INT64_t* nearest_gal_index_list, 
+                              ITYPE_t num_neighbors,
+                              FindNextScratch* scratch) nogil:
+    '''
+    Find the galaxies within radius of center, leaving out the existing 
+    bounding galaxies in nearest_gal_index_list, and copy them into 
+    scratch.i_nearest_reduced.  The scratch memory is grown if the sphere 
+    holds more galaxies than it can take.
+    
+    If inner_radius is not negative, only the galaxies outside the sphere 
+    of inner_radius around inner_center are returned, i.e. the ones that 
+    are new since the previous query of a search.
+    
+    Returns the number of candidate galaxies, or -1 if the scratch memory 
+    could not be grown.
+    '''
+    
+    cdef ITYPE_t idx
+    
+    cdef ITYPE_t jdx
+    
+    cdef ITYPE_t num_results
+    
+    cdef ITYPE_t num_nearest
+    
+    cdef DTYPE_B_t is_neighbor
+    
+    
+    num_results = query_sphere(galaxy_tree, center, radius, inner_center, inner_radius, scratch)
+    
+    if num_results > scratch.capacity:
+        
+        if grow_find_next_scratch(scratch, num_results) < 0:
+            
+            return -1
+        
+        query_sphere(galaxy_tree, center, radius, inner_center, inner_radius, scratch)
+    
+    
+    num_nearest = 0
+
+    for idx in range(num_results):
+        
+        is_neighbor = 0
+
+        for jdx in range(num_neighbors):
+            
+            if scratch.i_nearest[idx] == nearest_gal_index_list[jdx]:
+
+                is_neighbor = 1
+                
+                break
+            
+        if not is_neighbor:
+            
+            scratch.i_nearest_reduced[num_nearest] = scratch.i_nearest[idx]
+            
+            num_nearest += 1
+            
+    return num_nearest
+    
+    
+    
+    
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef void calculate_x_ratios(DTYPE_F64_t* hole_center,
+                             DTYPE_F64_t* unit_vector, 
+                             DTYPE_INT64_t* nearest_gal_index_list, 
+                             ITYPE_t num_neighbors,
+                             GalaxyTree galaxy_tree,
+                             FindNextScratch* scratch,
+                             ITYPE_t num_nearest) nogil:
+    '''
+    Fill scratch.x_ratio with the minimization ratio of the first num_nearest
+    candidates in scratch.i_nearest_reduced.
+    
+    For galaxy 2/B (num_neighbors == 1) the ratio is the radius of the 
+    sphere through galaxy 1/A and the candidate whose center lies on the line
+    from 1/A along -unit_vector.  For galaxies 3/C and 4/D it is the distance
+    the hole center moves along unit_vector from hole_center before the 
+    candidate lands on the surface.  Neither depends on how far the search 
+    has gotten, only on the candidate.
+    '''
+    
+    cdef ITYPE_t idx
+    
+    cdef ITYPE_t jdx
+    
+    cdef ITYPE_t temp_idx
+    
+    cdef DTYPE_F64_t temp_f64_accum
+    
+    cdef DTYPE_F64_t temp_f64_val
+    
+    cdef DTYPE_F64_t Bcenter[3]
+    
+    
+    ############################################################################
+    # Calculate vectors pointing from hole center and galaxy 1/A to next 
+    # nearest candidate galaxy
+    ############################################################################
+    for idx in range(num_nearest):
+
+        temp_idx = scratch.i_nearest_reduced[idx]
+
+        for jdx in range(3):
+            
+            if num_neighbors == 1:
+                
+                scratch.candidate_minus_A[3*idx + jdx] = galaxy_coord(galaxy_tree, nearest_gal_index_list[0], jdx) - galaxy_coord(galaxy_tree, temp_idx, jdx)
+                
+            else:
+
+                scratch.candidate_minus_A[3*idx + jdx] = galaxy_coord(galaxy_tree, temp_idx, jdx) - galaxy_coord(galaxy_tree, nearest_gal_index_list[0], jdx)
+
+            scratch.candidate_minus_center[3*idx + jdx] = galaxy_coord(galaxy_tree, temp_idx, jdx) - hole_center[jdx]
+
+
+    ############################################################################
+    # Calculate bottom of ratio to be minimized
+    ############################################################################
+    for idx in range(num_nearest):
+        
+        temp_f64_accum = 0.0
+        
+        for jdx in range(3):
+            
+            temp_f64_accum += scratch.candidate_minus_A[3*idx + jdx]*unit_vector[jdx]
+            
+        scratch.bot[idx] = 2*temp_f64_accum
+    
+    
+    ############################################################################
+    # Calculate top of ratio to be minimized
+    ############################################################################
+    if num_neighbors == 1:
+
+        for idx in range(num_nearest):
+        
+            temp_f64_accum = 0.0
+            
+            for jdx in range(3):
+                
+                temp_f64_accum += scratch.candidate_minus_A[3*idx + jdx]*scratch.candidate_minus_A[3*idx + jdx]
+                
+            scratch.top[idx] = temp_f64_accum
+
+    else:
+
+        for idx in range(3):
+
+            Bcenter[idx] = galaxy_coord(galaxy_tree, nearest_gal_index_list[1], idx) - hole_center[idx]
+
+
+        temp_f64_accum = 0.0
+        
+        for idx in range(3):
+            
+            temp_f64_accum += Bcenter[idx]*Bcenter[idx]
+            
+        temp_f64_val = temp_f64_accum
+
+        
+        for idx in range(num_nearest):
+            
+            temp_f64_accum = 0.0
+            
+            for jdx in range(3):
+                
+                temp_f64_accum += scratch.candidate_minus_center[3*idx + jdx]*scratch.candidate_minus_center[3*idx + jdx]
+                
+            scratch.top[idx] = temp_f64_accum - temp_f64_val
+
+
+
+    ############################################################################
+    # Calculate the minimization ratios
+    ############################################################################
+    for idx in range(num_nearest):
+
+        scratch.x_ratio[idx] = scratch.top[idx]/scratch.bot[idx]
+        
+        
+        
+        
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview, 
-                           DTYPE_F64_t[:,:] temp_hole_center_memview,
-                           DTYPE_F64_t search_radius, 
-                           DTYPE_F64_t dr, 
-                           DTYPE_F64_t direction_mod,
-                           DTYPE_F64_t[:] unit_vector_memview, 
-                           galaxy_tree, 
-                           DTYPE_INT64_t[:] nearest_gal_index_list, 
-                           ITYPE_t num_neighbors,
-                           DTYPE_F64_t[:,:] w_coord, 
-                           DTYPE_B_t[:,:] mask, 
-                           DTYPE_INT32_t mask_resolution,
-                           DTYPE_F64_t min_dist, 
-                           DTYPE_F64_t max_dist, 
-                           
-                           
-                           DTYPE_F64_t[:] Bcenter_memview,
-                           
-                           ITYPE_t[:] MAX_NEAREST,
-                           ITYPE_t[:] i_nearest_reduced_memview_z,
-                           DTYPE_F64_t[:,:] candidate_minus_A_memview_z,
-                           DTYPE_F64_t[:,:] candidate_minus_center_memview_z,
-                           DTYPE_F64_t[:] bot_memview_z,
-                           DTYPE_F64_t[:] top_memview_z,
-                           DTYPE_F64_t[:] x_ratio_memview_z,
-                           
-                           
-                           ITYPE_t[:] nearest_neighbor_index,           #return variable
-                           DTYPE_F64_t[:] min_x_ratio,                  #return variable
-                           DTYPE_B_t[:] in_mask                         #return variable
-                           
-                           ): 
-                           #) except *:              
+cdef int find_next_galaxy(DTYPE_F64_t* hole_center, 
+                          DTYPE_F64_t* temp_hole_center,
+                          DTYPE_F64_t search_radius, 
+                          DTYPE_F64_t dr, 
+                          DTYPE_F64_t direction_mod,
+                          DTYPE_F64_t* unit_vector, 
+                          GalaxyTree galaxy_tree, 
+                          DTYPE_INT64_t* nearest_gal_index_list, 
+                          ITYPE_t num_neighbors,
+                          DTYPE_B_t[:,:] mask, 
+                          DTYPE_INT32_t mask_resolution,
+                          DTYPE_F64_t min_dist, 
+                          DTYPE_F64_t max_dist, 
+                          SurveyVoxels* voxels,
+                          FindNextScratch* scratch,
+                          ITYPE_t* nearest_neighbor_index,           #return variable
+                          DTYPE_F64_t* min_x_ratio,                  #return variable
+                          DTYPE_B_t* in_mask                         #return variable
+                          ) nogil:
 
     '''
     Description:
     ============
     Function to locate the next nearest galaxy during hole center propagation 
-    along direction defined by unit_vector_memview.
+    along direction defined by unit_vector.
 
     The algorithm needs to find 4 bounding galaxies per cell.  The 
     first galaxy is found as the minimum of regular euclidean distance to the hole center.  The
@@ -95,14 +1240,21 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
     in the input nearest_gal_index_list, when its 1 it assumes we're finding for galaxy 2
     and when its not 1 it assumes we have the first 2 galaxies and we're looking for galaxy
     3 or 4.
+    
+    This function does not touch the GIL, all of its working memory comes 
+    from scratch, so it can be called from several threads at once as long 
+    as each thread passes its own scratch.
 
 
 
     Parameters:
     ===========
 
-    hole_center_memview : memview of shape (1,3)
+    hole_center : pointer to 3 doubles
         x,y,z coordinate of current center of hole in units of Mpc/h
+        
+    temp_hole_center : pointer to 3 doubles
+        x,y,z coordinate of the moving hole center, updated in place
 
     search_radius : float
         Radius of hole in units of Mpc/h
@@ -110,21 +1262,19 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
     dr : float
         Incrememt value for hole propagation
 
-    unit_vector_memview : memview of shape (3)
+    unit_vector : pointer to 3 doubles
         Unit vector indicating direction hole center will shift
 
-    galaxy_tree : sklearn KDTree
-        Tree to query for nearest-neighbor results
+    galaxy_tree : GalaxyTree
+        Tree to query for nearest-neighbor results, also holds the galaxy 
+        coordinates
 
-    nearest_gal_index_list : memview of shape (N)
-        List of row indices in w_coord for existing bounding galaxies
+    nearest_gal_index_list : pointer to num_neighbors int64
+        List of tree positions of the existing bounding galaxies
         
     num_neighbors : int
         number of valid neighbor indices in the nearest_gal_index_list object    
 
-    w_coord : memview of shape (N_galaxies, 3)
-        x,y,z coordinates of all galaxies in sample in units of Mpc/h
-
     mask : memview of shape (ra_dim, dec_dim)
         uint8 array of whether location is within survey footprint
 
@@ -136,16 +1286,24 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
 
     max_dist : float
         maximum distance (redshift) in survey in units of Mpc/h
+        
+    voxels : pointer to SurveyVoxels
+        precomputed in-survey lookup answering most of the survey checks 
+        without the angular test (see not_in_survey), or one with NULL 
+        states to always use the angular test
+        
+    scratch : pointer to FindNextScratch
+        working memory for the candidate galaxies, grown when a radius query 
+        returns more galaxies than it can hold
 
 
     Returns:
     ========
-
-    nearest_neighbor_x_ratio_index : index
-        Index value to nearest_neighbor_x_ratio array of next nearest neighbor
+    
+    0 on success, -1 if the scratch memory could not be grown
 
     nearest_neighbor_index : index
-        Index value to w_coord array of next nearest neighbor
+        Tree position of next nearest neighbor
 
     min_x_ratio : float
         ???
@@ -167,36 +1325,6 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
     # is the next nearest galaxy that bounds the hole.
 
 
-
-    '''
-    i_nearest_reduced_memview = np.empty(num_nearest, dtype=np.int64)
-                
-    candidate_minus_A_memview = np.empty((num_nearest, 3), dtype=np.float64, order='C')
-
-    candidate_minus_center_memview = np.empty((num_nearest, 3), dtype=np.float64, order='C')
-    
-    bot_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-    
-    top_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-    
-    x_ratio_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-    '''
-
-    
-    cdef ITYPE_t[:] i_nearest_reduced_memview
-    
-    cdef DTYPE_F64_t[:,:] candidate_minus_A_memview
-    
-    cdef DTYPE_F64_t[:,:] candidate_minus_center_memview
-    
-    cdef DTYPE_F64_t[:] bot_memview
-    
-    cdef DTYPE_F64_t[:] top_memview
-    
-    cdef DTYPE_F64_t[:] x_ratio_memview
-    
-
-
     ############################################################################
     #
     #   DECLARATIONS
@@ -209,56 +1337,36 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
     ############################################################################
     cdef ITYPE_t idx
     
-    cdef ITYPE_t jdx
-    
-    cdef ITYPE_t temp_idx
-    
     cdef DTYPE_F64_t temp_f64_accum
     
-    cdef DTYPE_F64_t temp_f64_val
-
-    ############################################################################
-    # Used in filtering exiting neighbors out of results
-    ############################################################################
-    
-    cdef ITYPE_t[:] i_nearest_memview
-    
-    cdef ITYPE_t num_results
-    
-    cdef ITYPE_t num_nearest
-    
-    cdef DTYPE_B_t[:] boolean_nearest_memview
-    
-    ############################################################################
-    #
-    ############################################################################
-    
-    
-    ############################################################################
-    # Used in finding valid x ratio values
-    ############################################################################
-    cdef DTYPE_B_t any_valid = 0
-            
-    cdef ITYPE_t valid_min_idx
-    
-    cdef DTYPE_F64_t valid_min_val
-    
-    
-    
-    
-    
-    
-    
-    
-    
-    
+    cdef DTYPE_F64_t temp_f64_val
+
+    ############################################################################
+    # Number of new candidate galaxies in the sphere after filtering out the
+    # existing neighbors, and the number of candidates seen so far
+    ############################################################################
     
+    cdef ITYPE_t num_nearest
     
+    cdef ITYPE_t num_seen = 0
     
+    ############################################################################
+    # The sphere of the previous step.  A negative radius means there was no
+    # previous step yet.
+    ############################################################################
+    cdef DTYPE_F64_t prev_center[3]
     
+    cdef DTYPE_F64_t prev_radius = -1.0
     
     
+    ############################################################################
+    # Used in finding valid x ratio values
+    ############################################################################
+    cdef DTYPE_B_t any_valid = 0
+            
+    cdef ITYPE_t valid_min_idx
     
+    cdef DTYPE_F64_t valid_min_val
     
     
 
@@ -272,6 +1380,12 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
     # sphere centered at the new hole center of larger radius until we find one
     # that bounds the sphere
     #
+    # The x ratio of a galaxy does not depend on the step, and a galaxy that
+    # was in the sphere without bounding it stays in the sphere of the later
+    # steps (the spheres all touch 1/A, and grow on the side the hole center
+    # moves to).  So each step only queries the shell between the previous 
+    # sphere and the new one, and only the new galaxies are evaluated.
+    #
     ############################################################################
     
     cdef DTYPE_B_t galaxy_search = True
@@ -284,7 +1398,7 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
         ############################################################################
         for idx in range(3):
 
-            temp_hole_center_memview[0, idx] = temp_hole_center_memview[0, idx] + direction_mod*dr*unit_vector_memview[idx]
+            temp_hole_center[idx] = temp_hole_center[idx] + direction_mod*dr*unit_vector[idx]
 
         
         ############################################################################
@@ -300,51 +1414,38 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
             
             for idx in range(3):
                 
-                temp_f64_val = w_coord[nearest_gal_index_list[0],idx] - temp_hole_center_memview[0,idx]
+                temp_f64_val = galaxy_coord(galaxy_tree, nearest_gal_index_list[0], idx) - temp_hole_center[idx]
                 
                 temp_f64_accum += temp_f64_val*temp_f64_val
                 
             search_radius = sqrt(temp_f64_accum)
             
         
-        
-        
-        
-        ############################################################################
-        # use KDtree to find the galaxies within our target sphere
-        ############################################################################
-
-        i_nearest = galaxy_tree.query_radius(temp_hole_center_memview, r=search_radius)
-
-        i_nearest = i_nearest[0]
-
-        i_nearest_memview = i_nearest
-
-
         ############################################################################
-        # The resulting galaxies may include galaxies we already found in previous
-        # steps, so build a boolean index representing whether a resultant galaxy
-        # is valid or not, and track how many valid result galaxies we actually have
-        # for the next step.
+        # use KDtree to find the galaxies that entered our target sphere since
+        # the previous step.  The existing bounding galaxies are left out.
         ############################################################################
 
-        num_results = i_nearest_memview.shape[0]
-
-        boolean_nearest_memview = np.ones(num_results, dtype=np.uint8)
+        num_nearest = query_candidates(galaxy_tree,
+                                       temp_hole_center,
+                                       search_radius,
+                                       prev_center,
+                                       prev_radius,
+                                       nearest_gal_index_list,
+                                       num_neighbors,
+                                       scratch)
         
-        num_nearest = num_results
-
-        for idx in range(num_results):
-
-            for jdx in range(num_neighbors):
-                
-                if i_nearest_memview[idx] == nearest_gal_index_list[jdx]:
-
-                    boolean_nearest_memview[idx] = 0
-                    
-                    num_nearest -= 1
-                    
-                    break
+        if num_nearest < 0:
+            
+            return -1
+        
+        num_seen += num_nearest
+        
+        for idx in range(3):
+            
+            prev_center[idx] = temp_hole_center[idx]
+            
+        prev_radius = search_radius
                 
         ############################################################################
         # If we have any valid result galaxies, use the special x ratio distance
@@ -357,152 +1458,13 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
         ############################################################################
         if num_nearest > 0:
             
-            
-            '''
-            if num_nearest > MAX_NEAREST[0]:
-                
-                #reallocate the memory for computation if not big enough
-                
-                i_nearest_reduced_memview = np.empty(num_nearest, dtype=np.int64)
-                
-                candidate_minus_A_memview = np.empty((num_nearest, 3), dtype=np.float64, order='C')
-
-                candidate_minus_center_memview = np.empty((num_nearest, 3), dtype=np.float64, order='C')
-                
-                bot_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-                
-                top_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-                
-                x_ratio_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-                
-                #print("REALLOCATE", num_nearest)
-                
-                MAX_NEAREST[0] = num_nearest
-            '''
-            i_nearest_reduced_memview = np.empty(num_nearest, dtype=np.int64)
-                
-            candidate_minus_A_memview = np.empty((num_nearest, 3), dtype=np.float64, order='C')
-
-            candidate_minus_center_memview = np.empty((num_nearest, 3), dtype=np.float64, order='C')
-            
-            bot_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-            
-            top_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-            
-            x_ratio_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-            ############################################################################
-            # copy the valid galaxy indicies into the i_nearest_reduced memory
-            ############################################################################
-            
-            #i_nearest_reduced_memview = np.empty(num_nearest, dtype=np.int64)
-            
-            jdx = 0
-            
-            for idx in range(num_results):
-                
-                if boolean_nearest_memview[idx]:
-                    
-                    i_nearest_reduced_memview[jdx] = i_nearest_memview[idx]
-                    
-                    jdx += 1
-            
-            #i_nearest_reduced_memview = i_nearest_reduced
-            
-            
-            ############################################################################
-            # Calculate vectors pointing from hole center and galaxy 1/A to next 
-            # nearest candidate galaxy
-            ############################################################################
-            #candidate_minus_A_memview = np.empty((num_nearest, 3), dtype=np.float64, order='C')
-
-            #candidate_minus_center_memview = np.empty((num_nearest, 3), dtype=np.float64, order='C')
-            
-            for idx in range(num_nearest):
-
-                temp_idx = i_nearest_reduced_memview[idx]
-
-                for jdx in range(3):
-                    
-                    if num_neighbors == 1:
-                        
-                        candidate_minus_A_memview[idx, jdx] = w_coord[nearest_gal_index_list[0], jdx] - w_coord[temp_idx, jdx]
-                        
-                    else:
-
-                        candidate_minus_A_memview[idx, jdx] = w_coord[temp_idx, jdx] - w_coord[nearest_gal_index_list[0], jdx]
-
-                    candidate_minus_center_memview[idx, jdx] = w_coord[temp_idx, jdx] - hole_center_memview[0, jdx]
-
-
-            ############################################################################
-            # Calculate bottom of ratio to be minimized
-            ############################################################################
-            #bot_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-            
-            for idx in range(num_nearest):
-                
-                temp_f64_accum = 0.0
-                
-                for jdx in range(3):
-                    
-                    temp_f64_accum += candidate_minus_A_memview[idx,jdx]*unit_vector_memview[jdx]
-                    
-                bot_memview[idx] = 2*temp_f64_accum
-            
-            
-            ############################################################################
-            # Calculate top of ratio to be minimized
-            ############################################################################
-            #top_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-
-            if num_neighbors == 1:
-
-                for idx in range(num_nearest):
-                
-                    temp_f64_accum = 0.0
-                    
-                    for jdx in range(3):
-                        
-                        temp_f64_accum += candidate_minus_A_memview[idx,jdx]*candidate_minus_A_memview[idx,jdx]
-                        
-                    top_memview[idx] = temp_f64_accum
-
-            else:
-
-                for idx in range(3):
-
-                    Bcenter_memview[idx] = w_coord[nearest_gal_index_list[1], idx] - hole_center_memview[0, idx]
-
-
-                temp_f64_accum = 0.0
-                
-                for idx in range(3):
-                    
-                    temp_f64_accum += Bcenter_memview[idx]*Bcenter_memview[idx]
-                    
-                temp_f64_val = temp_f64_accum
-
-                
-                for idx in range(num_nearest):
-                    
-                    temp_f64_accum = 0.0
-                    
-                    for jdx in range(3):
-                        
-                        temp_f64_accum += candidate_minus_center_memview[idx, jdx]*candidate_minus_center_memview[idx, jdx]
-                        
-                    top_memview[idx] = temp_f64_accum - temp_f64_val
-
-
-
-            ############################################################################
-            # Calculate the minimization ratios
-            ############################################################################
-            #x_ratio_memview = np.empty(num_nearest, dtype=np.float64, order='C')
-
-            for idx in range(num_nearest):
-
-                x_ratio_memview[idx] = top_memview[idx]/bot_memview[idx]
+            calculate_x_ratios(hole_center,
+                               unit_vector,
+                               nearest_gal_index_list,
+                               num_neighbors,
+                               galaxy_tree,
+                               scratch,
+                               num_nearest)
 
             ############################################################################
             # Locate positive values of x_ratio
@@ -515,7 +1477,7 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
             
             for idx in range(num_nearest):
                 
-                temp_f64_val = x_ratio_memview[idx]
+                temp_f64_val = scratch.x_ratio[idx]
                 
                 if temp_f64_val > 0.0:
                     
@@ -534,21 +1496,225 @@ cdef void find_next_galaxy(DTYPE_F64_t[:,:] hole_center_memview,
             ############################################################################
             if any_valid:
                 
-                nearest_neighbor_index[0] = i_nearest_reduced_memview[valid_min_idx]
+                nearest_neighbor_index[0] = scratch.i_nearest_reduced[valid_min_idx]
 
-                min_x_ratio[0] = x_ratio_memview[valid_min_idx]
+                min_x_ratio[0] = scratch.x_ratio[valid_min_idx]
                 
                 galaxy_search = False
             
 
-        elif not_in_mask(temp_hole_center_memview, mask, mask_resolution, min_dist, max_dist):
+        elif num_seen == 0 and not_in_survey(temp_hole_center, mask, mask_resolution, min_dist, max_dist, voxels):
             
             galaxy_search = False
 
             in_mask[0] = False
 
 
-    return
+    return 0
+
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef int find_next_galaxy_exact(DTYPE_F64_t* hole_center, 
+                                DTYPE_F64_t* temp_hole_center,
+                                DTYPE_F64_t search_radius, 
+                                DTYPE_F64_t direction_mod,
+                                DTYPE_F64_t* unit_vector, 
+                                GalaxyTree galaxy_tree, 
+                                DTYPE_INT64_t* nearest_gal_index_list, 
+                                ITYPE_t num_neighbors,
+                                DTYPE_B_t[:,:] mask, 
+                                DTYPE_INT32_t mask_resolution,
+                                DTYPE_F64_t min_dist, 
+                                DTYPE_F64_t max_dist, 
+                                SurveyVoxels* voxels,
+                                FindNextScratch* scratch,
+                                ITYPE_t* nearest_neighbor_index,           #return variable
+                                DTYPE_F64_t* min_x_ratio,                  #return variable
+                                DTYPE_B_t* in_mask                         #return variable
+                                ) nogil:
+    '''
+    Description:
+    ============
+    Same search as find_next_galaxy(), but instead of stepping the hole 
+    center by dr until a galaxy bounds the sphere, find the bounding galaxy 
+    exactly.
+    
+    The x_ratio of a candidate does not depend on how far the center has 
+    moved, and every galaxy with 0 < x_ratio <= T lies inside the sphere the 
+    hole would have once the center has moved far enough for an x_ratio of 
+    T.  So we query that sphere for a guess T, doubling T until the smallest 
+    positive x_ratio found is <= T, at which point it is the smallest 
+    positive x_ratio of all the galaxies.  The number of queries grows with 
+    log(void radius) instead of void radius/dr, and the result does not 
+    depend on dr.
+    
+    Since the center is not stepped, the survey check is done on the exact 
+    center where the new galaxy lands on the sphere: in_mask is set to False 
+    if that center is outside the survey, or if one of the guessed centers 
+    short of it is.  Either way temp_hole_center is left at a location 
+    outside the survey, like in find_next_galaxy().
+    
+    
+    Parameters:
+    ===========
+    
+    Same as find_next_galaxy(), except there is no dr.
+    
+    
+    Returns:
+    ========
+    
+    Same as find_next_galaxy().
+    '''
+    
+    cdef ITYPE_t idx
+    
+    cdef DTYPE_F64_t temp_f64_accum
+    
+    cdef DTYPE_F64_t temp_f64_val
+    
+    cdef ITYPE_t num_nearest
+    
+    cdef DTYPE_F64_t valid_min_val = INFINITY
+    
+    ############################################################################
+    # shift - distance the center has moved along the search direction
+    # ratio_offset - converts shift into the largest x_ratio certain to be 
+    #     inside the sphere.  For galaxy 2/B the x_ratio is the sphere radius,
+    #     for 3/C and 4/D it is the shift itself.
+    ############################################################################
+    cdef DTYPE_F64_t shift = 0.5*search_radius
+    
+    cdef DTYPE_F64_t ratio_offset = 0.0
+    
+    cdef DTYPE_F64_t start_center[3]
+    
+    cdef DTYPE_F64_t query_radius
+    
+    ############################################################################
+    # The spheres of successive guesses are nested, so each guess only 
+    # queries the shell outside the previous sphere, and the best candidate 
+    # so far is carried over
+    ############################################################################
+    cdef DTYPE_F64_t prev_center[3]
+    
+    cdef DTYPE_F64_t prev_radius = -1.0
+    
+    cdef ITYPE_t best_idx = -1
+    
+    
+    for idx in range(3):
+        
+        start_center[idx] = temp_hole_center[idx]
+    
+    if num_neighbors == 1:
+        
+        ratio_offset = search_radius
+    
+    
+    while True:
+        
+        ############################################################################
+        # Move the center to the current guess and find the sphere through 
+        # galaxy 1/A around it
+        ############################################################################
+        for idx in range(3):
+
+            temp_hole_center[idx] = start_center[idx] + direction_mod*shift*unit_vector[idx]
+        
+        if num_neighbors == 1:
+            
+            query_radius = search_radius + shift
+            
+        else:
+            
+            temp_f64_accum = 0.0
+            
+            for idx in range(3):
+                
+                temp_f64_val = galaxy_coord(galaxy_tree, nearest_gal_index_list[0], idx) - temp_hole_center[idx]
+                
+                temp_f64_accum += temp_f64_val*temp_f64_val
+                
+            query_radius = sqrt(temp_f64_accum)
+        
+        
+        num_nearest = query_candidates(galaxy_tree,
+                                       temp_hole_center,
+                                       query_radius,
+                                       prev_center,
+                                       prev_radius,
+                                       nearest_gal_index_list,
+                                       num_neighbors,
+                                       scratch)
+        
+        if num_nearest < 0:
+            
+            return -1
+        
+        for idx in range(3):
+            
+            prev_center[idx] = temp_hole_center[idx]
+            
+        prev_radius = query_radius
+        
+        calculate_x_ratios(hole_center,
+                           unit_vector,
+                           nearest_gal_index_list,
+                           num_neighbors,
+                           galaxy_tree,
+                           scratch,
+                           num_nearest)
+        
+        for idx in range(num_nearest):
+            
+            temp_f64_val = scratch.x_ratio[idx]
+            
+            if temp_f64_val > 0.0 and temp_f64_val < valid_min_val:
+                
+                best_idx = scratch.i_nearest_reduced[idx]
+                
+                valid_min_val = temp_f64_val
+                
+        ############################################################################
+        # Only a minimum inside the guess is certain to be the global minimum
+        ############################################################################
+        if best_idx >= 0 and valid_min_val <= shift + ratio_offset:
+            
+            break
+        
+        ############################################################################
+        # Nothing bounds the sphere before the center leaves the survey
+        ############################################################################
+        if not_in_survey(temp_hole_center, mask, mask_resolution, min_dist, max_dist, voxels):
+            
+            in_mask[0] = False
+            
+            return 0
+        
+        shift *= 2.0
+        
+        
+    nearest_neighbor_index[0] = best_idx
+
+    min_x_ratio[0] = valid_min_val
+    
+    ############################################################################
+    # Leave the moving center where the new galaxy lands on the sphere
+    ############################################################################
+    for idx in range(3):
+
+        temp_hole_center[idx] = start_center[idx] + direction_mod*(valid_min_val - ratio_offset)*unit_vector[idx]
+        
+    if not_in_survey(temp_hole_center, mask, mask_resolution, min_dist, max_dist, voxels):
+        
+        in_mask[0] = False
+        
+    return 0
 
 
 
@@ -566,18 +1732,18 @@ cdef DTYPE_F64_t dec_offset = -90
 @cython.boundscheck(False)
 @cython.wraparound(False)
 @cython.cdivision(True)
-cdef DTYPE_B_t not_in_mask(DTYPE_F64_t[:,:] coordinates, 
-                  DTYPE_B_t[:,:] survey_mask_ra_dec, 
-                  DTYPE_INT32_t n,
-                  DTYPE_F64_t rmin, 
-                  DTYPE_F64_t rmax):
+cdef DTYPE_B_t not_in_mask(DTYPE_F64_t* coordinates, 
+                           DTYPE_B_t[:,:] survey_mask_ra_dec, 
+                           DTYPE_INT32_t n,
+                           DTYPE_F64_t rmin, 
+                           DTYPE_F64_t rmax) nogil:
     '''
     Determine whether a given set of coordinates falls within the survey.
 
     Parameters:
     ============
 
-    coordinates : numpy.ndarray of shape (3,), in x-y-z order and cartesian coordinates
+    coordinates : pointer to 3 doubles, in x-y-z order and cartesian coordinates
         x,y, and z are measured in Mpc/h
 
     survey_mask_ra_dec : numpy.ndarray of shape (num_ra, num_dec) where 
@@ -618,9 +1784,9 @@ cdef DTYPE_B_t not_in_mask(DTYPE_F64_t[:,:] coordinates,
     cdef DTYPE_B_t return_mask_value
 
     
-    coord_x = coordinates[0,0]
-    coord_y = coordinates[0,1]
-    coord_z = coordinates[0,2]
+    coord_x = coordinates[0]
+    coord_y = coordinates[1]
+    coord_z = coordinates[2]
     
     
     r_sq = coord_x*coord_x + coord_y*coord_y + coord_z*coord_z
@@ -670,3 +1836,59 @@ cdef DTYPE_B_t not_in_mask(DTYPE_F64_t[:,:] coordinates,
 
 
 
+
+
+
+
+@cython.boundscheck(False)
+@cython.wraparound(False)
+@cython.cdivision(True)
+cdef DTYPE_B_t not_in_survey(DTYPE_F64_t* coordinates, 
+                             DTYPE_B_t[:,:] survey_mask_ra_dec, 
+                             DTYPE_INT32_t n,
+                             DTYPE_F64_t rmin, 
+                             DTYPE_F64_t rmax,
+                             SurveyVoxels* voxels) nogil:
+    '''
+    Same answer as not_in_mask(), looked up in the voxel grid of voxels 
+    where the voxel holding coordinates lies entirely inside or entirely 
+    outside the survey (see SurveyVoxelGrid).  Coordinates in boundary 
+    voxels or outside the grid, or any coordinates if voxels.states is NULL,
+    fall back to not_in_mask().
+    '''
+    
+    cdef ITYPE_t idx
+    
+    cdef ITYPE_t voxel_idx[3]
+    
+    cdef DTYPE_F64_t scaled
+    
+    cdef DTYPE_B_t state
+    
+    
+    if voxels.states != NULL:
+        
+        for idx in range(3):
+            
+            scaled = (coordinates[idx] - voxels.origin[idx])*voxels.inv_voxel_size
+            
+            ############################################################
+            # Also catches NAN coordinates
+            ############################################################
+            if not (scaled >= 0.0 and scaled < voxels.shape[idx]):
+                
+                return not_in_mask(coordinates, survey_mask_ra_dec, n, rmin, rmax)
+            
+            voxel_idx[idx] = <ITYPE_t>scaled
+            
+        state = voxels.states[(voxel_idx[0]*voxels.shape[1] + voxel_idx[1])*voxels.shape[2] + voxel_idx[2]]
+        
+        if state == SURVEY_VOXEL_INSIDE:
+            
+            return 0
+        
+        elif state == SURVEY_VOXEL_OUTSIDE:
+            
+            return 1
+        
+    return not_in_mask(coordinates, survey_mask_ra_dec, n, rmin, rmax)
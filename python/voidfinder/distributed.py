@@ -0,0 +1,612 @@
+'''
+Grow the holes with worker processes on several hosts, coordinated over TCP.
+
+The coordinator (run_distributed, called by _main_hole_finder when it is
+given a coordinator_address) writes the galaxy coordinates and the mask to a
+path every host can read, then hands out batches of cell IDs to whichever
+workers connect and writes the hole arrays they send back into one
+(N_empty_cells, 4) array.  Each worker sends a heartbeat every few seconds
+while it works, and the batches of a worker which disconnects or goes quiet
+for longer than heartbeat_timeout are handed to the others.
+
+A worker is started on each host with
+
+    VOIDFINDER_AUTHKEY=<key> python -m voidfinder.distributed <host> <port>
+
+where <host>:<port> is the coordinator_address and <key> the authkey the
+coordinator was given (or the same environment variable on its host).
+'''
+
+import os
+
+import socket
+
+import time
+
+import threading
+
+from collections import deque
+
+from multiprocessing.connection import Listener, Client, wait
+
+import numpy as np
+
+from ._voidfinder import compact_holes
+
+from ._voidfinder_cython import main_algorithm, GalaxyTree, HoleGrowthWorkspace
+
+from .voidfinder_functions import SurveyVoxelGrid
+
+
+
+
+def get_authkey(authkey=None):
+    '''
+    Return authkey as bytes, falling back to the VOIDFINDER_AUTHKEY
+    environment variable.  Raises a ValueError if neither is set, since the
+    connections pickle their messages and must not accept strangers.
+    '''
+
+    if authkey is None:
+
+        authkey = os.environ.get('VOIDFINDER_AUTHKEY')
+
+    if not authkey:
+
+        raise ValueError("Set authkey or the VOIDFINDER_AUTHKEY environment variable to run distributed")
+
+    if isinstance(authkey, str):
+
+        authkey = authkey.encode()
+
+    return authkey
+
+
+
+
+def run_distributed(cell_ID_gen,
+                    dl,
+                    dr,
+                    coord_min,
+                    mask,
+                    mask_resolution,
+                    min_dist,
+                    max_dist,
+                    w_coord,
+                    coordinator_address,
+                    data_path,
+                    authkey=None,
+                    batch_size=1000,
+                    heartbeat_timeout=30.,
+                    verbose=False,
+                    exact_search=False,
+                    single_precision=False,
+                    checkpoint=None,
+                    telemetry=None,
+                    hole_stream=None,
+                    survey_voxels=None):
+    '''
+    Description:
+    ============
+
+    Grow a hole in every cell of cell_ID_gen on the workers which connect to
+    coordinator_address, and return the holes as run_multi_process does.
+
+
+
+    Parameters:
+    ===========
+
+    cell_ID_gen : CellIDGenerator or MortonCellIDGenerator
+        empty cells to grow holes in
+
+    dl, dr, coord_min, mask, mask_resolution, min_dist, max_dist, w_coord :
+        as for _main_hole_finder
+
+    coordinator_address : tuple of (string, integer)
+        host and port to listen on for workers
+
+    data_path : string
+        path of the .npz file to write w_coord and the mask to, readable by
+        every worker host
+
+    authkey : bytes or string
+        shared secret the workers must present.  Default is the
+        VOIDFINDER_AUTHKEY environment variable.
+
+    batch_size : integer
+        Number of cells in each batch handed to a worker.  Default is 1000.
+
+    heartbeat_timeout : float
+        Seconds after which a silent worker is considered lost and its
+        batches are handed out again.  Default is 30.
+
+    verbose : boolean
+        Print progress messages.  Default is False.
+
+    exact_search, single_precision : boolean
+        as for _main_hole_finder
+        
+    checkpoint : CheckpointLog
+        If not None, log to append each finished batch to.  Default is None.
+        
+    telemetry : HoleGrowthTelemetry
+        If not None, counters to add the number of workers which connected 
+        and were lost to.  Default is None.
+
+    hole_stream : HoleStream
+        If not None, stream to add each finished batch of holes to.  Default
+        is None.
+
+    survey_voxels : SurveyVoxelGrid
+        If not None, voxel grid the workers check the survey footprint with
+        before falling back to the mask.  Written to data_path with the 
+        galaxies.  Default is None.
+
+
+
+    Returns:
+    ========
+
+    myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes :
+        as returned by _main_hole_finder
+    '''
+
+    start_time = time.time()
+
+    authkey = get_authkey(authkey)
+
+    n_empty_cells = len(cell_ID_gen)
+
+    results = np.empty((n_empty_cells, 4), dtype=np.float64)
+
+    ################################################################################
+    #
+    # Everything a worker needs besides its batches: the galaxies and mask
+    # once through the shared path, and the scalar parameters on connecting
+    #
+    ################################################################################
+
+    data = {'w_coord' : w_coord, 'mask' : mask.astype(np.uint8)}
+
+    if survey_voxels is not None:
+
+        data['voxel_states'] = survey_voxels.states
+
+    np.savez(data_path, **data)
+
+    setup = {'data_path' : data_path,
+             'dl' : dl,
+             'dr' : dr,
+             'coord_min' : coord_min,
+             'mask_resolution' : mask_resolution,
+             'min_dist' : min_dist,
+             'max_dist' : max_dist,
+             'exact_search' : exact_search,
+             'single_precision' : single_precision,
+             'heartbeat_interval' : heartbeat_timeout/4.}
+
+    if survey_voxels is not None:
+
+        setup['voxel_origin'] = survey_voxels.origin
+
+        setup['voxel_size'] = survey_voxels.voxel_size
+
+    ################################################################################
+    #
+    # Accept workers on a background thread, since the Listener cannot be
+    # waited on together with the worker connections
+    #
+    ################################################################################
+
+    listener = Listener(coordinator_address, authkey=authkey)
+
+    new_connections = deque()
+
+    def accept_workers():
+
+        while True:
+
+            try:
+
+                conn = listener.accept()
+
+            except OSError:
+
+                ############################################################
+                # The listener was closed, or a client failed to
+                # authenticate
+                ############################################################
+                if listener._listener is None:
+
+                    return
+
+                continue
+
+            new_connections.append(conn)
+
+    accept_thread = threading.Thread(target=accept_workers, daemon=True)
+
+    accept_thread.start()
+
+    if verbose:
+
+        print("Coordinator listening on", listener.address)
+
+    ################################################################################
+    #
+    # pending_jobs - batches (job_id, offset, i_j_k_array) not yet handed out,
+    #     including those taken back from lost workers
+    # worker_jobs - the batch each connected worker is working on, or None
+    # ready_workers - the workers which have loaded the data and said 'ready'
+    # last_seen - time of the last message from each worker
+    #
+    ################################################################################
+
+    pending_jobs = deque()
+
+    worker_jobs = {}
+
+    ready_workers = set()
+
+    last_seen = {}
+
+    num_cells_dispatched = 0
+
+    num_cells_processed = 0
+
+    num_jobs = 0
+
+    num_lost = 0
+
+    num_connected = 0
+
+    def drop_worker(conn):
+
+        job = worker_jobs.pop(conn)
+
+        del last_seen[conn]
+
+        ready_workers.discard(conn)
+
+        if job is not None:
+
+            pending_jobs.appendleft(job)
+
+        conn.close()
+
+    def next_job():
+
+        nonlocal num_cells_dispatched, num_jobs
+
+        if pending_jobs:
+
+            return pending_jobs.popleft()
+
+        i_j_k_array = cell_ID_gen.next_batch(batch_size)
+
+        if i_j_k_array.shape[0] == 0:
+
+            return None
+
+        job = (num_jobs, num_cells_dispatched, i_j_k_array)
+
+        num_jobs += 1
+
+        num_cells_dispatched += i_j_k_array.shape[0]
+
+        return job
+
+    def give_job(conn):
+
+        job = next_job()
+
+        worker_jobs[conn] = job
+
+        if job is not None:
+
+            conn.send(('job',) + job)
+
+    try:
+
+        while num_cells_processed < n_empty_cells:
+
+            while new_connections:
+
+                conn = new_connections.popleft()
+
+                conn.send(('setup', setup))
+
+                num_connected += 1
+
+                worker_jobs[conn] = None
+
+                last_seen[conn] = time.time()
+
+            ############################################################
+            # Idle workers (those which found the work had run out) pick
+            # up the batches taken back from lost workers
+            ############################################################
+            for conn in [conn for conn, job in worker_jobs.items() if job is None]:
+
+                if pending_jobs and conn in ready_workers:
+
+                    give_job(conn)
+
+            for conn in wait(list(worker_jobs), timeout=1.):
+
+                try:
+
+                    message = conn.recv()
+
+                except (EOFError, OSError):
+
+                    num_lost += 1
+
+                    drop_worker(conn)
+
+                    continue
+
+                last_seen[conn] = time.time()
+
+                if message[0] == 'data':
+
+                    job_id, offset, return_array = message[1:]
+
+                    job = worker_jobs[conn]
+
+                    if job is not None and job[0] == job_id:
+
+                        results[offset:offset + return_array.shape[0]] = return_array
+
+                        num_cells_processed += return_array.shape[0]
+
+                        if checkpoint is not None:
+
+                            checkpoint.append(job[2], return_array)
+
+                        if hole_stream is not None:
+
+                            hole_stream.add(return_array)
+
+                        if verbose:
+
+                            print('Processed', num_cells_processed, 'cells of', n_empty_cells)
+
+                    give_job(conn)
+
+                elif message[0] == 'ready':
+
+                    ready_workers.add(conn)
+
+                    give_job(conn)
+
+            ############################################################
+            # Take the batches back from workers which went quiet
+            ############################################################
+            now = time.time()
+
+            for conn in [conn for conn in worker_jobs if now - last_seen[conn] > heartbeat_timeout]:
+
+                num_lost += 1
+
+                drop_worker(conn)
+
+    finally:
+
+        for conn in list(worker_jobs):
+
+            try:
+
+                conn.send(('exit',))
+
+            except OSError:
+
+                pass
+
+            conn.close()
+
+        ################################################################
+        # Shut the socket down before closing it, since closing alone
+        # leaves the accept thread blocked on a socket which still takes
+        # connections, such as those of the workers of a later run
+        ################################################################
+        listener._listener._socket.shutdown(socket.SHUT_RDWR)
+
+        listener.close()
+
+    if verbose:
+
+        print("Distributed hole growth time: ", time.time() - start_time)
+        print("Workers lost: ", num_lost)
+
+    if telemetry is not None:
+
+        telemetry.run.update({'num_workers' : num_connected,
+                              'num_workers_lost' : num_lost})
+
+    return compact_holes(results)
+
+
+
+
+def distributed_worker(coordinator_address,
+                       authkey=None,
+                       num_threads=1,
+                       connect_timeout=60.):
+    '''
+    Description:
+    ============
+
+    Connect to the coordinator at coordinator_address, load the galaxies and
+    mask from the path it gives, and grow holes in the batches it sends
+    until it says to exit.
+
+
+
+    Parameters:
+    ===========
+
+    coordinator_address : tuple of (string, integer)
+        host and port of the coordinator
+
+    authkey : bytes or string
+        shared secret of the coordinator.  Default is the VOIDFINDER_AUTHKEY
+        environment variable.
+
+    num_threads : integer
+        Number of OpenMP threads to grow the holes of each batch with.
+        Default is 1.
+
+    connect_timeout : float
+        Seconds to keep retrying to connect, so that workers may be started
+        before the coordinator.  Default is 60.
+    '''
+
+    authkey = get_authkey(authkey)
+
+    give_up_time = time.time() + connect_timeout
+
+    while True:
+
+        try:
+
+            conn = Client(coordinator_address, authkey=authkey)
+
+        except ConnectionRefusedError:
+
+            if time.time() > give_up_time:
+
+                raise
+
+            time.sleep(0.5)
+
+        else:
+
+            break
+
+    message = conn.recv()
+
+    if message[0] != 'setup':
+
+        conn.close()
+
+        return
+
+    setup = message[1]
+
+    ################################################################################
+    #
+    # Heartbeats go out from a background thread, so that they keep going
+    # while the data loads and while main_algorithm runs without the GIL
+    #
+    ################################################################################
+
+    send_lock = threading.Lock()
+
+    stop_heartbeat = threading.Event()
+
+    def send_heartbeats():
+
+        while not stop_heartbeat.wait(setup['heartbeat_interval']):
+
+            try:
+
+                with send_lock:
+
+                    conn.send(('heartbeat',))
+
+            except OSError:
+
+                return
+
+    heartbeat_thread = threading.Thread(target=send_heartbeats, daemon=True)
+
+    heartbeat_thread.start()
+
+    try:
+
+        data = np.load(setup['data_path'])
+
+        galaxy_tree = GalaxyTree(data['w_coord'], single_precision=setup['single_precision'])
+
+        mask = data['mask']
+
+        survey_voxels = None
+
+        if 'voxel_states' in data:
+
+            survey_voxels = SurveyVoxelGrid(data['voxel_states'],
+                                            setup['voxel_origin'],
+                                            setup['voxel_size'])
+
+        workspace = HoleGrowthWorkspace(num_threads)
+
+        with send_lock:
+
+            conn.send(('ready',))
+
+        while True:
+
+            try:
+
+                message = conn.recv()
+
+            except EOFError:
+
+                break
+
+            if message[0] == 'exit':
+
+                break
+
+            job_id, offset, i_j_k_array = message[1:]
+
+            return_array = np.empty((i_j_k_array.shape[0], 4), dtype=np.float64)
+
+            main_algorithm(i_j_k_array,
+                           galaxy_tree,
+                           setup['dl'],
+                           setup['dr'],
+                           setup['coord_min'],
+                           mask,
+                           setup['mask_resolution'],
+                           setup['min_dist'],
+                           setup['max_dist'],
+                           return_array,
+                           0,  #verbose level
+                           num_threads,
+                           setup['exact_search'],
+                           workspace,
+                           survey_voxels
+                           )
+
+            with send_lock:
+
+                conn.send(('data', job_id, offset, return_array))
+
+    finally:
+
+        stop_heartbeat.set()
+
+        conn.close()
+
+
+
+
+if __name__ == '__main__':
+
+    import argparse
+
+    parser = argparse.ArgumentParser(description='Run a VoidFinder hole growing worker')
+
+    parser.add_argument('host', help='host of the coordinator')
+
+    parser.add_argument('port', type=int, help='port of the coordinator')
+
+    parser.add_argument('--num_threads', type=int, default=1,
+                        help='number of OpenMP threads to grow holes with')
+
+    args = parser.parse_args()
+
+    distributed_worker((args.host, args.port), num_threads=args.num_threads)
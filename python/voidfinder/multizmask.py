@@ -6,6 +6,7 @@ import numpy as np
 #import pickle
 
 from .absmag_comovingdist_functions import Distance
+from .voidfinder_functions import HealpixMask
 
 '''
 parser = argparse.ArgumentParser(description='make mask')
@@ -129,3 +130,58 @@ def generate_mask(gal_data, H_0=100., O_m=0.3):
 
      return mask, mask_resolution
 
+
+
+
+
+def generate_healpix_mask(gal_data, nside=None, H_0=100., O_m=0.3):
+     '''
+     Generate a HEALPix mask of the footprint of the input galaxy survey: the
+     NESTED pixels holding at least one galaxy.  Its memory scales with the 
+     area of the footprint, and its pixels all have the same area.
+
+
+     Parameters:
+     ===========
+
+     gal_data : astropy table
+          List of galaxies, with columns ra, dec and redshift.
+
+     nside : integer
+          HEALPix resolution parameter, a power of 2.  Default is the 
+          smallest one whose pixels are no larger than those of the mask 
+          generate_mask would make.
+
+     H_0 : float
+          Hubble's constant.  Default value is 100h.
+
+     O_m : float
+          Omega-matter.  Default value is 0.3.
+
+
+     Returns:
+     ========
+
+     mask : HealpixMask
+          Pixels within the survey limits.
+
+     mask_resolution : integer
+          Scale factor of coordinates of the ra-dec mask generate_mask would 
+          make, with which the hole growth rasterizes this one
+     '''
+
+     D2R = np.pi/180.
+
+     ra  = gal_data['ra']%360
+     dec = gal_data['dec']
+     r   = Distance(gal_data['redshift'], O_m, H_0/100.)
+
+     mask_resolution = 1 + int(D2R*np.amax(r)/10)
+
+     # A pixel of nside has a side of sqrt(pi/3)/nside radians
+     if nside is None:
+          nside = 2**int(np.ceil(np.log2(np.sqrt(np.pi/3)*mask_resolution/D2R)))
+
+     mask = HealpixMask.from_ra_dec(np.asarray(ra), np.asarray(dec), nside)
+
+     return mask, mask_resolution
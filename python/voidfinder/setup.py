@@ -3,7 +3,6 @@
 from distutils.core import setup
 from distutils.extension import Extension
 
-from Cython.Distutils import build_ext
 from Cython.Build import cythonize
 
 import numpy
@@ -19,8 +18,8 @@ extensions = [
         ["_voidfinder_cython.pyx"],
         include_dirs=[numpy.get_include()+"/numpy"],
         libraries=["m"],
-        #extra_compile_args=['-fopenmp'],
-        #extra_link_args=['-fopenmp']
+        extra_compile_args=['-fopenmp'],
+        extra_link_args=['-fopenmp']
         
         
         ),
@@ -29,18 +28,22 @@ extensions = [
         ["_voidfinder_cython_find_next.pyx"],
         include_dirs=[numpy.get_include()+"/numpy"],
         libraries=["m"],
-        #extra_compile_args=['-fopenmp'],
-        #extra_link_args=['-fopenmp']
+        extra_compile_args=['-fopenmp'],
+        extra_link_args=['-fopenmp']
         
         
         )
               
 ]
 
+################################################################################
+# cythonize() compiles each .pyx under its Extension name, so the top-level
+# cimports (typedefs, _voidfinder_cython_find_next) resolve against the .pxd
+# files in this directory even though it is also the voidfinder package
+################################################################################
 setup(
     name = 'voidfinder',
-    cmdclass = {'build_ext': build_ext},
-    ext_modules = extensions,
+    ext_modules = cythonize(extensions, include_path=["."]),
     include_dirs=[numpy.get_include(), numpy.get_include()+"/numpy"]
   
 )
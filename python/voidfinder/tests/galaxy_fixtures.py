@@ -0,0 +1,24 @@
+'''
+Random galaxy catalogs shared by the tests.
+'''
+
+import numpy as np
+
+def random_galaxies(seed, radius, num_draws):
+    '''
+    Galaxies drawn uniformly from the cube of side 2*radius around the
+    observer, keeping those within radius of it.
+    '''
+    rng = np.random.RandomState(seed)
+    w_coord = rng.uniform(-radius, radius, size=(num_draws, 3))
+    return w_coord[np.linalg.norm(w_coord, axis=1) < radius]
+
+def galaxy_grid(w_coord, dl):
+    '''
+    coord_min, ngrid and cell_ID_dict of the grid of cells of side dl over
+    the galaxies, as passed to _main_hole_finder.
+    '''
+    coord_min = w_coord.min(axis=0).reshape(1, 3)
+    ngrid = np.ceil((w_coord.max(axis=0) - coord_min[0])/dl).astype(int)
+    cell_ID_dict = {tuple(cell): 1 for cell in ((w_coord - coord_min)/dl).astype(int)}
+    return coord_min, ngrid, cell_ID_dict
@@ -0,0 +1,17 @@
+from unittest import TestCase
+
+from voidfinder._voidfinder import AdaptiveBatchSizer
+
+class TestAdaptiveBatchSizer(TestCase):
+    def test_guided_tail(self):
+        sizer = AdaptiveBatchSizer(1000, 4)
+        self.assertEqual(sizer.next_size(100000), 1000)
+        self.assertEqual(sizer.next_size(4000), 500)
+        self.assertEqual(sizer.next_size(10), 16)
+
+    def test_measured_time(self):
+        sizer = AdaptiveBatchSizer(1000, 4, target_batch_time=0.5)
+        sizer.update(100, 1.)
+        self.assertEqual(sizer.next_size(100000), 50)
+        sizer.update(100, 0.01)
+        self.assertTrue(50 < sizer.next_size(100000) < 1000)
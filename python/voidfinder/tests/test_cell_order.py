@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+import numpy as np
+from voidfinder._voidfinder import CellIDGenerator, MortonCellIDGenerator, morton_decode, occupancy_grid
+from voidfinder.voidfinder_functions import mesh_galaxies_dict, mesh_galaxies_grid
+
+class TestCellOrder(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(3)
+        self.ngrid = (37, 21, 50)
+        self.cell_ID_dict = {tuple(cell): 1 for cell in rng.randint(0, self.ngrid, size=(3000, 3))}
+
+    def test_morton_decode(self):
+        cells = morton_decode(np.arange(64, dtype=np.int64))
+        self.assertEqual(len(set(map(tuple, cells.tolist()))), 64)
+        self.assertEqual(cells.max(), 3)
+        self.assertTrue(np.array_equal(cells[:8], np.indices((2, 2, 2)).reshape(3, -1).T))
+
+    def test_same_cells(self):
+        ijk = list(CellIDGenerator(*self.ngrid, self.cell_ID_dict))
+        morton = MortonCellIDGenerator(*self.ngrid, self.cell_ID_dict)
+        self.assertEqual(len(morton), len(ijk))
+        morton = list(morton)
+        self.assertEqual(len(morton), len(ijk))
+        self.assertEqual(sorted(morton), sorted(ijk))
+
+    def test_stays_exhausted(self):
+        for generator in (CellIDGenerator, MortonCellIDGenerator):
+            cell_ID_gen = generator(*self.ngrid, self.cell_ID_dict)
+            list(cell_ID_gen)
+            self.assertEqual(list(cell_ID_gen), [])
+            self.assertEqual(cell_ID_gen.next_batch(10).shape, (0, 3))
+
+    def test_batches_across_chunks(self):
+        occupied = occupancy_grid(self.ngrid, self.cell_ID_dict)
+        for generator in (CellIDGenerator, MortonCellIDGenerator):
+            cells = list(generator(*self.ngrid, occupied))
+            cell_ID_gen = generator(*self.ngrid, occupied, chunk_cells=1000)
+            batches = [cell_ID_gen.next_batch(777) for _ in range(len(cells)//777 + 2)]
+            self.assertTrue(all(batch.dtype == np.int64 for batch in batches))
+            self.assertTrue(all(batch.shape[0] == 777 for batch in batches[:-2]))
+            self.assertEqual(batches[-1].shape[0], 0)
+            self.assertEqual(list(map(tuple, np.concatenate(batches).tolist())), cells)
+
+    def test_mesh_galaxies_grid(self):
+        rng = np.random.RandomState(4)
+        w_coord = rng.uniform(-50, 50, size=(2000, 3))
+        coord_min = w_coord.min(axis=0).reshape(1, 3)
+        ngrid = np.ceil((w_coord.max(axis=0) - coord_min[0])/5.).astype(int)
+        occupied = mesh_galaxies_grid(w_coord, coord_min, 5., ngrid)
+        expected = occupancy_grid(ngrid, mesh_galaxies_dict(w_coord, coord_min, 5.))
+        self.assertTrue(np.array_equal(occupied, expected))
@@ -0,0 +1,52 @@
+from unittest import TestCase
+
+import os
+import tempfile
+
+import numpy as np
+from voidfinder._voidfinder import CheckpointLog, _main_hole_finder
+from voidfinder.tests.galaxy_fixtures import random_galaxies, galaxy_grid
+
+class TestCheckpoint(TestCase):
+    def setUp(self):
+        self.w_coord = random_galaxies(13, 50, 4000)
+        self.coord_min, self.ngrid, self.cell_ID_dict = galaxy_grid(self.w_coord, 5.)
+        self.mask = np.ones((360, 180), dtype=bool)
+
+    def find(self, **kwargs):
+        holes = _main_hole_finder(self.cell_ID_dict, self.ngrid, 5., 1., self.coord_min, self.mask,
+                                  1, 0., 50., self.w_coord, batch_size=100, **kwargs)
+        return np.sort(np.stack(holes[:4], axis=1), axis=0), holes[4]
+
+    def test_truncated_record(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'holes.ckpt')
+            log = CheckpointLog(path, self.ngrid, 5., 1., self.coord_min, 0., 50.)
+            log.append([(0, 0, 1), (0, 0, 2)], np.arange(8.).reshape(2, 4))
+            log.append([(0, 0, 3)], np.ones((1, 4)))
+            log.close()
+            with open(path, 'r+b') as log_file:
+                log_file.truncate(os.path.getsize(path) - 5)
+            log = CheckpointLog(path, self.ngrid, 5., 1., self.coord_min, 0., 50., resume=True)
+            self.assertEqual(log.cells.tolist(), [[0, 0, 1], [0, 0, 2]])
+            self.assertTrue(np.array_equal(log.results, np.arange(8.).reshape(2, 4)))
+            log.close()
+            with self.assertRaises(ValueError):
+                CheckpointLog(path, self.ngrid, 5., 2., self.coord_min, 0., 50., resume=True)
+
+    def test_resume(self):
+        full, n_full = self.find()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'holes.ckpt')
+            self.find(checkpoint_path=path)
+            ############################################################
+            # Keep the header and the first few records, as if the run
+            # had been interrupted
+            ############################################################
+            log = CheckpointLog(path, self.ngrid, 5., 1., self.coord_min, 0., 50., resume=True)
+            log.close()
+            with open(path, 'r+b') as log_file:
+                log_file.truncate(len(log.header) + 3*(8 + 56*100) + 10)
+            resumed, n_resumed = self.find(checkpoint_path=path, resume=True)
+        self.assertEqual(n_resumed, n_full)
+        self.assertTrue(np.array_equal(resumed, full))
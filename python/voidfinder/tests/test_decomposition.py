@@ -0,0 +1,81 @@
+from unittest import TestCase
+from unittest import mock
+
+import os
+import signal
+import threading
+import time
+import multiprocessing
+
+import numpy as np
+import voidfinder._voidfinder as _voidfinder
+from voidfinder._voidfinder import _main_hole_finder, bin_galaxies, run_decomposed, split_domains
+from voidfinder.tests.galaxy_fixtures import random_galaxies, galaxy_grid
+
+class TestDecomposition(TestCase):
+    def setUp(self):
+        self.w_coord = random_galaxies(23, 60, 6000)
+        self.coord_min, self.ngrid, self.cell_ID_dict = galaxy_grid(self.w_coord, 5.)
+        self.mask = np.ones((360, 180), dtype=bool)
+
+    def find(self, **kwargs):
+        holes = _main_hole_finder(self.cell_ID_dict, self.ngrid, 5., 1., self.coord_min, self.mask,
+                                  1, 0., 60., self.w_coord, batch_size=200, **kwargs)
+        return np.array(sorted(map(tuple, np.stack(holes[:4], axis=1)))), holes[4]
+
+    def test_split_domains(self):
+        covered = np.zeros((10, 7, 5), dtype=int)
+        for lower, upper in split_domains((10, 7, 5), 4):
+            covered[lower[0]:upper[0], lower[1]:upper[1], lower[2]:upper[2]] += 1
+        self.assertTrue(np.all(covered == 1))
+
+    def test_bin_galaxies(self):
+        order, galaxy_ranges = bin_galaxies(self.w_coord, self.coord_min, 5., self.ngrid, 6, 15.)
+        w_sorted = self.w_coord[order]
+        self.assertEqual(len(galaxy_ranges), len(split_domains(self.ngrid, 6)))
+        for (lower, upper), ranges in zip(split_domains(self.ngrid, 6), galaxy_ranges):
+            in_halo = np.all((w_sorted >= self.coord_min[0] + lower*5. - 15.)
+                             & (w_sorted <= self.coord_min[0] + upper*5. + 15.), axis=1)
+            listed = np.zeros(len(w_sorted), dtype=bool)
+            for start, stop in ranges:
+                listed[start:stop] = True
+            self.assertTrue(np.all(listed[in_halo]))
+            self.assertLess(np.count_nonzero(listed), len(w_sorted))
+
+    def test_same_holes(self):
+        full, n_full = self.find()
+        ############################################################
+        # A halo this narrow sends many holes back to the full tree
+        ############################################################
+        decomposed, n_decomposed = self.find(domain_cells=6, halo=15.)
+        self.assertEqual(n_decomposed, n_full)
+        self.assertTrue(np.array_equal(decomposed, full))
+
+    def run_with_kill(self, **kwargs):
+        def kill_a_worker():
+            give_up_time = time.time() + 10.
+            while not multiprocessing.active_children() and time.time() < give_up_time:
+                time.sleep(0.01)
+            for child in multiprocessing.active_children():
+                os.kill(child.pid, signal.SIGKILL)
+                break
+        killer = threading.Thread(target=kill_a_worker)
+        killer.start()
+        try:
+            with mock.patch.object(_voidfinder, 'cpu_count', return_value=3):
+                holes = run_decomposed(self.cell_ID_dict, self.ngrid, 5., 1., self.coord_min, self.mask,
+                                       1, 0., 60., self.w_coord, domain_cells=6, halo=15.,
+                                       batch_size=200, num_cpus=3, **kwargs)
+        finally:
+            killer.join()
+        return np.array(sorted(map(tuple, np.stack(holes[:4], axis=1)))), holes[4]
+
+    def test_replaces_dead_worker(self):
+        full, n_full = self.find()
+        decomposed, n_decomposed = self.run_with_kill()
+        self.assertEqual(n_decomposed, n_full)
+        self.assertTrue(np.array_equal(decomposed, full))
+
+    def test_respawn_limit(self):
+        with self.assertRaises(RuntimeError):
+            self.run_with_kill(max_respawns=0)
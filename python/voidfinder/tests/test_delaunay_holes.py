@@ -0,0 +1,32 @@
+from unittest import TestCase
+
+import numpy as np
+from sklearn import neighbors
+from voidfinder._voidfinder import delaunay_hole_finder
+from voidfinder._voidfinder_cython import main_algorithm, GalaxyTree
+from voidfinder.tests.galaxy_fixtures import random_galaxies
+
+class TestDelaunayHoles(TestCase):
+    def setUp(self):
+        self.w_coord = random_galaxies(5, 60, 6000)
+        self.mask = np.zeros((360, 180), dtype=np.uint8)
+        self.mask[0:270, 60:180] = 1
+
+    def test_holes_are_empty(self):
+        x, y, z, r, n_holes = delaunay_hole_finder(self.w_coord, self.mask, 1, 0., 60.)
+        centers = np.stack([x, y, z], axis=1)
+        self.assertEqual(centers.shape[0], n_holes)
+        dist, _ = GalaxyTree(self.w_coord).query(centers)
+        self.assertTrue(np.allclose(dist[:,0], r))
+
+    def test_grid_holes_found(self):
+        coord_min = self.w_coord.min(axis=0).reshape(1, 3)
+        ngrid = np.ceil((self.w_coord.max(axis=0) - coord_min[0])/5.).astype(int)
+        i_j_k_array = np.indices(ngrid).reshape(3, -1).T.astype(np.int64)
+        return_array = np.empty((i_j_k_array.shape[0], 4), dtype=np.float64)
+        main_algorithm(i_j_k_array, GalaxyTree(self.w_coord), 5., 1., coord_min, self.mask,
+                       1, 0., 60., return_array, 0, 1, True)
+        grid_holes = return_array[np.isfinite(return_array[:,3])]
+        delaunay_holes = np.stack(delaunay_hole_finder(self.w_coord, self.mask, 1, 0., 60.)[:4], axis=1)
+        dist, _ = neighbors.KDTree(delaunay_holes).query(grid_holes, k=1)
+        self.assertTrue(np.all(dist < 1e-6))
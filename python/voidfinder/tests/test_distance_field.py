@@ -0,0 +1,74 @@
+from unittest import TestCase
+
+import numpy as np
+from astropy.table import Table
+from voidfinder.voidfinder_functions import build_survey_distance_field, points_in_mask
+from voidfinder.volume_cut import volume_cut
+from voidfinder.vflag import determine_vflag
+
+class TestDistanceField(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(17)
+        ############################################################
+        # A footprint across ra = 0 and ra = 180, with holes
+        ############################################################
+        self.mask = np.zeros((360, 180), dtype=bool)
+        self.mask[150:250, 90:160] = True
+        self.mask[0:40, 80:130] = True
+        self.mask[330:360, 80:130] = True
+        self.mask[rng.rand(*self.mask.shape) < 0.005] = False
+        self.field = build_survey_distance_field(self.mask, 1, 0., 150., 4.)
+        self.rng = rng
+
+    def test_lower_bound(self):
+        centers = self.rng.uniform(-160, 160, size=(100000, 3))
+        distances = self.field.distance(centers)
+        self.assertTrue((distances > 10).any() and (distances < -10).any())
+        for _ in range(10):
+            offsets = self.rng.normal(size=centers.shape)
+            offsets *= np.abs(distances)[:,None]*0.999999/np.linalg.norm(offsets, axis=1)[:,None]
+            in_survey = points_in_mask(centers + offsets, self.mask, 1, 0., 150.)
+            self.assertFalse(((distances > 0) & ~in_survey).any())
+            self.assertFalse(((distances < 0) & in_survey).any())
+
+    def test_narrow_survey(self):
+        ############################################################
+        # Points outside a grid which covers only the survey are
+        # outside by at least their distance to the grid
+        ############################################################
+        mask = np.zeros((360, 180), dtype=bool)
+        mask[100:130, 100:120] = True
+        field = build_survey_distance_field(mask, 1, 10., 150., 3.)
+        self.assertLess(field.distances.size, 0.1*100**3)
+        centers = self.rng.uniform(-160, 160, size=(100000, 3))
+        distances = field.distance(centers)
+        upper = field.origin + 3.*np.array(field.distances.shape)
+        outside_grid = np.any((centers < field.origin) | (centers >= upper), axis=1)
+        self.assertTrue((distances[outside_grid & (np.linalg.norm(centers, axis=1) < 150)] < -50).any())
+        offsets = self.rng.normal(size=centers.shape)
+        offsets *= np.abs(distances)[:,None]*0.999999/np.linalg.norm(offsets, axis=1)[:,None]
+        self.assertFalse(((distances < 0) & points_in_mask(centers + offsets, mask, 1, 10., 150.)).any())
+        with self.assertRaises(ValueError):
+            build_survey_distance_field(mask, 1, 10., 150., 3., max_voxels=1000)
+
+    def test_volume_cut(self):
+        holes = np.empty((3000, 4))
+        holes[:,:3] = self.rng.uniform(-150, 150, size=(3000, 3))
+        holes[:,3] = self.rng.uniform(2, 30, size=3000)
+        holes = holes[points_in_mask(holes[:,:3], self.mask, 1, 0., 150.)]
+        hole_table = Table([holes[:,0], holes[:,1], holes[:,2], holes[:,3]], names=('x','y','z','radius'))
+        expected = volume_cut(hole_table.copy(), self.mask, 1, [0., 150.])
+        cut = volume_cut(hole_table.copy(), self.mask, 1, [0., 150.], self.field)
+        self.assertTrue(0 < len(expected) < len(hole_table))
+        self.assertTrue(self.field.spheres_inside(holes[:,:3], holes[:,3]).any())
+        for name in expected.colnames:
+            self.assertTrue(np.array_equal(cut[name], expected[name]))
+
+    def test_vflag(self):
+        voids = Table([[0.], [0.], [0.], [5.]], names=('x','y','z','radius'))
+        galaxies = self.rng.uniform(-310, 310, size=(3000, 3))
+        field = build_survey_distance_field(self.mask, 1, 0., 300., 5.)
+        vflags = [determine_vflag(x, y, z, voids, self.mask, 1) for x, y, z in galaxies]
+        field_vflags = [determine_vflag(x, y, z, voids, self.mask, 1, field) for x, y, z in galaxies]
+        self.assertEqual(set(vflags), {0, 2, 9})
+        self.assertEqual(vflags, field_vflags)
@@ -0,0 +1,98 @@
+from unittest import TestCase
+
+import os
+import socket
+import tempfile
+import threading
+from unittest import mock
+from multiprocessing.connection import Client
+
+import numpy as np
+from voidfinder._voidfinder import CellIDGenerator, CheckpointLog, _main_hole_finder, \
+                                   run_single_process_cython
+from voidfinder.distributed import run_distributed, distributed_worker
+from voidfinder.tests.galaxy_fixtures import random_galaxies, galaxy_grid
+
+class TestDistributed(TestCase):
+    def setUp(self):
+        self.w_coord = random_galaxies(11, 50, 4000)
+        self.coord_min, self.ngrid, self.cell_ID_dict = galaxy_grid(self.w_coord, 5.)
+        self.mask = np.ones((360, 180), dtype=bool)
+        with socket.socket() as sock:
+            sock.bind(('localhost', 0))
+            self.address = ('localhost', sock.getsockname()[1])
+        self.authkey = b'test'
+
+    def args(self):
+        return (CellIDGenerator(*self.ngrid, self.cell_ID_dict), 5., 1., self.coord_min,
+                self.mask, 1, 0., 50., self.w_coord)
+
+    def test_lost_worker_requeued(self):
+        got_job = threading.Event()
+
+        def silent_worker():
+            conn = connect(self.address, self.authkey)
+            conn.recv()
+            conn.send(('ready',))
+            conn.recv()
+            got_job.set()
+            with self.assertRaises(EOFError):  # never answers; the coordinator drops it
+                conn.recv()
+
+        def worker():
+            got_job.wait(10)
+            distributed_worker(self.address, self.authkey, connect_timeout=10)
+
+        threads = [threading.Thread(target=silent_worker, daemon=True),
+                   threading.Thread(target=worker, daemon=True)]
+        for thread in threads:
+            thread.start()
+        with tempfile.TemporaryDirectory() as tmpdir:
+            distributed = run_distributed(*self.args(), self.address,
+                                          os.path.join(tmpdir, 'data.npz'),
+                                          authkey=self.authkey, batch_size=200,
+                                          heartbeat_timeout=1.)
+        serial = run_single_process_cython(self.args()[0], self.ngrid, *self.args()[1:],
+                                           batch_size=200)
+        self.assertTrue(got_job.is_set())
+        self.assertEqual(distributed[4], serial[4])
+        for distributed_array, serial_array in zip(distributed[:4], serial[:4]):
+            self.assertTrue(np.array_equal(distributed_array, serial_array))
+
+    def test_checkpoint_resume(self):
+        def find(tmpdir, **kwargs):
+            worker = threading.Thread(target=distributed_worker, args=(self.address, self.authkey),
+                                      kwargs={'connect_timeout' : 10}, daemon=True)
+            worker.start()
+            holes = _main_hole_finder(self.cell_ID_dict, self.ngrid, 5., 1., self.coord_min,
+                                      self.mask, 1, 0., 50., self.w_coord, batch_size=100,
+                                      coordinator_address=self.address,
+                                      shared_data_path=os.path.join(tmpdir, 'data.npz'),
+                                      checkpoint_path=os.path.join(tmpdir, 'holes.ckpt'),
+                                      **kwargs)
+            worker.join(10)
+            return np.sort(np.stack(holes[:4], axis=1), axis=0), holes[4]
+
+        with tempfile.TemporaryDirectory() as tmpdir, \
+             mock.patch.dict(os.environ, {'VOIDFINDER_AUTHKEY' : self.authkey.decode()}):
+            full, n_full = find(tmpdir)
+            ############################################################
+            # Keep the header and the first few records, as if the run
+            # had been interrupted
+            ############################################################
+            path = os.path.join(tmpdir, 'holes.ckpt')
+            log = CheckpointLog(path, self.ngrid, 5., 1., self.coord_min, 0., 50., resume=True)
+            log.close()
+            self.assertGreater(log.cells.shape[0], 300)
+            with open(path, 'r+b') as log_file:
+                log_file.truncate(len(log.header) + 3*(8 + 56*100) + 10)
+            resumed, n_resumed = find(tmpdir, resume=True)
+        self.assertEqual(n_resumed, n_full)
+        self.assertTrue(np.array_equal(resumed, full))
+
+def connect(address, authkey):
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            pass
@@ -0,0 +1,33 @@
+from unittest import TestCase
+
+import numpy as np
+from voidfinder._voidfinder import mark_cells_outside_survey, occupancy_grid
+from voidfinder._voidfinder_cython import main_algorithm, GalaxyTree
+
+class TestFootprintCells(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(23)
+        w_coord = rng.uniform(-80, 80, size=(30000, 3))
+        r = np.linalg.norm(w_coord, axis=1)
+        ra = np.degrees(np.arctan2(w_coord[:,1], w_coord[:,0])) % 360
+        dec = np.degrees(np.arcsin(w_coord[:,2]/r))
+        self.w_coord = w_coord[(r > 10) & (r < 80) & (ra < 40) & (dec > 0) & (dec < 40)]
+        self.mask = np.zeros((360, 180), dtype=np.uint8)
+        self.mask[0:40, 90:130] = 1
+        self.coord_min = self.w_coord.min(axis=0).reshape(1, 3)
+        self.ngrid = np.ceil((self.w_coord.max(axis=0) - self.coord_min[0])/5.).astype(int)
+        self.occupied = occupancy_grid(self.ngrid, {tuple(cell): 1 for cell in ((self.w_coord - self.coord_min)/5.).astype(int)})
+
+    def test_skips_only_cells_without_holes(self):
+        marked, num_skipped = mark_cells_outside_survey(self.occupied, 5., self.coord_min, self.mask,
+                                                        1, 10., 80., chunk_cells=500)
+        skipped = marked & ~self.occupied
+        self.assertEqual(skipped.sum(), num_skipped)
+        self.assertTrue(num_skipped > (~marked).sum())
+        cells = np.argwhere(~self.occupied).astype(np.int64)
+        return_array = np.empty((cells.shape[0], 4), dtype=np.float64)
+        main_algorithm(cells, GalaxyTree(self.w_coord), 5., 1., self.coord_min, self.mask,
+                       1, 10., 80., return_array, 0)
+        is_skipped = skipped[tuple(cells.T)]
+        self.assertTrue(np.isnan(return_array[is_skipped]).all())
+        self.assertTrue(np.isfinite(return_array[~is_skipped, 3]).any())
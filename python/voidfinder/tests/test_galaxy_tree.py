@@ -0,0 +1,54 @@
+from unittest import TestCase
+
+import pickle
+
+import numpy as np
+from sklearn import neighbors
+from voidfinder._voidfinder_cython import GalaxyTree
+from voidfinder._voidfinder import SharedArrays
+
+class TestGalaxyTree(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(17)
+        self.w_coord = rng.uniform(-50, 50, size=(2000, 3))
+        self.points = rng.uniform(-60, 60, size=(100, 3))
+        self.tree = GalaxyTree(self.w_coord, leaf_size=16)
+        self.sklearn_tree = neighbors.KDTree(self.w_coord)
+
+    def test_query(self):
+        dist, idx = self.tree.query(self.points)
+        sk_dist, sk_idx = self.sklearn_tree.query(self.points, k=1)
+        self.assertTrue(np.array_equal(idx, sk_idx))
+        self.assertTrue(np.allclose(dist, sk_dist))
+
+    def test_query_radius(self):
+        idx = self.tree.query_radius(self.points, 12.)
+        sk_idx = self.sklearn_tree.query_radius(self.points, 12.)
+        for found, expected in zip(idx, sk_idx):
+            self.assertTrue(np.array_equal(np.sort(found), np.sort(expected)))
+
+    def test_pickle(self):
+        tree = pickle.loads(pickle.dumps(self.tree))
+        self.assertTrue(np.array_equal(tree.query(self.points)[1], self.tree.query(self.points)[1]))
+
+    def test_single_precision(self):
+        tree = GalaxyTree(self.w_coord, leaf_size=16, single_precision=True)
+        sklearn_tree = neighbors.KDTree(self.w_coord.astype(np.float32).astype(np.float64))
+        dist, idx = tree.query(self.points)
+        sk_dist, sk_idx = sklearn_tree.query(self.points, k=1)
+        self.assertTrue(np.array_equal(idx, sk_idx))
+        self.assertTrue(np.allclose(dist, sk_dist))
+        self.assertEqual(tree.get_arrays()[0].dtype, np.float32)
+        self.assertTrue(pickle.loads(pickle.dumps(tree)).single_precision)
+
+    def test_shared_arrays(self):
+        arrays = self.tree.get_arrays()
+        shared = SharedArrays(list(arrays[:-1]))
+        attached = pickle.loads(pickle.dumps(shared))
+        tree = GalaxyTree.from_arrays(*attached.arrays, arrays[-1])
+        self.assertTrue(np.array_equal(tree.query(self.points)[1], self.tree.query(self.points)[1]))
+        shared.arrays[0][0] += 1.
+        self.assertTrue(np.array_equal(attached.arrays[0], shared.arrays[0]))
+        del tree
+        attached.close()
+        shared.close()
@@ -0,0 +1,41 @@
+from unittest import TestCase
+
+import numpy as np
+from voidfinder.voidfinder_functions import HealpixMask, ang2pix_nest, points_in_mask, in_mask, not_in_mask
+
+class TestHealpixMask(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(7)
+        self.ra = rng.uniform(0, 360, 200000)
+        self.dec = np.degrees(np.arcsin(rng.uniform(-1, 1, 200000)))
+        ############################################################
+        # A footprint of galaxies in a wedge across ra = 0
+        ############################################################
+        footprint = ((self.ra < 40) | (self.ra > 320)) & (self.dec > 10) & (self.dec < 60)
+        self.mask = HealpixMask.from_ra_dec(self.ra[footprint], self.dec[footprint], 32)
+        self.rng = rng
+
+    def test_ang2pix_nest(self):
+        np.testing.assert_array_equal(ang2pix_nest(1, [45., 0., 90., 45.], [60., 0., 0., -60.]), [0, 4, 5, 8])
+        for nside in (1, 2, 16, 1024):
+            np.testing.assert_array_equal(ang2pix_nest(2*nside, self.ra, self.dec)//4,
+                                          ang2pix_nest(nside, self.ra, self.dec))
+        counts = np.bincount(ang2pix_nest(4, self.ra, self.dec), minlength=192)
+        self.assertTrue(np.all(np.abs(counts - 200000/192.) < 6*np.sqrt(200000/192.)))
+
+    def test_mask_checks(self):
+        self.assertTrue(len(self.mask.pixels) < 0.1*12*32**2)
+        self.assertTrue(self.mask.contains([10.], [30.])[0] and not self.mask.contains([180.], [30.])[0])
+        r = self.rng.uniform(0, 200, self.ra.shape[0])
+        points = np.stack([r*np.cos(np.radians(self.dec))*np.cos(np.radians(self.ra)),
+                           r*np.cos(np.radians(self.dec))*np.sin(np.radians(self.ra)),
+                           r*np.sin(np.radians(self.dec))], axis=1)
+        expected = self.mask.contains(self.ra, self.dec) & (r >= 20) & (r <= 150)
+        np.testing.assert_array_equal(points_in_mask(points, self.mask, 1, 20., 150.), expected)
+        for i in range(200):
+            self.assertEqual(not_in_mask(points[i:i+1], self.mask, 1, 20., 150.), not expected[i])
+        np.testing.assert_array_equal(in_mask(points[:2000], self.mask, 1, [20., 150.]), expected[:2000])
+
+    def test_nside(self):
+        with self.assertRaises(ValueError):
+            HealpixMask(48, [0])
@@ -0,0 +1,39 @@
+from unittest import TestCase
+
+import numpy as np
+from astropy.table import Table
+from voidfinder._voidfinder import HoleStream
+from voidfinder.volume_cut import volume_cut
+
+class TestHoleStream(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(11)
+        self.mask = np.zeros((360, 180), dtype=bool)
+        self.mask[0:270, 60:180] = True
+        self.holes = np.empty((400, 4))
+        self.holes[:,:3] = rng.uniform(-40, 40, size=(400, 3))
+        self.holes[:,3] = rng.uniform(2, 15, size=400)
+        self.holes[rng.rand(400) < 0.2] = np.nan
+
+    def test_matches_volume_cut(self):
+        found = self.holes[~np.isnan(self.holes[:,0])]
+        expected = Table([found[:,0], found[:,1], found[:,2], found[:,3]], names=('x','y','z','radius'))
+        expected.sort('radius')
+        expected.reverse()
+        expected = volume_cut(expected, self.mask, 1, [0., 45.])
+        self.assertTrue(0 < len(expected) < len(found))
+
+        hole_stream = HoleStream(self.mask, 1, [0., 45.])
+        for start in range(0, 400, 37):
+            batch = self.holes[start:start + 37].copy()
+            hole_stream.add(batch)
+            batch[:] = 0.
+        streamed = hole_stream.finish()
+        self.assertEqual(streamed.colnames, expected.colnames)
+        for name in expected.colnames:
+            self.assertTrue(np.array_equal(streamed[name], expected[name]))
+
+    def test_empty(self):
+        hole_stream = HoleStream(self.mask, 1, [0., 45.])
+        hole_stream.add(np.full((5, 4), np.nan))
+        self.assertEqual(len(hole_stream.finish()), 0)
@@ -0,0 +1,53 @@
+from unittest import TestCase
+
+import numpy as np
+from voidfinder._voidfinder_cython import main_algorithm, GalaxyTree, HoleGrowthWorkspace
+from voidfinder.tests.galaxy_fixtures import random_galaxies
+
+class TestMainAlgorithm(TestCase):
+    def setUp(self):
+        self.w_coord = random_galaxies(5, 60, 6000)
+        self.galaxy_tree = GalaxyTree(self.w_coord)
+        self.mask = np.zeros((360, 180), dtype=np.uint8)
+        self.mask[0:270, 60:180] = 1
+        self.coord_min = self.w_coord.min(axis=0).reshape(1, 3)
+        ngrid = np.ceil((self.w_coord.max(axis=0) - self.coord_min[0])/5.).astype(int)
+        self.i_j_k_array = np.indices(ngrid).reshape(3, -1).T.astype(np.int64)
+
+    def grow(self, num_threads, exact_search=False, workspace=None, galaxy_tree=None):
+        return_array = np.empty((self.i_j_k_array.shape[0], 4), dtype=np.float64)
+        main_algorithm(self.i_j_k_array, galaxy_tree or self.galaxy_tree, 5., 1.,
+                       self.coord_min, self.mask, 1, 0., 60., return_array, 0,
+                       num_threads, exact_search, workspace)
+        return return_array
+
+    def test_threads_match_serial(self):
+        serial = self.grow(1)
+        threaded = self.grow(3)
+        self.assertTrue(np.isfinite(serial[:,3]).any())
+        self.assertTrue(np.array_equal(serial, threaded, equal_nan=True))
+
+    def test_exact_search_matches_stepping(self):
+        stepped = self.grow(1)
+        exact = self.grow(1, exact_search=True)
+        both = np.isfinite(stepped[:,3]) & np.isfinite(exact[:,3])
+        self.assertTrue(both.sum() > 0.95*np.isfinite(stepped[:,3]).sum())
+        self.assertTrue(np.allclose(stepped[both], exact[both]))
+
+    def test_workspace_reuse(self):
+        workspace = HoleGrowthWorkspace(2, initial_capacity=1)
+        first = self.grow(2, workspace=workspace)
+        capacities = workspace.capacities()
+        self.assertTrue(max(capacities) > 1)
+        for capacity in capacities:
+            self.assertEqual(capacity & (capacity - 1), 0)
+        second = self.grow(2, workspace=workspace)
+        self.assertEqual(max(workspace.capacities()), max(capacities))
+        self.assertTrue(np.array_equal(first, second, equal_nan=True))
+
+    def test_single_precision_radius_drift(self):
+        double = self.grow(1)
+        single = self.grow(1, galaxy_tree=GalaxyTree(self.w_coord, single_precision=True))
+        self.assertTrue(np.array_equal(np.isnan(double[:,3]), np.isnan(single[:,3])))
+        found = np.isfinite(double[:,3])
+        self.assertTrue(np.abs(double[found] - single[found]).max() < 1e-2)
@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+import numpy as np
+from voidfinder._voidfinder import CellIDGenerator, find_unproductive_cells
+from voidfinder._voidfinder_cython import main_algorithm, GalaxyTree
+from voidfinder.voidfinder_functions import mesh_galaxies_dict
+
+class TestPruneCells(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(1)
+        w_coord = rng.uniform(-80, 80, size=(20000, 3))
+        w_coord = w_coord[np.linalg.norm(w_coord, axis=1) < 80]
+        void_centers = rng.uniform(-60, 60, size=(8, 3))
+        void_radii = rng.uniform(10, 25, size=8)
+        empty = np.linalg.norm(w_coord[:,None] - void_centers[None], axis=2) < void_radii
+        self.w_coord = w_coord[~empty.any(axis=1)]
+        self.mask = np.ones((360, 180), dtype=np.uint8)
+        self.coord_min = self.w_coord.min(axis=0).reshape(1, 3)
+        self.ngrid = np.ceil((self.w_coord.max(axis=0) - self.coord_min[0])/5.).astype(int)
+        self.cell_ID_dict = mesh_galaxies_dict(self.w_coord, self.coord_min, 5.)
+
+    def test_pruned_cells_grow_small_holes(self):
+        cells = np.array(list(CellIDGenerator(*self.ngrid, self.cell_ID_dict)), dtype=np.int64)
+        return_array = np.empty((cells.shape[0], 4), dtype=np.float64)
+        galaxy_tree = GalaxyTree(self.w_coord)
+        main_algorithm(cells, galaxy_tree, 5., 1., self.coord_min, self.mask,
+                       1, 0., 80., return_array, 0, 1, True)
+        pruned = find_unproductive_cells(self.cell_ID_dict, self.ngrid, 5., self.coord_min,
+                                         self.w_coord, galaxy_tree, self.mask, 1, 0., 80., 20.)
+        ############################################################
+        # Chunks much smaller than the grid give the same cells
+        ############################################################
+        chunked = find_unproductive_cells(self.cell_ID_dict, self.ngrid, 5., self.coord_min,
+                                          self.w_coord, galaxy_tree, self.mask, 1, 0., 80., 20.,
+                                          chunk_cells=1000)
+        self.assertTrue(np.array_equal(chunked, pruned))
+        self.assertTrue(pruned.shape[0] > 0)
+        pruned = set(map(tuple, pruned.tolist()))
+        is_pruned = np.array([cell in pruned for cell in map(tuple, cells.tolist())])
+        self.assertEqual(is_pruned.sum(), len(pruned))
+        self.assertFalse((return_array[is_pruned, 3] >= 20.).any())
+        self.assertTrue((return_array[~is_pruned, 3] >= 20.).any())
@@ -0,0 +1,62 @@
+from unittest import TestCase
+
+import numpy as np
+from voidfinder.voidfinder_functions import build_survey_voxels, points_in_mask
+from voidfinder._voidfinder_cython import main_algorithm, points_in_survey, GalaxyTree
+
+class TestSurveyVoxels(TestCase):
+    def setUp(self):
+        rng = np.random.RandomState(31)
+        self.mask = np.zeros((720, 360), dtype=np.uint8)
+        self.mask[200:520, 180:320] = 1
+        self.mask[rng.rand(*self.mask.shape) < 0.01] = 0
+        self.voxels = build_survey_voxels(self.mask, 2, 20., 150., 5.)
+        ############################################################
+        # Random points, and points on the pixel edges and radial
+        # limits where the voxels must defer to the mask
+        ############################################################
+        ra = rng.randint(0, 720, 50000)/2.
+        dec = rng.randint(0, 360, 50000)/2. - 90
+        r = rng.choice([20., 150., 80.], 50000)
+        edges = np.stack([r*np.cos(np.radians(dec))*np.cos(np.radians(ra)),
+                          r*np.cos(np.radians(dec))*np.sin(np.radians(ra)),
+                          r*np.sin(np.radians(dec))], axis=1)
+        self.points = np.concatenate([rng.uniform(-160, 160, size=(200000, 3)), edges])
+
+    def test_voxels_match_mask(self):
+        states = self.voxels.states
+        self.assertTrue((states == self.voxels.INSIDE).any() and (states == self.voxels.OUTSIDE).any())
+        exact = np.empty(self.points.shape[0], dtype=np.uint8)
+        points_in_survey(self.points, self.mask, 2, 20., 150., exact)
+        with_voxels = np.empty(self.points.shape[0], dtype=np.uint8)
+        points_in_survey(self.points, self.mask, 2, 20., 150., with_voxels, self.voxels)
+        np.testing.assert_array_equal(exact, with_voxels)
+        np.testing.assert_array_equal(points_in_mask(self.points, self.mask.astype(bool), 2, 20., 150.),
+                                      self.voxels.points_in_survey(self.points, self.mask.astype(bool), 2, 20., 150.))
+
+    def test_bounding_box(self):
+        ############################################################
+        # The grid covers the survey and little else
+        ############################################################
+        in_survey = self.points[points_in_mask(self.points, self.mask.astype(bool), 2, 20., 150.)]
+        upper = self.voxels.origin + 5.*np.array(self.voxels.states.shape)
+        self.assertTrue(np.all((in_survey >= self.voxels.origin) & (in_survey < upper)))
+        self.assertLess(self.voxels.states.size, 0.5*60**3)
+        with self.assertRaises(ValueError):
+            build_survey_voxels(self.mask, 2, 20., 150., 5., max_voxels=1000)
+
+    def test_same_holes(self):
+        w_coord = self.points[points_in_mask(self.points, self.mask.astype(bool), 2, 20., 150.)][:20000]
+        coord_min = w_coord.min(axis=0).reshape(1, 3)
+        ngrid = np.ceil((w_coord.max(axis=0) - coord_min[0])/10.).astype(int)
+        cells = np.indices(ngrid).reshape(3, -1).T.astype(np.int64)
+        galaxy_tree = GalaxyTree(w_coord)
+        for exact_search in (0, 1):
+            holes = np.empty((cells.shape[0], 4))
+            main_algorithm(cells, galaxy_tree, 10., 2., coord_min, self.mask, 2, 20., 150., holes, 0,
+                           1, exact_search)
+            voxel_holes = np.empty((cells.shape[0], 4))
+            main_algorithm(cells, galaxy_tree, 10., 2., coord_min, self.mask, 2, 20., 150., voxel_holes, 0,
+                           1, exact_search, None, self.voxels)
+            self.assertTrue(np.isfinite(holes[:,3]).any())
+            np.testing.assert_array_equal(holes, voxel_holes)
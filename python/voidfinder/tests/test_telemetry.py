@@ -0,0 +1,48 @@
+from unittest import TestCase
+from unittest import mock
+
+import csv
+import json
+import os
+import tempfile
+
+import numpy as np
+import voidfinder._voidfinder as _voidfinder
+from voidfinder._voidfinder import _main_hole_finder
+from voidfinder.tests.galaxy_fixtures import random_galaxies, galaxy_grid
+
+class TestTelemetry(TestCase):
+    def setUp(self):
+        self.w_coord = random_galaxies(19, 50, 4000)
+        self.coord_min, self.ngrid, self.cell_ID_dict = galaxy_grid(self.w_coord, 5.)
+        self.mask = np.ones((360, 180), dtype=bool)
+
+    def find(self, telemetry_path, num_cpus):
+        with mock.patch.object(_voidfinder, 'cpu_count', return_value=num_cpus):
+            return _main_hole_finder(self.cell_ID_dict, self.ngrid, 5., 1., self.coord_min, self.mask,
+                                     1, 0., 50., self.w_coord, batch_size=100, num_cpus=num_cpus,
+                                     telemetry_path=telemetry_path)
+
+    def test_json_report(self):
+        for num_cpus in (1, 2):
+            with tempfile.TemporaryDirectory() as tmpdir:
+                path = os.path.join(tmpdir, 'telemetry.json')
+                n_holes = self.find(path, num_cpus)[4]
+                with open(path) as report_file:
+                    report = json.load(report_file)
+            self.assertEqual(report['run']['num_holes'], n_holes)
+            self.assertEqual(report['run']['num_workers'], num_cpus)
+            self.assertEqual(len(report['workers']), num_cpus)
+            self.assertEqual(sum(stats['num_cells'] for stats in report['workers']), report['run']['num_cells'])
+            self.assertEqual(sum(stats['num_holes'] for stats in report['workers']), n_holes)
+            self.assertTrue(all(stats['cells_per_sec'] > 0 for stats in report['workers']))
+
+    def test_csv_report(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'telemetry.csv')
+            n_holes = self.find(path, 1)[4]
+            with open(path, newline='') as report_file:
+                rows = list(csv.DictReader(report_file))
+        values = {(row['scope'], row['name']): row['value'] for row in rows}
+        self.assertEqual(int(values[('run', 'num_holes')]), n_holes)
+        self.assertTrue(float(values[('worker 0', 'time_main')]) > 0)
@@ -0,0 +1,96 @@
+from unittest import TestCase
+from unittest import mock
+
+import os
+import signal
+import threading
+import time
+import multiprocessing
+
+import numpy as np
+import voidfinder._voidfinder as _voidfinder
+from voidfinder._voidfinder import CellIDGenerator, run_multi_process, run_single_process_cython
+from voidfinder.tests.galaxy_fixtures import random_galaxies, galaxy_grid
+
+class TestWorkerSupervision(TestCase):
+    def setUp(self):
+        self.w_coord = random_galaxies(17, 60, 8000)
+        self.coord_min, self.ngrid, self.cell_ID_dict = galaxy_grid(self.w_coord, 2.5)
+        self.mask = np.ones((360, 180), dtype=bool)
+
+    def run_with_kill(self, run, **kwargs):
+        def kill_a_worker():
+            give_up_time = time.time() + 10.
+            while not multiprocessing.active_children() and time.time() < give_up_time:
+                time.sleep(0.01)
+            for child in multiprocessing.active_children():
+                os.kill(child.pid, signal.SIGKILL)
+                break
+        killer = threading.Thread(target=kill_a_worker)
+        killer.start()
+        try:
+            with mock.patch.object(_voidfinder, 'cpu_count', return_value=3):
+                return run(CellIDGenerator(*self.ngrid, self.cell_ID_dict), self.ngrid, 2.5, 1.,
+                           self.coord_min, self.mask, 1, 0., 60., self.w_coord, batch_size=50,
+                           num_cpus=3, **kwargs)
+        finally:
+            killer.join()
+
+    def test_replaces_dead_worker(self):
+        holes = self.run_with_kill(run_multi_process)
+        serial = run_single_process_cython(CellIDGenerator(*self.ngrid, self.cell_ID_dict), self.ngrid,
+                                           2.5, 1., self.coord_min, self.mask, 1, 0., 60., self.w_coord)
+        self.assertEqual(holes[4], serial[4])
+        for multi_array, serial_array in zip(holes[:4], serial[:4]):
+            self.assertTrue(np.array_equal(multi_array, serial_array))
+
+    def test_respawn_limit(self):
+        with self.assertRaises(RuntimeError):
+            self.run_with_kill(run_multi_process, max_respawns=0)
+
+    def test_death_between_batches(self):
+        # Three batches for three workers, so the first worker to finish is
+        # left with nothing to do, and kills itself once its notice is out.
+        # Any batch charged with its death stops the run.
+        cells = CellIDGenerator(*self.ngrid, self.cell_ID_dict).next_batch(48)
+        victim_pid = multiprocessing.Value('q', 0)
+        real_main_algorithm = _voidfinder.main_algorithm
+
+        def main_algorithm(*args):
+            with victim_pid.get_lock():
+                if victim_pid.value == 0:
+                    victim_pid.value = os.getpid()
+            if victim_pid.value != os.getpid():
+                time.sleep(1.)
+            real_main_algorithm(*args)
+            if victim_pid.value == os.getpid():
+                threading.Timer(0.2, os.kill, (os.getpid(), signal.SIGKILL)).start()
+
+        telemetry = _voidfinder.HoleGrowthTelemetry()
+        with mock.patch.object(_voidfinder, 'main_algorithm', main_algorithm), \
+             mock.patch.object(_voidfinder, 'cpu_count', return_value=3):
+            holes = run_multi_process(CellList(cells), self.ngrid, 2.5, 1., self.coord_min, self.mask,
+                                      1, 0., 60., self.w_coord, batch_size=1000, num_cpus=3,
+                                      max_respawns=1, max_batch_failures=1, telemetry=telemetry)
+        self.assertEqual(telemetry.run['num_respawns'], 1)
+        serial = run_single_process_cython(CellList(cells), self.ngrid, 2.5, 1., self.coord_min,
+                                           self.mask, 1, 0., 60., self.w_coord)
+        self.assertEqual(holes[4], serial[4])
+        for multi_array, serial_array in zip(holes[:4], serial[:4]):
+            self.assertTrue(np.array_equal(multi_array, serial_array))
+
+class CellList(object):
+    '''
+    Hands out the rows of a fixed array of cell IDs, like CellIDGenerator.
+    '''
+    def __init__(self, cells):
+        self.cells = cells
+        self.num_handed_out = 0
+
+    def __len__(self):
+        return len(self.cells)
+
+    def next_batch(self, batch_size):
+        batch = self.cells[self.num_handed_out:self.num_handed_out + batch_size]
+        self.num_handed_out += len(batch)
+        return batch
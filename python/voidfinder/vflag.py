@@ -23,7 +23,7 @@ rmax = 300
 ################################################################################
 
 
-def determine_vflag(x, y, z, voids, mask, mask_resolution):
+def determine_vflag(x, y, z, voids, mask, mask_resolution, distance_field=None):
     '''
     Determines whether or not a galaxy is a void, wall, edge, or unclassifiable
     galaxy.
@@ -50,6 +50,11 @@ def determine_vflag(x, y, z, voids, mask, mask_resolution):
         True values correspond to ra,dec coordinates which lie within the 
         survey footprint.
 
+    distance_field : SurveyDistanceField
+        If not None, distance to the edge of the survey (built with the rmin 
+        and rmax of this module) used to classify the galaxies well inside 
+        or outside the survey without testing the mask.  Default is None.
+
 
     Returns:
     ========
@@ -95,8 +100,14 @@ def determine_vflag(x, y, z, voids, mask, mask_resolution):
 
         coord_array = np.array([[x,y,z]])
 
+        # Distance to the survey edge, positive inside; 0 if unknown
+        edge_distance = 0.
+
+        if distance_field is not None:
+            edge_distance = distance_field.distance(coord_array)[0]
+
         # Check to see if the galaxy is within the survey
-        if not_in_mask(coord_array, mask, mask_resolution, rmin, rmax):
+        if edge_distance < 0 or (edge_distance == 0 and not_in_mask(coord_array, mask, mask_resolution, rmin, rmax)):
             # Galaxy is outside the survey mask
             vflag = 9
 
@@ -108,24 +119,27 @@ def determine_vflag(x, y, z, voids, mask, mask_resolution):
             # Is the galaxy within 10 Mpc/h of the survey boundary?
             ####################################################################
 
-            # Calculate coordinates that are 10 Mpc/h in each Cartesian 
-            # direction of the galaxy
-            coord_min = np.array([x,y,z]) - 10
-            coord_max = np.array([x,y,z]) + 10
-
-            # Coordinates to check
-            x_coords = [coord_min[0], coord_max[0], x, x, x, x]
-            y_coords = [y, y, coord_min[1], coord_max[1], y, y]
-            z_coords = [z, z, z, z, coord_min[2], coord_max[2]]
-            extreme_coords = np.array([x_coords, y_coords, z_coords]).T
-
-            i = 0
-            while vflag == 0 and i <= 5:
-                # Check to see if any of these are outside the survey
-                if not_in_mask(extreme_coords[i].reshape(1,3), mask, mask_resolution, rmin, rmax):
-                    # Galaxy is within 10 Mpc/h of the survey edge
-                    vflag = 2
-                i += 1
+            # Unless the distance field puts the edge more than 10 Mpc/h away
+            if edge_distance <= 10:
+
+                # Calculate coordinates that are 10 Mpc/h in each Cartesian 
+                # direction of the galaxy
+                coord_min = np.array([x,y,z]) - 10
+                coord_max = np.array([x,y,z]) + 10
+
+                # Coordinates to check
+                x_coords = [coord_min[0], coord_max[0], x, x, x, x]
+                y_coords = [y, y, coord_min[1], coord_max[1], y, y]
+                z_coords = [z, z, z, z, coord_min[2], coord_max[2]]
+                extreme_coords = np.array([x_coords, y_coords, z_coords]).T
+
+                i = 0
+                while vflag == 0 and i <= 5:
+                    # Check to see if any of these are outside the survey
+                    if not_in_mask(extreme_coords[i].reshape(1,3), mask, mask_resolution, rmin, rmax):
+                        # Galaxy is within 10 Mpc/h of the survey edge
+                        vflag = 2
+                    i += 1
         
         
     ############################################################################
@@ -6,7 +6,7 @@ from astropy.table import Table
 import time
 
 from .hole_combine import combine_holes
-from .voidfinder_functions import build_mask, mesh_galaxies, in_mask, not_in_mask, in_survey, save_maximals, mesh_galaxies_dict
+from .voidfinder_functions import build_mask, mesh_galaxies, in_mask, not_in_mask, in_survey, save_maximals, mesh_galaxies_dict, mesh_galaxies_grid, build_survey_distance_field, HealpixMask
 from .table_functions import add_row, subtract_row, to_vector, to_array, table_dtype_cast, table_divide
 from .volume_cut import volume_cut
 
@@ -14,7 +14,7 @@ from .avsepcalc import av_sep_calc
 from .mag_cutoff_function import mag_cut, field_gal_cut
 
 
-from ._voidfinder import _main_hole_finder
+from ._voidfinder import _main_hole_finder, delaunay_hole_finder, HoleStream
 
 
 
@@ -244,7 +244,7 @@ def filter_galaxies(infile, maskfile, mask_resolution, min_dist, max_dist, surve
 
 
 
-def find_voids(ngrid, min_dist, max_dist, coord_min_table, mask, mask_resolution, out1_filename, out2_filename, survey_name, num_cpus):
+def find_voids(ngrid, min_dist, max_dist, coord_min_table, mask, mask_resolution, out1_filename, out2_filename, survey_name, num_cpus, use_threads=False, exact_search=False, single_precision=False, cell_order='ijk', min_radius=None, hole_engine='grid', coordinator_address=None, shared_data_path=None, checkpoint_path=None, resume=False, telemetry_path=None, domain_cells=None, halo=75., streaming=False, survey_voxel_size=None):
     
 
     
@@ -270,9 +270,10 @@ def find_voids(ngrid, min_dist, max_dist, coord_min_table, mask, mask_resolution
     print('Wall galaxy grid set up')
     '''
 
-    # Build a dictionary of all the cell IDs that have at least one galaxy in them
+    # Mark all the cells that have at least one galaxy in them
     #cell_ID_dict = mesh_galaxies_dict(w_coord_table, coord_min_table, dl)
-    cell_ID_dict = mesh_galaxies_dict(w_coord, coord_min, dl)
+    #cell_ID_dict = mesh_galaxies_dict(w_coord, coord_min, dl)
+    occupied = mesh_galaxies_grid(w_coord, coord_min, dl, ngrid)
 
 
     print('Galaxy grid indices computed')
@@ -290,65 +291,138 @@ def find_voids(ngrid, min_dist, max_dist, coord_min_table, mask, mask_resolution
 
     print('Growing holes', flush=True)
 
-    myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes = _main_hole_finder(cell_ID_dict, 
-                                                                            ngrid, 
-                                                                            dl, 
-                                                                            dr,
-                                                                            coord_min,
-                                                                            mask,
-                                                                            mask_resolution,
-                                                                            min_dist,
-                                                                            max_dist,
-                                                                            w_coord,
-                                                                            verbose=True,
-                                                                            num_cpus=num_cpus)
+    # The hole growth and the survey voxels work on an ra-dec mask, so a 
+    # HEALPix mask is rasterized for them at mask_resolution
+    grid_mask = mask
+
+    if isinstance(mask, HealpixMask):
+
+        grid_mask = mask.to_ra_dec_mask(mask_resolution)
+
+    # Distance to the survey edge on the survey voxels, so that the volume 
+    # cut skips the holes well inside the survey
+    distance_field = None
+
+    if survey_voxel_size is not None:
+
+        distance_field = build_survey_distance_field(grid_mask, mask_resolution, min_dist, max_dist, survey_voxel_size)
+
+    # Volume cut the holes on a background thread while the rest are growing
+    hole_stream = None
+
+    if streaming:
+
+        hole_stream = HoleStream(mask, mask_resolution, [min_dist, max_dist], distance_field)
+
+    if hole_engine == 'delaunay':
+
+        myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes = delaunay_hole_finder(w_coord,
+                                                                                   mask,
+                                                                                   mask_resolution,
+                                                                                   min_dist,
+                                                                                   max_dist,
+                                                                                   verbose=True)
+
+        if hole_stream is not None:
+
+            hole_stream.add(np.stack((myvoids_x, myvoids_y, myvoids_z, myvoids_r), axis=1))
+
+    elif hole_engine == 'grid':
+
+        myvoids_x, myvoids_y, myvoids_z, myvoids_r, n_holes = _main_hole_finder(occupied, 
+                                                                                ngrid, 
+                                                                                dl, 
+                                                                                dr,
+                                                                                coord_min,
+                                                                                grid_mask,
+                                                                                mask_resolution,
+                                                                                min_dist,
+                                                                                max_dist,
+                                                                                w_coord,
+                                                                                verbose=True,
+                                                                                num_cpus=num_cpus,
+                                                                                use_threads=use_threads,
+                                                                                exact_search=exact_search,
+                                                                                single_precision=single_precision,
+                                                                                cell_order=cell_order,
+                                                                                min_radius=min_radius,
+                                                                                coordinator_address=coordinator_address,
+                                                                                shared_data_path=shared_data_path,
+                                                                                checkpoint_path=checkpoint_path,
+                                                                                resume=resume,
+                                                                                telemetry_path=telemetry_path,
+                                                                                domain_cells=domain_cells,
+                                                                                halo=halo,
+                                                                                hole_stream=hole_stream,
+                                                                                survey_voxel_size=survey_voxel_size)
+
+    else:
+
+        raise ValueError("hole_engine must be 'grid' or 'delaunay', not " + repr(hole_engine))
 
     print('Found a total of', n_holes, 'potential voids.', flush=True)
 
     print('Time to find all holes =', time.time() - tot_hole_start, flush=True)
     
 
-    ################################################################################
-    #
-    #   SORT HOLES BY SIZE
-    #
-    ################################################################################
+    if hole_stream is not None:
 
-    sort_start = time.time()
+        ############################################################################
+        #
+        #   FINISH THE VOLUME CUT OF THE STREAMED HOLES, SORTED BY SIZE
+        #
+        ############################################################################
 
-    print('Sorting holes by size', flush=True)
+        cut_start = time.time()
 
-    potential_voids_table = Table([myvoids_x, myvoids_y, myvoids_z, myvoids_r], names=('x','y','z','radius'))
+        potential_voids_table = hole_stream.finish()
 
-    # Need to sort the potential voids into size order
-    potential_voids_table.sort('radius')
-    potential_voids_table.reverse()
+        print('Time spent cutting holes during growth =', hole_stream.time_cutting, flush=True)
+        print('Time to finish the volume cut =', time.time() - cut_start, flush=True)
 
-    '''
-    potential_voids_file = open('potential_voids_list.txt', 'wb')
-    pickle.dump(potential_voids_table, potential_voids_file)
-    potential_voids_file.close()
+    else:
 
+        ################################################################################
+        #
+        #   SORT HOLES BY SIZE
+        #
+        ################################################################################
 
-    in_file = open('potential_voids_list.txt', 'rb')
-    potential_voids_table = pickle.load(in_file)
-    in_file.close()
-    '''
+        sort_start = time.time()
 
-    sort_end = time.time()
+        print('Sorting holes by size', flush=True)
 
-    print('Holes are sorted.',flush=True)
-    print('Time to sort holes =', sort_end-sort_start,flush=True)
+        potential_voids_table = Table([myvoids_x, myvoids_y, myvoids_z, myvoids_r], names=('x','y','z','radius'))
 
-    ################################################################################
-    #
-    #   CHECK IF 90% OF VOID VOLUME IS WITHIN SURVEY LIMITS
-    #
-    ################################################################################
+        # Need to sort the potential voids into size order
+        potential_voids_table.sort('radius')
+        potential_voids_table.reverse()
+
+        '''
+        potential_voids_file = open('potential_voids_list.txt', 'wb')
+        pickle.dump(potential_voids_table, potential_voids_file)
+        potential_voids_file.close()
+
+
+        in_file = open('potential_voids_list.txt', 'rb')
+        potential_voids_table = pickle.load(in_file)
+        in_file.close()
+        '''
+
+        sort_end = time.time()
+
+        print('Holes are sorted.',flush=True)
+        print('Time to sort holes =', sort_end-sort_start,flush=True)
+
+        ################################################################################
+        #
+        #   CHECK IF 90% OF VOID VOLUME IS WITHIN SURVEY LIMITS
+        #
+        ################################################################################
 
-    print('Removing holes with at least 10% of their volume outside the mask',flush=True)
+        print('Removing holes with at least 10% of their volume outside the mask',flush=True)
 
-    potential_voids_table = volume_cut(potential_voids_table, mask, mask_resolution, [min_dist, max_dist])
+        potential_voids_table = volume_cut(potential_voids_table, mask, mask_resolution, [min_dist, max_dist], distance_field)
 
     potential_voids_table.write(survey_name + 'potential_voids_list.txt', format='ascii.commented_header', overwrite=True)
 
@@ -2,6 +2,7 @@
 
 import numpy as np
 from astropy.table import Table, Row
+from scipy import ndimage
 
 from .table_functions import add_row, subtract_row, table_divide, table_dtype_cast, row_cross, row_dot, to_vector, to_array
 
@@ -111,6 +112,28 @@ def mesh_galaxies_dict(galaxy_coords, coord_min, grid_side_length):
     return cell_ID_dict
 
 
+################################################################################
+################################################################################
+
+def mesh_galaxies_grid(galaxy_coords, coord_min, grid_side_length, ngrid):
+    '''
+    Build a boolean occupancy array of shape ngrid, True in the cells holding
+    at least one galaxy.  The vectorized equivalent of mesh_galaxies_dict,
+    except that galaxies outside the grid (on its upper edge) are left out.
+    '''
+
+    # Convert the galaxy coordinates to grid indices
+    mesh_indices = ((galaxy_coords - coord_min)/grid_side_length).astype(np.int64)
+
+    in_grid = np.all((mesh_indices >= 0) & (mesh_indices < np.asarray(ngrid)), axis=1)
+
+    occupied = np.zeros(tuple(ngrid), dtype=bool)
+
+    occupied[tuple(mesh_indices[in_grid].T)] = True
+
+    return occupied
+
+
 ################################################################################
 ################################################################################
 
@@ -138,9 +161,13 @@ def build_mask(maskfile, mask_resolution):
     mask : numpy array of shape (N,M)
         Boolean array of the entire sky, with points within the survey limits 
         set to True.  N represents the incremental RA; M represents the 
-        incremental dec.
+        incremental dec.  If maskfile is a HealpixMask (see 
+        multizmask.generate_healpix_mask), it is returned as it is.
     '''
 
+    if isinstance(maskfile, HealpixMask):
+        return maskfile
+
     '''
     mask = []
     
@@ -164,6 +191,187 @@ def build_mask(maskfile, mask_resolution):
     return mask
 
 
+################################################################################
+################################################################################
+
+def ang2pix_nest(nside, ra, dec):
+    '''
+    NESTED HEALPix pixel index of each ra, dec, as 
+    healpy.ang2pix(nside, ra, dec, nest=True, lonlat=True) gives it.
+    
+    
+    Parameters:
+    ===========
+    
+    nside : integer
+        HEALPix resolution parameter, a power of 2
+        
+    ra, dec : numpy.ndarray of shape (N,)
+        coordinates in degrees
+        
+        
+    Returns:
+    ========
+    
+    ipix : numpy.ndarray of shape (N,) of int64
+    '''
+
+    order = int(nside).bit_length() - 1
+
+    theta = 0.5*np.pi - np.radians(np.asarray(dec, dtype=np.float64))
+
+    z = np.cos(theta)
+    za = np.abs(z)
+
+    ############################################################
+    # Longitude in units of 90 degrees, in [0,4), wrapped the 
+    # way healpy does
+    ############################################################
+    tt = np.radians(np.asarray(ra, dtype=np.float64))*(2/np.pi)
+    tt = np.where(tt >= 0, np.where(tt < 4, tt, np.fmod(tt, 4.)), np.fmod(tt, 4.) + 4.)
+
+    face = np.empty(z.shape, dtype=np.int64)
+    ix = np.empty(z.shape, dtype=np.int64)
+    iy = np.empty(z.shape, dtype=np.int64)
+
+    ############################################################
+    # Equatorial region: the indices of the ascending and
+    # descending edge lines through the point
+    ############################################################
+    equatorial = za <= 2./3
+
+    temp1 = nside*(0.5 + tt[equatorial])
+    temp2 = nside*(z[equatorial]*0.75)
+
+    jp = (temp1 - temp2).astype(np.int64)
+    jm = (temp1 + temp2).astype(np.int64)
+
+    ifp = jp >> order
+    ifm = jm >> order
+
+    face[equatorial] = np.where(ifp == ifm, ifp | 4, np.where(ifp < ifm, ifp, ifm + 8))
+    ix[equatorial] = jm & (nside - 1)
+    iy[equatorial] = nside - (jp & (nside - 1)) - 1
+
+    ############################################################
+    # Polar caps, with healpy's more accurate form within 0.01 
+    # radians of the poles
+    ############################################################
+    polar = ~equatorial
+
+    ntt = np.minimum(tt[polar].astype(np.int64), 3)
+    tp = tt[polar] - ntt
+
+    near_pole = (theta[polar] < 0.01) | (theta[polar] > 3.14159 - 0.01)
+
+    with np.errstate(invalid='ignore'):
+        tmp = np.where(near_pole & (za[polar] >= 0.99), 
+                       nside*np.sin(theta[polar])/np.sqrt((1. + za[polar])/3.), 
+                       nside*np.sqrt(3*(1 - za[polar])))
+
+    jp = np.minimum((tp*tmp).astype(np.int64), nside - 1)
+    jm = np.minimum(((1.0 - tp)*tmp).astype(np.int64), nside - 1)
+
+    north = z[polar] >= 0
+
+    face[polar] = np.where(north, ntt, ntt + 8)
+    ix[polar] = np.where(north, nside - jm - 1, jp)
+    iy[polar] = np.where(north, nside - jp - 1, jm)
+
+    return (face << (2*order)) + spread_bits(ix) + (spread_bits(iy) << 1)
+
+
+def spread_bits(x):
+    '''
+    Move bit i of each of the (N,) int64 x (less than 2**32) to bit 2i.
+    '''
+
+    x = (x | (x << 16)) & 0x0000FFFF0000FFFF
+    x = (x | (x << 8)) & 0x00FF00FF00FF00FF
+    x = (x | (x << 4)) & 0x0F0F0F0F0F0F0F0F
+    x = (x | (x << 2)) & 0x3333333333333333
+    x = (x | (x << 1)) & 0x5555555555555555
+
+    return x
+
+
+################################################################################
+################################################################################
+
+class HealpixMask(object):
+    '''
+    Description:
+    ============
+    
+    Survey footprint as the sorted list of the NESTED HEALPix pixels it 
+    covers, an alternative to the (360*n, 180*n) boolean ra-dec array of 
+    build_mask.  Its memory scales with the area of the footprint rather than
+    with the whole sky, and its pixels all have the same area, where the 
+    ra-dec pixels shrink towards the poles.  not_in_mask, in_mask and 
+    points_in_mask (and so vflag and volume_cut) take one in place of the 
+    ra-dec array, and look the points up with ang2pix_nest and a binary 
+    search.  The hole growth kernel still works on an ra-dec array, made 
+    with to_ra_dec_mask.
+    
+    
+    Parameters:
+    ===========
+    
+    nside : integer
+        HEALPix resolution parameter, a power of 2
+        
+    pixels : numpy.ndarray of shape (N,)
+        NESTED indices of the pixels in the footprint, in any order
+    '''
+
+    def __init__(self, nside, pixels):
+
+        nside = int(nside)
+
+        if nside < 1 or nside & (nside - 1):
+            raise ValueError("nside must be a power of 2, not " + repr(nside))
+
+        self.nside = nside
+
+        self.pixels = np.unique(np.asarray(pixels, dtype=np.int64))
+
+
+    @classmethod
+    def from_ra_dec(cls, ra, dec, nside):
+        '''
+        Footprint of the pixels holding at least one of the (N,) ra, dec in 
+        degrees.
+        '''
+
+        return cls(nside, ang2pix_nest(nside, ra, dec))
+
+
+    def contains(self, ra, dec):
+        '''
+        True for each of the ra, dec (in degrees) in the footprint.
+        '''
+
+        ipix = ang2pix_nest(self.nside, ra, dec)
+
+        idx = np.minimum(np.searchsorted(self.pixels, ipix), self.pixels.shape[0] - 1)
+
+        return (self.pixels.shape[0] > 0) & (self.pixels[idx] == ipix)
+
+
+    def to_ra_dec_mask(self, n):
+        '''
+        The (360*n, 180*n) boolean ra-dec array of build_mask, each pixel 
+        set by whether its center is in the footprint.
+        '''
+
+        ra = (np.arange(maskra*n) + 0.5)/n
+        dec = (np.arange(maskdec*n) + 0.5)/n + dec_offset
+
+        ra, dec = np.meshgrid(ra, dec, indexing='ij')
+
+        return self.contains(ra.ravel(), dec.ravel()).reshape(ra.shape)
+
+
 ################################################################################
 ################################################################################
 
@@ -216,10 +424,13 @@ def in_mask(coordinates, survey_mask, n, r_limits):
     ra[boolean_ra180] += 180.
     ra[ra < 0] += 360.
 
-    angood = []
-    for i in range(len(ra)):
-        
-        angood.append( survey_mask[ int(n*ra[i]), int(n*dec[i]) - n*dec_offset])
+    if isinstance(survey_mask, HealpixMask):
+        angood = survey_mask.contains(ra, dec)
+    else:
+        angood = []
+        for i in range(len(ra)):
+            
+            angood.append( survey_mask[ int(n*ra[i]), int(n*dec[i]) - n*dec_offset])
         
         
     good = np.logical_and.reduce((np.array(angood), r <= r_limits[1], r >= r_limits[0]))
@@ -241,7 +452,8 @@ def not_in_mask(coordinates, survey_mask_ra_dec, n, rmin, rmax):
     survey_mask_ra_dec : numpy.ndarray of shape (num_ra, num_dec) where 
         the element at [i,j] represents whether or not the ra corresponding to
         i and the dec corresponding to j fall within the mask.  ra and dec
-        are both measured in degrees.
+        are both measured in degrees.  May also be a HealpixMask, in which
+        case n is not used.
 
     n : integer
         Scale factor of coordinates in mask
@@ -269,11 +481,660 @@ def not_in_mask(coordinates, survey_mask_ra_dec, n, rmin, rmax):
     if ra < 0:
         ra += 360
 
+    if isinstance(survey_mask_ra_dec, HealpixMask):
+        return not survey_mask_ra_dec.contains([ra], [dec])[0]
+
     return not survey_mask_ra_dec[int(n*ra), int(n*dec) - n*dec_offset]
 
 
 
 
+def points_in_mask(points, survey_mask_ra_dec, n, rmin, rmax):
+    '''
+    Determine which of a set of coordinates fall within the survey.  Array 
+    version of not_in_mask, with the opposite sense.
+
+    Parameters:
+    ============
+
+    points : numpy.ndarray of shape (N,3), in x-y-z order and cartesian 
+        coordinates.  x,y, and z are measured in Mpc/h
+
+    survey_mask_ra_dec : numpy.ndarray of shape (num_ra, num_dec) where 
+        the element at [i,j] represents whether or not the ra corresponding to
+        i and the dec corresponding to j fall within the mask.  ra and dec
+        are both measured in degrees.  May also be a HealpixMask, in which
+        case n is not used.
+
+    n : integer
+        Scale factor of coordinates in mask
+
+    rmin, rmax : scalar, min and max values of survey distance in units of
+        Mpc/h
+
+    Returns:
+    ========
+
+    in_mask : numpy.ndarray of shape (N,) of bool, True where the 
+        coordinates fall within the survey
+    '''
+
+    r = np.linalg.norm(points, axis=1)
+
+    in_mask = (r >= rmin) & (r <= rmax)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+
+        ra = np.arctan(points[in_mask,1]/points[in_mask,0])*RtoD
+        dec = np.arcsin(points[in_mask,2]/r[in_mask])*RtoD
+
+    ra[(points[in_mask,0] < 0) & (points[in_mask,1] != 0)] += 180
+    ra[ra < 0] += 360
+
+    if isinstance(survey_mask_ra_dec, HealpixMask):
+        in_mask[in_mask] = survey_mask_ra_dec.contains(ra, dec)
+        return in_mask
+
+    ra_idx = np.clip((n*ra).astype(int), 0, survey_mask_ra_dec.shape[0] - 1)
+    dec_idx = np.clip((n*dec).astype(int) - n*dec_offset, 0, survey_mask_ra_dec.shape[1] - 1)
+
+    in_mask[in_mask] = survey_mask_ra_dec[ra_idx, dec_idx].astype(bool)
+
+    return in_mask
+
+
+
+
+
+
+################################################################################
+################################################################################
+
+class SurveyVoxelGrid(object):
+    '''
+    Description:
+    ============
+    
+    Cubic voxels covering the survey volume, each marked as lying entirely 
+    inside the survey (INSIDE), entirely outside it (OUTSIDE), or neither 
+    (BOUNDARY).  A point in an INSIDE or OUTSIDE voxel is answered with one 
+    array lookup instead of the sqrt, atan and asin of not_in_mask, and only
+    the points in BOUNDARY voxels (or outside the grid) need the angular 
+    test.  Built with build_survey_voxels().
+    
+    
+    Parameters:
+    ===========
+    
+    states : numpy.ndarray of shape (L,M,N) of uint8
+        OUTSIDE, INSIDE or BOUNDARY for each voxel, C-contiguous
+        
+    origin : numpy.ndarray of shape (3,)
+        x,y,z of the lower corner of voxel (0,0,0) in Mpc/h
+        
+    voxel_size : float
+        length of the side of each voxel in Mpc/h
+    '''
+    
+    OUTSIDE = 0
+    
+    INSIDE = 1
+    
+    BOUNDARY = 2
+    
+    def __init__(self, states, origin, voxel_size):
+        
+        self.states = np.ascontiguousarray(states, dtype=np.uint8)
+        
+        self.origin = np.asarray(origin, dtype=np.float64).reshape(3)
+        
+        self.voxel_size = float(voxel_size)
+        
+        
+    def lookup(self, points):
+        '''
+        State of the voxel holding each of the (N,3) points, BOUNDARY for 
+        points outside the grid.
+        '''
+        
+        scaled = (points - self.origin)/self.voxel_size
+        
+        in_grid = np.all((scaled >= 0) & (scaled < self.states.shape), axis=1)
+        
+        states = np.full(points.shape[0], self.BOUNDARY, dtype=np.uint8)
+        
+        voxel_idx = scaled[in_grid].astype(np.intp)
+        
+        states[in_grid] = self.states[tuple(voxel_idx.T)]
+        
+        return states
+    
+    
+    def points_in_survey(self, points, mask, mask_resolution, rmin, rmax):
+        '''
+        Array version of the voxel lookup, with the same answers as 
+        points_in_mask: the points in BOUNDARY voxels go through 
+        points_in_mask.
+        '''
+        
+        states = self.lookup(points)
+        
+        in_survey = states == self.INSIDE
+        
+        boundary = states == self.BOUNDARY
+        
+        in_survey[boundary] = points_in_mask(points[boundary], mask, mask_resolution, rmin, rmax)
+        
+        return in_survey
+    
+    
+    
+
+def survey_bounding_box(survey_mask_ra_dec, n, rmin, rmax):
+    '''
+    Description:
+    ============
+    
+    Bounding box in x,y,z of the part of the survey within rmin and rmax of 
+    the observer, from the directions covered by the pixels in the mask.  
+    Each pixel is bounded on its own, from the extremes of the cosine and 
+    sine of its right ascension and declination ranges, so the box is 
+    exact up to rounding.  The pixels on the edges of the declination range 
+    of the mask are taken to reach the poles (and those on the last right 
+    ascension to reach 360 degrees), since the angular test clips the 
+    angles beyond the mask to them.
+    
+    
+    Parameters:
+    ===========
+    
+    survey_mask_ra_dec : numpy.ndarray of shape (num_ra, num_dec)
+        the survey mask, as for not_in_mask
+        
+    n : integer
+        Scale factor of coordinates in mask
+        
+    rmin, rmax : scalar
+        min and max values of survey distance in units of Mpc/h
+        
+        
+    Returns:
+    ========
+    
+    lower, upper : numpy.ndarray of shape (3,)
+        corners of the box in Mpc/h, both 0 if the mask is empty
+    '''
+    
+    mask = np.asarray(survey_mask_ra_dec).astype(bool)
+    
+    ra_idx, dec_idx = np.nonzero(mask)
+    
+    if ra_idx.shape[0] == 0:
+        
+        return np.zeros(3), np.zeros(3)
+    
+    ra_lo = ra_idx/n
+    
+    ra_hi = np.where(ra_idx == mask.shape[0] - 1, 360., (ra_idx + 1)/n)
+    
+    dec_lo = np.where(dec_idx == 0, -90., dec_idx/n + dec_offset)
+    
+    dec_hi = np.where(dec_idx == mask.shape[1] - 1, 90., (dec_idx + 1)/n + dec_offset)
+    
+    def angle_range(function, lo, hi, peak):
+        '''
+        Range of function (cos or sin) over the angles from lo to hi 
+        degrees, whose maximum is at peak and minimum at peak + 180.
+        '''
+        
+        ends = np.stack((function(np.radians(lo)), function(np.radians(hi))))
+        
+        def reaches(angle):
+            
+            return np.floor((hi - angle)/360) >= np.ceil((lo - angle)/360)
+        
+        return np.where(reaches(peak + 180), -1., ends.min(axis=0)), \
+               np.where(reaches(peak), 1., ends.max(axis=0))
+    
+    def product_range(a, b):
+        
+        products = np.stack([a_end*b_end for a_end in a for b_end in b])
+        
+        return products.min(axis=0), products.max(axis=0)
+    
+    cos_dec = angle_range(np.cos, dec_lo, dec_hi, 0.)
+    
+    ############################################################
+    # Range of each component of the unit vectors of the pixel,
+    # then of its points between rmin and rmax
+    ############################################################
+    unit_ranges = [product_range(cos_dec, angle_range(np.cos, ra_lo, ra_hi, 0.)),
+                   product_range(cos_dec, angle_range(np.sin, ra_lo, ra_hi, 90.)),
+                   angle_range(np.sin, dec_lo, dec_hi, 90.)]
+    
+    lower = np.array([np.minimum(rmin*unit_lo, rmax*unit_lo).min() for unit_lo, unit_hi in unit_ranges])
+    
+    upper = np.array([np.maximum(rmin*unit_hi, rmax*unit_hi).max() for unit_lo, unit_hi in unit_ranges])
+    
+    return lower, upper
+    
+    
+    
+
+def survey_voxel_extent(survey_mask_ra_dec, n, rmin, rmax, voxel_size, max_voxels):
+    '''
+    Origin and shape of the voxels of side voxel_size covering the bounding 
+    box of the survey (see survey_bounding_box) with a margin of one voxel, 
+    on the lattice of the cube of side 2*rmax centered on the observer.  
+    Raises a ValueError if there would be more than max_voxels of them.
+    '''
+    
+    num_cube_voxels = int(np.ceil(2*rmax/voxel_size))
+    
+    cube_origin = -0.5*num_cube_voxels*voxel_size
+    
+    lower, upper = survey_bounding_box(survey_mask_ra_dec, n, rmin, rmax)
+    
+    idx_lower = np.clip(np.floor((lower - cube_origin)/voxel_size).astype(np.int64) - 1, 0, num_cube_voxels - 1)
+    
+    idx_upper = np.clip(np.ceil((upper - cube_origin)/voxel_size).astype(np.int64) + 1, idx_lower + 1, num_cube_voxels)
+    
+    shape = idx_upper - idx_lower
+    
+    if np.prod(shape) > max_voxels:
+        
+        raise ValueError("The survey needs " + str(tuple(shape)) + " voxels of side " + str(voxel_size) \
+                         + " Mpc/h, more than max_voxels = " + str(max_voxels) + "; use larger voxels")
+    
+    return cube_origin + idx_lower*voxel_size, tuple(shape)
+    
+    
+    
+
+def build_survey_voxels(survey_mask_ra_dec, n, rmin, rmax, voxel_size, geometric=False, max_voxels=2**30):
+    '''
+    Description:
+    ============
+    
+    Build the SurveyVoxelGrid of the survey within rmax of the observer, 
+    with voxels of side voxel_size.  The grid only covers the bounding box 
+    of the survey (see survey_voxel_extent), and takes one byte per voxel,
+    so a narrow survey does not pay for the whole sphere of radius rmax.  
+    Points outside the grid are BOUNDARY, and are answered by the angular 
+    test.
+    
+    A voxel is only marked INSIDE or OUTSIDE if the angular test 
+    (not_in_mask) gives that answer for every point which can land in it, 
+    so looking it up never changes an answer.  For a voxel which does not 
+    cross the x=0 or y=0 planes the right ascension is extreme at a corner 
+    of its x-y rectangle, and the declination at its highest or lowest z 
+    and its nearest or farthest x-y distance, which bounds the block of 
+    mask pixels it can fall in.  The voxel is padded slightly, and the 
+    angles widened by 1e-5 degrees, to cover rounding in the lookup and in 
+    the angular test.  Voxels crossing the x=0 or y=0 planes (where the 
+    angular test switches quadrant) are left as BOUNDARY unless they are 
+    outside the radial limits.
+    
+    With geometric=True the voxels crossing those planes are classified too,
+    from the pixels their directions actually cover (two blocks of right 
+    ascension for those around ra = 0, all of it for those around the z 
+    axis).  The classification is then that of the survey region itself, 
+    and may disagree with not_in_mask for points lying exactly on the 
+    planes, where its right ascension is off by 180 degrees.
+    
+    
+    Parameters:
+    ===========
+    
+    survey_mask_ra_dec : numpy.ndarray of shape (num_ra, num_dec)
+        the survey mask, as for not_in_mask
+        
+    n : integer
+        Scale factor of coordinates in mask
+        
+    rmin, rmax : scalar
+        min and max values of survey distance in units of Mpc/h
+        
+    voxel_size : float
+        length of the side of each voxel in Mpc/h
+        
+    geometric : boolean
+        classify the voxels crossing the x=0 and y=0 planes too.  Default is
+        False.
+        
+    max_voxels : integer
+        Largest number of voxels to build; a ValueError is raised before 
+        allocating more.  Default is 2**30.
+        
+        
+    Returns:
+    ========
+    
+    survey_voxels : SurveyVoxelGrid
+    '''
+    
+    origin, shape = survey_voxel_extent(survey_mask_ra_dec, n, rmin, rmax, voxel_size, max_voxels)
+    
+    pad = 1e-6*voxel_size
+    
+    margin = 1e-5
+    
+    ############################################################
+    # Padded extent of the voxels along each axis, and the 
+    # smallest and largest absolute coordinate in them
+    ############################################################
+    lower = [origin[dim] + np.arange(shape[dim])*voxel_size - pad for dim in range(3)]
+    
+    upper = [lower[dim] + voxel_size + 2*pad for dim in range(3)]
+    
+    crosses_zero = [(lower[dim] <= 0) & (upper[dim] >= 0) for dim in range(3)]
+    
+    abs_min = [np.where(crosses_zero[dim], 0., np.minimum(np.abs(lower[dim]), np.abs(upper[dim]))) for dim in range(3)]
+    
+    abs_max = [np.maximum(np.abs(lower[dim]), np.abs(upper[dim])) for dim in range(3)]
+    
+    ############################################################
+    # Mask pixel counts over any block of pixels, from its 
+    # summed-area table
+    ############################################################
+    mask = np.asarray(survey_mask_ra_dec).astype(bool)
+    
+    summed = np.zeros((mask.shape[0] + 1, mask.shape[1] + 1), dtype=np.int64)
+    
+    summed[1:,1:] = np.cumsum(np.cumsum(mask, axis=0), axis=1)
+    
+    ############################################################
+    # Right ascension pixels and x-y distance range of each 
+    # column of voxels
+    ############################################################
+    ra_corners = np.stack([np.degrees(np.arctan2(y[None,:], x[:,None])) % 360 
+                           for x in (lower[0], upper[0]) for y in (lower[1], upper[1])])
+    
+    ra_idx_min = np.floor(n*(ra_corners.min(axis=0) - margin)).astype(np.int64)
+    
+    ra_idx_max = np.floor(n*(ra_corners.max(axis=0) + margin)).astype(np.int64)
+    
+    column_ok = ~crosses_zero[0][:,None] & ~crosses_zero[1][None,:] & (ra_idx_min >= 0) & (ra_idx_max < mask.shape[0])
+    
+    ra_idx_min = np.clip(ra_idx_min, 0, mask.shape[0] - 1)
+    
+    ra_idx_max = np.clip(ra_idx_max, 0, mask.shape[0] - 1)
+    
+    ############################################################
+    # A second block of right ascension pixels [wrap_lo, 
+    # wrap_hi), empty unless the column wraps around ra = 0
+    ############################################################
+    wrap_lo = np.zeros_like(ra_idx_min)
+    
+    wrap_hi = np.zeros_like(ra_idx_min)
+    
+    if geometric:
+        
+        on_axis = crosses_zero[0][:,None] & crosses_zero[1][None,:]
+        
+        wraps = (lower[0][:,None] > 0) & crosses_zero[1][None,:]
+        
+        ra_below = np.where(ra_corners < 180, ra_corners, -np.inf).max(axis=0)
+        
+        ra_above = np.where(ra_corners >= 180, ra_corners, np.inf).min(axis=0)
+        
+        ra_idx_min[wraps | on_axis] = 0
+        
+        ra_idx_max[wraps] = np.clip(np.floor(n*(ra_below[wraps] + margin)), 0, mask.shape[0] - 1)
+        
+        ra_idx_max[on_axis] = mask.shape[0] - 1
+        
+        wrap_lo[wraps] = np.clip(np.floor(n*(ra_above[wraps] - margin)), 0, mask.shape[0] - 1)
+        
+        wrap_hi[wraps] = mask.shape[0]
+        
+        column_ok[:] = True
+        
+    def count_in_mask(ra_lo, ra_hi, dec_lo, dec_hi):
+        
+        return summed[ra_hi, dec_hi] - summed[ra_lo, dec_hi] - summed[ra_hi, dec_lo] + summed[ra_lo, dec_lo]
+    
+    rho_min = np.hypot(abs_min[0][:,None], abs_min[1][None,:])
+    
+    rho_max = np.hypot(abs_max[0][:,None], abs_max[1][None,:])
+    
+    r_sq_min_xy = abs_min[0][:,None]**2 + abs_min[1][None,:]**2
+    
+    r_sq_max_xy = abs_max[0][:,None]**2 + abs_max[1][None,:]**2
+    
+    states = np.empty(shape, dtype=np.uint8)
+    
+    for i in range(shape[0]):
+        
+        ############################################################
+        # Declination pixels of each voxel of the slab, from the 
+        # extreme elevations of its z range over its x-y distance 
+        # range
+        ############################################################
+        with np.errstate(divide='ignore', invalid='ignore'):
+            
+            dec_max = np.degrees(np.where(upper[2][None,:] >= 0, 
+                                          np.arctan2(upper[2][None,:], rho_min[i][:,None]), 
+                                          np.arctan2(upper[2][None,:], rho_max[i][:,None])))
+            
+            dec_min = np.degrees(np.where(lower[2][None,:] >= 0, 
+                                          np.arctan2(lower[2][None,:], rho_max[i][:,None]), 
+                                          np.arctan2(lower[2][None,:], rho_min[i][:,None])))
+        
+        dec_idx_min = np.trunc(n*(dec_min - margin)).astype(np.int64) - int(n*dec_offset)
+        
+        dec_idx_max = np.trunc(n*(dec_max + margin)).astype(np.int64) - int(n*dec_offset)
+        
+        angular_ok = column_ok[i][:,None] & (geometric | ((dec_idx_min >= 0) & (dec_idx_max < mask.shape[1])))
+        
+        dec_idx_min = np.clip(dec_idx_min, 0, mask.shape[1] - 1)
+        
+        dec_idx_max = np.clip(dec_idx_max, 0, mask.shape[1] - 1)
+        
+        ra_lo = ra_idx_min[i][:,None]
+        
+        ra_hi = ra_idx_max[i][:,None] + 1
+        
+        num_in_mask = count_in_mask(ra_lo, ra_hi, dec_idx_min, dec_idx_max + 1) \
+                      + count_in_mask(wrap_lo[i][:,None], wrap_hi[i][:,None], dec_idx_min, dec_idx_max + 1)
+        
+        num_pixels = (ra_hi - ra_lo + wrap_hi[i][:,None] - wrap_lo[i][:,None])*(dec_idx_max + 1 - dec_idx_min)
+        
+        ############################################################
+        # Radial limits, with a relative margin for the rounding of
+        # the squared distance
+        ############################################################
+        r_sq_min = r_sq_min_xy[i][:,None] + abs_min[2][None,:]**2
+        
+        r_sq_max = r_sq_max_xy[i][:,None] + abs_max[2][None,:]**2
+        
+        radial_inside = (r_sq_min >= rmin*rmin*(1 + 1e-9)) & (r_sq_max <= rmax*rmax*(1 - 1e-9))
+        
+        radial_outside = (r_sq_max < rmin*rmin*(1 - 1e-9)) | (r_sq_min > rmax*rmax*(1 + 1e-9))
+        
+        slab = np.full(shape[1:], SurveyVoxelGrid.BOUNDARY, dtype=np.uint8)
+        
+        slab[radial_outside | (angular_ok & (num_in_mask == 0))] = SurveyVoxelGrid.OUTSIDE
+        
+        slab[radial_inside & angular_ok & (num_in_mask == num_pixels)] = SurveyVoxelGrid.INSIDE
+        
+        states[i] = slab
+        
+    return SurveyVoxelGrid(states, origin, voxel_size)
+
+
+
+
+################################################################################
+################################################################################
+
+class SurveyDistanceField(object):
+    '''
+    Description:
+    ============
+    
+    Signed distance from each voxel of a grid over the survey to the edge of 
+    the survey: positive inside, negative outside.  Each value is a lower 
+    bound on the distance from any point of its voxel to the other side of 
+    the edge, and 0 where the voxel straddles the edge, so that
+    
+        distance(point) > R
+        
+    means that the whole sphere of radius R around the point is inside the 
+    survey with one lookup and one comparison.  Built with 
+    build_survey_distance_field().
+    
+    
+    Parameters:
+    ===========
+    
+    distances : numpy.ndarray of shape (L,M,N) of float32
+        signed distance in Mpc/h for each voxel
+        
+    origin : numpy.ndarray of shape (3,)
+        x,y,z of the lower corner of voxel (0,0,0) in Mpc/h
+        
+    voxel_size : float
+        length of the side of each voxel in Mpc/h
+        
+    rmax : float
+        maximum distance of the survey in Mpc/h, to bound the distance of 
+        points outside the grid
+        
+    The grid must cover the whole survey, so that points outside it are 
+    outside the survey by at least their distance to the grid.
+    '''
+    
+    def __init__(self, distances, origin, voxel_size, rmax):
+        
+        self.distances = np.ascontiguousarray(distances, dtype=np.float32)
+        
+        self.origin = np.asarray(origin, dtype=np.float64).reshape(3)
+        
+        self.voxel_size = float(voxel_size)
+        
+        self.rmax = float(rmax)
+        
+        
+    def distance(self, points):
+        '''
+        Signed distance to the survey edge of each of the (N,3) points, 
+        rounded towards 0.  Points outside the grid are outside the survey 
+        by at least their distance to the grid, and by at least r - rmax.
+        '''
+        
+        scaled = (points - self.origin)/self.voxel_size
+        
+        in_grid = np.all((scaled >= 0) & (scaled < self.distances.shape), axis=1)
+        
+        grid_upper = self.origin + self.voxel_size*np.array(self.distances.shape)
+        
+        to_grid = np.linalg.norm(np.maximum(np.maximum(self.origin - points, points - grid_upper), 0.), axis=1)
+        
+        distances = -np.maximum(np.maximum(to_grid, np.linalg.norm(points, axis=1) - self.rmax), 0.)
+        
+        voxel_idx = scaled[in_grid].astype(np.intp)
+        
+        distances[in_grid] = self.distances[tuple(voxel_idx.T)]
+        
+        return distances
+    
+    
+    def spheres_inside(self, centers, radii):
+        '''
+        True for the spheres of the given (N,3) centers and (N,) radii which
+        are certainly entirely inside the survey.  False does not mean that 
+        a sphere sticks out, only that the field cannot tell.
+        '''
+        
+        return self.distance(centers) > radii
+    
+    
+    
+
+def build_survey_distance_field(survey_mask_ra_dec, n, rmin, rmax, voxel_size, max_voxels=2**27):
+    '''
+    Description:
+    ============
+    
+    Build the SurveyDistanceField of the survey within rmax of the observer,
+    with voxels of side voxel_size.
+    
+    The voxels entirely inside and entirely outside the survey come from 
+    build_survey_voxels(geometric=True).  Everything outside the survey lies
+    in the voxels which are not entirely inside it, so the distance from any
+    point of an inside voxel to the outside is at least the distance between
+    the boxes of that voxel and the nearest voxel which is not inside.  That
+    is at least the distance between their centers (from the Euclidean 
+    distance transform of the voxel states) less one voxel diagonal.  The 
+    same holds for the outside voxels and the distance to the inside.  The 
+    field is thus smaller than the true distance by up to about 
+    (1 + sqrt(3))*voxel_size, and decisions made with it never differ from
+    those of the angular test except for points exactly on the x=0 or y=0
+    planes (see build_survey_voxels).
+    
+    The grid covers the bounding box of the survey, like that of 
+    build_survey_voxels.  The distance transforms peak at about 30 bytes 
+    per voxel (their float64 output and scipy's int32 feature transform), 
+    so max_voxels is lower than for build_survey_voxels.
+    
+    
+    Parameters:
+    ===========
+    
+    survey_mask_ra_dec : numpy.ndarray of shape (num_ra, num_dec)
+        the survey mask, as for not_in_mask
+        
+    n : integer
+        Scale factor of coordinates in mask
+        
+    rmin, rmax : scalar
+        min and max values of survey distance in units of Mpc/h
+        
+    voxel_size : float
+        length of the side of each voxel in Mpc/h
+        
+    max_voxels : integer
+        Largest number of voxels to build; a ValueError is raised before 
+        allocating more.  Default is 2**27.
+        
+        
+    Returns:
+    ========
+    
+    distance_field : SurveyDistanceField
+    '''
+    
+    survey_voxels = build_survey_voxels(survey_mask_ra_dec, n, rmin, rmax, voxel_size, geometric=True, 
+                                        max_voxels=max_voxels)
+    
+    ############################################################
+    # Everything beyond the grid is outside, so pad the states 
+    # with a layer of outside voxels
+    ############################################################
+    states = np.pad(survey_voxels.states, 1, constant_values=SurveyVoxelGrid.OUTSIDE)
+    
+    distances = np.zeros(states.shape, dtype=np.float32)
+    
+    ############################################################
+    # One transform at a time, each value stepped one float32 
+    # ulp towards 0 after rounding, so that it stays a lower 
+    # bound
+    ############################################################
+    for state, sign in ((SurveyVoxelGrid.INSIDE, 1.), (SurveyVoxelGrid.OUTSIDE, -1.)):
+        
+        selected = states == state
+        
+        edt = ndimage.distance_transform_edt(selected)[selected]
+        
+        distances[selected] = np.nextafter((sign*voxel_size*np.maximum(edt - np.sqrt(3), 0.)).astype(np.float32), 
+                                           np.float32(0))
+        
+        del selected, edt
+    
+    return SurveyDistanceField(distances[1:-1,1:-1,1:-1], survey_voxels.origin, voxel_size, rmax)
+
+
 
 
 ################################################################################
@@ -3,6 +3,7 @@
 import numpy as np
 
 from .voidfinder_functions import in_mask
+from .table_functions import to_array
 from .hole_combine import spherical_cap_volume
 from astropy.table import Table
 
@@ -47,16 +48,27 @@ def check_coordinates(coord, direction, sign, survey_mask, mask_resolution, r_li
 
 
 
-def volume_cut(hole_table, survey_mask, mask_resolution, r_limits):
+def volume_cut(hole_table, survey_mask, mask_resolution, r_limits, distance_field=None):
 
-    xpos = max_range_check(Table(hole_table), 'x', '+', survey_mask, mask_resolution, r_limits)
-    xneg = max_range_check(Table(hole_table), 'x', '-', survey_mask, mask_resolution, r_limits)
+    # Holes whose whole sphere is inside the survey, by the distance field 
+    # (see SurveyDistanceField), keep all six points in the mask, so only the
+    # others near the edge are checked
+    edge_indices = np.arange(len(hole_table))
 
-    ypos = max_range_check(Table(hole_table), 'y', '+', survey_mask, mask_resolution, r_limits)
-    yneg = max_range_check(Table(hole_table), 'y', '-', survey_mask, mask_resolution, r_limits)
+    if distance_field is not None:
+        inside = distance_field.spheres_inside(to_array(hole_table), np.asarray(hole_table['radius']))
+        edge_indices = np.flatnonzero(~inside)
 
-    zpos = max_range_check(Table(hole_table), 'z', '+', survey_mask, mask_resolution, r_limits)
-    zneg = max_range_check(Table(hole_table), 'z', '-', survey_mask, mask_resolution, r_limits)
+    edge_table = hole_table[edge_indices]
+
+    xpos = max_range_check(Table(edge_table), 'x', '+', survey_mask, mask_resolution, r_limits)
+    xneg = max_range_check(Table(edge_table), 'x', '-', survey_mask, mask_resolution, r_limits)
+
+    ypos = max_range_check(Table(edge_table), 'y', '+', survey_mask, mask_resolution, r_limits)
+    yneg = max_range_check(Table(edge_table), 'y', '-', survey_mask, mask_resolution, r_limits)
+
+    zpos = max_range_check(Table(edge_table), 'z', '+', survey_mask, mask_resolution, r_limits)
+    zneg = max_range_check(Table(edge_table), 'z', '-', survey_mask, mask_resolution, r_limits)
 
 
     comb_bool = np.logical_and.reduce((xpos, xneg, ypos, yneg, zpos, zneg))
@@ -69,7 +81,7 @@ def volume_cut(hole_table, survey_mask, mask_resolution, r_limits):
 
         not_removed = True
 
-        coord = hole_table[i]
+        coord = edge_table[i]
 
         # Check x-direction 
 
@@ -126,7 +138,7 @@ def volume_cut(hole_table, survey_mask, mask_resolution, r_limits):
                 out_spheres_indices.append(i)
                 not_removed = False
     
-    out_spheres_indices = np.unique(out_spheres_indices)
+    out_spheres_indices = edge_indices[np.unique(np.array(out_spheres_indices, dtype=int))]
 
     hole_table.remove_rows(out_spheres_indices)
 